@@ -15,6 +15,7 @@
 # is hist['min'] + i
 
 from iceboot.test_waveform import parseTestWaveform
+from iceboot.adc_accumulator import ADCHistogramAccumulator
 from matplotlib import pyplot as plt
 import numpy as np
 import math
@@ -49,51 +50,38 @@ def plot_hist(hist, log_y=True):
 def make_sw_trig_histogram(session, channel, wfm_period=3,
                            n_waveforms=1000, blocksize=0):
     """ Acquires software triggered waveforms and returns an
-    ADC sample histogram dictionary """
+    ADC sample histogram dictionary
+
+    blocksize > 0 reads blocks of blocksize bytes and histograms
+    each block in one go
+    """
 
     session.startDEggSWTrigStream(channel, wfm_period)
 
-    total_counts = None
-    wfm = None
-    inputWfs = []
-    for _ in range(n_waveforms):
+    accumulator = ADCHistogramAccumulator(channel)
+    while accumulator.nWaveforms < n_waveforms:
         if blocksize == 0:
             # Read waveforms one-at-a-time
-            wfm = parseTestWaveform(session.readWFMFromStream())
+            accumulator.addBlock([parseTestWaveform(
+                session.readWFMFromStream())])
         else:
             # Read waveforms in blocks
-            if len(inputWfs) == 0:
-                inputWfs = session.readWFBlock(blocksize)
-                if len(inputWfs) == 0:
-                    raise RuntimeError("Read empty waveform block")
-            wfm = inputWfs.pop()
-
-        if wfm["channel"] != channel:
-            raise RuntimeError("Read a waveform from the wrong channel!")
-
-        # histogram the ADC samples from this waveform
-        wfm_counts = np.bincount(wfm["waveform"], minlength=(1 << 14))
-
-        # add this waveform's ADC histogram to the total histogram
-        if total_counts is None:
-            total_counts = wfm_counts
-        else:
-            total_counts += wfm_counts
+            blocks = session.readWFBlockArrays(blocksize)
+            if len(blocks) == 0:
+                raise RuntimeError("Read empty waveform block")
+            for block in blocks:
+                n_missing = n_waveforms - accumulator.nWaveforms
+                if n_missing <= 0:
+                    break
+                if len(block["waveform"]) > n_missing:
+                    block = dict(block)
+                    block["channel"] = block["channel"][:n_missing]
+                    block["waveform"] = block["waveform"][:n_missing]
+                accumulator.addBlock(block)
 
     session.endStream()
 
-    # prepare the histogram dictionary
-    nonzero_args = np.argwhere(total_counts > 0)
-    min_samp = nonzero_args[0][0]
-    max_samp = nonzero_args[-1][0]
-
-    histogram = {
-        "counts": total_counts[min_samp : max_samp + 1],
-        "min": min_samp,
-        "max": max_samp,
-    }
-
-    return histogram
+    return accumulator.toHistogram()
 
 
 def calculate_quantiles(hist):
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 
 from iceboot.iceboot_session import getParser, startIcebootSession
-from iceboot.test_waveform import writeWaveformFile
+from iceboot.test_waveform import writeWaveformFile, BINARY_WAVEFORM_EXTENSION
+from iceboot.waveform_file import WaveformFileWriter
 from optparse import OptionParser
 import sys
 
@@ -15,7 +16,12 @@ def main():
     parser.add_option("--samples", dest="samples", help="Number of samples "
                                "per waveform",  default=256)
     parser.add_option("--outputFile", dest="outputFile",
-                      help="Name of file to write", default=None)
+                      help="Name of file to write, waveforms are streamed "
+                           "to a binary file if it ends with %s" %
+                           BINARY_WAVEFORM_EXTENSION, default=None)
+    parser.add_option("--compress", dest="compress", action="store_true",
+                      help="Compress the binary waveform file",
+                      default=False)
     parser.add_option("--external", dest="external", action="store_true",
                       help="Use external trigger", default=False)
     parser.add_option("--threshold", dest="threshold",
@@ -44,19 +50,29 @@ def main():
 
     session.setDEggConstReadout(int(options.channel), 1, nSamples)
 
-    waveforms = []
-    while len(waveforms) < int(options.waveformCount):
-        if (options.external):
-            session.testDEggExternalTrig(int(options.channel))
-        elif options.threshold is None:
-            session.testDEggCPUTrig(int(options.channel))
-        else:
-            session.testDEggThresholdTrig(int(options.channel),
-                                          int(options.threshold))
-        readout = session.testDEggWaveformReadout()
-        if readout is not None:
-            waveforms.append(readout)
-    writeWaveformFile(waveforms, options.outputFile)
+    def readWaveforms():
+        nRead = 0
+        while nRead < int(options.waveformCount):
+            if (options.external):
+                session.testDEggExternalTrig(int(options.channel))
+            elif options.threshold is None:
+                session.testDEggCPUTrig(int(options.channel))
+            else:
+                session.testDEggThresholdTrig(int(options.channel),
+                                              int(options.threshold))
+            readout = session.testDEggWaveformReadout()
+            if readout is not None:
+                nRead += 1
+                yield readout
+
+    if options.outputFile.endswith(BINARY_WAVEFORM_EXTENSION):
+        # Stream to disk while recording
+        with WaveformFileWriter(options.outputFile,
+                                compress=options.compress) as writer:
+            for readout in readWaveforms():
+                writer.append(readout)
+    else:
+        writeWaveformFile(list(readWaveforms()), options.outputFile)
 
 
 if __name__ == "__main__":
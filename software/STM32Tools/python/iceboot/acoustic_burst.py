@@ -0,0 +1,176 @@
+''' Burst acquisition of the acoustic module
+
+setupBurst and setupReceiver send a whole configuration as one IceBoot
+command line (the set words, then AMallocWfBuffer and AMinitWfTimer
+for the transmitter) instead of one round trip per setting.
+
+iterBursts triggers and reads out several bursts per command line. For
+every burst the line holds the trigger word, a wait for the
+acquisition, the IRQ counter (the sample clock, used as the burst
+timestamp), the receiver status and the waveform data:
+
+    ARsendSWTrigger 10000 usleep ARgetIRQ_counter ARgetStatus
+    ARgetWaveformData ...
+
+The acoustic receiver has no binary waveform readout command, so the
+samples come back as text; the reply of a command line is converted
+to numpy arrays with a single np.array call.
+'''
+
+import time
+import numpy as np
+
+# Longest command line sent to IceBoot (see UnmodifiedMMB._sendData)
+MAX_CMD_LENGTH = 1000
+# Bit of ARgetStatus which is set when a waveform is ready
+STATUS_WAVEFORM_READY = 1 << 7
+MAX_FREQ_HZ = 40000
+
+
+def _checkRange(name, val, lo, hi):
+    if not lo <= val <= hi:
+        raise ValueError("%s must be between %d and %d, not %s" %
+                         (name, lo, hi, val))
+
+
+def setupBurst(session, mode=0, sineFreqHz=None, chirpMode=None,
+               chirpStartFreqHz=None, chirpStopFreqHz=None, nBurst=1,
+               durationMs=None, delayMs=None):
+    ''' Configures the transmitted waveform, allocates the waveform
+    buffer and initializes the waveform timer with one command.
+    Settings which are None are left as they are.
+
+    mode        0: sine, 1: chirp
+    chirpMode   0: linear, 1: logarithmic
+    '''
+    if mode not in [0, 1]:
+        raise ValueError("Mode must be either 0 (sine) or 1 (chirp).")
+    words = ["%d AMsetWfMode" % mode]
+    if chirpMode is not None:
+        if chirpMode not in [0, 1]:
+            raise ValueError("Chirp mode must be either 0 (linear) or "
+                             "1 (logarithmic).")
+        words.append("%d AMsetWfChirpMode" % chirpMode)
+    for name, val, word in [
+            ("Sine frequency", sineFreqHz, "AMsetWfSineFreqHz"),
+            ("Chirp start frequency", chirpStartFreqHz,
+             "AMsetWfChirpStartFreqHz"),
+            ("Chirp stop frequency", chirpStopFreqHz,
+             "AMsetWfChirpStopFreqHz")]:
+        if val is not None:
+            _checkRange(name, val, 0, MAX_FREQ_HZ)
+            words.append("%d %s" % (val, word))
+    if nBurst is not None:
+        words.append("%d AMsetWfNBurst" % nBurst)
+    if durationMs is not None:
+        _checkRange("Waveform duration [ms]", durationMs, 0, 999)
+        words.append("%d AMsetWfDurationMs" % durationMs)
+    if delayMs is not None:
+        words.append("%d AMsetWfDelayMs" % delayMs)
+    words += ["AMallocWfBuffer", "AMinitWfTimer"]
+    session.cmd(" ".join(words))
+
+
+def setupReceiver(session, gain=None, sampleIRQ=None, nSamples=None,
+                  pretrigger=None, triggerMean=None, triggerLevel=None,
+                  selfTrigger=None):
+    ''' Configures the acoustic receiver with one command. Settings which
+    are None are left as they are. Returns the number of samples per
+    waveform. '''
+    words = []
+    for name, val, lo, hi, word in [
+            ("Gain value", gain, 0, 255, "ARsetGain"),
+            ("Sample IRQ value", sampleIRQ, 0, 65536, "ARsetSample_irq"),
+            ("N samples", nSamples, 0, 65536, "ARsetWaveform_sample"),
+            ("Pretrigger samples", pretrigger, 0, 65536,
+             "ARsetPretrigger_sample"),
+            ("Trigger mean", triggerMean, 0, 4096, "ARsetTrigger_mean"),
+            ("Trigger level", triggerLevel, 0, 4096, "ARsetTrigger_level")]:
+        if val is not None:
+            _checkRange(name, val, lo, hi)
+            words.append("%d %s" % (val, word))
+    if selfTrigger is not None:
+        words.append("ARenableSelfTrigger" if selfTrigger
+                     else "ARdisableSelfTrigger")
+    words.append("ARgetWaveform_sample")
+    return int(session.cmd(" ".join(words)).split()[-1])
+
+
+def _burstCmd(nBursts, trigger, waitUs):
+    segment = "%s %d usleep ARgetIRQ_counter ARgetStatus ARgetWaveformData" \
+        % (trigger, waitUs)
+    cmd = " ".join([segment] * nBursts)
+    if len(cmd) > MAX_CMD_LENGTH:
+        raise ValueError("Command too long (%d bursts): %d characters" %
+                         (nBursts, len(cmd)))
+    return cmd
+
+
+def parseBurstReply(reply, nBursts, nSamples):
+    ''' Splits the reply of a burst command line into a dict of arrays:
+    samples (nBursts, nSamples), irqCounter, status and ready (nBursts,)
+    '''
+    try:
+        values = np.array(reply.split(), dtype=np.int64)
+    except ValueError:
+        raise IOError("Unexpected acoustic burst reply: %.80s" % reply)
+    if len(values) != nBursts * (nSamples + 2):
+        raise IOError("Expected %d values for %d bursts of %d samples, "
+                      "got %d" % (nBursts * (nSamples + 2), nBursts,
+                                  nSamples, len(values)))
+    values = values.reshape(nBursts, nSamples + 2)
+    status = values[:, 1]
+    return {"samples": values[:, 2:].astype(np.int16),
+            "irqCounter": values[:, 0],
+            "status": status,
+            "ready": (status & STATUS_WAVEFORM_READY) != 0}
+
+
+def iterBursts(session, nBursts, nSamples=None, burstsPerCmd=8,
+               trigger="ARsendSWTrigger", waitUs=10000):
+    ''' Triggers and reads out nBursts bursts, burstsPerCmd per command
+    line (see module doc). trigger is the IceBoot word that starts an
+    acquisition, e.g. ARsendHWTrigger or a transmit sequence. waitUs
+    has to cover the acquisition of one waveform.
+
+    Yields one dict of arrays per command line (see parseBurstReply)
+    with the host time [s] of the command added as hostTime.
+    '''
+    if nSamples is None:
+        nSamples = session.ARgetWaveformSample()
+    nDone = 0
+    while nDone < nBursts:
+        n = min(burstsPerCmd, nBursts - nDone)
+        cmd = _burstCmd(n, trigger, waitUs)
+        hostTime = time.time()
+        reply = session.cmd(cmd, timeout=1. + n * waitUs * 1e-6)
+        block = parseBurstReply(reply, n, nSamples)
+        block["hostTime"] = np.full(n, hostTime)
+        nDone += n
+        yield block
+
+
+def captureBursts(session, nBursts, fileName=None, attrs=None, **kwargs):
+    ''' Reads nBursts bursts (see iterBursts for kwargs) into one dict of
+    arrays, optionally saved as .npz with attrs '''
+    blocks = list(iterBursts(session, nBursts, **kwargs))
+    bursts = {key: np.concatenate([b[key] for b in blocks])
+              for key in blocks[0]}
+    if fileName is not None:
+        np.savez(fileName, **bursts, **(attrs if attrs is not None else {}))
+    return bursts
+
+
+def analyzeBursts(bursts, nPretrigger):
+    ''' Per burst baseline (mean of the pretrigger samples), noise (their
+    standard deviation), peak amplitude above the baseline and its sample
+    index, computed on the whole sample array '''
+    samples = np.asarray(bursts["samples"], dtype=np.float64)
+    pre = samples[:, :max(nPretrigger, 1)]
+    baseline = pre.mean(axis=1)
+    signal = np.abs(samples - baseline[:, np.newaxis])
+    peakIndex = np.argmax(signal, axis=1)
+    return {"baseline": baseline,
+            "noise": pre.std(axis=1),
+            "amplitude": signal[np.arange(len(samples)), peakIndex],
+            "peakIndex": peakIndex}
@@ -0,0 +1,219 @@
+''' Streaming accumulators for ADC sample and charge histograms
+
+The accumulators keep a persistent histogram and are fed whole blocks
+of waveforms at a time, so the per-waveform Python overhead is limited
+to the readout itself.  A block can be:
+
+ - a 2D array (nWaveforms, nSamples) of ADC samples
+ - a dict of arrays as returned by parseWaveformMatrix /
+   xDOM.readWFBlockArrays
+ - a list of waveform dicts as returned by parseTestWaveform /
+   readWFBlock / HitBufReader
+
+See DEggTest/adc_histogram.py and iceboot/charge_hist.py for example
+code using these classes
+'''
+
+import itertools
+import numpy as np
+
+ADC_BINS = 1 << 14
+
+ADC_TO_V = 2. / 16384.
+SAMPLING_RATE = 240e6
+TERMINATION_OHM = 50.
+PICOCOULOMB = 1e-12
+
+
+def adcToPicoCoulomb(adcSum):
+    ''' integrated ADC counts over 240 MSPS samples -> pC '''
+    return adcSum * ADC_TO_V / TERMINATION_OHM / SAMPLING_RATE / PICOCOULOMB
+
+
+def _blockToArrays(block, channel=None):
+    ''' returns a list of 2D sample arrays for a block
+
+    A bare sample array carries no channel, so it can not be checked
+    against channel; pass the dict of arrays to have it checked.
+    '''
+    if isinstance(block, np.ndarray):
+        if block.ndim == 1:
+            block = block[np.newaxis, :]
+        return [block]
+    if isinstance(block, dict):
+        if channel is not None and \
+                np.any(np.asarray(block['channel']) != channel):
+            raise RuntimeError("Read a waveform from the wrong channel!")
+        return [np.asarray(block['waveform'])]
+
+    # list of waveform dicts, group equal-length waveforms
+    byLength = {}
+    for wfm in block:
+        if channel is not None and wfm['channel'] != channel:
+            raise RuntimeError("Read a waveform from the wrong channel!")
+        byLength.setdefault(len(wfm['waveform']), []).append(wfm['waveform'])
+    return [np.vstack(wfs) for wfs in byLength.values()]
+
+
+class _BlockAccumulator:
+    def addBlock(self, block):
+        raise NotImplementedError
+
+    def consume(self, source, nWaveforms=None, batchSize=1000):
+        ''' adds waveform dicts from an iterator (e.g. a HitBufReader)
+        in batches of batchSize '''
+        source = iter(source)
+        nRead = 0
+        while nWaveforms is None or nRead < nWaveforms:
+            n = batchSize
+            if nWaveforms is not None:
+                n = min(n, nWaveforms - nRead)
+            batch = list(itertools.islice(source, n))
+            if len(batch) == 0:
+                break
+            self.addBlock(batch)
+            nRead += len(batch)
+        return nRead
+
+
+class ADCHistogramAccumulator(_BlockAccumulator):
+    ''' Histogram of all ADC samples, updated in place per block
+
+    channel: if not None, blocks containing waveforms from other
+             channels raise a RuntimeError
+    '''
+    def __init__(self, channel=None, nBins=ADC_BINS):
+        self.channel = channel
+        self.nBins = nBins
+        self.counts = np.zeros(nBins, dtype=np.int64)
+        self.nWaveforms = 0
+
+    def reset(self):
+        self.counts[:] = 0
+        self.nWaveforms = 0
+
+    def addBlock(self, block):
+        for samples in _blockToArrays(block, self.channel):
+            self.counts += np.bincount(samples.ravel(),
+                                       minlength=self.nBins)[:self.nBins]
+            self.nWaveforms += len(samples)
+
+    @property
+    def nSamples(self):
+        return int(self.counts.sum())
+
+    def _binValues(self):
+        return np.arange(self.nBins)
+
+    def mean(self):
+        return np.average(self._binValues(), weights=self.counts)
+
+    def std(self):
+        mean = self.mean()
+        return np.sqrt(np.average((self._binValues() - mean) ** 2,
+                                  weights=self.counts))
+
+    def quantile(self, q):
+        ''' smallest ADC value x where p(ADC <= x) >= q, q may be an
+        array of quantiles '''
+        cdf = np.cumsum(self.counts)
+        total = cdf[-1]
+        if total == 0:
+            raise ValueError("Histogram is empty")
+        return np.searchsorted(cdf, np.asarray(q) * total, side='left')
+
+    def toHistogram(self):
+        ''' returns the histogram dictionary used in
+        DEggTest/adc_histogram.py '''
+        nonzero = np.flatnonzero(self.counts)
+        if len(nonzero) == 0:
+            raise ValueError("Histogram is empty")
+        minSamp = int(nonzero[0])
+        maxSamp = int(nonzero[-1])
+        return {
+            "counts": self.counts[minSamp:maxSamp + 1].copy(),
+            "min": minSamp,
+            "max": maxSamp,
+        }
+
+
+class ChargeHistogramAccumulator(_BlockAccumulator):
+    ''' Histogram of integrated charges in pC, updated per block
+
+    nbins, start, width: histogram binning in pC
+    gate:     (first, last) sample of a fixed integration window, or
+              None to integrate around the peak of each waveform
+    binsBeforePeak, binsAfterPeak: integration window around the peak
+              if gate is None
+    baseline: fixed baseline in ADC counts; if None the baseline of
+              each waveform is the mean of its first baselineSamples
+    '''
+    def __init__(self, nbins, start, width, gate=None, binsBeforePeak=2,
+                 binsAfterPeak=5, baseline=None, baselineSamples=16,
+                 channel=None, keepCharges=False):
+        self.nbins = nbins
+        self.start = start
+        self.width = width
+        self.edges = start + width * np.arange(nbins + 1)
+        self.gate = gate
+        self.binsBeforePeak = binsBeforePeak
+        self.binsAfterPeak = binsAfterPeak
+        self.baseline = baseline
+        self.baselineSamples = baselineSamples
+        self.channel = channel
+        self.hist = np.zeros(nbins, dtype=np.int64)
+        self.nWaveforms = 0
+        self._keepCharges = keepCharges
+        self._charges = []
+
+    def charges(self, samples):
+        ''' integrated charges in pC of a 2D sample array '''
+        samples = np.asarray(samples, dtype=np.float64)
+        if self.baseline is None:
+            baseline = samples[:, :self.baselineSamples].mean(axis=1)
+        else:
+            baseline = np.full(len(samples), float(self.baseline))
+        nSamples = samples.shape[1]
+
+        if self.gate is not None:
+            first, last = self.gate
+            adcSum = samples[:, first:last + 1].sum(axis=1)
+            nGate = len(range(nSamples)[first:last + 1])
+            adcSum = adcSum - nGate * baseline
+        else:
+            peak = (samples - baseline[:, np.newaxis]).argmax(axis=1)
+            offsets = np.arange(-self.binsBeforePeak, self.binsAfterPeak + 1)
+            idx = peak[:, np.newaxis] + offsets[np.newaxis, :]
+            inside = (idx >= 0) & (idx < nSamples)
+            window = np.take_along_axis(samples,
+                                        np.clip(idx, 0, nSamples - 1), axis=1)
+            window = window - baseline[:, np.newaxis]
+            adcSum = np.where(inside, window, 0.).sum(axis=1)
+        return adcToPicoCoulomb(adcSum)
+
+    def addBlock(self, block):
+        for samples in _blockToArrays(block, self.channel):
+            charges = self.charges(samples)
+            self.hist += np.histogram(charges, bins=self.edges)[0]
+            self.nWaveforms += len(samples)
+            if self._keepCharges:
+                self._charges.append(charges)
+
+    def allCharges(self):
+        if not self._keepCharges:
+            raise ValueError("Accumulator was created with keepCharges=False")
+        if len(self._charges) == 0:
+            return np.zeros(0)
+        return np.concatenate(self._charges)
+
+    def quantile(self, q):
+        ''' quantiles in pC, interpolated within the histogram bins '''
+        cdf = np.concatenate(([0], np.cumsum(self.hist)))
+        if cdf[-1] == 0:
+            raise ValueError("Histogram is empty")
+        return np.interp(np.asarray(q) * cdf[-1], cdf, self.edges)
+
+    def toHistogram(self):
+        ''' returns the histogram dictionary of iceboot/charge_hist.py '''
+        return {'hist': self.hist.copy(), 'nbins': self.nbins,
+                'min': self.start, 'width': self.width}
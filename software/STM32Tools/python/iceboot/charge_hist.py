@@ -1,4 +1,5 @@
 from .test_waveform import parseTestWaveform, waveformNWords
+from .adc_accumulator import ChargeHistogramAccumulator
 import sys
 import numpy as np
 import time
@@ -12,14 +13,16 @@ def make_hist(session,
               threshold_over_baseline,
               bins_before_peak,
               bins_after_peak,
-              enable_fepulser=True):
+              enable_fepulser=True,
+              blocksize=0,
+              gate=None):
+    """ blocksize > 0 takes data in threshold trigger stream mode and
+    reads blocks of blocksize bytes instead of triggering and reading
+    one waveform at a time.  gate=(first, last) integrates a fixed
+    sample window instead of the window around the peak """
     nSamples = 256
     nCounts = 1000
-    adc_to_v = lambda a: (2 * a) / (16384.)
-    v_to_c = lambda v: v/50./(240e6)
-    c_to_picoc = lambda c: c/1e-12
-    c_to_pe = lambda c: c/1.60217733e-19
-    
+
     session.setDEggConstReadout(channel, 1, nSamples)
     # measure baseline
     session.testDEggCPUTrig(channel)
@@ -30,26 +33,32 @@ def make_hist(session,
         print('Enabling FEPulser for channel {}'.format(channel))
         session.enableFEPulser(channel,2)
 
-    charges = []
+    accumulator = ChargeHistogramAccumulator(nbins, start, width,
+                                             gate=gate,
+                                             binsBeforePeak=bins_before_peak,
+                                             binsAfterPeak=bins_after_peak,
+                                             baseline=baseline,
+                                             channel=channel)
     thres = baseline+threshold_over_baseline
-    for _ in range(nCounts):
-        session.testDEggThresholdTrig(channel, int(thres))
-        readout = session.testDEggWaveformReadout()
-        wf = np.asarray(readout["waveform"])-baseline
-        ### DEBUG
-        # plt.plot(range(len(wf)), wf-baseline)
-        # plt.show()
-        ### END
-        charges.append(v_to_c(adc_to_v(
-            np.sum(wf[wf.argmax()-bins_before_peak:wf.argmax()+bins_after_peak+1]))))
-    ### DEBUG
-    # from matplotlib import pyplot as plt
-    # plt.figure()
-    # plt.hist(c_to_picoc(np.asarray(charges)), bins=nbins,
-    #          range=(start, start+width*nbins), histtype='step')
-    # plt.xlabel('pC')
-    # plt.show()
-    ## end
-    h, _ = np.histogram(c_to_picoc(np.asarray(charges)), bins=nbins,
-                        range=(start, start+width*nbins))
-    return {'hist':h, 'nbins':nbins, 'min':start, 'width':width}
+    if blocksize == 0:
+        waveforms = []
+        for _ in range(nCounts):
+            session.testDEggThresholdTrig(channel, int(thres))
+            waveforms.append(session.testDEggWaveformReadout()["waveform"])
+        accumulator.addBlock(np.vstack(waveforms))
+    else:
+        session.startDEggThreshTrigStream(channel, int(thres))
+        while accumulator.nWaveforms < nCounts:
+            blocks = session.readWFBlockArrays(blocksize)
+            if len(blocks) == 0:
+                raise RuntimeError("Read empty waveform block")
+            for block in blocks:
+                n_missing = nCounts - accumulator.nWaveforms
+                if n_missing > 0:
+                    # keep the channels, so that the accumulator can
+                    # reject waveforms of the other channel
+                    accumulator.addBlock(
+                        {"channel": block["channel"][:n_missing],
+                         "waveform": block["waveform"][:n_missing]})
+        session.endStream()
+    return accumulator.toHistogram()
@@ -1,5 +1,6 @@
 from .unmodified_mmb import UnmodifiedMMB
 from ..iceboot_comms import IceBootComms
+from .. import acoustic_burst
 
 AM_fb_adc_to_voltage = 1/9.1
 AM_FB_ADC_coeff_a = 1/9.1
@@ -79,7 +80,7 @@ class Acoustic(UnmodifiedMMB):
                 1: transmitter mode
         """
         out = self.cmd("AMgetTRstate")
-        return out
+        return int(out)
 
     """
     charge functions
@@ -586,6 +587,50 @@ class Acoustic(UnmodifiedMMB):
         out = self.cmd("ARgetWaveformData", timeout=3.0)
         return [int(s) for s in out.split()]
 
+    def AMsetupBurst(self, **kwargs) -> None:
+        """
+        Configure the transmitted waveform, allocate the waveform buffer
+        and initialize the waveform timer in one command, see
+        iceboot.acoustic_burst.setupBurst for the keyword arguments.
+
+            Returns:
+                None
+        """
+        acoustic_burst.setupBurst(self, **kwargs)
+
+    def ARsetupReceiver(self, **kwargs) -> int:
+        """
+        Configure the receiver in one command, see
+        iceboot.acoustic_burst.setupReceiver for the keyword arguments.
+
+            Returns:
+                n samples per waveform
+        """
+        return acoustic_burst.setupReceiver(self, **kwargs)
+
+    def ARiterBursts(self, nBursts, **kwargs):
+        """
+        Trigger and read out nBursts waveforms, several per command, see
+        iceboot.acoustic_burst.iterBursts for the keyword arguments.
+
+            Returns:
+                generator of dicts of arrays: samples, irqCounter,
+                status, ready, hostTime
+        """
+        return acoustic_burst.iterBursts(self, nBursts, **kwargs)
+
+    def ARcaptureBursts(self, nBursts, fileName=None, **kwargs) -> dict:
+        """
+        Read out nBursts waveforms into one dict of arrays (see
+        ARiterBursts), saved as .npz if fileName is given.
+
+            Returns:
+                dict of arrays: samples (nBursts, nSamples), irqCounter,
+                status, ready, hostTime
+        """
+        return acoustic_burst.captureBursts(self, nBursts,
+                                            fileName=fileName, **kwargs)
+
     def ARgetSerialNumber(self) -> list:
         """
         Get the serial number
@@ -3,6 +3,7 @@ import time
 import numpy as np
 
 from .unmodified_mmb import UnmodifiedMMB
+from ..pwm_scan import scanPWM
 
 
 class POCAM(UnmodifiedMMB):
@@ -362,17 +363,19 @@ class POCAM(UnmodifiedMMB):
         else:
             return self.pcmCmd(self.symbCmdADC(fpga, addr, rw, data))
 
-    def pwm(self, hv, val):
+    def pwm(self, hv, val, sleep=0.5):
         """
         Sets the HV PWM of a specific channel to a specific value.
 
             Keyword arguments:
                 hv      hv name of chain
                 val     value to set in [0, 65535]
+                sleep   time to wait after setting [s]
         """
         if 0 <= val <= 65535:
             self.pcmCmd(self.symbCmdVal(hv, val, 'pcmPWM'))
-            time.sleep(0.5)
+            if sleep > 0:
+                time.sleep(sleep)
         else:
             raise ValueError('PWM value must be between 0 and 65535.')
 
@@ -516,6 +519,25 @@ class POCAM(UnmodifiedMMB):
             print('\t%s: %i --> %.2fV' % (hv, val, v))
             time.sleep(wait)
 
+    def scan_pwm_adaptive(self, hvs, verbose=True, **kwargs):
+        """
+        Closed-loop scan of the HV PWM of one or several channels:
+        waits for the ADC read-back to settle instead of a fixed time
+        and refines the steps where the voltage changes quickly, see
+        iceboot.pwm_scan.scanPWM for the keyword arguments.
+        Returns {hv: PWMCurve}, PWMCurve.pwmFor(voltage) gives the
+        PWM value for a target voltage.
+
+        Keyword arguments:
+            hvs     name or list of names of hv channels
+            verbose print the scan points
+        """
+        for hv in ([hvs] if isinstance(hvs, str) else hvs):
+            if hv not in self.hv:
+                raise ValueError('Unknown HV channel %s, allowed: %s' %
+                                 (hv, list(self.hv)))
+        return scanPWM(self, hvs, verbose=verbose, **kwargs)
+
     @staticmethod
     def set_sensorAdc():
         """ placeholder?
@@ -5,6 +5,7 @@ import numpy as np
 from .xdevice import xDevice
 from ..iceboot_comms import IceBootComms
 from ..test_waveform import parseTestWaveform, waveformNWords
+from ..test_waveform import splitWaveformBlock, parseWaveformMatrix
 
 
 class xDOM(xDevice):
@@ -279,6 +280,14 @@ class xDOM(xDevice):
     def readWFBlock(self, nBytes: int=66000):
         return self._readWFBlockRaw(nBytes)
 
+    def readWFBlockArrays(self, nBytes: int=66000) -> list:
+        ''' like readWFBlock, but returns one dict of arrays per
+        waveform length (see parseWaveformMatrix) instead of one
+        dict per waveform '''
+        cmd = ("%d readDEggWfmBlock" % nBytes)
+        wfm_buff = self.comms.receiveRawCmd(cmd, nBytes, timeout=10)
+        return [parseWaveformMatrix(m) for m in splitWaveformBlock(wfm_buff)]
+
     @requiresLIDInterlock
     def testCameraSPI(self, cameraNumber: int, trials: int) -> int:
         cmdStr = "%d %d testCameraSPI .s drop" % (cameraNumber, trials)
@@ -19,8 +19,11 @@ def getParser():
     return parser
 
 
-def calibrateSession(session, baseline):
-    fitparams = dac_cal.calibrateDAC(session)
+def calibrateSession(session, baseline, fast=False):
+    if fast:
+        fitparams = dac_cal.calibrateDACFast(session)
+    else:
+        fitparams = dac_cal.calibrateDAC(session)
     for channel in fitparams:
         print("Calibrating channel {} to baseline of {}".format(channel,
                                                                 baseline))
@@ -49,7 +52,8 @@ def getIcebootSession(**kwargs):
     if session.isDEgg() or session.isPDOM():
         if session.fpgaVersion() != 0xFFFF:
             if options.setBaseline is not None:
-                calibrateSession(session, options.setBaseline)
+                calibrateSession(session, options.setBaseline,
+                                 fast=getattr(options, "fastDACCal", False))
     return session
 
 
@@ -24,6 +24,9 @@ def configureOptions(parser):
                       help="Print board I/O stdout")
     parser.add_option("--setBaseline", type=float,
                       help="Set ADC baseline")
+    parser.add_option("--fastDACCal", action="store_true", default=False,
+                      help="Set the ADC baseline with the adaptive, "
+                           "block readout DAC calibration")
     parser.add_option("--class_name",
                       help="Device class name, default: <probed>")
     parser.add_option("--baudRate", type=int, default=1000000,
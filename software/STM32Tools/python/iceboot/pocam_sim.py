@@ -0,0 +1,87 @@
+''' Simulated POCAM command responder
+
+SimulatedPOCAMComms stands in for the IceBootComms of a POCAM session,
+so that POCAM(SimulatedPOCAMComms()) can run PWM scans offline. Every
+command advances a simulated clock by cmdTime seconds; the voltage of
+each HV channel follows its target voltage with a first-order lag of
+time constant tau. The target voltage is a logistic function of the PWM
+value: flat at both ends, steep around pwm0.
+
+Only the commands of the PWM scan are understood, everything else is
+answered with "ERROR 1".
+'''
+
+import re
+import numpy as np
+
+# (vMin, vMax, pwm0, width) of the logistic voltage vs. PWM curve
+DEFAULT_CURVES = {
+    'lmg1':  (2., 60., 30000., 4000.),
+    'lmg2':  (2., 60., 34000., 5000.),
+    'sipm1': (20., 45., 25000., 3000.),
+    'sipm2': (20., 45., 28000., 3000.),
+    'kapu1': (0., 120., 40000., 6000.),
+    'kapu2': (0., 120., 38000., 6000.),
+}
+
+# Full scale of the simulated HV ADC [V] and its number of counts
+ADC_FULL_SCALE = 150.
+ADC_COUNTS = 4095
+
+_PWM_RE = re.compile(r'^s" (\w+)" (\d+) pcmPWM$')
+_ADC_RE = re.compile(r'^s" (\w+)" pcmADC$')
+
+
+class SimulatedPOCAMComms:
+    def __init__(self, curves=None, tau=0.2, cmdTime=0.01, noise=0.005,
+                 seed=0, softwareVersion=0x1234):
+        self.curves = dict(DEFAULT_CURVES if curves is None else curves)
+        self.tau = tau
+        self.cmdTime = cmdTime
+        self.noise = noise
+        self.rnd = np.random.RandomState(seed)
+        self.softwareVersion = softwareVersion
+        self.clock = 0.
+        self.pwm = {hv: 0 for hv in self.curves}
+        self.voltage = {hv: self.target(hv, 0) for hv in self.curves}
+        self.nCommands = 0
+        self.log = []
+
+    def target(self, hv, pwm):
+        vMin, vMax, pwm0, width = self.curves[hv]
+        return vMin + (vMax - vMin) / (1. + np.exp(-(pwm - pwm0) / width))
+
+    def _advance(self, dt):
+        decay = np.exp(-dt / self.tau) if self.tau > 0 else 0.
+        for hv in self.voltage:
+            target = self.target(hv, self.pwm[hv])
+            self.voltage[hv] = target + (self.voltage[hv] - target) * decay
+        self.clock += dt
+
+    def _adc(self, hv):
+        v = self.voltage[hv] + self.rnd.normal(0, self.noise)
+        raw = int(round(np.clip(v / ADC_FULL_SCALE, 0, 1) * ADC_COUNTS))
+        return 'OK %.4f %d' % (v, raw)
+
+    def cmd(self, cmdStr, timeout=1.0, strip_stack=False):
+        self.nCommands += 1
+        self.log.append(cmdStr)
+        self._advance(self.cmdTime)
+        if cmdStr == 'softwareVersion .s drop':
+            return str(self.softwareVersion)
+        if cmdStr == 'printSoftwareId':
+            return 'SimulatedPOCAM'
+        match = _PWM_RE.match(cmdStr)
+        if match and match.group(1) in self.curves:
+            val = int(match.group(2))
+            if val > 65535:
+                return 'ERROR 2'
+            self.pwm[match.group(1)] = val
+            return 'OK'
+        match = _ADC_RE.match(cmdStr)
+        if match and match.group(1) in self.curves:
+            return self._adc(match.group(1))
+        return 'ERROR 1'
+
+    def close(self):
+        pass
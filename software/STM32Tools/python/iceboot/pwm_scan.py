@@ -0,0 +1,200 @@
+''' Closed-loop scan of the POCAM HV PWM settings
+
+Instead of waiting a fixed time after every PWM step, the HV ADC of the
+channel is read back until the voltage has settled. The PWM values start
+on a coarse grid, intervals where the voltage changes by more than
+maxDeltaV are bisected. Several HV channels are scanned interleaved: in
+every round each channel gets its next PWM value and the read-backs of
+all channels alternate until all of them have settled.
+
+The result per channel is a PWMCurve with the measured points and an
+inverse lookup of the PWM value for a target voltage.
+
+See iceboot/pocam_sim.py for a simulated POCAM to run it against.
+'''
+
+import time
+import numpy as np
+
+PWM_MAX = 65535
+
+# Points of a PWMCurve, sorted by PWM value
+CURVE_DTYPE = np.dtype([
+    ("pwm", np.int32), ("voltage", np.float64), ("voltageRaw", np.float64),
+    ("settleTime", np.float64), ("nReads", np.int32), ("settled", np.bool_)])
+
+
+class PWMCurve:
+    ''' Voltage vs. PWM calibration curve of one HV channel '''
+    def __init__(self, hv, points):
+        self.hv = hv
+        self.points = np.sort(np.asarray(points, dtype=CURVE_DTYPE),
+                              order="pwm")
+
+    def __len__(self):
+        return len(self.points)
+
+    def voltage(self, pwm):
+        ''' voltage at pwm, interpolated linearly '''
+        return np.interp(pwm, self.points["pwm"], self.points["voltage"])
+
+    def _monotonic(self):
+        # (voltage, pwm) with increasing voltage, flat or reversed parts
+        # (e.g. saturation) are left out up to their point next to the
+        # rising part
+        v = self.points["voltage"]
+        pwm = self.points["pwm"]
+        if len(v) > 1 and v[-1] < v[0]:
+            v, pwm = v[::-1], pwm[::-1]
+        vMax = np.maximum.accumulate(v)
+        keep = np.concatenate([np.diff(vMax) > 0, [True]])
+        return vMax[keep], pwm[keep]
+
+    def pwmFor(self, voltage):
+        ''' PWM value that gives voltage, ValueError outside the range
+        of the curve '''
+        v, pwm = self._monotonic()
+        if len(v) < 2 or not (v[0] <= voltage <= v[-1]):
+            raise ValueError("%.3f V is outside of the range of %s "
+                             "(%.3f V - %.3f V)" % (voltage, self.hv,
+                                                   v[0], v[-1]))
+        return int(round(np.interp(voltage, v, pwm)))
+
+    def toDict(self):
+        return {"hv": self.hv,
+                **{name: self.points[name].tolist()
+                   for name in CURVE_DTYPE.names}}
+
+    @classmethod
+    def fromDict(cls, d):
+        points = np.zeros(len(d["pwm"]), dtype=CURVE_DTYPE)
+        for name in CURVE_DTYPE.names:
+            points[name] = d[name]
+        return cls(d["hv"], points)
+
+
+class _ChannelScan:
+    ''' PWM schedule and measured points of one HV channel '''
+    def __init__(self, hv, start, stop, nCoarse, minStep, maxDeltaV,
+                 maxPoints):
+        self.hv = hv
+        self.minStep = minStep
+        self.maxDeltaV = maxDeltaV
+        self.maxPoints = maxPoints
+        self.todo = sorted(set(int(round(p)) for p in
+                               np.linspace(start, stop, nCoarse)))
+        self.points = np.zeros(0, dtype=CURVE_DTYPE)
+        self.done = False
+
+    def nextPWM(self):
+        if not self.todo and not self.done:
+            self._refine()
+        if self.done or not self.todo:
+            self.done = True
+            return None
+        return self.todo.pop(0)
+
+    def addPoint(self, pwm, voltage, voltageRaw, settleTime, nReads,
+                 settled):
+        point = np.zeros(1, dtype=CURVE_DTYPE)
+        point["pwm"] = pwm
+        point["voltage"] = voltage
+        point["voltageRaw"] = voltageRaw
+        point["settleTime"] = settleTime
+        point["nReads"] = nReads
+        point["settled"] = settled
+        self.points = np.sort(np.concatenate([self.points, point]),
+                              order="pwm")
+
+    def _refine(self):
+        # bisect all intervals where the voltage changes too quickly
+        pwm = self.points["pwm"]
+        v = self.points["voltage"]
+        maxDeltaV = self.maxDeltaV
+        if maxDeltaV is None:
+            maxDeltaV = 0.02 * (v.max() - v.min())
+        steep = ((np.abs(np.diff(v)) > maxDeltaV) &
+                 (np.diff(pwm) >= 2 * self.minStep))
+        nFree = self.maxPoints - len(self.points)
+        self.todo = [int((pwm[i] + pwm[i + 1]) // 2)
+                     for i in np.flatnonzero(steep)][:max(nFree, 0)]
+        if not self.todo:
+            self.done = True
+
+    def curve(self):
+        return PWMCurve(self.hv, self.points)
+
+
+def _isSettled(voltages, nReads, tol, relTol):
+    if len(voltages) < nReads:
+        return False
+    last = voltages[-nReads:]
+    return (max(last) - min(last) <=
+            max(tol, relTol * abs(np.mean(last))))
+
+
+def scanPWM(session, hvs, start=0, stop=PWM_MAX, nCoarse=9, minStep=256,
+            maxDeltaV=None, maxPoints=64, settleTol=0.05, settleRelTol=1e-3,
+            settleReads=3, readInterval=0.05, settleTimeout=10.,
+            maxReads=1000, verbose=False):
+    ''' Closed-loop PWM scan of the HV channels hvs (see module doc)
+
+    start, stop   PWM range
+    nCoarse       number of points of the initial grid
+    minStep       smallest PWM step of the refinement
+    maxDeltaV     largest voltage step between neighbouring points,
+                  default 2% of the voltage range of the coarse grid
+    maxPoints     largest number of points per channel
+    settleTol, settleRelTol, settleReads
+                  a point is settled when settleReads successive
+                  read-backs are within max(settleTol [V],
+                  settleRelTol * voltage)
+    readInterval  time between read-back rounds [s], should not be
+                  much shorter than the settling time of the HV, or a
+                  slow drift is taken as settled
+    settleTimeout, maxReads
+                  the point is recorded as not settled after this time
+                  [s] or number of read-backs
+
+    Returns {hv: PWMCurve}
+    '''
+    if isinstance(hvs, str):
+        hvs = [hvs]
+    scans = [_ChannelScan(hv, start, stop, nCoarse, minStep, maxDeltaV,
+                          maxPoints) for hv in hvs]
+    nRounds = 0
+    t0 = time.time()
+    while True:
+        active = [(scan, scan.nextPWM()) for scan in scans]
+        active = [(scan, pwm) for scan, pwm in active if pwm is not None]
+        if not active:
+            break
+        for scan, pwm in active:
+            session.pwm(scan.hv, pwm, sleep=0)
+        tStep = time.time()
+        voltages = {scan.hv: [] for scan, _ in active}
+        pending = list(active)
+        while pending:
+            for scan, pwm in list(pending):
+                v, vRaw = session.parseADC(session.adc_read(scan.hv))
+                readings = voltages[scan.hv]
+                readings.append(v)
+                settled = _isSettled(readings, settleReads, settleTol,
+                                     settleRelTol)
+                elapsed = time.time() - tStep
+                if (settled or elapsed > settleTimeout or
+                        len(readings) >= maxReads):
+                    voltage = np.mean(readings[-settleReads:])
+                    scan.addPoint(pwm, voltage, vRaw, elapsed, len(readings),
+                                  settled)
+                    if verbose:
+                        print('\t%s: %i --> %.2fV (%d reads%s)' %
+                              (scan.hv, pwm, voltage, len(readings),
+                               '' if settled else ', NOT SETTLED'))
+                    pending.remove((scan, pwm))
+            if pending and readInterval > 0:
+                time.sleep(readInterval)
+        nRounds += 1
+    if verbose:
+        print('PWM scan: %d rounds in %.1f s' % (nRounds, time.time() - t0))
+    return {scan.hv: scan.curve() for scan in scans}
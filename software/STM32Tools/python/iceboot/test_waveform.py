@@ -1,5 +1,9 @@
 import json
 import numpy as np
+from .waveform_file import (isBinaryWaveformFile, writeBinaryWaveformFile,
+                            loadBinaryWaveformFile)
+
+BINARY_WAVEFORM_EXTENSION = ".wfb"
 
 class Rev90Stats():
     FPGA_TEST_WF_WORDS_PER_SAMPLE = 2
@@ -251,6 +255,95 @@ def parseTestWaveform(args):
     raise Exception("Unknown waveform version: %s" % version)
 
 
+# (first sample word, words per sample, shift, mask) of the ADC samples
+_SAMPLE_LAYOUT = {
+    0x80: (7, 2, 2, 0x3FFF),
+    0x81: (13, 1, 2, 0x3FFF),
+    0x82: (17, 1, 2, 0x3FFF),
+    0x90: (6, 2, 0, 0xFFF),
+    0x91: (8, 2, 0, 0xFFF),
+    0x92: (8, 2, 0, 0xFFF),
+}
+
+
+def _blockTimestamps(words, version):
+    w = words[:, :6].astype(np.uint64)
+    if version in [0x80, 0x81]:
+        return w[:, 5] | (w[:, 4] << 16) | (w[:, 3] << 32)
+    if version == 0x82:
+        return (((w[:, 2] >> 6) & 0x3) | (w[:, 5] << 2) |
+                (w[:, 4] << 18) | (w[:, 3] << 34))
+    return (((w[:, 2] & 0x4) >> 2) | (w[:, 5] << 1) |
+            (w[:, 4] << 17) | (w[:, 3] << 33))
+
+
+def parseWaveformMatrix(words):
+    """ Vectorized parseTestWaveform for an (nWaveforms, nWords) array
+    of equal length, same version raw waveforms.
+
+    Returns a dict of arrays: version, channel, timestamp (nWaveforms,)
+    and waveform, thresholdFlags (nWaveforms, nSamples)
+    """
+    words = np.asarray(words, dtype=np.uint16)
+    if words.ndim != 2 or len(words) == 0:
+        raise ValueError("Expected a non-empty 2D array of waveform words")
+    version = (int(words[0, 0]) >> 8) & 0xFF
+    if np.any(((words[:, 0] >> 8) & 0xFF) != version):
+        raise ValueError("Waveforms in the matrix have different versions")
+    if version not in _SAMPLE_LAYOUT:
+        raise Exception("Unknown waveform version: %s" % version)
+    start, step, shift, mask = _SAMPLE_LAYOUT[version]
+    samples = words[:, start:-2:step]
+    if version >= 0x90:
+        flagWords = words[:, start + 1:-2:step]
+    else:
+        flagWords = samples
+    return {
+        "version": version,
+        "channel": words[:, 0] & 0xFF,
+        "timestamp": _blockTimestamps(words, version),
+        "waveform": (samples >> shift) & mask,
+        "thresholdFlags": (flagWords >> 1) & 0x1,
+    }
+
+
+def splitWaveformBlock(buf):
+    """ Splits a readDEggWfmBlock buffer (uint32 word count followed by
+    the waveform words, repeated, terminated by a zero count) into
+    (nWaveforms, nWords) uint16 matrices, one per waveform length.
+    """
+    words = np.frombuffer(bytes(buf[:len(buf) - len(buf) % 2]), np.uint16)
+    if len(words) < 2:
+        return []
+    nWords = int(words[0]) | (int(words[1]) << 16)
+    if nWords == 0:
+        return []
+    # Fast path: constant readout length, the block is a regular matrix
+    stride = nWords + 2
+    nFull = len(words) // stride
+    block = words[:nFull * stride].reshape(nFull, stride)
+    nSame = nFull
+    mismatch = np.flatnonzero((block[:, 0] != words[0]) |
+                              (block[:, 1] != words[1]))
+    if len(mismatch) > 0:
+        nSame = mismatch[0]
+    matrices = []
+    if nSame > 0:
+        matrices.append(block[:nSame, 2:])
+    idx = nSame * stride
+    # Variable lengths: group the remaining waveforms by length
+    groups = {}
+    while idx + 2 <= len(words):
+        n = int(words[idx]) | (int(words[idx + 1]) << 16)
+        if n == 0 or idx + 2 + n > len(words):
+            break
+        groups.setdefault(n, []).append(words[idx + 2:idx + 2 + n])
+        idx += 2 + n
+    for n, wfs in groups.items():
+        matrices.append(np.vstack(wfs))
+    return matrices
+
+
 def applyPatternSubtraction(wf):
     if wf["version"] not in [0x81, 0x82]:
         raise Exception("Pattern subtraction not supported for "
@@ -269,19 +362,28 @@ def applyPatternSubtraction(wf):
 def deNumpy(wf):
     wf["waveform"] = [int(x) for x in wf["waveform"]]
     wf["thresholdFlags"] = [int(x) for x in wf["thresholdFlags"]]
+    if "discWords" in wf:
+        wf["discWords"] = [int(x) for x in wf["discWords"]]
     return wf
 
 
 def reNumpy(wf):
     wf["waveform"] = np.array(wf["waveform"])
     wf["thresholdFlags"] = np.array(wf["thresholdFlags"])
+    if "discWords" in wf:
+        wf["discWords"] = np.array(wf["discWords"])
     return wf
 
 
-def writeWaveformFile(wfs, fileName):
+def writeWaveformFile(wfs, fileName, compress=False):
+    if fileName.endswith(BINARY_WAVEFORM_EXTENSION):
+        writeBinaryWaveformFile(wfs, fileName, compress=compress)
+        return
     with open(fileName, "w") as f:
         json.dump([deNumpy(x) for x in wfs], f)
     
 def loadWaveformFile(fileName):
+    if isBinaryWaveformFile(fileName):
+        return loadBinaryWaveformFile(fileName)
     with open(fileName, "r") as f:
         return [reNumpy(x) for x in json.load(f)]
@@ -0,0 +1,447 @@
+''' Compact binary container for test waveforms
+
+Layout of a file:
+
+    fixed header (64 bytes)
+    JSON descriptor (sample dtype, chunking, user attributes)
+    sample data, written in chunks (optionally zlib compressed)
+    per-waveform metadata table (numpy structured array)
+    chunk table
+
+The header is patched with the table offsets when the writer is
+closed, so waveforms can be appended one by one while they are
+recorded.  Uncompressed sample data is contiguous and is memory-mapped
+on read; compressed files are decompressed one chunk at a time.
+
+Waveforms are the dicts returned by parseTestWaveform.  Keys outside
+of METADATA_FIELDS and SAMPLE_FIELDS are not stored.  Samples are
+stored as '<u2', or as '<f4' for float waveforms (e.g. pattern
+subtracted ones); the dtype is recorded in the descriptor.  The reader
+returns the stored dtypes, loadBinaryWaveformFile the int64 / float64
+arrays that loading a JSON file gives.
+
+See DEggTest/waveformRecorder.py for example code using this module
+'''
+
+import json
+import struct
+import zlib
+import numpy as np
+
+MAGIC = b'ICEBWFB\x00'
+FORMAT_VERSION = 1
+FLAG_ZLIB = 0x1
+
+# magic, format version, flags, descriptor length, number of waveforms,
+# number of samples, metadata table offset, chunk table offset,
+# number of chunks
+_HEADER = struct.Struct('<8sHHIQQQQQ')
+HEADER_SIZE = 64
+
+METADATA_FIELDS = [
+    ('version', 'u1'),
+    ('channel', 'u1'),
+    ('waveformLength', '<u4'),
+    ('header1', '<u2'),
+    ('header0', '<u2'),
+    ('timestamp', '<u8'),
+    ('syncReady', '?'),
+    ('preConfigCnt', 'u1'),
+    ('const', '?'),
+    ('lc', '?'),
+    ('triggerSource', 'u1'),
+    ('baselineSumValid', '?'),
+    ('baselineSumLength', '<u2'),
+    ('baselineSum', '<u4'),
+    ('chargeStamp', '<u4'),
+    ('chargeStampTime', '<u4'),
+    ('patternLenWord', '<u2'),
+    ('patternValid', '?'),
+    ('pattern', '<u4', (4,)),
+    ('footer1', '<u2'),
+    ('footer0', '<u2'),
+]
+SAMPLE_FIELDS = ['waveform', 'thresholdFlags', 'discWords']
+
+# Bookkeeping columns of the metadata table
+_INDEX_FIELDS = [
+    ('sampleOffset', '<u8'),
+    ('sampleCount', '<u4'),
+    ('present', '<u4'),
+]
+_PRESENT_BITS = dict(
+    (name, 1 << i) for i, name in
+    enumerate([f[0] for f in METADATA_FIELDS] + SAMPLE_FIELDS))
+_CHUNK_DTYPE = np.dtype([('fileOffset', '<u8'), ('storedSize', '<u8'),
+                         ('firstSample', '<u8'), ('nSamples', '<u8')])
+
+
+def metadataDtype():
+    return np.dtype(_INDEX_FIELDS + METADATA_FIELDS)
+
+
+def sampleDtype(waveformDtype='<u2'):
+    return np.dtype([('waveform', waveformDtype),
+                     ('thresholdFlags', 'u1'),
+                     ('discWords', 'u1')])
+
+
+def waveformDtypeFor(waveform):
+    ''' storage dtype of the samples of a waveform '''
+    if np.asarray(waveform).dtype.kind == 'f':
+        return '<f4'
+    return '<u2'
+
+
+def _checkWaveform(waveform, dtype):
+    waveform = np.asarray(waveform)
+    if waveform.dtype.kind == 'f' and dtype.kind != 'f':
+        raise ValueError(f'Float waveform cannot be stored as {dtype}, '
+                         f"use waveformDtype='<f4'")
+    if waveform.dtype.kind in 'iu' and dtype.kind in 'iu' and \
+            len(waveform) > 0:
+        info = np.iinfo(dtype)
+        if waveform.min() < info.min or waveform.max() > info.max:
+            raise ValueError(f'Waveform samples out of the range of '
+                             f'{dtype}')
+
+
+def isBinaryWaveformFile(fileName):
+    try:
+        with open(fileName, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+
+class WaveformFileWriter:
+    ''' Streams waveforms into a binary waveform file
+
+    Waveforms are buffered and written in chunks of chunkSamples
+    samples; the metadata table is kept in memory and written on
+    close().  Use as a context manager to make sure the file is
+    finalized.
+
+    waveformDtype is the dtype of the stored samples, by default it is
+    taken from the first waveform (see waveformDtypeFor).  Waveforms
+    which do not fit into it raise a ValueError.
+    '''
+    def __init__(self, fileName, compress=False, chunkSamples=1 << 20,
+                 waveformDtype=None, attrs=None):
+        self._fileName = fileName
+        self._compress = compress
+        self._chunkSamples = int(chunkSamples)
+        self._attrs = attrs if attrs is not None else {}
+        self._sampleDtype = None
+        self._metaDtype = metadataDtype()
+        self._meta = np.zeros(1024, dtype=self._metaDtype)
+        self._nWaveforms = 0
+        self._nSamples = 0
+        self._pending = []
+        self._pendingSamples = 0
+        self._chunks = []
+        self._f = open(fileName, 'wb')
+        if waveformDtype is not None:
+            self._start(waveformDtype)
+
+    def _start(self, waveformDtype):
+        self._sampleDtype = sampleDtype(waveformDtype)
+        descriptor = {
+            'sampleDtype': self._sampleDtype.descr,
+            'metadataDtype': [list(f) for f in self._metaDtype.descr],
+            'attrs': self._attrs,
+        }
+        self._descriptor = json.dumps(descriptor).encode()
+        self._writeHeader(0, 0)
+        self._f.write(self._descriptor)
+        self._dataEnd = self._f.tell()
+
+    @property
+    def nWaveforms(self):
+        return self._nWaveforms
+
+    def _writeHeader(self, tableOffset, chunkTableOffset):
+        flags = FLAG_ZLIB if self._compress else 0
+        header = _HEADER.pack(MAGIC, FORMAT_VERSION, flags,
+                              len(self._descriptor), self._nWaveforms,
+                              self._nSamples, tableOffset,
+                              chunkTableOffset, len(self._chunks))
+        self._f.seek(0)
+        self._f.write(header.ljust(HEADER_SIZE, b'\x00'))
+
+    def append(self, wf):
+        if self._sampleDtype is None:
+            self._start(waveformDtypeFor(wf['waveform']))
+        _checkWaveform(wf['waveform'], self._sampleDtype['waveform'])
+        if self._nWaveforms == len(self._meta):
+            meta = np.zeros(2 * len(self._meta), dtype=self._metaDtype)
+            meta[:self._nWaveforms] = self._meta
+            self._meta = meta
+        row = self._meta[self._nWaveforms]
+
+        present = 0
+        for field in METADATA_FIELDS:
+            name = field[0]
+            if name in wf:
+                row[name] = wf[name]
+                present |= _PRESENT_BITS[name]
+
+        nSamples = len(wf['waveform'])
+        samples = np.zeros(nSamples, dtype=self._sampleDtype)
+        for name in SAMPLE_FIELDS:
+            if name in wf:
+                if len(wf[name]) != nSamples:
+                    raise ValueError(f'{name} has {len(wf[name])} entries, '
+                                     f'expected {nSamples}')
+                samples[name] = wf[name]
+                present |= _PRESENT_BITS[name]
+
+        row['sampleOffset'] = self._nSamples
+        row['sampleCount'] = nSamples
+        row['present'] = present
+        self._nWaveforms += 1
+        self._nSamples += nSamples
+
+        self._pending.append(samples)
+        self._pendingSamples += nSamples
+        if self._pendingSamples >= self._chunkSamples:
+            self._flushChunk()
+
+    def extend(self, wfs):
+        for wf in wfs:
+            self.append(wf)
+
+    def _flushChunk(self):
+        if self._pendingSamples == 0:
+            return
+        data = np.concatenate(self._pending).tobytes()
+        if self._compress:
+            data = zlib.compress(data)
+        self._f.seek(self._dataEnd)
+        self._f.write(data)
+        self._chunks.append((self._dataEnd, len(data),
+                             self._nSamples - self._pendingSamples,
+                             self._pendingSamples))
+        self._dataEnd += len(data)
+        self._pending = []
+        self._pendingSamples = 0
+
+    def close(self):
+        if self._f is None:
+            return
+        if self._sampleDtype is None:
+            self._start('<u2')
+        self._flushChunk()
+        self._f.seek(self._dataEnd)
+        tableOffset = self._dataEnd
+        self._f.write(self._meta[:self._nWaveforms].tobytes())
+        chunkTableOffset = self._f.tell()
+        self._f.write(np.array(self._chunks, dtype=_CHUNK_DTYPE).tobytes())
+        self._writeHeader(tableOffset, chunkTableOffset)
+        self._f.close()
+        self._f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __del__(self):
+        if getattr(self, '_f', None) is not None:
+            self.close()
+
+
+class WaveformFile:
+    ''' Random access reader for binary waveform files
+
+    wfFile[i] returns the waveform dict as written, wfFile.metadata
+    the full metadata table as a structured array.  For uncompressed
+    files the sample arrays are views into a memory map.
+    '''
+    def __init__(self, fileName):
+        self._fileName = fileName
+        with open(fileName, 'rb') as f:
+            header = _HEADER.unpack(f.read(_HEADER.size))
+            (magic, formatVersion, flags, descriptorLength, nWaveforms,
+             nSamples, tableOffset, chunkTableOffset, nChunks) = header
+            if magic != MAGIC:
+                raise IOError(f'{fileName} is not a binary waveform file')
+            if formatVersion > FORMAT_VERSION:
+                raise IOError(f'Unsupported waveform file version '
+                              f'{formatVersion}')
+            if tableOffset == 0:
+                raise IOError(f'{fileName} was not closed properly')
+            f.seek(HEADER_SIZE)
+            descriptor = json.loads(f.read(descriptorLength).decode())
+
+        self.attrs = descriptor['attrs']
+        self._compressed = bool(flags & FLAG_ZLIB)
+        self._sampleDtype = np.dtype(
+            [tuple(f) for f in descriptor['sampleDtype']])
+        metaDtype = np.dtype([tuple(f) if len(f) == 2
+                              else (f[0], f[1], tuple(f[2]))
+                              for f in descriptor['metadataDtype']])
+        self.metadata = np.fromfile(fileName, dtype=metaDtype,
+                                    count=nWaveforms, offset=tableOffset)
+        self._chunks = np.fromfile(fileName, dtype=_CHUNK_DTYPE,
+                                   count=nChunks, offset=chunkTableOffset)
+        self._nSamples = nSamples
+        self._metaFields = [f[0] for f in METADATA_FIELDS
+                            if f[0] in metaDtype.names]
+
+        self._samples = None
+        self._cachedChunk = (-1, None)
+        if not self._compressed and nSamples > 0:
+            self._samples = np.memmap(fileName, dtype=self._sampleDtype,
+                                      mode='r',
+                                      offset=int(self._chunks[0]['fileOffset']),
+                                      shape=(nSamples,))
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def _chunk(self, index):
+        if self._cachedChunk[0] != index:
+            chunk = self._chunks[index]
+            with open(self._fileName, 'rb') as f:
+                f.seek(int(chunk['fileOffset']))
+                data = zlib.decompress(f.read(int(chunk['storedSize'])))
+            self._cachedChunk = (
+                index, np.frombuffer(data, dtype=self._sampleDtype))
+        return self._cachedChunk[1]
+
+    def _sampleRange(self, start, stop):
+        if self._samples is not None:
+            return self._samples[start:stop]
+        if start == stop:
+            return np.zeros(0, dtype=self._sampleDtype)
+        firsts = self._chunks['firstSample']
+        first = np.searchsorted(firsts, start, side='right') - 1
+        last = np.searchsorted(firsts, stop - 1, side='right') - 1
+        parts = [self._chunk(i) for i in range(first, last + 1)]
+        data = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        offset = start - int(firsts[first])
+        return data[offset:offset + stop - start]
+
+    def samples(self, i):
+        ''' structured sample array of waveform i '''
+        row = self.metadata[i]
+        start = int(row['sampleOffset'])
+        return self._sampleRange(start, start + int(row['sampleCount']))
+
+    def waveforms(self, start=0, stop=None):
+        ''' waveform samples of a range of equal-length waveforms as
+        an (nWaveforms, nSamples) array '''
+        rows = self.metadata[start:stop]
+        if len(rows) == 0:
+            return np.zeros((0, 0), dtype=self._sampleDtype['waveform'])
+        counts = rows['sampleCount']
+        if np.any(counts != counts[0]):
+            raise ValueError('Waveforms in range have different lengths')
+        first = int(rows['sampleOffset'][0])
+        data = self._sampleRange(first, first + int(counts.sum()))
+        return data['waveform'].reshape(len(rows), int(counts[0]))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        row = self.metadata[i]
+        present = int(row['present'])
+        wf = {}
+        for name in self._metaFields:
+            if present & _PRESENT_BITS[name]:
+                value = row[name]
+                wf[name] = value.tolist() if name == 'pattern' \
+                    else value.item()
+        samples = self.samples(i)
+        for name in SAMPLE_FIELDS:
+            if present & _PRESENT_BITS[name]:
+                wf[name] = samples[name]
+        return wf
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        # the memmap is unmapped once the last array returned by
+        # samples(), waveforms() or [] is gone, not here
+        self._samples = None
+        self._cachedChunk = (-1, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def writeBinaryWaveformFile(wfs, fileName, compress=False, attrs=None):
+    wfs = list(wfs)
+    waveformDtype = '<u2'
+    if any(waveformDtypeFor(wf['waveform']) == '<f4' for wf in wfs):
+        waveformDtype = '<f4'
+    with WaveformFileWriter(fileName, compress=compress,
+                            waveformDtype=waveformDtype,
+                            attrs=attrs) as writer:
+        writer.extend(wfs)
+
+
+def _upcast(samples):
+    # the dtypes of arrays loaded from JSON (see test_waveform.reNumpy),
+    # so that e.g. baseline subtraction does not wrap around
+    if samples.dtype.kind == 'f':
+        return samples.astype(np.float64)
+    return samples.astype(np.int64)
+
+
+def loadBinaryWaveformFile(fileName):
+    with WaveformFile(fileName) as wfFile:
+        return [dict((k, _upcast(v) if k in SAMPLE_FIELDS else v)
+                     for k, v in wf.items()) for wf in wfFile]
+
+
+def convertJsonToBinary(jsonFileName, binFileName, compress=False):
+    with open(jsonFileName, 'r') as f:
+        wfs = json.load(f)
+    # Pattern subtracted waveforms are stored as floats
+    waveformDtype = '<u2'
+    if any(isinstance(x, float) for wf in wfs for x in wf['waveform']):
+        waveformDtype = '<f4'
+    with WaveformFileWriter(binFileName, compress=compress,
+                            waveformDtype=waveformDtype) as writer:
+        for wf in wfs:
+            writer.append(wf)
+    return len(wfs)
+
+
+def convertBinaryToJson(binFileName, jsonFileName):
+    with WaveformFile(binFileName) as wfFile:
+        wfs = []
+        for wf in wfFile:
+            for name in SAMPLE_FIELDS:
+                if name in wf:
+                    wf[name] = wf[name].tolist()
+            wfs.append(wf)
+    with open(jsonFileName, 'w') as f:
+        json.dump(wfs, f)
+    return len(wfs)
+
+
+if __name__ == "__main__":
+    import sys
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] inputFile outputFile")
+    parser.add_option("--compress", dest="compress", action="store_true",
+                      help="Compress the binary waveform file",
+                      default=False)
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.print_help()
+        sys.exit(1)
+    if isBinaryWaveformFile(args[0]):
+        n = convertBinaryToJson(args[0], args[1])
+    else:
+        n = convertJsonToBinary(args[0], args[1], compress=options.compress)
+    print("Converted %d waveforms" % n)
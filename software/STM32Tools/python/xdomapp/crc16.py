@@ -1,3 +1,10 @@
+import struct
+import binascii
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 """
   CRC16 with polynomial 0x8005, starting value = 0xFFFF, final XOR = 0x0
@@ -38,7 +45,7 @@ crc_table_ibm = [
   0x0220, 0x8225, 0x822F, 0x022A, 0x823B, 0x023E, 0x0234, 0x8231,
   0x8213, 0x0216, 0x021C, 0x8219, 0x0208, 0x820D, 0x8207, 0x0202]
 
-def calcCrcIBM(buf, crc = 0xFFFF):
+def calcCrcIBMBytewise(buf, crc = 0xFFFF):
     for b in buf:
         crc = ((crc << 8) ^ crc_table_ibm[(((crc >> 8) ^ b) & 0xFF)]) & 0xFFFF
     return crc
@@ -83,7 +90,185 @@ crctab_ymodem = [
     0x6e17,  0x7e36,  0x4e55,  0x5e74,  0x2e93,  0x3eb2,  0x0ed1,  0x1ef0]
 
 
-def calcCrcYmodem(buf, crc = 0x0):
+def calcCrcYmodemBytewise(buf, crc = 0x0):
     for b in buf:
         crc = (crctab_ymodem[((crc >> 8) & 255)] ^ (crc << 8) ^ b) & 0xFFFF
-    return crc
\ No newline at end of file
+    return crc
+
+
+"""
+  Fast engines for the two CRCs above, same results as the bytewise
+  reference functions.
+
+  Both are "MSB first" CRCs. With the register c and the next 16 bit
+  big-endian word w, two steps of the table loop are c = T16[c ^ w],
+  where T16 is the CRC of the two bytes of the index (slicing-by-2,
+  half the Python iterations and no shifting or masking).
+
+  Large buffers (numpy) are split into equal blocks whose CRCs are
+  computed side by side, one table lookup per byte column; the block
+  CRCs are then combined pairwise, shifting the left one by the length
+  of the right one (c * x^(8*length) mod P, linear in c, so two 256
+  entry tables per length).
+
+  The YModem CRC is the same polynomial as binascii.crc_hqx (compiled),
+  which is used for it. Its table loop is the "augmented" form (the
+  data is shifted in instead of XORed into the top byte): for n >= 2
+  bytes it is the normal CRC of the first n - 2 bytes, starting from
+  the register shifted by two zero bytes, XOR the last two bytes.
+"""
+NUMPY_MIN_SIZE = 8192
+NUMPY_BLOCK_SIZE = 32
+
+
+class Crc16Engine(object):
+    def __init__(self, table, augmented=False, hqx=False):
+        self.table = table
+        self.augmented = augmented
+        self.hqx = hqx
+        self._table16 = None
+        self._shift_tables = {}
+
+    ##normal (not augmented) CRC, register crc
+    def _bytewise(self, buf, crc):
+        table = self.table
+        for b in buf:
+            crc = ((crc << 8) ^ table[(((crc >> 8) ^ b) & 0xFF)]) & 0xFFFF
+        return crc
+
+    def _getTable16(self):
+        if self._table16 is None:
+            table16 = []
+            for w in range(0x10000):
+                table16.append(self._bytewise((w >> 8, w & 0xFF), 0))
+            self._table16 = table16
+        return self._table16
+
+    def _sliced(self, buf, crc):
+        table16 = self._getTable16()
+        n_words = len(buf) // 2
+        for w in struct.unpack_from(">%dH" % n_words, buf):
+            crc = table16[crc ^ w]
+        if len(buf) % 2:
+            crc = self._bytewise(buf[-1:], crc)
+        return crc
+
+    def _shiftImages(self, n_bytes):
+        ##register after n_bytes zero bytes, for each of the 16 bits
+        images = [1 << k for k in range(16)]
+        for _ in range(n_bytes):
+            images = [self._bytewise(b"\x00", c) for c in images]
+        return images
+
+    def _getShiftTables(self, n_bytes):
+        if n_bytes not in self._shift_tables:
+            if n_bytes // 2 in self._shift_tables:
+                ##shifting twice by n/2
+                lo, hi = self._shift_tables[n_bytes // 2]
+                images = [1 << k for k in range(16)]
+                images = [int(lo[c & 0xFF] ^ hi[c >> 8]) for c in images]
+                images = [int(lo[c & 0xFF] ^ hi[c >> 8]) for c in images]
+            else:
+                images = self._shiftImages(n_bytes)
+            images = np.array(images, dtype=np.uint32)
+            bits = (np.arange(256)[:, np.newaxis] >> np.arange(8)) & 1
+            lo = np.bitwise_xor.reduce(bits * images[:8], axis=1)
+            hi = np.bitwise_xor.reduce(bits * images[8:], axis=1)
+            self._shift_tables[n_bytes] = (lo.astype(np.uint32),
+                                           hi.astype(np.uint32))
+        return self._shift_tables[n_bytes]
+
+    def _blocks(self, buf, crc):
+        data = np.frombuffer(bytes(buf), dtype=np.uint8)
+        ##the initial register is the same as XORing it into the first
+        ##two bytes, and leading zero bytes do not change a CRC that
+        ##starts at 0
+        data = data.copy()
+        data[0] ^= crc >> 8
+        data[1] ^= crc & 0xFF
+        n_blocks = 1 << int(np.ceil(np.log2(
+            -(-len(data) // NUMPY_BLOCK_SIZE))))
+        padded = np.zeros(n_blocks * NUMPY_BLOCK_SIZE, dtype=np.uint8)
+        padded[len(padded) - len(data):] = data
+        ##one contiguous row per byte column
+        columns = np.ascontiguousarray(
+            padded.reshape(n_blocks, NUMPY_BLOCK_SIZE).T)
+
+        table = np.array(self.table, dtype=np.uint32)
+        crcs = np.zeros(n_blocks, dtype=np.uint32)
+        for column in columns:
+            crcs = ((crcs << 8) & 0xFFFF) ^ table[(crcs >> 8) ^ column]
+        length = NUMPY_BLOCK_SIZE
+        while len(crcs) > 1:
+            lo, hi = self._getShiftTables(length)
+            left = crcs[0::2]
+            crcs = lo[left & 0xFF] ^ hi[left >> 8] ^ crcs[1::2]
+            length *= 2
+        return int(crcs[0])
+
+    def _normal(self, buf, crc):
+        if self.hqx:
+            return binascii.crc_hqx(buf, crc)
+        if np is not None and len(buf) >= NUMPY_MIN_SIZE:
+            return self._blocks(buf, crc)
+        return self._sliced(buf, crc)
+
+    def calc(self, buf, crc):
+        if not isinstance(buf, (bytes, bytearray, memoryview)):
+            buf = bytes(buf)
+        if not self.augmented:
+            return self._normal(buf, crc)
+        if len(buf) < 2:
+            for b in bytes(buf):
+                crc = (self.table[((crc >> 8) & 255)] ^ (crc << 8) ^ b) & 0xFFFF
+            return crc
+        tail = buf[-2:]
+        crc = self._bytewise(b"\x00\x00", crc)
+        return self._normal(buf[:-2], crc) ^ (tail[0] << 8 | tail[1])
+
+
+ibmEngine = Crc16Engine(crc_table_ibm)
+ymodemEngine = Crc16Engine(crctab_ymodem, augmented=True, hqx=True)
+
+
+def calcCrcIBM(buf, crc = 0xFFFF):
+    return ibmEngine.calc(buf, crc)
+
+
+def calcCrcYmodem(buf, crc = 0x0):
+    return ymodemEngine.calc(buf, crc)
+
+
+class Crc16(object):
+    """
+      Incremental CRC, e.g. over the pieces of a packet:
+        crc = CrcIBM(); crc.update(hdr); crc.update(payload); crc.crc
+    """
+    engine = None
+    init = 0
+
+    def __init__(self, data=None, crc=None):
+        self.crc = self.init if crc is None else crc
+        if data is not None:
+            self.update(data)
+
+    def update(self, data):
+        self.crc = self.engine.calc(data, self.crc)
+        return self
+
+    def copy(self):
+        return type(self)(crc=self.crc)
+
+    def digest(self):
+        # big-endian, as sent on the wire
+        return struct.pack(">H", self.crc)
+
+
+class CrcIBM(Crc16):
+    engine = ibmEngine
+    init = 0xFFFF
+
+
+class CrcYmodem(Crc16):
+    engine = ymodemEngine
+    init = 0x0
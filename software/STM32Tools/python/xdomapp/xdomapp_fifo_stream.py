@@ -0,0 +1,284 @@
+
+from . import xdomapp_msg
+from . import opcode
+import numpy as np
+import threading
+import time
+
+
+# Largest FIFO read: below the reply limit and a multiple of the word size
+DEFAULT_CHUNK_SIZE = xdomapp_msg.MAX_PAYLOAD_SIZE & ~0x7
+
+# Idle time between size polls of an empty FIFO
+DEFAULT_POLL_INTERVAL = 0.001
+
+# Retries of a FIFO read; the ack is not retried, see XDOMAppFifoStream
+STREAM_N_RETRIES = 2
+
+
+class XDOMAppFifoStream(object):
+    """
+    Keeps draining an xDOM FIFO into a numpy ring buffer of capacity
+    words, in a thread.  The bytes are decoded as little-endian words of
+    dtype; the consumer gets them with read() or by iterating, as arrays.
+
+    Each FIFO read is only acknowledged after its reply has arrived, and
+    the ack is sent in flight together with the next read (and a size
+    poll once the known content of the FIFO is used up), so the FIFO is
+    read with one round trip per chunk.  A failed read is retried, a
+    failed ack stops the stream: it is unknown whether the xDOM has
+    consumed the data.
+
+    If the consumer falls behind, overflow="block" stops reading until
+    there is space in the ring buffer (backpressure, the data waits in
+    the FIFO on the xDOM), overflow="drop" overwrites the oldest words.
+    With stopWhenEmpty the stream ends at the first empty FIFO.
+
+    The session must not be used otherwise while the stream runs.
+    statistics() returns the counters of the stream.
+    """
+
+    def __init__(self, cmd, fifo_def, token1=0, token2=0, dtype="<u2",
+                 capacity=1 << 22, chunkSize=DEFAULT_CHUNK_SIZE,
+                 overflow="block", pollInterval=DEFAULT_POLL_INTERVAL,
+                 stopWhenEmpty=False):
+        if overflow not in ("block", "drop"):
+            raise ValueError("overflow must be 'block' or 'drop', "
+                             "not %s" % overflow)
+        self.msg = cmd.msg
+        self.fifo_def = fifo_def
+        self.token1 = token1
+        self.token2 = token2
+        self.dtype = np.dtype(dtype)
+        self.wordSize = self.dtype.itemsize
+        self.chunkSize = max(chunkSize - chunkSize % self.wordSize,
+                             self.wordSize)
+        self.overflow = overflow
+        self.pollInterval = pollInterval
+        self.stopWhenEmpty = stopWhenEmpty
+        # Decoded to the native byte order when copied into the ring
+        self._ring = np.zeros(int(capacity), dtype=self.dtype.newbyteorder("="))
+        self._head = 0
+        self._fill = 0
+        self._leftover = b""
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self._running = False
+        self.error = None
+        self.stats = {
+            "bytes":         0,
+            "words":         0,
+            "reads":         0,
+            "retries":       0,
+            "idlePolls":     0,
+            "maxDeviceFill": 0,
+            "maxFill":       0,
+            "blocked":       0,
+            "blockedTime":   0.0,
+            "overflowWords": 0,
+            "elapsed":       0.0,
+        }
+
+    def __del__(self):
+        try:
+            self.stop()
+        except:
+            pass
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def __iter__(self):
+        if not self._running and self._thread is None:
+            self.start()
+        while True:
+            words = self.read()
+            if len(words) > 0:
+                yield words
+            elif not self._running:
+                if self.error is not None:
+                    raise self.error
+                return
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self.error = None
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop reading; the words in the ring buffer can still be read"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        self._thread.join()
+        self._thread = None
+
+    def running(self):
+        return self._running
+
+    def available(self):
+        """Number of words in the ring buffer"""
+        with self._cond:
+            return self._fill
+
+    def read(self, maxWords=None, timeout=None):
+        """
+        Words from the ring buffer, waiting up to timeout [s] (forever if
+        None) until there are any or the stream has stopped
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._fill > 0 or not self._running,
+                                timeout)
+            n = self._fill if maxWords is None else min(self._fill, maxWords)
+            words = np.empty(n, dtype=self._ring.dtype)
+            cap = len(self._ring)
+            first = min(n, cap - self._head)
+            words[:first] = self._ring[self._head:self._head + first]
+            words[first:] = self._ring[:n - first]
+            self._head = (self._head + n) % cap
+            self._fill -= n
+            self._cond.notify_all()
+        return words
+
+    def statistics(self):
+        stats = dict(self.stats)
+        if stats["elapsed"] > 0:
+            stats["Bps"] = stats["bytes"] / stats["elapsed"]
+            stats["Mbps"] = stats["Bps"] * 8 / 1.0e6
+        return stats
+
+    # Ring buffer
+
+    def _space(self):
+        # FIFO bytes that fit into the ring buffer
+        with self._cond:
+            free = len(self._ring) - self._fill
+        return free * self.wordSize - len(self._leftover)
+
+    def _wait_space(self):
+        t0 = time.time()
+        self.stats["blocked"] += 1
+        with self._cond:
+            self._cond.wait_for(
+                lambda: (self._fill < len(self._ring) or
+                         self._stop.is_set()), self.pollInterval * 100)
+        self.stats["blockedTime"] += time.time() - t0
+
+    def _push_bytes(self, data):
+        nBytes = len(data)
+        if self._leftover:
+            data = self._leftover + data
+        n = len(data) - len(data) % self.wordSize
+        words = np.frombuffer(data, dtype=self.dtype, count=n // self.wordSize)
+        self._leftover = bytes(data[n:])
+        self.stats["bytes"] += nBytes
+        self.stats["words"] += len(words)
+
+        with self._cond:
+            cap = len(self._ring)
+            if len(words) > cap:
+                self.stats["overflowWords"] += len(words) - cap
+                words = words[-cap:]
+            drop = len(words) - (cap - self._fill)
+            if drop > 0:
+                # Only in overflow="drop" mode
+                self.stats["overflowWords"] += drop
+                self._head = (self._head + drop) % cap
+                self._fill -= drop
+            n = len(words)
+            tail = (self._head + self._fill) % cap
+            first = min(n, cap - tail)
+            self._ring[tail:tail + first] = words[:first]
+            self._ring[:n - first] = words[first:]
+            self._fill += n
+            self.stats["maxFill"] = max(self.stats["maxFill"], self._fill)
+            self._cond.notify_all()
+
+    # Reader thread
+
+    def _submit_ack(self, cnt):
+        ack_def = self.fifo_def["ack"]
+        return self.msg.submit_write(ack_def["opcode"],
+                                     opcode.to_bytearray(ack_def, cnt),
+                                     token1=self.token1, token2=self.token2,
+                                     timeout=ack_def["timeout"])
+
+    def _run(self):
+        fifo_def = self.fifo_def["fifo"]
+        size_def = self.fifo_def["size"]
+        # Bytes known to be in the FIFO and read but not acknowledged
+        avail = 0
+        ackPending = 0
+        retries = 0
+        start = time.time()
+        try:
+            self.msg.flush()
+            while not self._stop.is_set():
+                nbytes = min(avail, self.chunkSize)
+                if self.overflow == "block" and nbytes > 0:
+                    nbytes = min(nbytes, self._space())
+                    if nbytes <= 0 and not ackPending:
+                        self._wait_space()
+                        continue
+                ack = read = size = None
+                if ackPending:
+                    ack = self._submit_ack(ackPending)
+                if nbytes > 0:
+                    read = self.msg.submit_read(fifo_def["opcode"], nbytes,
+                                                token1=self.token1,
+                                                token2=self.token2,
+                                                timeout=fifo_def["timeout"])
+                if avail - nbytes <= 0:
+                    size = self.msg.submit_poll(size_def["opcode"],
+                                                token1=self.token1,
+                                                token2=self.token2,
+                                                timeout=size_def["timeout"])
+                if ack is not None:
+                    self.msg.wait(ack)
+                    ackPending = 0
+                if read is not None:
+                    try:
+                        data = self.msg.wait(read)
+                    except IOError:
+                        # Nothing was consumed, read again
+                        retries += 1
+                        self.stats["retries"] += 1
+                        if retries > STREAM_N_RETRIES:
+                            raise
+                        continue
+                    retries = 0
+                    self.stats["reads"] += 1
+                    ackPending = len(data)
+                    avail -= len(data)
+                    self._push_bytes(data)
+                if size is not None:
+                    fill = opcode.from_bytearray(size_def,
+                                                 self.msg.wait(size))
+                    self.stats["maxDeviceFill"] = max(
+                        self.stats["maxDeviceFill"], fill)
+                    avail = fill - ackPending
+                    if avail <= 0 and not ackPending:
+                        if self.stopWhenEmpty:
+                            break
+                        self.stats["idlePolls"] += 1
+                        self._stop.wait(self.pollInterval)
+            if ackPending:
+                self.msg.wait(self._submit_ack(ackPending))
+        except Exception as e:
+            self.error = e
+        finally:
+            self.stats["elapsed"] += time.time() - start
+            with self._cond:
+                self._running = False
+                self._cond.notify_all()
@@ -0,0 +1,224 @@
+
+from .crc16 import calcCrcIBM, CrcIBM
+from . import xdomapp_msg
+from .xdomapp_msg import (PKT_HEADER, PKT_READ_REQ, PKT_WRITE_REQ,
+                          PKT_POLL_REQ, PKT_ECHO_REQ, REQ_HEADER_SIZE,
+                          MAX_PAYLOAD_SIZE)
+import socket
+import struct
+import threading
+import time
+
+
+# Error codes, see xdomapp_msg.checkErrorCode()
+EC_OK             = 0
+EC_OPCODE         = 1
+EC_VALUE          = 3
+EC_FIFO_UNDERFLOW = 4
+EC_CHECKSUM       = 6
+
+
+class LoopbackFifo(object):
+    """
+    Device side of an xDOM FIFO: a producer calls feed(), the host reads
+    through the fifo/ack/size/reset opcodes.  Data that does not fit into
+    capacity bytes is dropped and counted in overflowBytes, like on the
+    xDOM.
+    """
+
+    def __init__(self, capacity=1 << 20):
+        self.capacity = capacity
+        self.buf = bytearray()
+        self.fedBytes = 0
+        self.overflowBytes = 0
+        self.maxFill = 0
+        self.lock = threading.Lock()
+
+    def feed(self, data):
+        with self.lock:
+            n = min(len(data), self.capacity - len(self.buf))
+            self.buf.extend(memoryview(data)[:n])
+            self.fedBytes += n
+            self.overflowBytes += len(data) - n
+            self.maxFill = max(self.maxFill, len(self.buf))
+            return n
+
+    def available(self):
+        with self.lock:
+            return len(self.buf)
+
+    def peek(self, n):
+        with self.lock:
+            if n > len(self.buf):
+                return None
+            return bytes(self.buf[:n])
+
+    def ack(self, n):
+        with self.lock:
+            if n > len(self.buf):
+                return False
+            del self.buf[:n]
+            return True
+
+    def reset(self):
+        with self.lock:
+            self.buf = bytearray()
+
+
+class XDOMAppLoopback(threading.Thread):
+    """
+    Fake xDOMApp server on one end of a socket, for tests and benchmarks
+    without hardware.  Requests are answered in order.
+
+    Opcodes are served by handlers registered with on_read(), on_write()
+    and on_poll(); add_fifo() registers the four opcodes of a FIFO.
+    Handlers are called with (token1, token2, payload) and return the
+    reply payload or raise LoopbackError(errorCode).  latency [s] delays
+    every reply, to emulate the round trip of a real link.
+    """
+
+    def __init__(self, sock, latency=0):
+        super(XDOMAppLoopback, self).__init__(daemon=True)
+        self.sock = sock
+        self.latency = latency
+        self.handlers = {}
+        self.fifos = {}
+        self.requests = 0
+        self.maxQueued = 0
+
+    # Registration of opcodes
+
+    def on_read(self, opcode, handler):
+        self.handlers[(PKT_READ_REQ, opcode)] = handler
+
+    def on_write(self, opcode, handler):
+        self.handlers[(PKT_WRITE_REQ, opcode)] = handler
+
+    def on_poll(self, opcode, handler):
+        self.handlers[(PKT_POLL_REQ, opcode)] = handler
+
+    def add_fifo(self, fifo_def, token1=0, capacity=1 << 20):
+        """LoopbackFifo behind the opcodes of fifo_def, selected by token1"""
+        fifo = LoopbackFifo(capacity)
+        self.fifos[(fifo_def["fifo"]["opcode"], token1)] = fifo
+        fifoOpcode = fifo_def["fifo"]["opcode"]
+
+        def get(token1):
+            if (fifoOpcode, token1) not in self.fifos:
+                raise LoopbackError(EC_VALUE)
+            return self.fifos[(fifoOpcode, token1)]
+
+        def read(token1, token2, payload):
+            data = get(token1).peek(struct.unpack("<H", payload)[0])
+            if data is None:
+                raise LoopbackError(EC_FIFO_UNDERFLOW)
+            return data
+
+        def poll(token1, token2, payload):
+            fifo = get(token1)
+            return fifo.peek(min(fifo.available(), MAX_PAYLOAD_SIZE))
+
+        def ack(token1, token2, payload):
+            if not get(token1).ack(struct.unpack("<H", payload)[0]):
+                raise LoopbackError(EC_FIFO_UNDERFLOW)
+            return b""
+
+        def size(token1, token2, payload):
+            return struct.pack("<I", get(token1).available())
+
+        def reset(token1, token2, payload):
+            get(token1).reset()
+            return b""
+
+        self.on_read(fifoOpcode, read)
+        self.on_poll(fifoOpcode, poll)
+        self.on_write(fifo_def["ack"]["opcode"], ack)
+        self.on_poll(fifo_def["size"]["opcode"], size)
+        self.on_write(fifo_def["reset"]["opcode"], reset)
+        return fifo
+
+    # Protocol
+
+    def _reply(self, errorCode, data=b""):
+        pkt = bytearray(struct.pack("<HHB", PKT_HEADER, len(data) + 7,
+                                    errorCode))
+        pkt.extend(data)
+        pkt.extend(CrcIBM(pkt).digest())
+        return pkt
+
+    def _handle(self, pktCode, opcode, token1, token2, payload):
+        if pktCode == PKT_ECHO_REQ:
+            return self._reply(EC_OK, payload)
+        handler = self.handlers.get((pktCode, opcode))
+        if handler is None:
+            return self._reply(EC_OPCODE)
+        try:
+            data = handler(token1, token2, payload)
+        except LoopbackError as e:
+            return self._reply(e.errorCode)
+        return self._reply(EC_OK, data)
+
+    def run(self):
+        buf = bytearray()
+        try:
+            while True:
+                chunk = self.sock.recv(1 << 16)
+                if not chunk:
+                    return
+                buf.extend(chunk)
+                replies = bytearray()
+                ptr = 0
+                nQueued = 0
+                while len(buf) - ptr >= REQ_HEADER_SIZE:
+                    header, pktlen, pktCode, opcode, token1, token2 = \
+                        struct.unpack_from("<HHBHBB", buf, ptr)
+                    if header != PKT_HEADER:
+                        # Lost framing, drop everything received so far
+                        replies.extend(self._reply(EC_CHECKSUM))
+                        ptr = len(buf)
+                        break
+                    if len(buf) - ptr < pktlen:
+                        break
+                    pkt = memoryview(buf)[ptr:ptr + pktlen]
+                    ptr += pktlen
+                    nQueued += 1
+                    self.requests += 1
+                    if calcCrcIBM(pkt) != 0:
+                        replies.extend(self._reply(EC_CHECKSUM))
+                    else:
+                        replies.extend(self._handle(
+                            pktCode, opcode, token1, token2,
+                            bytes(pkt[REQ_HEADER_SIZE:-2])))
+                    pkt.release()
+                del buf[:ptr]
+                self.maxQueued = max(self.maxQueued, nQueued)
+                if replies:
+                    if self.latency:
+                        time.sleep(self.latency)
+                    self.sock.sendall(replies)
+        except OSError:
+            return
+
+
+class LoopbackError(Exception):
+
+    def __init__(self, errorCode):
+        super(LoopbackError, self).__init__(errorCode)
+        self.errorCode = errorCode
+
+
+def startXDOMAppLoopbackSession(latency=0, **kwargs):
+    """
+    XDOMAppSessionCmdDispatch connected to an XDOMAppLoopback, which
+    serves the flash and camera FIFOs of the dispatch.  Returns
+    (session, server).
+    """
+    from .xdomapp_session_cmd_dispatch import XDOMAppSessionCmdDispatch
+    host, device = socket.socketpair()
+    host.setblocking(False)
+    server = XDOMAppLoopback(device, latency=latency)
+    server.start()
+    session = XDOMAppSessionCmdDispatch(host, **kwargs)
+    server.add_fifo(session.flashFifo)
+    server.add_fifo(session.cameraFifo)
+    return session, server
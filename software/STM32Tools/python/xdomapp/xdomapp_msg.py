@@ -3,6 +3,7 @@ from crc16 import calcCrcIBM
 import struct
 import os
 import select
+import collections
 
 
 class XDOMAppException(Exception):
@@ -51,15 +52,59 @@ PKT_ECHO_REQ  = 4
 
 PKT_HEADER = 0x8F15
 MAX_MSG_SIZE = 0x8000 # 32 KB
+REQ_HEADER_SIZE = 9
+REP_HEADER_SIZE = 5
+CRC_SIZE = 2
+# Largest payload of a reply
+MAX_PAYLOAD_SIZE = MAX_MSG_SIZE - REP_HEADER_SIZE - CRC_SIZE
 
 CLEAR_TIMEOUT = 0.1
 
+# Default number of requests that may wait for their reply at once
+MAX_OUTSTANDING = 4
+
+
+class XDOMAppRequest(object):
+    """
+    A request that has been sent and whose reply is collected with
+    XDOMAppMsg.wait().  The xDOM answers requests in the order they
+    were sent; opcode and tokens identify the request in errors.
+    """
+
+    def __init__(self, pktCode, opcode, token1, token2, timeout):
+        self.pktCode = pktCode
+        self.opcode = opcode
+        self.token1 = token1
+        self.token2 = token2
+        self.timeout = timeout
+        self.done = False
+        self.reply = None
+        self.error = None
+
+    def __repr__(self):
+        return "XDOMAppRequest(opcode=0x%04X, token1=%d, token2=%d)" % (
+                    self.opcode, self.token1, self.token2)
+
 
 class XDOMAppMsg(object):
+    """
+    Packet layer of the xDOMApp protocol.
 
-    def __init__(self, comms, **kwargs):
+    read(), write(), poll() and echo() send one request and wait for its
+    reply.  submit() only sends the request, so that several requests
+    (up to maxOutstanding) can be in flight at once; wait() returns the
+    reply of one of them.  Replies are received into a preallocated
+    buffer with recv_into(), so the comms object must implement send(),
+    recv(), recv_into(), close(), and fileno().
+    """
+
+    def __init__(self, comms, maxOutstanding=MAX_OUTSTANDING, **kwargs):
         self.comms = comms
         self.options = kwargs
+        self.maxOutstanding = max(int(maxOutstanding), 1)
+        self._rxBuf = bytearray(MAX_MSG_SIZE)
+        self._rxView = memoryview(self._rxBuf)
+        self._pending = collections.deque()
         self._clear()
 
     def __del__(self):
@@ -75,81 +120,77 @@ class XDOMAppMsg(object):
         while True:
             rdy = select.select([self.comms], [], [], CLEAR_TIMEOUT)
             if rdy[0]:
-                recv_bytes = self.comms.recv(4096)
+                recv_bytes = self.comms.recv_into(self._rxView)
+                if recv_bytes == 0:
+                    return
             else:
                 return
 
-    def _read_next(self, n_bytes, timeout):
-
-        rdy = select.select([self.comms], [], [], timeout)
-
-        if rdy[0]:
-            recv_bytes = self.comms.recv(n_bytes)
-            if len(recv_bytes) == 0:
+    def _recv_into(self, view, timeout):
+        # Fill the memoryview completely
+        ptr = 0
+        tot = len(view)
+        while ptr < tot:
+            rdy = select.select([self.comms], [], [], timeout)
+            if not rdy[0]:
+                raise IOError('Timeout')
+            recv_bytes = self.comms.recv_into(view[ptr:])
+            if recv_bytes == 0:
                 # Socket is closed
                 raise IOError("Socket is closed")
-            return recv_bytes
-        else:
-            raise IOError('Timeout')
+            ptr += recv_bytes
 
-    def _read_n(self, n_bytes, timeout):
-        buf = bytearray()
-        while len(buf) < n_bytes:
-            buf.extend(self._read_next(n_bytes - len(buf), timeout=timeout))
-
-        return buf
-
-    def _send_next(self, data, timeout):
-
-        rdy = select.select([], [self.comms], [], timeout)      
-
-        if rdy[1]:
-            sent_bytes = self.comms.send(data)
+    def _send_n(self, data, timeout):
+        view = memoryview(data)
+        ptr = 0
+        tot = len(view)
+        while ptr < tot:
+            rdy = select.select([], [self.comms], [], timeout)
+            if not rdy[1]:
+                raise IOError('Timeout')
+            sent_bytes = self.comms.send(view[ptr:])
             if sent_bytes == 0:
                 # Socket is closed
                 raise IOError("Socket is closed")
-            return sent_bytes
-        else:
-            raise IOError('Timeout')
+            ptr += sent_bytes
 
-    def _send_n(self, data, timeout):
-        ptr = 0
-        tot = len(data)
-        while ptr < tot:
-            ptr += self._send_next(data[ptr:tot], timeout)
+    def _build_req_packet(self, pktCode, opcode, token1, token2, data):
+        # Header, payload and CRC in one buffer
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            try:
+                data = memoryview(data)
+            except TypeError:
+                data = bytearray(data)
+        n = memoryview(data).nbytes
+        pkt = bytearray(REQ_HEADER_SIZE + n + CRC_SIZE)
+        struct.pack_into("<HHBHBB", pkt, 0, PKT_HEADER,
+                         REQ_HEADER_SIZE + n + CRC_SIZE,
+                         pktCode, opcode, token1, token2)
+        view = memoryview(pkt)
+        view[REQ_HEADER_SIZE:REQ_HEADER_SIZE + n] = memoryview(data).cast("B")
+        # Write CRC as big-endian
+        struct.pack_into(">H", pkt, REQ_HEADER_SIZE + n,
+                         calcCrcIBM(view[:REQ_HEADER_SIZE + n]))
+        return pkt
 
     def _send_req_packet(self, pktCode, opcode, token1, token2, data, timeout):
-        pkt = bytearray(9)
-        payload = bytearray(data)
-        pkt[0:2] = struct.pack("<H", PKT_HEADER)
-        pkt[2:4] = struct.pack("<H", 11 + len(payload))
-        pkt[4]   = struct.pack("<B", pktCode)
-        pkt[5:7] = struct.pack("<H", opcode)
-        pkt[7]   = struct.pack("<B", token1)
-        pkt[8]   = struct.pack("<B", token2)
-        self._send_n(pkt, timeout)
-        self._send_n(payload, timeout)
-        crc = calcCrcIBM(pkt)
-        crc = calcCrcIBM(payload, crc)
-        pkt = bytearray(2)
-        # Write CRC as big-endian
-        pkt[0:2] = struct.pack(">H", crc)
-        self._send_n(pkt, timeout)
+        self._send_n(self._build_req_packet(pktCode, opcode, token1, token2,
+                                            data), timeout)
 
     def _recv_rep_packet1(self, timeout):
-        hdr = bytearray(self._read_n(5, timeout))
-        if struct.unpack("<H", hdr[0:2])[0] != PKT_HEADER:
+        view = self._rxView
+        self._recv_into(view[:REP_HEADER_SIZE], timeout)
+        header, msglen, errorCode = struct.unpack_from("<HHB", view)
+        if header != PKT_HEADER:
             raise IOError("Checksum/packet error")
-        msglen = struct.unpack("<H", hdr[2:4])[0]
-        if msglen > MAX_MSG_SIZE:
+        if msglen > MAX_MSG_SIZE or msglen < REP_HEADER_SIZE + CRC_SIZE:
             raise IOError("Checksum/packet error")
-        checkErrorCode(hdr[4])
-        remainder = bytearray(self._read_n(msglen - 5, timeout))
-        crc = calcCrcIBM(hdr)
-        crc = calcCrcIBM(remainder, crc)
-        if crc != 0:
+        checkErrorCode(errorCode)
+        self._recv_into(view[REP_HEADER_SIZE:msglen], timeout)
+        if calcCrcIBM(view[:msglen]) != 0:
             raise IOError("Checksum/packet error")
-        return remainder[:-2]
+        # The receive buffer is reused, hand out a copy
+        return bytearray(view[REP_HEADER_SIZE:msglen - CRC_SIZE])
 
     def _recv_rep_packet(self, timeout):
         try:
@@ -158,23 +199,101 @@ class XDOMAppMsg(object):
             self._clear()
             raise
 
-    def read(self, opcode, nbytes, token1=0, token2=0, timeout=1):
-        self._send_req_packet(PKT_READ_REQ, opcode, token1, token2,
-                              bytearray(struct.pack("<H", nbytes)), timeout)
+    def _recv_next(self):
+        # Collect the reply of the oldest outstanding request
+        req = self._pending.popleft()
+        try:
+            req.reply = self._recv_rep_packet1(req.timeout)
+        except (IOError, XDOMAppException) as e:
+            req.error = e
+            req.done = True
+            # The replies of the following requests can not be told
+            # apart from the rest of this one any more
+            self._abort(IOError("Request discarded after error of %s: %s"
+                                % (req, e)))
+            return
+        req.done = True
+
+    def _abort(self, error):
+        self._clear()
+        while self._pending:
+            req = self._pending.popleft()
+            req.error = error
+            req.done = True
+
+    def submit(self, pktCode, opcode, data=bytearray(0), token1=0, token2=0,
+               timeout=1):
+        """
+        Send a request without waiting for its reply.  If maxOutstanding
+        requests are already in flight, the oldest reply is received
+        first.  Returns an XDOMAppRequest for wait().
+        """
+        while len(self._pending) >= self.maxOutstanding:
+            self._recv_next()
+        req = XDOMAppRequest(pktCode, opcode, token1, token2, timeout)
+        try:
+            self._send_req_packet(pktCode, opcode, token1, token2,
+                                  data, timeout)
+        except IOError as e:
+            self._abort(IOError("Request discarded after error of %s: %s"
+                                % (req, e)))
+            raise
+        self._pending.append(req)
+        return req
+
+    def submit_read(self, opcode, nbytes, token1=0, token2=0, timeout=1):
+        return self.submit(PKT_READ_REQ, opcode, struct.pack("<H", nbytes),
+                           token1, token2, timeout)
+
+    def submit_write(self, opcode, data, token1=0, token2=0, timeout=1):
+        return self.submit(PKT_WRITE_REQ, opcode, data,
+                           token1, token2, timeout)
+
+    def submit_poll(self, opcode, token1=0, token2=0, timeout=1):
+        return self.submit(PKT_POLL_REQ, opcode, bytearray(0),
+                           token1, token2, timeout)
+
+    def wait(self, req):
+        """
+        Reply of a submitted request; replies of requests sent before it
+        are received and kept in their XDOMAppRequest.  Raises the
+        error of the request if it failed.
+        """
+        while not req.done:
+            if not self._pending:
+                raise IOError("%s is not outstanding" % req)
+            self._recv_next()
+        if req.error is not None:
+            raise req.error
+        return req.reply
+
+    def flush(self):
+        """Receive the replies of all outstanding requests"""
+        while self._pending:
+            self._recv_next()
+
+    def outstanding(self):
+        return len(self._pending)
+
+    def _transact(self, pktCode, opcode, token1, token2, data, timeout):
+        # A single request behaves as before: errors reported by the
+        # xDOM flush the input
+        self.flush()
+        self._send_req_packet(pktCode, opcode, token1, token2, data, timeout)
         return self._recv_rep_packet(timeout)
 
+    def read(self, opcode, nbytes, token1=0, token2=0, timeout=1):
+        return self._transact(PKT_READ_REQ, opcode, token1, token2,
+                              struct.pack("<H", nbytes), timeout)
+
     def write(self, opcode, data, token1=0, token2=0, timeout=1):
-        payload = bytearray(data)
-        self._send_req_packet(PKT_WRITE_REQ, opcode, token1, token2,
-                              payload, timeout)
         # We still need to receive the response!
-        return self._recv_rep_packet(timeout)
+        return self._transact(PKT_WRITE_REQ, opcode, token1, token2,
+                              data, timeout)
 
     def poll(self, opcode, token1=0, token2=0, timeout=1):
-        self._send_req_packet(PKT_POLL_REQ, opcode, token1, token2,
+        return self._transact(PKT_POLL_REQ, opcode, token1, token2,
                               bytearray(0), timeout)
-        return (self._recv_rep_packet(timeout))
 
     def echo(self, data, timeout=1):
-        self._send_req_packet(PKT_ECHO_REQ, 0, 0, 0, bytearray(data), timeout)
-        return self._recv_rep_packet(timeout)
+        return self._transact(PKT_ECHO_REQ, 0, 0, 0, data, timeout)
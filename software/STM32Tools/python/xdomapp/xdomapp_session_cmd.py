@@ -1,6 +1,7 @@
 
 from . import xdomapp_msg
 from . import opcode
+from . import xdomapp_fifo_stream
 
 
 XDOMAPP_N_RETRIES = 2
@@ -43,6 +44,30 @@ class XDOMAppSessionCmd(object):
                                                timeout=opcode_def["timeout"]))
         return opcode.from_bytearray(opcode_def, res)
 
+    def _pipelined(self, submit, tokens):
+        # All requests in flight at once (up to msg.maxOutstanding), the
+        # whole batch is retried on IO errors
+        def cmd():
+            reqs = [submit(token1, token2) for (token1, token2) in tokens]
+            return [self.msg.wait(req) for req in reqs]
+        return _retry_cmd(cmd)
+
+    def read_opcodes(self, opcode_def, len, tokens):
+        """read_opcode() for every (token1, token2) in tokens"""
+        res = self._pipelined(
+            lambda token1, token2: self.msg.submit_read(
+                opcode_def["opcode"], len, token1=token1, token2=token2,
+                timeout=opcode_def["timeout"]), tokens)
+        return [opcode.from_bytearray(opcode_def, r) for r in res]
+
+    def poll_opcodes(self, opcode_def, tokens):
+        """poll_opcode() for every (token1, token2) in tokens"""
+        res = self._pipelined(
+            lambda token1, token2: self.msg.submit_poll(
+                opcode_def["opcode"], token1=token1, token2=token2,
+                timeout=opcode_def["timeout"]), tokens)
+        return [opcode.from_bytearray(opcode_def, r) for r in res]
+
     def write_opcode(self, opcode_def, value=None, token1=0, token2=0):
         data = opcode.to_bytearray(opcode_def, value)
         _retry_cmd(lambda: self.msg.write(opcode_def["opcode"], data,
@@ -74,3 +99,11 @@ class XDOMAppSessionCmd(object):
     def write_fifo(self, fifo_def, value, token1=0, token2=0):
         self.write_opcode(fifo_def["fifo"], value,
                           token1=token1, token2=token2)
+
+    def stream_fifo(self, fifo_def, token1=0, token2=0, **kwargs):
+        """
+        XDOMAppFifoStream that keeps draining the FIFO, see there for
+        the options
+        """
+        return xdomapp_fifo_stream.XDOMAppFifoStream(
+            self, fifo_def, token1=token1, token2=token2, **kwargs)
@@ -1,5 +1,5 @@
 
-from opcode import (define_opcode, define_fifo, Datatype)
+from .opcode import (define_opcode, define_fifo, Datatype)
 from . import xdomapp_session_cmd
 from . import xdomapp_data
 from . import xdomapp_msg
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# Measure the FIFO read bandwidth of the xDOMApp session layer offline,
+# against the loopback xDOMApp server: the FIFO stream reader compared
+# to a loop of poll_fifo() calls.
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+# The xdomapp modules import some of their siblings without the package
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "xdomapp"))
+from xdomapp.xdomapp_loopback import startXDOMAppLoopbackSession
+
+
+def pollFifoLoop(session, nBytes):
+    start = time.time()
+    got = 0
+    while got < nBytes:
+        if session.cmd.get_fifo_available_bytes(session.cameraFifo) > 0:
+            got += len(session.cmd.poll_fifo(session.cameraFifo))
+    return time.time() - start
+
+
+def streamFifo(session, nBytes, chunkSize):
+    stream = session.cmd.stream_fifo(session.cameraFifo, chunkSize=chunkSize)
+    start = time.time()
+    got = 0
+    with stream:
+        for words in stream:
+            got += words.nbytes
+            if got >= nBytes:
+                break
+    return time.time() - start, stream.statistics()
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--nBytes", help="Bytes to transfer", type=int,
+                      default=20000000)
+    parser.add_option("--latency", help="Reply latency of the loopback "
+                      "server, ms", type=float, default=0)
+    parser.add_option("--chunkSize", help="Stream read size, bytes",
+                      type=int, default=32760)
+    (options, args) = parser.parse_args()
+
+    payload = bytes(range(256)) * 4096
+    for name in ["poll_fifo", "stream"]:
+        session, server = startXDOMAppLoopbackSession(
+                                latency=options.latency * 1e-3)
+        fifo = server.fifos[(session.cameraFifo["fifo"]["opcode"], 0)]
+        fifo.capacity = options.nBytes
+        for i in range(0, options.nBytes, len(payload)):
+            fifo.feed(payload[:options.nBytes - i])
+        if name == "stream":
+            elapsed, stats = streamFifo(session, options.nBytes,
+                                        options.chunkSize)
+            extra = "reads:%d blocked:%d" % (stats["reads"], stats["blocked"])
+        else:
+            elapsed = pollFifoLoop(session, options.nBytes)
+            extra = ""
+        print("%-10s bytes:%d elapsed:%gs B/W:%f Mbps requests:%d %s" %
+              (name, options.nBytes, elapsed,
+               options.nBytes * 8 / elapsed / 1.0e6, server.requests, extra))
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
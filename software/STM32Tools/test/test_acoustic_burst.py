@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# Tests of the acoustic burst setup and capture against a fake acoustic
+# module which executes the IceBoot words of a command line in order
+#
+
+import os
+import sys
+import numpy as np
+import pytest
+
+# Fix up import path automatically
+sys.path.append(os.path.join(os.path.dirname(__file__), "../python"))
+from iceboot import acoustic_burst
+from iceboot.devices.acoustic import Acoustic
+
+
+class FakeAcousticComms:
+    def __init__(self, nSamples=50, pretrigger=10, baseline=2048,
+                 amplitude=300, notReady=(), seed=0):
+        self.settings = {"ARsetWaveform_sample": nSamples,
+                         "ARsetPretrigger_sample": pretrigger}
+        self.baseline = baseline
+        self.amplitude = amplitude
+        self.notReady = set(notReady)
+        self.rnd = np.random.RandomState(seed)
+        self.words = []
+        self.log = []
+        self.nTriggers = 0
+        self.irqCounter = 0
+        self.waveform = None
+
+    def _trigger(self):
+        nSamples = self.settings["ARsetWaveform_sample"]
+        pretrigger = self.settings["ARsetPretrigger_sample"]
+        wf = self.baseline + self.rnd.normal(0, 2, nSamples)
+        # the amplitude of burst i is amplitude + i
+        wf[pretrigger + 5] += self.amplitude + self.nTriggers
+        self.waveform = np.round(wf).astype(int)
+        self.nTriggers += 1
+
+    def cmd(self, cmdStr, timeout=1.0, strip_stack=False):
+        self.log.append(cmdStr)
+        if cmdStr == 'softwareVersion .s drop':
+            return '4660'
+        if cmdStr == 'printSoftwareId':
+            return 'FakeAcoustic'
+        stack = []
+        out = []
+        for word in cmdStr.split():
+            self.words.append(word)
+            if word.lstrip("-").isdigit():
+                stack.append(int(word))
+            elif word.startswith("AMset") or word.startswith("ARset"):
+                self.settings[word] = stack.pop()
+            elif word == "usleep":
+                stack.pop()
+                self.irqCounter += 1000
+            elif word in ("ARsendSWTrigger", "ARsendHWTrigger"):
+                self._trigger()
+            elif word == "ARgetIRQ_counter":
+                out.append(str(self.irqCounter))
+            elif word == "ARgetStatus":
+                ready = self.nTriggers - 1 not in self.notReady
+                out.append(str(0x81 if ready else 0x01))
+            elif word == "ARgetWaveformData":
+                out += [str(v) for v in self.waveform]
+            elif word == "ARgetWaveform_sample":
+                out.append(str(self.settings["ARsetWaveform_sample"]))
+        return " ".join(out)
+
+    def close(self):
+        pass
+
+
+def makeAcoustic(**kwargs):
+    comms = FakeAcousticComms(**kwargs)
+    return Acoustic(comms), comms
+
+
+def test_setup_burst_one_command():
+    am, comms = makeAcoustic()
+    comms.log = []
+    am.AMsetupBurst(mode=1, chirpMode=0, chirpStartFreqHz=5000,
+                    chirpStopFreqHz=30000, nBurst=3, durationMs=10,
+                    delayMs=5)
+    assert len(comms.log) == 1
+    assert comms.settings["AMsetWfMode"] == 1
+    assert comms.settings["AMsetWfChirpStartFreqHz"] == 5000
+    assert comms.settings["AMsetWfChirpStopFreqHz"] == 30000
+    assert comms.settings["AMsetWfNBurst"] == 3
+    assert comms.log[0].split()[-2:] == ["AMallocWfBuffer", "AMinitWfTimer"]
+
+
+def test_setup_receiver_one_command():
+    am, comms = makeAcoustic()
+    comms.log = []
+    nSamples = am.ARsetupReceiver(gain=10, nSamples=80, pretrigger=20,
+                                  triggerLevel=100, selfTrigger=False)
+    assert len(comms.log) == 1
+    assert nSamples == 80
+    assert comms.settings["ARsetGain"] == 10
+    assert comms.settings["ARsetPretrigger_sample"] == 20
+    assert "ARdisableSelfTrigger" in comms.log[0]
+
+
+def test_setup_validation():
+    am, comms = makeAcoustic()
+    with pytest.raises(ValueError):
+        am.AMsetupBurst(mode=2)
+    with pytest.raises(ValueError):
+        am.AMsetupBurst(sineFreqHz=50000)
+    with pytest.raises(ValueError):
+        am.ARsetupReceiver(gain=300)
+    with pytest.raises(ValueError):
+        am.ARiterBursts(20, burstsPerCmd=20).__next__()
+
+
+def test_capture_bursts(tmp_path):
+    am, comms = makeAcoustic(nSamples=50, pretrigger=10, notReady=[4])
+    comms.log = []
+    fileName = str(tmp_path / "bursts.npz")
+    bursts = am.ARcaptureBursts(21, burstsPerCmd=8, waitUs=1000,
+                                fileName=fileName, attrs={"gain": 10})
+    # the sample count is read once, then 8 + 8 + 5 bursts
+    assert len(comms.log) == 4
+    assert bursts["samples"].shape == (21, 50)
+    assert np.array_equal(bursts["irqCounter"], 1000 * np.arange(1, 22))
+    assert np.array_equal(np.nonzero(~bursts["ready"])[0], [4])
+    assert len(bursts["hostTime"]) == 21
+
+    result = acoustic_burst.analyzeBursts(bursts, nPretrigger=10)
+    assert np.all(result["peakIndex"] == 15)
+    assert np.allclose(result["amplitude"], 300 + np.arange(21), atol=10)
+    assert np.allclose(result["baseline"], 2048, atol=3)
+
+    saved = np.load(fileName)
+    assert np.array_equal(saved["samples"], bursts["samples"])
+    assert saved["gain"] == 10
+
+
+def test_short_reply():
+    am, comms = makeAcoustic(nSamples=50)
+    with pytest.raises(IOError):
+        am.ARcaptureBursts(4, nSamples=60)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+#
+# Tests of the readDEggWfmBlock buffer decoding and of the streaming ADC
+# and charge histogram accumulators
+#
+
+import os
+import sys
+import numpy as np
+import pytest
+
+# Fix up import path automatically
+sys.path.append(os.path.join(os.path.dirname(__file__), "../python"))
+from iceboot.test_waveform import (splitWaveformBlock, parseWaveformMatrix,
+                                   parseTestWaveform)
+from iceboot.adc_accumulator import (ADCHistogramAccumulator,
+                                     ChargeHistogramAccumulator,
+                                     adcToPicoCoulomb)
+from iceboot.charge_hist import make_hist
+
+
+def rev92Words(channel, timestamp, samples, flags=None):
+    ''' raw words of a version 0x92 waveform '''
+    if flags is None:
+        flags = np.zeros(len(samples), dtype=int)
+    words = [(0x92 << 8) | channel, 0, (timestamp & 0x1) << 2,
+             (timestamp >> 33) & 0xFFFF, (timestamp >> 17) & 0xFFFF,
+             (timestamp >> 1) & 0xFFFF, 0, 0]
+    for sample, flag in zip(samples, flags):
+        words += [int(sample) & 0xFFF, int(flag) << 1]
+    return words + [0, 0]
+
+
+def blockBuffer(wordLists, terminate=True):
+    ''' readDEggWfmBlock buffer: uint32 word count, then the words '''
+    words = []
+    for wfWords in wordLists:
+        words += [len(wfWords) & 0xFFFF, len(wfWords) >> 16] + wfWords
+    if terminate:
+        words += [0, 0]
+    return np.array(words, dtype='<u2').tobytes()
+
+
+def makeWaveforms(lengths, seed=0):
+    rnd = np.random.RandomState(seed)
+    wfs = []
+    for i, n in enumerate(lengths):
+        wfs.append(rev92Words(i % 2, 1000 * i + 3,
+                              rnd.randint(0, 4096, n),
+                              rnd.randint(0, 2, n)))
+    return wfs
+
+
+def test_split_constant_length():
+    wfs = makeWaveforms([32] * 10)
+    matrices = splitWaveformBlock(blockBuffer(wfs))
+    assert len(matrices) == 1
+    assert matrices[0].shape == (10, len(wfs[0]))
+    np.testing.assert_array_equal(matrices[0], np.array(wfs))
+
+    parsed = parseWaveformMatrix(matrices[0])
+    assert parsed["version"] == 0x92
+    for i, wfWords in enumerate(wfs):
+        wf = parseTestWaveform(wfWords)
+        assert parsed["channel"][i] == wf["channel"]
+        assert parsed["timestamp"][i] == wf["timestamp"]
+        np.testing.assert_array_equal(parsed["waveform"][i], wf["waveform"])
+        np.testing.assert_array_equal(parsed["thresholdFlags"][i],
+                                      wf["thresholdFlags"])
+
+
+def test_split_variable_length():
+    lengths = [32, 32, 48, 32, 48, 16]
+    wfs = makeWaveforms(lengths)
+    matrices = splitWaveformBlock(blockBuffer(wfs))
+    # the leading waveforms of equal length, then one matrix per length
+    assert [m.shape[0] for m in matrices] == [2, 2, 1, 1]
+    rows = sorted(tuple(row) for m in matrices for row in m)
+    assert rows == sorted(tuple(wf) for wf in wfs)
+
+
+def test_split_termination():
+    wfs = makeWaveforms([32] * 3)
+    assert splitWaveformBlock(b"") == []
+    assert splitWaveformBlock(blockBuffer([])) == []
+    # no waveform after the zero count is read
+    buf = blockBuffer(wfs[:2]) + blockBuffer(wfs[2:])
+    assert sum(len(m) for m in splitWaveformBlock(buf)) == 2
+    # an incomplete last waveform and an odd byte are dropped
+    buf = blockBuffer(wfs, terminate=False)
+    matrices = splitWaveformBlock(buf[:-10] + b"\x01")
+    assert sum(len(m) for m in matrices) == 2
+
+
+def test_parse_waveform_matrix_invalid():
+    with pytest.raises(ValueError):
+        parseWaveformMatrix(np.zeros((0, 10)))
+    wfs = makeWaveforms([16, 16])
+    wfs[1][0] = (0x91 << 8) | 1
+    with pytest.raises(ValueError):
+        parseWaveformMatrix(np.array(wfs))
+
+
+def test_adc_histogram_block_types():
+    rnd = np.random.RandomState(1)
+    samples = rnd.randint(7900, 8100, (50, 64))
+    fromArray = ADCHistogramAccumulator()
+    fromArray.addBlock(samples[:20])
+    fromArray.addBlock(samples[20:])
+    fromDict = ADCHistogramAccumulator(channel=0)
+    fromDict.addBlock({"channel": np.zeros(50, dtype=int),
+                       "waveform": samples})
+    fromList = ADCHistogramAccumulator(channel=0)
+    wfList = [{"channel": 0, "waveform": wf} for wf in samples]
+    assert fromList.consume(iter(wfList), batchSize=7) == 50
+
+    for acc in (fromArray, fromDict, fromList):
+        assert acc.nWaveforms == 50
+        assert acc.nSamples == samples.size
+        np.testing.assert_array_equal(acc.counts, fromArray.counts)
+    assert fromArray.mean() == pytest.approx(samples.mean())
+    assert fromArray.std() == pytest.approx(samples.std())
+    assert fromArray.quantile(0.5) == \
+        np.percentile(samples, 50, method="inverted_cdf")
+    hist = fromArray.toHistogram()
+    assert hist["min"] == samples.min()
+    assert hist["max"] == samples.max()
+    assert hist["counts"].sum() == samples.size
+
+    with pytest.raises(RuntimeError):
+        fromDict.addBlock({"channel": np.ones(2, dtype=int),
+                           "waveform": samples[:2]})
+    with pytest.raises(RuntimeError):
+        fromList.addBlock([{"channel": 1, "waveform": samples[0]}])
+    fromArray.reset()
+    with pytest.raises(ValueError):
+        fromArray.quantile(0.5)
+
+
+def test_adc_histogram_mixed_lengths():
+    acc = ADCHistogramAccumulator()
+    acc.addBlock([{"channel": 0, "waveform": np.full(32, 100)},
+                  {"channel": 0, "waveform": np.full(16, 200)}])
+    assert acc.nWaveforms == 2
+    assert acc.counts[100] == 32
+    assert acc.counts[200] == 16
+
+
+def test_charge_fixed_gate():
+    samples = np.full((4, 32), 8000)
+    samples[:, 10:13] += [[10, 20, 10]]
+    acc = ChargeHistogramAccumulator(100, -1., 0.05, gate=(8, 15),
+                                     baseline=8000, keepCharges=True)
+    acc.addBlock(samples)
+    expected = adcToPicoCoulomb(40.)
+    np.testing.assert_allclose(acc.allCharges(), expected)
+    assert acc.hist.sum() == 4
+    assert acc.hist[int((expected + 1.) / 0.05)] == 4
+    assert acc.toHistogram()["nbins"] == 100
+
+
+def test_charge_peak_window():
+    rnd = np.random.RandomState(2)
+    samples = 8000 + np.zeros((200, 64))
+    peaks = rnd.randint(20, 60, 200)
+    amplitudes = rnd.randint(50, 500, 200)
+    samples[np.arange(200), peaks] += amplitudes
+    # the peaks are behind the 16 baseline samples
+    acc = ChargeHistogramAccumulator(200, -1., 0.05, keepCharges=True)
+    acc.consume(iter([{"channel": 0, "waveform": wf} for wf in samples]),
+                batchSize=64)
+    assert acc.nWaveforms == 200
+    np.testing.assert_allclose(acc.allCharges(),
+                               adcToPicoCoulomb(amplitudes))
+    median = acc.quantile(0.5)
+    assert median == pytest.approx(
+        np.median(adcToPicoCoulomb(amplitudes)), abs=0.05)
+
+    # the window is cut at the end of the waveform
+    edge = np.full((1, 64), 8000.)
+    edge[0, -1] += 100
+    assert acc.charges(edge)[0] == pytest.approx(adcToPicoCoulomb(100.))
+
+    noCharges = ChargeHistogramAccumulator(10, 0., 1.)
+    with pytest.raises(ValueError):
+        noCharges.allCharges()
+    with pytest.raises(ValueError):
+        noCharges.quantile(0.5)
+
+
+class StreamSession:
+    ''' session in threshold trigger stream mode, reading blocks of
+    readWFBlockArrays with the given channels '''
+    def __init__(self, channels, blockLength=300):
+        self.channels = channels
+        self.blockLength = blockLength
+
+    def setDEggConstReadout(self, channel, prescale, nSamples):
+        self.nSamples = nSamples
+
+    def testDEggCPUTrig(self, channel):
+        pass
+
+    def testDEggWaveformReadout(self):
+        return {"channel": 0, "waveform": np.full(self.nSamples, 8000)}
+
+    def startDEggThreshTrigStream(self, channel, threshold):
+        pass
+
+    def readWFBlockArrays(self, blocksize):
+        waveforms = np.full((self.blockLength, self.nSamples), 8000)
+        waveforms[:, 100] += 100
+        return [{"channel": np.array(self.channels[:self.blockLength]),
+                 "waveform": waveforms}]
+
+    def endStream(self):
+        pass
+
+
+def test_charge_hist_stream():
+    session = StreamSession([0] * 300)
+    hist = make_hist(session, 0, 100, -1., 0.05, 20, 2, 5,
+                     enable_fepulser=False, blocksize=4096)
+    # 1000 waveforms of the 4 blocks
+    assert hist["hist"].sum() == 1000
+    assert hist["hist"][int((adcToPicoCoulomb(100.) + 1.) / 0.05)] == 1000
+
+    # the last waveform of every block is from the other channel
+    session = StreamSession([0] * 299 + [1])
+    with pytest.raises(RuntimeError):
+        make_hist(session, 0, 100, -1., 0.05, 20, 2, 5,
+                  enable_fepulser=False, blocksize=4096)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# Property tests of the fast CRC-16 engines in xdomapp/crc16.py:
+# random buffers of all sizes, start values and split points are
+# checked against the bytewise table loops and a bitwise reference
+#
+
+import os
+import sys
+import random
+import pytest
+
+# Fix up import path automatically
+sys.path.append(os.path.join(os.path.dirname(__file__), "../python/xdomapp"))
+import crc16
+
+SIZES = list(range(0, 40)) + [255, 256, 257, 1024, 1026, 8191, 8192, 8193,
+                              20000, 65536, 100003]
+SEEDS = range(5)
+
+
+def bitwiseCrc(buf, crc, poly, augmented):
+    # straight from the definition, one bit at a time
+    for b in buf:
+        for i in range(7, -1, -1):
+            bit = (b >> i) & 1
+            if augmented:
+                top = crc >> 15
+                crc = ((crc << 1) | bit) & 0xFFFF
+            else:
+                top = (crc >> 15) ^ bit
+                crc = (crc << 1) & 0xFFFF
+            if top:
+                crc ^= poly
+    return crc
+
+
+def randomBuffer(rnd, n):
+    return bytes(rnd.getrandbits(8) for _ in range(n))
+
+
+@pytest.mark.parametrize("table,poly", [(crc16.crc_table_ibm, 0x8005),
+                                        (crc16.crctab_ymodem, 0x1021)])
+def test_tables(table, poly):
+    assert table == [bitwiseCrc([i], 0, poly, False) for i in range(256)]
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_bytewise_vs_bitwise(seed):
+    rnd = random.Random(seed)
+    for n in range(0, 40):
+        buf = randomBuffer(rnd, n)
+        init = rnd.getrandbits(16)
+        assert crc16.calcCrcIBMBytewise(buf, init) == \
+            bitwiseCrc(buf, init, 0x8005, False)
+        assert crc16.calcCrcYmodemBytewise(buf, init) == \
+            bitwiseCrc(buf, init, 0x1021, True)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+@pytest.mark.parametrize("n", SIZES)
+def test_ibm(seed, n):
+    rnd = random.Random(seed * 1000003 + n)
+    buf = randomBuffer(rnd, n)
+    init = rnd.getrandbits(16)
+    assert crc16.calcCrcIBM(buf) == crc16.calcCrcIBMBytewise(buf)
+    assert crc16.calcCrcIBM(buf, init) == crc16.calcCrcIBMBytewise(buf, init)
+    assert crc16.calcCrcIBM(bytearray(buf), init) == \
+        crc16.calcCrcIBMBytewise(buf, init)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+@pytest.mark.parametrize("n", SIZES)
+def test_ymodem(seed, n):
+    rnd = random.Random(seed * 1000003 + n)
+    buf = randomBuffer(rnd, n)
+    init = rnd.getrandbits(16)
+    assert crc16.calcCrcYmodem(buf) == crc16.calcCrcYmodemBytewise(buf)
+    assert crc16.calcCrcYmodem(buf, init) == \
+        crc16.calcCrcYmodemBytewise(buf, init)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+@pytest.mark.parametrize("engine", [crc16.ibmEngine, crc16.ymodemEngine])
+def test_engine_paths(seed, engine):
+    # the numpy and slicing-by-2 paths have to agree for all sizes
+    if crc16.np is None:
+        pytest.skip("numpy not available")
+    rnd = random.Random(seed)
+    for n in [2, 3, 31, 32, 33, 1000, 4099]:
+        buf = randomBuffer(rnd, n)
+        init = rnd.getrandbits(16)
+        assert engine._blocks(buf, init) == engine._sliced(buf, init)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+@pytest.mark.parametrize("cls,reference", [
+    (crc16.CrcIBM, crc16.calcCrcIBMBytewise),
+    (crc16.CrcYmodem, crc16.calcCrcYmodemBytewise)])
+def test_incremental(seed, cls, reference):
+    rnd = random.Random(seed)
+    buf = randomBuffer(rnd, rnd.randint(0, 20000))
+    splits = sorted(rnd.randint(0, len(buf)) for _ in range(rnd.randint(0, 5)))
+    crc = cls()
+    start = 0
+    for stop in splits + [len(buf)]:
+        crc.update(buf[start:stop])
+        start = stop
+    assert crc.crc == reference(buf)
+    assert crc.digest() == bytes([crc.crc >> 8, crc.crc & 0xFF])
+    copy = crc.copy().update(b"\x01")
+    assert copy.crc == reference(buf + b"\x01")
+    assert crc.crc == reference(buf)
+
+
+def test_packet_check():
+    # a packet followed by its big-endian CRC has the CRC 0
+    rnd = random.Random(0)
+    for n in [9, 100, 10000]:
+        pkt = randomBuffer(rnd, n)
+        assert crc16.calcCrcIBM(pkt + crc16.CrcIBM(pkt).digest()) == 0
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+#
+# Tests of the DAC calibration against a fake D-Egg whose ADC baseline
+# is a linear function of the DAC, saturating at the ends of the ADC
+#
+
+import os
+import sys
+from collections import deque
+import numpy as np
+import pytest
+
+# Fix up import path automatically
+sys.path.append(os.path.join(os.path.dirname(__file__), "../python"))
+from iceboot import dac_cal
+
+ADC_MAX = 16383
+
+
+class FakeDEgg:
+    # ADC = gain * DAC + offset per channel
+    def __init__(self, gains=(0.3, 0.35), offsets=(-2000., 500.), noise=3.,
+                 seed=0):
+        self.gains = gains
+        self.offsets = offsets
+        self.noise = noise
+        self.rnd = np.random.RandomState(seed)
+        self.dac = {'A': 0, 'B': 0}
+        self.nSamples = {}
+        self.stream = None
+        self.buffer = deque()
+        self.nCommands = 0
+
+    def setDEggConstReadout(self, channel, preConfig, nSamples):
+        self.nSamples[channel] = nSamples
+
+    def setDAC(self, channel, value):
+        self.nCommands += 1
+        self.dac[channel] = value
+
+    def baseline(self, channel):
+        return (self.gains[channel] * self.dac['AB'[channel]] +
+                self.offsets[channel])
+
+    def waveforms(self, channel, n):
+        wfs = (self.baseline(channel) +
+               self.rnd.normal(0, self.noise, (n, self.nSamples[channel])))
+        return np.clip(np.round(wfs), 0, ADC_MAX).astype(np.int64)
+
+    def startDEggSWTrigStream(self, channel, period_in_ms):
+        self.nCommands += 1
+        self.stream = channel
+
+    def endStream(self):
+        self.stream = None
+
+    def readWFBlockArrays(self, nBytes):
+        # the stream adds 10 waveforms of the current DAC level to the
+        # buffer per read and a read returns at most 7, so that several
+        # reads are needed and waveforms are left over in the buffer
+        # after the stream ends
+        self.nCommands += 1
+        if self.stream is not None:
+            wfs = self.waveforms(self.stream, 10)
+            self.buffer.extend((self.stream, wf) for wf in wfs)
+        if len(self.buffer) == 0:
+            return []
+        nSamples = len(self.buffer[0][1])
+        n = nBytes // (4 + 2 * (2 * nSamples + 10))
+        n = min(n, 7, len(self.buffer))
+        read = [self.buffer.popleft() for _ in range(n)]
+        return [{"channel": np.array([channel for channel, _ in read]),
+                 "waveform": np.array([wf for _, wf in read])}]
+
+
+def test_read_level_block_stale_waveforms():
+    # waveforms of the previous level left in the buffer are not taken
+    # as data of the next level of the same channel
+    fake = FakeDEgg(noise=1.)
+    fake.setDEggConstReadout(0, 1, 64)
+    fake.setDAC('A', 20000)
+    dac_cal.readLevelBlock(fake, 0, 10, 64)
+    assert len(fake.buffer) == 0
+    fake.setDAC('A', 30000)
+    wfs = dac_cal.readLevelBlock(fake, 0, 10, 64)
+    assert np.all(np.abs(wfs.mean(axis=1) - fake.baseline(0)) < 1.)
+
+
+def expected(fake, channel):
+    # DAC = slope * ADC + intercept
+    slope = 1. / fake.gains[channel]
+    return slope, -fake.offsets[channel] * slope
+
+
+def test_read_level_block():
+    fake = FakeDEgg()
+    fake.setDEggConstReadout(1, 1, 64)
+    fake.setDAC('B', 20000)
+    wfs = dac_cal.readLevelBlock(fake, 1, 20, 64)
+    assert wfs.shape == (20, 64)
+    assert abs(wfs.mean() - fake.baseline(1)) < 1.
+    assert fake.stream is None
+
+
+def test_calibrate_fast():
+    fake = FakeDEgg()
+    fitparams = dac_cal.calibrateDACFast(fake, settle=0)
+    for channel in [0, 1]:
+        fit = fitparams[channel]
+        slope, intercept = expected(fake, channel)
+        assert fit["slope"] == pytest.approx(slope, rel=1e-3)
+        assert fit["intercept"] == pytest.approx(intercept, abs=30)
+        assert fit["r2"] > 0.9999
+        assert fit["converged"]
+        levels = fit["levels"]
+        assert levels.dtype == dac_cal.LEVEL_DTYPE
+        assert np.all(np.diff(levels["dac"]) > 0)
+        assert fit["nLevels"] == len(levels) < 22
+        assert np.sum(levels["inWindow"]) >= 5
+        assert np.all(np.abs(levels["residual"][levels["inWindow"]]) < 20)
+    # both channels had saturated levels to skip
+    assert not np.all(fitparams[0]["levels"]["inWindow"])
+    assert not np.all(fitparams[1]["levels"]["inWindow"])
+
+
+def test_calibrate_fast_noisy():
+    # large noise and partly clipped levels: still a good fit, stops at
+    # maxLevels if it can not converge
+    fake = FakeDEgg(noise=400., seed=1)
+    fitparams = dac_cal.calibrateDACFast(fake, settle=0, maxLevels=12,
+                                         minR2=1.)
+    for channel in [0, 1]:
+        assert not fitparams[channel]["converged"]
+        assert fitparams[channel]["nLevels"] == 12
+        slope, _ = expected(fake, channel)
+        assert fitparams[channel]["slope"] == pytest.approx(slope, rel=1e-2)
+
+
+def test_calibrate_batch():
+    fakes = [FakeDEgg(gains=(0.2 + 0.01 * i, 0.3), seed=i) for i in range(4)]
+    broken = FakeDEgg(gains=(0., 0.), offsets=(ADC_MAX + 100., 0.))
+    results = dac_cal.calibrateDACBatch(fakes + [broken], settle=0)
+    for fake, fitparams in zip(fakes, results):
+        slope, _ = expected(fake, 0)
+        assert fitparams[0]["slope"] == pytest.approx(slope, rel=1e-3)
+    assert isinstance(results[-1], RuntimeError)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#
+# Tests of the closed-loop POCAM PWM scan against the simulated POCAM
+#
+
+import os
+import sys
+import numpy as np
+import pytest
+
+# Fix up import path automatically
+sys.path.append(os.path.join(os.path.dirname(__file__), "../python"))
+from iceboot import pwm_scan
+from iceboot.devices.pocam import POCAM
+from iceboot.pocam_sim import SimulatedPOCAMComms
+
+
+def makePOCAM(**kwargs):
+    comms = SimulatedPOCAMComms(**kwargs)
+    return POCAM(comms), comms
+
+
+def test_scan_single():
+    pocam, comms = makePOCAM(tau=0.1)
+    curves = pocam.scan_pwm_adaptive('lmg1', readInterval=0, settleReads=10,
+                                     settleTol=0.03, verbose=False)
+    curve = curves['lmg1']
+    points = curve.points
+    assert points.dtype == pwm_scan.CURVE_DTYPE
+    assert np.all(points["settled"])
+    assert np.all(np.diff(points["pwm"]) > 0)
+    assert points["pwm"][0] == 0 and points["pwm"][-1] == 65535
+    # measured after settling, not after a fixed time
+    assert np.all(np.abs(points["voltage"] -
+                         comms.target('lmg1', points["pwm"])) < 0.1)
+    assert points["nReads"].max() > 10
+    # the refinement puts the points on the steep part of the curve
+    steep = np.abs(points["pwm"] - 30000) < 8000
+    assert np.sum(steep) > len(points) / 2
+    for voltage in [5., 20., 31., 55.]:
+        pwm = curve.pwmFor(voltage)
+        assert comms.target('lmg1', pwm) == pytest.approx(voltage, abs=0.3)
+        assert curve.voltage(pwm) == pytest.approx(voltage, abs=0.01)
+
+
+def test_scan_interleaved():
+    pocam, comms = makePOCAM(tau=0.05)
+    hvs = ['lmg2', 'sipm2', 'kapu1']
+    comms.log = []
+    curves = pocam.scan_pwm_adaptive(hvs, nCoarse=5, maxPoints=12,
+                                     readInterval=0, verbose=False)
+    assert sorted(curves) == sorted(hvs)
+    for hv in hvs:
+        assert len(curves[hv]) == 12
+    # the PWM of all channels is set before their read-backs
+    first = [cmd.split('"')[1].strip() for cmd in comms.log[:6]]
+    assert first == hvs + hvs
+    assert [cmd.split()[-1] for cmd in comms.log[:6]] == ['pcmPWM'] * 3 + \
+        ['pcmADC'] * 3
+
+
+def test_scan_not_settled():
+    pocam, comms = makePOCAM(tau=1000.)
+    curves = pocam.scan_pwm_adaptive('sipm1', nCoarse=3, maxPoints=3,
+                                     maxReads=20, settleTol=1e-4,
+                                     settleRelTol=0,
+                                     readInterval=0, verbose=False)
+    points = curves['sipm1'].points
+    assert not np.any(points["settled"][1:])
+    assert np.all(points["nReads"][1:] == 20)
+
+
+def test_scan_errors():
+    pocam, comms = makePOCAM()
+    with pytest.raises(ValueError):
+        pocam.scan_pwm_adaptive('lmg3')
+    with pytest.raises(ValueError):
+        pocam.pwm('lmg1', 70000)
+    with pytest.raises(RuntimeError):
+        pwm_scan.scanPWM(pocam, ['ib'], readInterval=0)
+
+
+def test_curve_lookup():
+    points = np.zeros(5, dtype=pwm_scan.CURVE_DTYPE)
+    points["pwm"] = [4000, 0, 1000, 3000, 2000]
+    points["voltage"] = [10., 50., 40., 10., 20.]
+    curve = pwm_scan.PWMCurve('kapu2', points)
+    assert list(curve.points["pwm"]) == [0, 1000, 2000, 3000, 4000]
+    # falling curve, flat end left out of the inverse
+    assert curve.pwmFor(45.) == 500
+    assert curve.pwmFor(15.) == 2500
+    with pytest.raises(ValueError):
+        curve.pwmFor(5.)
+    with pytest.raises(ValueError):
+        curve.pwmFor(51.)
+    copy = pwm_scan.PWMCurve.fromDict(curve.toDict())
+    assert copy.hv == 'kapu2'
+    assert np.array_equal(copy.points, curve.points)
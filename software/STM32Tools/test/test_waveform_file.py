@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# Round trip tests of the binary waveform file against the JSON format
+#
+
+import os
+import sys
+import numpy as np
+import pytest
+
+# Fix up import path automatically
+sys.path.append(os.path.join(os.path.dirname(__file__), "../python"))
+from iceboot import waveform_file
+from iceboot.test_waveform import (writeWaveformFile, loadWaveformFile,
+                                   BINARY_WAVEFORM_EXTENSION)
+from iceboot.waveform_file import WaveformFile, WaveformFileWriter
+
+
+def makeWaveforms(n=20, nSamples=64, seed=0):
+    rnd = np.random.RandomState(seed)
+    wfs = []
+    for i in range(n):
+        wfs.append({
+            "version": 0x92,
+            "channel": i % 2,
+            "timestamp": 1000 * i,
+            "waveformLength": nSamples,
+            "pattern": [1, 2, 3, 4],
+            "waveform": rnd.randint(7000, 9000, nSamples),
+            "thresholdFlags": rnd.randint(0, 2, nSamples),
+        })
+    return wfs
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_round_trip_json(tmp_path, compress):
+    wfs = makeWaveforms()
+    jsonFile = str(tmp_path / "wfs.json")
+    binFile = str(tmp_path / ("wfs" + BINARY_WAVEFORM_EXTENSION))
+    writeWaveformFile([dict(wf) for wf in wfs], jsonFile)
+    writeWaveformFile([dict(wf) for wf in wfs], binFile, compress=compress)
+    fromJson = loadWaveformFile(jsonFile)
+    fromBin = loadWaveformFile(binFile)
+    assert len(fromBin) == len(fromJson) == len(wfs)
+    for a, b in zip(fromJson, fromBin):
+        assert sorted(a) == sorted(b)
+        for key in a:
+            if isinstance(a[key], np.ndarray):
+                assert b[key].dtype == a[key].dtype
+                np.testing.assert_array_equal(a[key], b[key])
+            else:
+                assert a[key] == b[key]
+    # no wrap around when the baseline is subtracted
+    assert np.all(fromBin[0]["waveform"] - 9000 < 0)
+
+
+def test_float_waveforms(tmp_path):
+    wfs = makeWaveforms(n=5)
+    for wf in wfs:
+        wf["waveform"] = wf["waveform"] - 8000.25
+    binFile = str(tmp_path / "float.wfb")
+    waveform_file.writeBinaryWaveformFile(wfs, binFile)
+    loaded = waveform_file.loadBinaryWaveformFile(binFile)
+    assert loaded[0]["waveform"].dtype == np.float64
+    for wf, wfLoaded in zip(wfs, loaded):
+        np.testing.assert_allclose(wfLoaded["waveform"], wf["waveform"])
+
+    # the writer takes the dtype from the first waveform
+    with WaveformFileWriter(str(tmp_path / "float2.wfb")) as writer:
+        writer.extend(wfs)
+    with WaveformFile(str(tmp_path / "float2.wfb")) as wfFile:
+        assert wfFile.waveforms().dtype == np.float32
+
+
+def test_refuse_lossy_input(tmp_path):
+    wfs = makeWaveforms(n=2)
+    with WaveformFileWriter(str(tmp_path / "u2.wfb"),
+                            waveformDtype="<u2") as writer:
+        writer.append(wfs[0])
+        with pytest.raises(ValueError):
+            writer.append(dict(wfs[1], waveform=wfs[1]["waveform"] + 0.5))
+        with pytest.raises(ValueError):
+            writer.append(dict(wfs[1], waveform=wfs[1]["waveform"] - 8000))
+    with WaveformFile(str(tmp_path / "u2.wfb")) as wfFile:
+        assert len(wfFile) == 1
+
+
+def test_memmap_slicing(tmp_path):
+    wfs = makeWaveforms(n=50, nSamples=32)
+    fileName = str(tmp_path / "wfs.wfb")
+    # small chunks, so that a slice spans several of them
+    with WaveformFileWriter(fileName, chunkSamples=100) as writer:
+        writer.extend(wfs)
+    with WaveformFile(fileName) as wfFile:
+        assert isinstance(wfFile.waveforms(), np.memmap)
+        block = wfFile.waveforms(10, 23)
+        assert block.shape == (13, 32)
+        np.testing.assert_array_equal(
+            block, np.array([wf["waveform"] for wf in wfs[10:23]]))
+        np.testing.assert_array_equal(wfFile[17]["waveform"],
+                                      wfs[17]["waveform"])
+        assert [wf["timestamp"] for wf in wfFile[5:8]] == [5000, 6000, 7000]
+        np.testing.assert_array_equal(wfFile.metadata["channel"][:4],
+                                      [0, 1, 0, 1])
+
+
+def test_read_after_close(tmp_path):
+    wfs = makeWaveforms(n=5, nSamples=32)
+    fileName = str(tmp_path / "wfs.wfb")
+    waveform_file.writeBinaryWaveformFile(wfs, fileName)
+    with WaveformFile(fileName) as wfFile:
+        record = wfFile[3]
+        block = wfFile.waveforms()
+        samples = wfFile.samples(1)
+    wfFile.close()
+    np.testing.assert_array_equal(record["waveform"], wfs[3]["waveform"])
+    np.testing.assert_array_equal(block[4], wfs[4]["waveform"])
+    np.testing.assert_array_equal(samples["waveform"], wfs[1]["waveform"])
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+#
+# Tests of the FIFO stream reader against the loopback xDOMApp server
+#
+
+import os
+import sys
+import threading
+import time
+import numpy as np
+import pytest
+
+# Fix up import path automatically
+sys.path.append(os.path.join(os.path.dirname(__file__), "../python"))
+sys.path.append(os.path.join(os.path.dirname(__file__), "../python/xdomapp"))
+from xdomapp import xdomapp_msg
+from xdomapp.xdomapp_loopback import startXDOMAppLoopbackSession
+
+
+def counter(start, n):
+    return (np.arange(start, start + n) & 0xFFFF).astype("<u2")
+
+
+@pytest.fixture
+def loopback():
+    session, server = startXDOMAppLoopbackSession()
+    yield session, server
+    session.close()
+
+
+def test_loopback_fifo(loopback):
+    session, server = loopback
+    server.fifos[(0xC120, 1)] = server.fifos[(0xC120, 0)]
+    server.fifos[(0xC120, 0)].feed(bytes(range(100)))
+    assert session.cameraImageSize(1) == 100
+    assert session.readCameraImage(1) == bytes(range(100))
+    assert session.cameraImageSize(1) == 0
+    with pytest.raises(xdomapp_msg.XDOMAppException):
+        session.cmd.read_fifo(session.cameraFifo, 10)
+
+
+def test_poll_opcodes(loopback):
+    session, server = loopback
+    fifo = server.add_fifo(session.cameraFifo, token1=3)
+    fifo.feed(b"12345")
+    sizes = session.cmd.poll_opcodes(session.cameraFifo["size"],
+                                     [(0, 0), (3, 0), (0, 0)])
+    assert sizes == [0, 5, 0]
+
+
+@pytest.mark.parametrize("nBytes", [0, 1, 2, 33333, 200001])
+def test_stream_until_empty(loopback, nBytes):
+    session, server = loopback
+    data = bytes(np.random.RandomState(nBytes).randint(0, 256, nBytes,
+                                                       dtype=np.uint8))
+    server.fifos[(0x0210, 0)].feed(data)
+    stream = session.cmd.stream_fifo(session.flashFifo, dtype="u1",
+                                     stopWhenEmpty=True)
+    words = list(stream)
+    assert b"".join(w.tobytes() for w in words) == data
+    assert session.cmd.get_fifo_available_bytes(session.flashFifo) == 0
+    stats = stream.statistics()
+    assert stats["bytes"] == nBytes
+    assert stats["overflowWords"] == 0
+
+
+def test_stream_words(loopback):
+    session, server = loopback
+    fifo = server.fifos[(0xC120, 0)]
+    # odd-sized pieces: words are split between FIFO reads
+    data = counter(0, 40000).tobytes()
+    total = 0
+    for n in [1, 999, 70000, 3]:
+        fifo.feed(data[total:total + n])
+        total += n
+    stream = session.cmd.stream_fifo(session.cameraFifo, chunkSize=4001,
+                                     stopWhenEmpty=True)
+    words = np.concatenate(list(stream))
+    assert words.dtype == np.dtype("=u2")
+    assert len(words) == total // 2
+    assert np.array_equal(words[:500], counter(0, 500))
+
+
+def test_stream_continuous(loopback):
+    session, server = loopback
+    fifo = server.fifos[(0xC120, 0)]
+    nWords = 300000
+
+    def producer():
+        for start in range(0, nWords, 10000):
+            while fifo.feed(counter(start, 10000).tobytes()) == 0:
+                pass
+
+    stream = session.cmd.stream_fifo(session.cameraFifo, capacity=50000)
+    feeder = threading.Thread(target=producer)
+    with stream:
+        feeder.start()
+        received = []
+        n = 0
+        for words in stream:
+            received.append(words)
+            n += len(words)
+            if n >= nWords:
+                break
+    feeder.join()
+    words = np.concatenate(received)
+    assert np.array_equal(words, counter(0, nWords))
+    assert fifo.overflowBytes == 0
+    assert stream.error is None
+
+
+def test_stream_backpressure(loopback):
+    session, server = loopback
+    server.fifos[(0xC120, 0)].feed(counter(0, 50000).tobytes())
+    stream = session.cmd.stream_fifo(session.cameraFifo, capacity=10000,
+                                     stopWhenEmpty=True)
+    stream.start()
+    while stream.available() < 10000:
+        time.sleep(0.001)
+    # let the reader run into the full ring buffer
+    time.sleep(0.05)
+    first = stream.read(maxWords=5000)
+    # the reader waits for space instead of dropping words
+    rest = np.concatenate(list(stream))
+    assert np.array_equal(np.concatenate([first, rest]), counter(0, 50000))
+    stats = stream.statistics()
+    assert stats["blocked"] > 0
+    assert stats["overflowWords"] == 0
+    assert stats["maxFill"] <= 10000
+
+
+def test_stream_drop(loopback):
+    session, server = loopback
+    server.fifos[(0xC120, 0)].feed(counter(0, 50000).tobytes())
+    stream = session.cmd.stream_fifo(session.cameraFifo, capacity=10000,
+                                     overflow="drop", stopWhenEmpty=True)
+    stream.start()
+    while stream.running():
+        time.sleep(0.001)
+    stream.stop()
+    words = stream.read()
+    stats = stream.statistics()
+    assert stats["words"] == 50000
+    assert stats["overflowWords"] == 40000
+    assert np.array_equal(words, counter(40000, 10000))
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+#
+# Tests of the xDOMApp packet layer against a fake xDOM on the other
+# end of a socketpair: single requests, pipelined requests and error
+# handling
+#
+
+import os
+import sys
+import struct
+import socket
+import threading
+import pytest
+
+# Fix up import path automatically
+sys.path.append(os.path.join(os.path.dirname(__file__), "../python/xdomapp"))
+import xdomapp_msg
+from crc16 import calcCrcIBM, CrcIBM
+
+ERROR_OPCODE = 0x0BAD
+CORRUPT_OPCODE = 0x0BAE
+
+
+def pollReply(opcode, token1, token2):
+    return struct.pack("<HBB", opcode, token1, token2)
+
+
+def readReply(opcode, nbytes):
+    return bytes((opcode + i) & 0xFF for i in range(nbytes))
+
+
+def repPacket(errorCode, data):
+    pkt = struct.pack("<HHB", xdomapp_msg.PKT_HEADER, len(data) + 7,
+                      errorCode) + bytes(data)
+    return pkt + CrcIBM(pkt).digest()
+
+
+class FakeXDOM(threading.Thread):
+    """Answers requests in order, records what it received"""
+
+    def __init__(self, sock):
+        super().__init__(daemon=True)
+        self.sock = sock
+        self.requests = []
+
+    def recvN(self, n):
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = self.sock.recv(n - len(buf))
+            if not chunk:
+                raise EOFError
+            buf.extend(chunk)
+        return buf
+
+    def run(self):
+        try:
+            while True:
+                hdr = self.recvN(9)
+                _, pktlen, pktCode, opcode, token1, token2 = \
+                    struct.unpack("<HHBHBB", hdr)
+                rest = self.recvN(pktlen - 9)
+                assert calcCrcIBM(hdr + rest) == 0
+                payload = bytes(rest[:-2])
+                self.requests.append((pktCode, opcode, token1, token2,
+                                      payload))
+                self.sock.sendall(self.reply(pktCode, opcode, token1,
+                                             token2, payload))
+        except (EOFError, OSError):
+            pass
+
+    def reply(self, pktCode, opcode, token1, token2, payload):
+        if opcode == ERROR_OPCODE:
+            return repPacket(3, b"")
+        if opcode == CORRUPT_OPCODE:
+            pkt = bytearray(repPacket(0, b"abc"))
+            pkt[-1] ^= 0xFF
+            return pkt
+        if pktCode == xdomapp_msg.PKT_READ_REQ:
+            return repPacket(0, readReply(opcode,
+                                          struct.unpack("<H", payload)[0]))
+        if pktCode == xdomapp_msg.PKT_POLL_REQ:
+            return repPacket(0, pollReply(opcode, token1, token2))
+        if pktCode == xdomapp_msg.PKT_ECHO_REQ:
+            return repPacket(0, payload)
+        return repPacket(0, b"")
+
+
+@pytest.fixture
+def link():
+    a, b = socket.socketpair()
+    a.setblocking(False)
+    fake = FakeXDOM(b)
+    fake.start()
+    msg = xdomapp_msg.XDOMAppMsg(a, maxOutstanding=3)
+    yield msg, fake
+    msg.close()
+    b.close()
+    fake.join(1)
+
+
+def test_build_req_packet(link):
+    msg, _ = link
+    pkt = msg._build_req_packet(xdomapp_msg.PKT_WRITE_REQ, 0x1234, 5, 6,
+                                b"\x01\x02\x03")
+    assert pkt[:9] == struct.pack("<HHBHBB", xdomapp_msg.PKT_HEADER, 14,
+                                  xdomapp_msg.PKT_WRITE_REQ, 0x1234, 5, 6)
+    assert pkt[9:12] == b"\x01\x02\x03"
+    assert calcCrcIBM(pkt) == 0
+    assert msg._build_req_packet(xdomapp_msg.PKT_WRITE_REQ, 0x1234, 5, 6,
+                                 [1, 2, 3]) == pkt
+
+
+def test_single_requests(link):
+    msg, fake = link
+    assert msg.poll(0x0101, token1=7, token2=9) == pollReply(0x0101, 7, 9)
+    assert msg.read(0x0210, 1000) == readReply(0x0210, 1000)
+    assert msg.write(0x0211, b"\x10\x00") == bytearray()
+    data = bytes(range(256)) * 100
+    assert msg.echo(data) == data
+    assert fake.requests[2] == (xdomapp_msg.PKT_WRITE_REQ, 0x0211, 0, 0,
+                                b"\x10\x00")
+
+
+def test_pipelined(link):
+    msg, fake = link
+    reqs = [msg.submit_poll(0x0C00, token1=i) for i in range(20)]
+    assert msg.outstanding() <= 3
+    # replies are matched to their requests, also when collected out of order
+    assert msg.wait(reqs[10]) == pollReply(0x0C00, 10, 0)
+    assert all(req.done for req in reqs[:11])
+    for i, req in enumerate(reqs):
+        assert msg.wait(req) == pollReply(0x0C00, i, 0)
+    assert msg.outstanding() == 0
+    assert [r[2] for r in fake.requests] == list(range(20))
+
+
+def test_pipelined_read(link):
+    msg, _ = link
+    reqs = [msg.submit_read(0x0210, n) for n in [1, 100, 30000, 2]]
+    msg.flush()
+    assert [req.reply for req in reqs] == \
+        [readReply(0x0210, n) for n in [1, 100, 30000, 2]]
+
+
+def test_error_reply(link):
+    msg, _ = link
+    with pytest.raises(xdomapp_msg.XDOMAppException):
+        msg.poll(ERROR_OPCODE)
+    # the link is still usable afterwards
+    assert msg.poll(0x0101) == pollReply(0x0101, 0, 0)
+
+
+def test_pipelined_error(link):
+    msg, _ = link
+    first = msg.submit_poll(0x0101)
+    bad = msg.submit_poll(CORRUPT_OPCODE)
+    after = msg.submit_poll(0x0102)
+    assert msg.wait(first) == pollReply(0x0101, 0, 0)
+    with pytest.raises(IOError):
+        msg.wait(bad)
+    with pytest.raises(IOError):
+        msg.wait(after)
+    assert msg.outstanding() == 0
+    assert msg.poll(0x0103) == pollReply(0x0103, 0, 0)
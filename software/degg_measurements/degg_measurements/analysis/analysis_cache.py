@@ -0,0 +1,204 @@
+import os
+import fcntl
+import hashlib
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+def file_digest(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as open_file:
+        for chunk in iter(lambda: open_file.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class AnalysisCache(object):
+    '''
+    Incremental cache of per-file summary statistics.
+
+    Every entry is computed from one or more source files (plus an
+    optional parameter string) and is keyed by the sha1 of their
+    contents, so moved or copied files (e.g. local and remote copies)
+    hit the same entry and changed files get a new one. The digests
+    are remembered per path together with size and mtime, so unchanged
+    files are not read again.
+
+    The entries are rows of a columnar HDF5 table (one namespace per
+    analysis inside the cache file); optional arrays of an entry are
+    stored as separate nodes. Writers take an exclusive lock on
+    `<cache_file>.lock`, readers a shared one, so several analyses can
+    read the same cache while one of them adds entries.
+    '''
+    STRING_SIZE = 256
+
+    def __init__(self, cache_file, namespace, version=1):
+        self.cache_file = cache_file
+        self.namespace = namespace
+        self.version = version
+        self._lock_file = f'{cache_file}.lock'
+
+    @contextmanager
+    def _locked(self, exclusive):
+        cache_dir = os.path.dirname(os.path.abspath(self.cache_file))
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(self._lock_file, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _node(self, name):
+        return f'/{self.namespace}/{name}'
+
+    def _array_node(self, cache_key, name):
+        return f'/{self.namespace}/arrays/k{cache_key}/{name}'
+
+    def _read_tables(self):
+        files = None
+        summary = None
+        if not os.path.isfile(self.cache_file):
+            return files, summary
+        with pd.HDFStore(self.cache_file, mode='r') as store:
+            if self._node('files') in store:
+                files = store[self._node('files')]
+                files = files.drop_duplicates('path', keep='last')
+                files = files.set_index('path')
+            if self._node('summary') in store:
+                summary = store[self._node('summary')]
+        return files, summary
+
+    def _digest(self, path, files, new_files):
+        info = os.stat(path)
+        if files is not None and path in files.index:
+            known = files.loc[path]
+            if known['size'] == info.st_size and \
+                    known['mtime_ns'] == info.st_mtime_ns:
+                return known['digest']
+        digest = file_digest(path)
+        new_files.append({'path': path, 'size': info.st_size,
+                          'mtime_ns': info.st_mtime_ns, 'digest': digest})
+        return digest
+
+    def _entry_key(self, sources, params, files, new_files):
+        if isinstance(sources, str):
+            sources = [sources]
+        sha1 = hashlib.sha1(f'{self.version}|{params}'.encode())
+        for path in sources:
+            sha1.update(self._digest(os.path.abspath(path),
+                                     files, new_files).encode())
+        return sha1.hexdigest()
+
+    def _append(self, store, name, df):
+        node = self._node(name)
+        min_itemsize = {c: self.STRING_SIZE for c in df.columns
+                        if df[c].dtype == object}
+        try:
+            store.append(node, df, format='table', index=False,
+                         min_itemsize=min_itemsize)
+        except (ValueError, TypeError):
+            # the columns changed (e.g. a new sensor), rewrite the table
+            df = pd.concat([store[node], df], ignore_index=True, sort=False)
+            min_itemsize = {c: self.STRING_SIZE for c in df.columns
+                            if df[c].dtype == object}
+            store.put(node, df, format='table', index=False,
+                      min_itemsize=min_itemsize)
+
+    def update(self, entries, compute, verbose=True, n_jobs=1):
+        '''
+        entries: list of (sources, params), sources is a filename or a
+                 list of filenames, params a string of everything else
+                 the result depends on
+        compute: compute(sources, params) -> dict of scalars, or
+                 (dict of scalars, dict of arrays), or None to skip
+        n_jobs:  > 1 computes the entries in a process pool, compute
+                 has to be a module level function then
+
+        Only entries without a cached row are computed. Returns a
+        DataFrame with one row per entry that has a result, in the
+        order of entries, with the entry key in the column 'cache_key'
+        and its index in entries in the column 'entry'.
+        '''
+        with self._locked(exclusive=False):
+            files, summary = self._read_tables()
+        known = set() if summary is None else set(summary['cache_key'])
+
+        new_files = []
+        keys = [self._entry_key(sources, params, files, new_files)
+                for sources, params in entries]
+
+        todo = {}
+        for key, (sources, params) in zip(keys, entries):
+            if key not in known and key not in todo:
+                todo[key] = (sources, params)
+        todo_sources = [sources for sources, _ in todo.values()]
+        todo_params = [params for _, params in todo.values()]
+        if n_jobs > 1 and len(todo) > 1:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                results = list(executor.map(compute, todo_sources, todo_params))
+        else:
+            results = list(map(compute, todo_sources, todo_params))
+
+        new_rows = []
+        new_arrays = {}
+        skipped = []
+        for key, result in zip(todo.keys(), results):
+            if result is None:
+                skipped.append(key)
+                continue
+            if isinstance(result, tuple):
+                row, arrays = result
+            else:
+                row, arrays = result, {}
+            row = dict(row)
+            row['cache_key'] = key
+            new_rows.append(row)
+            new_arrays[key] = arrays
+        if verbose:
+            print(f'{self.namespace}: {len(entries)} entries, '
+                  f'{len(new_rows)} computed, {len(skipped)} without result')
+
+        if len(new_rows) > 0 or len(new_files) > 0:
+            with self._locked(exclusive=True):
+                with pd.HDFStore(self.cache_file, mode='a') as store:
+                    if len(new_files) > 0:
+                        self._append(store, 'files', pd.DataFrame(new_files))
+                    # another process may have added them meanwhile
+                    node = self._node('summary')
+                    if node in store:
+                        known = set(store[node]['cache_key'])
+                    new_rows = [r for r in new_rows
+                                if r['cache_key'] not in known]
+                    if len(new_rows) > 0:
+                        self._append(store, 'summary', pd.DataFrame(new_rows))
+                    for row in new_rows:
+                        key = row['cache_key']
+                        for name, arr in new_arrays[key].items():
+                            store.put(self._array_node(key, name),
+                                      pd.Series(np.asarray(arr)))
+                with pd.HDFStore(self.cache_file, mode='r') as store:
+                    # no summary yet if every compute returned None
+                    if node in store:
+                        summary = store[node]
+
+        if summary is None:
+            return pd.DataFrame({'cache_key': [], 'entry': []})
+        summary = summary.drop_duplicates('cache_key').set_index(
+            'cache_key', drop=False)
+        entry = [i for i, k in enumerate(keys) if k in summary.index]
+        result = summary.loc[[keys[i] for i in entry]].reset_index(drop=True)
+        result['entry'] = entry
+        return result
+
+    def get_array(self, cache_key, name):
+        with self._locked(exclusive=False):
+            with pd.HDFStore(self.cache_file, mode='r') as store:
+                node = self._array_node(cache_key, name)
+                if node not in store:
+                    return np.zeros(0)
+                return store[node].to_numpy()
@@ -0,0 +1,128 @@
+from collections import namedtuple
+import numpy as np
+
+from degg_measurements.utils import CALIBRATION_FACTORS
+
+##fraction of the sorted samples cut at each end for the trimmed means,
+##removes dark pulses and their undershoot
+TRIM_FRACTION = 0.1
+##MAD to gaussian sigma
+MAD_TO_SIGMA = 1.4826
+
+
+def _trimmed_mean(sorted_values, trim, axis=-1):
+    n = sorted_values.shape[axis]
+    k = int(trim * n)
+    if 2 * k >= n:
+        k = (n - 1) // 2
+    return np.take(sorted_values, np.arange(k, n - k), axis=axis).mean(
+        axis=axis)
+
+
+def _sorted_median(sorted_values, axis=-1):
+    n = sorted_values.shape[axis]
+    return 0.5 * (np.take(sorted_values, (n - 1) // 2, axis=axis) +
+                  np.take(sorted_values, n // 2, axis=axis))
+
+
+def baseline_stats(waveforms, timestamps=None, trim=TRIM_FRACTION):
+    '''
+    Robust baseline statistics of a block of forced trigger waveforms
+    (n_waveforms, n_samples) [ADC], computed on the whole array at once.
+
+    Returns a dict with
+      median, trimmed_mean, mean: of all samples
+      rms:          standard deviation of all samples
+      robust_rms:   1.4826 * median absolute deviation of all samples
+      drift_slope:  slope of the per waveform trimmed means [ADC/s]
+                    vs. the timestamps (FPGA clock), [ADC/waveform]
+                    without timestamps
+      per_sample_median, per_sample_mean: (n_samples,) over waveforms
+      per_waveform_median, per_waveform_trimmed_mean, per_waveform_rms:
+                    (n_waveforms,)
+    '''
+    wfs = np.asarray(waveforms, dtype=np.float64)
+    if wfs.ndim != 2 or wfs.size == 0:
+        raise ValueError('Expected a non-empty (n_waveforms, n_samples) '
+                         'array of waveforms')
+    n_waveforms, n_samples = wfs.shape
+
+    per_waveform = np.sort(wfs, axis=1)
+    per_waveform_median = _sorted_median(per_waveform)
+    per_waveform_trimmed = _trimmed_mean(per_waveform, trim)
+    per_waveform_rms = np.std(wfs, axis=1)
+
+    samples = np.sort(per_waveform, axis=None)
+    median = _sorted_median(samples)
+    deviation = np.sort(np.abs(samples - median))
+    robust_rms = MAD_TO_SIGMA * _sorted_median(deviation)
+
+    if timestamps is None:
+        t = np.arange(n_waveforms, dtype=np.float64)
+    else:
+        t = np.asarray(timestamps, dtype=np.float64)
+        t = (t - t[0]) * CALIBRATION_FACTORS.fpga_clock_to_s
+    t = t - np.mean(t)
+    t_var = np.sum(t**2)
+    if n_waveforms > 1 and t_var > 0:
+        drift_slope = np.sum(t * per_waveform_trimmed) / t_var
+    else:
+        drift_slope = 0.
+
+    return {'median': median,
+            'trimmed_mean': _trimmed_mean(samples, trim),
+            'mean': np.mean(wfs),
+            'rms': np.std(wfs),
+            'robust_rms': robust_rms,
+            'drift_slope': drift_slope,
+            'n_waveforms': n_waveforms,
+            'n_samples': n_samples,
+            'per_sample_median': np.median(wfs, axis=0),
+            'per_sample_mean': np.mean(wfs, axis=0),
+            'per_waveform_median': per_waveform_median,
+            'per_waveform_trimmed_mean': per_waveform_trimmed,
+            'per_waveform_rms': per_waveform_rms}
+
+
+_ChannelBaseline = namedtuple(
+    '_ChannelBaseline',
+    ['pmt', 'port', 'channel', 'baseline', 'median', 'trimmed_mean', 'rms',
+     'robust_rms', 'drift_slope', 'temperature', 'hv', 'dac_value', 'n_waveforms',
+     'n_samples', 'timestamp', 'per_sample_median'])
+
+
+class ChannelBaseline(_ChannelBaseline):
+    '''
+    Baseline of one PMT channel and the conditions it was measured at.
+    baseline is the mean of all samples [ADC], the same as the baseline
+    of calc_baseline, so thresholds do not depend on where the baseline
+    came from. temperature in C, hv the measured HV [V], timestamp the
+    unix time of the measurement.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_stats(cls, stats, **conditions):
+        return cls(baseline=float(stats['mean']),
+                   median=float(stats['median']),
+                   trimmed_mean=float(stats['trimmed_mean']),
+                   rms=float(stats['rms']),
+                   robust_rms=float(stats['robust_rms']),
+                   drift_slope=float(stats['drift_slope']),
+                   n_waveforms=int(stats['n_waveforms']),
+                   n_samples=int(stats['n_samples']),
+                   per_sample_median=stats['per_sample_median'],
+                   **conditions)
+
+    def threshold(self, over_baseline):
+        '''trigger threshold over_baseline ADC counts above the baseline'''
+        return int(round(self.baseline + over_baseline))
+
+    def spe_threshold(self, spe_peak_height, fraction=0.5,
+                      adc_to_volts=CALIBRATION_FACTORS.adc_to_volts):
+        '''trigger threshold at fraction of the SPE peak height [V]'''
+        return self.threshold(fraction * spe_peak_height / adc_to_volts)
+
+    def noise_threshold(self, n_sigma=5.):
+        '''trigger threshold n_sigma robust_rms above the baseline'''
+        return self.threshold(n_sigma * self.robust_rms)
@@ -7,15 +7,21 @@ from warnings import warn
 from degg_measurements.utils import read_data
 from degg_measurements.utils import load_degg_dict, load_run_json
 from degg_measurements.utils import update_json
+from degg_measurements.analysis.baseline.baseline_stats import baseline_stats
 
 
 def calc_baseline(filename):
-    event_id, _, waveforms, _, _, datetime_timestamp, parameters = read_data(filename)
+    event_id, _, waveforms, timestamps, _, datetime_timestamp, parameters = read_data(filename)
+    stats = baseline_stats(waveforms, timestamps)
     df = pd.DataFrame()
     df['name'] = pd.Series(parameters['name'])
     df['baseline_filename'] = pd.Series(filename)
-    df['baseline'] = np.mean(waveforms)
-    df['baseline_std'] = np.std(waveforms)
+    df['baseline'] = stats['mean']
+    df['baseline_std'] = stats['rms']
+    df['baseline_median'] = stats['median']
+    df['baseline_trimmed_mean'] = stats['trimmed_mean']
+    df['baseline_robust_rms'] = stats['robust_rms']
+    df['baseline_drift_slope'] = stats['drift_slope']
     df['n_samples'] = np.prod(waveforms.shape)
     df['temp'] = parameters['degg_temp']
     if datetime_timestamp[0] < datetime.strptime("2022/04/30", "%Y/%m/%d").timestamp():
@@ -31,11 +37,8 @@ def calc_baseline(filename):
 
 
 def make_baseline_df(filenames):
-    total_df = pd.DataFrame()
-
-    for file_i in filenames:
-        df = calc_baseline(filename)
-        total_df = total_df.append(df, ignore_index=True)
+    total_df = pd.concat([calc_baseline(file_i) for file_i in filenames],
+                         ignore_index=True)
     print(total_df)
     return total_df
 
@@ -5,19 +5,26 @@ import numpy as np
 from termcolor import colored
 import click
 from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+
+from degg_measurements.analysis.analysis_cache import AnalysisCache
 
 H_size = 1312
 V_size = 979
+RAW_FILE_SIZE = 2605632
+
+##a pattern is found with more keypoints and a larger variance of the laplacian
+MIN_KEYPOINTS = 9
+MIN_SHARPNESS = 4.0
 
 def Raw2Gray(img):
-    npy = np.fromfile(img, dtype=np.uint16, count=H_size*V_size)
-    npy = np.reshape(npy, (V_size, H_size), 'C')
-    npy = cv2.cvtColor(npy, cv2.COLOR_BAYER_BG2BGR)
-    npy = (npy/256).astype('uint8')
+    ##memory-mapped, only the part of the file that is used is read
+    npy = np.memmap(img, dtype=np.uint16, mode='r', shape=(V_size, H_size), order='C')
+    npy = cv2.cvtColor(np.ascontiguousarray(npy), cv2.COLOR_BAYER_BG2BGR)
+    npy = (npy >> 8).astype('uint8')
     return npy
 
-def Find_Pattern(img, outfile):
-
+def create_detector():
     #This function detects the pattern in theimage using openCVs SimpleBlobDetector
     params = cv2.SimpleBlobDetector_Params()
 
@@ -37,46 +44,90 @@ def Find_Pattern(img, outfile):
     params.filterByInertia = True
     params.minInertiaRatio = 0.01
     # Create a detector with the parameters
-    detector = cv2.SimpleBlobDetector_create(params)
-    # Detect blobs
-    keypoints = detector.detect(img)
-
-    im_with_keypoints = cv2.drawKeypoints(img, keypoints, np.array([]), (0,0,255), cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
+    return cv2.SimpleBlobDetector_create(params)
 
-    #cv2.imshow('with keypoints',im_with_keypoints)
-    cv2.imwrite(f'{outfile}.png', im_with_keypoints)
+def sharpness(img):
+    return cv2.Laplacian(img, cv2.CV_64F).var()
 
-    #print('The number of blobs is ' + str(len(keypoints)))
+def Find_Pattern(img, outfile=None):
 
-    #for x in keypoints:
-
-        #print('The size of this blob is ' + str(x.size))
-
-        #if x.size > 10:
+    # Detect blobs
+    keypoints = create_detector().detect(img)
 
-            #if a large enough ellipse is found pass the test
-            #return(True)
+    ##the annotated image is only written if requested
+    if outfile is not None:
+        im_with_keypoints = cv2.drawKeypoints(img, keypoints, np.array([]), (0,0,255), cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
+        cv2.imwrite(f'{outfile}.png', im_with_keypoints)
 
-    if (len(keypoints) > 9) and (cv2.Laplacian(img, cv2.CV_64F).var() >4.0):
+    if (len(keypoints) > MIN_KEYPOINTS) and (sharpness(img) > MIN_SHARPNESS):
         return True
     else:
         return False
 
+def analyse_image(image_file, params=''):
+    '''
+    keypoint count, sharpness and verdict of one raw image,
+    None for files that are not full raw images
+    '''
+    if os.path.getsize(image_file) != RAW_FILE_SIZE:
+        return None
+    image = Raw2Gray(image_file)
+    n_keypoints = len(create_detector().detect(image))
+    var_laplacian = sharpness(image)
+    verdict = (n_keypoints > MIN_KEYPOINTS) and (var_laplacian > MIN_SHARPNESS)
+    return {'n_keypoints': n_keypoints, 'sharpness': var_laplacian,
+            'verdict': bool(verdict)}
+
+def annotate_image(image_file, outfile):
+    Find_Pattern(Raw2Gray(image_file), outfile)
+    return outfile
+
+def analyse_folder(image_folder, cache_file=None, n_jobs=1, png_dir=None):
+    '''
+    Results of all *.RAW images in image_folder as a DataFrame (file,
+    n_keypoints, sharpness, verdict), cached by the contents of the
+    images. With png_dir, annotated images that do not exist yet are
+    written there.
+    '''
+    images = sorted(glob(os.path.join(image_folder, '*.RAW')))
+    if cache_file is None:
+        cache_file = os.path.join(image_folder, 'camera_pattern_cache.hdf5')
+    cache = AnalysisCache(cache_file, 'camera_pattern')
+    results = cache.update([(image, '') for image in images], analyse_image,
+                           n_jobs=n_jobs)
+    results['file'] = [images[i] for i in results['entry']]
+
+    if png_dir is not None:
+        if not os.path.isdir(png_dir):
+            os.makedirs(png_dir)
+        outfiles = [os.path.join(png_dir, os.path.splitext(os.path.basename(f))[0])
+                    for f in results['file']]
+        todo = [(f, o) for f, o in zip(results['file'], outfiles)
+                if not os.path.isfile(f'{o}.png')]
+        if n_jobs > 1 and len(todo) > 1:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                list(executor.map(annotate_image, *zip(*todo)))
+        else:
+            for image_file, outfile in todo:
+                annotate_image(image_file, outfile)
+    return results
+
 @click.command()
 @click.argument('image_folder')
-def main(image_folder):
-        glob_path = os.path.join(image_folder,'*.RAW' )
-        images = glob(glob_path)
-        for i, _image in enumerate(images):
-            print(f'File Path: {_image}')
-            if os.path.getsize(_image) == 2605632:
-                        image = Raw2Gray(_image)
-                        print(f'Variance of laplacian is: {str(cv2.Laplacian(image, cv2.CV_64F).var())}')
-                        verdict = Find_Pattern(image, i)
-                        if verdict == True:
-                            print(colored('Pass', 'green'))
-                        if verdict == False:
-                            print(colored('Fail', 'red'))
+@click.option('--n_jobs', '-j', default=1, help='number of worker processes')
+@click.option('--png_dir', default=None,
+              help='write annotated images (only missing ones) to this directory')
+@click.option('--cache_file', default=None,
+              help='default: camera_pattern_cache.hdf5 in image_folder')
+def main(image_folder, n_jobs, png_dir, cache_file):
+        results = analyse_folder(image_folder, cache_file, n_jobs, png_dir)
+        for _, row in results.iterrows():
+            print(f'File Path: {row["file"]}')
+            print(f'Variance of laplacian is: {row["sharpness"]}')
+            if row['verdict'] == True:
+                print(colored('Pass', 'green'))
+            else:
+                print(colored('Fail', 'red'))
 
 if __name__ == "__main__":
     main()
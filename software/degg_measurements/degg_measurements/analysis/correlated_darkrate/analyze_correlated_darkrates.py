@@ -11,6 +11,9 @@ from scipy import signal
 ##################################################
 from load_dict import load_degg_dict, load_run_json
 from read_data import read_data
+from degg_measurements.analysis.correlated_darkrate.block_rates import block_summary
+from degg_measurements.analysis.correlated_darkrate.block_rates import block_array
+from degg_measurements.analysis.correlated_darkrate.block_rates import COINCIDENCE_WINDOW
 ##################################################
 PLOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plots')
 
@@ -22,6 +25,9 @@ def intraDEggAnalysis(df, num):
     if len(num) == 4:
         PLOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plots_gain_change')
     deggs = df.DEgg.unique()
+    ##all blocks of all D-Eggs at once
+    summary = block_summary(df, by=['DEgg', 'Channel'],
+                            window=COINCIDENCE_WINDOW)
     for i, degg in enumerate(deggs):
         print(i, degg)
         _df = df[df.DEgg == degg]
@@ -36,51 +42,32 @@ def intraDEggAnalysis(df, num):
         pmt_b = df_b.PMT.values[0]
         pmt_t = df_t.PMT.values[0]
 
-        blockNums_b = df_b.blockNum.unique()
-        blockNums_t = df_t.blockNum.unique()
-        not_matched = False
-        total_blocks = 0
-        if blockNums_b.all() != blockNums_t.all():
-            print("Blocks not equal!")
-            print(blockNums_b, blockNums_t)
-            not_matched == True
-
-        if not_matched == True:
-            ##try to match blocks and make them the same length
-            b_max = np.max(blockNums_b)
-            t_max = np.max(blockNums_t)
-            if b_max >= t_max:
-                total_blocks = b_max
-            if b_max < t_max:
-                total_blocks = t_max
-        else:
-            total_blocks = np.max(blockNums_b)
-
-        rate_list_b   = [0] * total_blocks
-        charge_list_b = [0] * total_blocks
-        rate_list_t   = [0] * total_blocks
-        charge_list_t = [0] * total_blocks
-        for j, block in enumerate(range(total_blocks)):
-            df_n_b = df_b[df_b.blockNum == block]
-            df_n_t = df_t[df_t.blockNum == block]
-            charge_list_b[j] = np.sum(df_n_b.Charge.values)
-            charge_list_t[j] = np.sum(df_n_t.Charge.values)
-            ##correct for deadtime of 500 ns
-            if len(df_n_b.index) <= 1:
-                rate_list_b[j] = 0
-            else:
-                total_time = (np.max(df_n_b.mfhTime.values) - np.min(df_n_b.mfhTime.values)) - (len(df_n_b.index) * 500)
-                rate = len(df_n_b.index) / total_time
-                rate = rate / 1e-9 ##convert into Hz
-                rate_list_b[j] = rate
-
-            if len(df_n_t.index) <= 1:
-                rate_list_t[j] = 0
-            else:
-                total_time = (np.max(df_n_t.mfhTime.values) - np.min(df_n_t.mfhTime.values)) - (len(df_n_t.index) * 500)
-                rate = len(df_n_t.index) / total_time
-                rate = rate / 1e-9 ##convert into Hz
-                rate_list_t[j] = rate
+        ##per block rates and charges of both PMTs
+        _summary = summary[summary.DEgg == degg]
+        sum_b = _summary[_summary.Channel == 0]
+        sum_t = _summary[_summary.Channel == 1]
+        total_blocks = int(max(np.max(sum_b.blockNum.values),
+                               np.max(sum_t.blockNum.values))) + 1
+        rate_list_b   = block_array(sum_b, 'rate', total_blocks)
+        charge_list_b = block_array(sum_b, 'charge', total_blocks)
+        rate_list_t   = block_array(sum_t, 'rate', total_blocks)
+        charge_list_t = block_array(sum_t, 'charge', total_blocks)
+
+        ##fraction of hits with a hit of the other PMT nearby
+        n_hits_b = block_array(sum_b, 'nHits', total_blocks)
+        n_hits_t = block_array(sum_t, 'nHits', total_blocks)
+        coinc_b = block_array(sum_b, 'nCoincident', total_blocks) / np.maximum(n_hits_b, 1)
+        coinc_t = block_array(sum_t, 'nCoincident', total_blocks) / np.maximum(n_hits_t, 1)
+        figcb, axcb = plt.subplots()
+        axcb.plot(np.arange(total_blocks), coinc_b, 'o', linewidth=0, color='royalblue', alpha=0.5, label=f'{pmt_b} (0)')
+        axcb.plot(np.arange(total_blocks), coinc_t, 'o', linewidth=0, color='goldenrod', alpha=0.5, label=f'{pmt_t} (1)')
+        axcb.set_xlabel('Charge Block')
+        axcb.set_ylabel(f'Fraction of Hits in Coincidence (+-{COINCIDENCE_WINDOW} ns)')
+        axcb.grid(True)
+        axcb.legend()
+        figcb.tight_layout()
+        figcb.savefig(os.path.join(PLOT_DIR, f'{degg}_block_coincidences_{num}.png'), dpi=300)
+        plt.close(figcb)
 
         figrb, axrb = plt.subplots()
         axrb.plot(np.arange(len(rate_list_b)), rate_list_b, 'o', linewidth=0, color='royalblue', alpha=0.5, label=f'{pmt_b} (0)')
@@ -167,33 +154,27 @@ def separateAnalysis(df, num):
     binning = np.logspace(2, 7, 200)
     total_max = 0
     #binning=200
+    summary = block_summary(df, by='PMT')
     for i, pmt in enumerate(pmts):
         print(i, pmt)
         _df = df[df.PMT == pmt]
         mfh_t = _df.mfhTime.values
         charge = _df.Charge.values
-        blockNums = _df.blockNum.unique()
+        _summary = summary[summary.PMT == pmt]
+        blockNums = _summary.blockNum.values
         small_qbinning = np.linspace(-2, 5, 700)
         figqb, axqb = plt.subplots()
-        rate_list = [0] * len(blockNums)
-        charge_list = [0] * len(blockNums)
-        block_times = [0] * len(blockNums)
-        plotting_times = [0] * len(blockNums)
+        ##charge distribution of the first and last blocks
         for j, blockNum in enumerate(blockNums):
-            _df_n = _df[_df.blockNum == blockNum]
             if j <= 4 or j > (len(blockNums) - 4):
-                axqb.hist(_df_n.Charge.values, bins=small_qbinning, histtype='step')
-            charge_list[j] = np.sum(_df_n.Charge.values)
-            plotting_times[j] = ((np.max(_df_n.mfhTime.values) - np.min(_df_n.mfhTime.values))/2 + np.min(_df_n.mfhTime.values)) * 1e-9
-            block_times[j] = (np.max(_df_n.mfhTime.values))*1e-9 - plotting_times[j]
-            ##correct for deadtime of 500 ns
-            if len(_df_n.index) <= 1:
-                rate_list[j] = 0
-                continue
-            total_time = (np.max(_df_n.mfhTime.values) - np.min(_df_n.mfhTime.values)) - (len(_df_n.index) * 500)
-            rate = len(_df_n.index) / total_time
-            rate = rate / 1e-9 ##convert into Hz
-            rate_list[j] = rate
+                axqb.hist(charge[_df.blockNum.values == blockNum], bins=small_qbinning, histtype='step')
+        charge_list = _summary.charge.values
+        t_start = _summary.tStart.values
+        t_stop = _summary.tStop.values
+        plotting_times = ((t_stop - t_start)/2 + t_start) * 1e-9
+        block_times = t_stop * 1e-9 - plotting_times
+        ##corrected for deadtime of 500 ns
+        rate_list = _summary.rate.values
 
         ##I know SQ0558 has a few big and frequent spikes
         if pmt == 'SQ0558':
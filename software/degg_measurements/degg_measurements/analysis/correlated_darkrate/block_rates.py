@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+
+##deadtime per trigger [ns]
+DEADTIME = 500
+##window to count hits of the other PMT of the same D-Egg [ns]
+COINCIDENCE_WINDOW = 1000
+
+
+def coincident_hits(times, channels, deggs, window=COINCIDENCE_WINDOW):
+    '''
+    For every hit, whether the other PMT of the same D-Egg has a hit
+    within +-window [ns]. All D-Eggs are handled in one pass: the times
+    of each D-Egg are shifted into their own, non overlapping range and
+    sorted once per channel.
+    '''
+    times = np.asarray(times, dtype=float)
+    channels = np.asarray(channels)
+    degg_codes, _ = pd.factorize(np.asarray(deggs))
+    coincident = np.zeros(len(times), dtype=bool)
+    if len(times) == 0:
+        return coincident
+
+    t_min = np.full(degg_codes.max() + 1, np.inf)
+    np.minimum.at(t_min, degg_codes, times)
+    rel_times = times - t_min[degg_codes]
+    spacing = np.max(rel_times) + 2 * window + 1
+    shifted = rel_times + degg_codes * spacing
+
+    for channel in [0, 1]:
+        this = channels == channel
+        other = np.sort(shifted[channels == 1 - channel])
+        if len(other) == 0:
+            continue
+        lower = np.searchsorted(other, shifted[this] - window, side='left')
+        upper = np.searchsorted(other, shifted[this] + window, side='right')
+        coincident[this] = upper > lower
+    return coincident
+
+
+def block_summary(df, by='PMT', window=None, deadtime=DEADTIME):
+    '''
+    Per block statistics of a DataFrame built by buildTotalDataFrame
+    (columns blockNum, mfhTime [ns], Charge and the columns in by), in
+    one sort of the rows instead of a mask per block.
+
+    Returns a DataFrame with one row per (by, blockNum) that has hits,
+    sorted by group and block, with the columns
+    nHits, tStart, tStop [ns], liveTime [ns] (tStop - tStart minus the
+    deadtime of every hit), rate [Hz] (0 for blocks with <= 1 hit),
+    charge (summed) and, if window is given, nCoincident: hits with a
+    hit of the other PMT of the same D-Egg within +-window [ns].
+    '''
+    if isinstance(by, str):
+        by = [by]
+    columns = ['blockNum', 'nHits', 'tStart', 'tStop', 'liveTime', 'rate',
+               'charge'] + (['nCoincident'] if window is not None else [])
+    if len(df.index) == 0:
+        return pd.DataFrame(columns=by + columns)
+
+    groups = df.groupby(by, sort=True).ngroup().to_numpy()
+    blocks = df.blockNum.to_numpy().astype(np.int64)
+    times = df.mfhTime.to_numpy().astype(float)
+    charges = df.Charge.to_numpy().astype(float)
+
+    key = groups * (blocks.max() + 1) + blocks
+    order = np.argsort(key, kind='stable')
+    sorted_key = key[order]
+    starts = np.flatnonzero(np.r_[True, sorted_key[1:] != sorted_key[:-1]])
+
+    n_hits = np.diff(np.r_[starts, len(order)])
+    t_start = np.minimum.reduceat(times[order], starts)
+    t_stop = np.maximum.reduceat(times[order], starts)
+    charge = np.add.reduceat(charges[order], starts)
+    live_time = (t_stop - t_start) - n_hits * deadtime
+    rate = np.zeros(len(starts))
+    ##correct for deadtime of 500 ns, convert into Hz
+    valid = n_hits > 1
+    rate[valid] = n_hits[valid] / live_time[valid] / 1e-9
+
+    summary = df[by].iloc[order[starts]].reset_index(drop=True)
+    summary['blockNum'] = blocks[order[starts]]
+    summary['nHits'] = n_hits
+    summary['tStart'] = t_start
+    summary['tStop'] = t_stop
+    summary['liveTime'] = live_time
+    summary['rate'] = rate
+    summary['charge'] = charge
+    if window is not None:
+        coincident = coincident_hits(times, df.Channel.to_numpy(),
+                                     df.DEgg.to_numpy(), window)
+        summary['nCoincident'] = np.add.reduceat(
+            coincident[order].astype(int), starts)
+    return summary
+
+
+def block_array(summary, column, n_blocks, fill=0):
+    '''values of column for blocks 0 .. n_blocks-1 of one group'''
+    values = np.full(n_blocks, fill, dtype=float)
+    blocks = summary.blockNum.to_numpy()
+    mask = blocks < n_blocks
+    values[blocks[mask]] = summary[column].to_numpy()[mask]
+    return values
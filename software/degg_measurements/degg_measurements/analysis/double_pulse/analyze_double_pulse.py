@@ -19,6 +19,7 @@ from degg_measurements.utils import load_run_json
 from degg_measurements.utils import load_degg_dict
 from degg_measurements.utils import extract_runnumber_from_path
 from degg_measurements.utils import CALIBRATION_FACTORS
+from degg_measurements.utils.wfana import find_double_peaks
 from degg_measurements.utils.load_dict import audit_ignore_list
 from degg_measurements.utils.analysis import Analysis
 from degg_measurements.analysis import RunHandler
@@ -30,10 +31,7 @@ PLOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'figs')
 
 def extract_info(filename, pmt_id):
     e_id, time, waveforms, ts, pc_t, datetime_timestamp, params = read_data(filename)
-    baselines = []
-    for wf in waveforms:
-        baseline = np.mean(wf[:8])
-        baselines.append(baseline)
+    baselines = np.mean(waveforms[:, :8], axis=1)
     d = {
         'X': time,
         'Y': waveforms,
@@ -177,7 +175,6 @@ def process_pulses(info, run_number, data_key, pdf=None, detailed_pdf=False, num
         peaks_ind_l = info['PeaksIndList']
         double_peaks_ind = info['DoublePeaksInd']
         print(double_peaks_ind)
-        int_dp_ind = [int(np.round(double_peaks_ind[0])), int(np.round(double_peaks_ind[1]))]
         if len(peaks_l) == 0:
             warn_msg = f'No double peak structure found for {degg} - {pmt} \n'
             warn_msg = warn_msg + 'Check if problems have been observed in linearity/TTS analyses \n'
@@ -186,29 +183,14 @@ def process_pulses(info, run_number, data_key, pdf=None, detailed_pdf=False, num
             send_warning(warn_msg)
             print(f"No double peaks for {degg} - {pmt}")
             return
+        int_dp_ind = [int(np.round(double_peaks_ind[0])), int(np.round(double_peaks_ind[1]))]
 
-        ##get the list of valley Y values
-        valley_y = info['ValleyList']
-        peak_to_valley_l = []
-        min_ptv = 1000
-        max_ptv = 0
-        ##calculate peak to valley for both peaks
-        for _peak_y, _valley_y in zip(peaks_l, valley_y):
-            these_ptv = np.zeros(2)
-            for pnum, _py in enumerate(_peak_y):
-                if _valley_y[0] <= 0:
-                    these_ptv[pnum] = -1
-                    continue
-                peak_to_valley = _py / _valley_y[0]
-                if peak_to_valley < min_ptv:
-                    min_ptv = peak_to_valley
-                if peak_to_valley > max_ptv:
-                    max_ptv = peak_to_valley
-
-                these_ptv[pnum] = peak_to_valley
-            peak_to_valley_l.append(these_ptv)
-
-        peak_to_valley_l = np.array(peak_to_valley_l)
+        ##get the list of valley Y values (first valley between the peaks)
+        valley_y = info['ValleyList'][:, np.newaxis]
+        ##calculate peak to valley for both peaks, -1 without a valley
+        peak_to_valley_l = np.full(peaks_l.shape, -1.)
+        np.divide(peaks_l, valley_y, out=peak_to_valley_l,
+                  where=(valley_y > 0))
         ##plot the distribution of the 1st and 2nd peak to valleys
         #binning = np.linspace(min_ptv, max_ptv, 40)
         binning = np.linspace(1, 5, 50)
@@ -261,24 +243,6 @@ def process_pulses(info, run_number, data_key, pdf=None, detailed_pdf=False, num
 
     return plot_y_vals
 
-def find_valley(p_i, wz):
-    ##only look between the two peaks
-    wf = wz[p_i[0]:p_i[1]]
-    #print(f'Searching size: {len(wf)}')
-
-    ##need to find min so invert wf
-    n_wf = -1 * wf
-    #print(n_wf)
-
-    m_i, _ = signal.find_peaks(n_wf)
-    #print(m_i)
-    if len(m_i) == 0:
-        return [0]
-
-    ##return the value of the waveform at the valley
-    else:
-        return wf[m_i]
-
 def double_pulse_ana(info, threshold, every_wf=False):
     wf = info['Y']
     n_wfs = len(wf)
@@ -303,42 +267,29 @@ def double_pulse_ana(info, threshold, every_wf=False):
     ##also do wf by wf
     double_peaks = 0
     single_peaks = 0
-    peak1_ind = 0
-    peak2_ind = 0
     if every_wf == True:
-        peaks_list = []
-        peaks_ind_list = []
-        valley_list = []
-        valid_double = [False] * len(wf)
-        for i, w in enumerate(wf):
-            wz = w - bl_ave
-            p_i, _ = signal.find_peaks(wz, height=threshold)
-            p = wz[p_i]
-
-            if len(p) == 2:
-                peaks_list.append(p)
-                peaks_ind_list.append(p_i)
-                double_peaks += 1
-                valid_double[i] = True
-                peak1_ind += p_i[0]
-                peak2_ind += p_i[1]
-                min_y = find_valley(p_i, wz)
-                valley_list.append(min_y)
-
-            if len(p) == 1:
-                single_peaks += 1
+        ##all waveforms at once, same result as find_peaks per waveform
+        ##and find_valley for the ones with exactly two peaks
+        found = find_double_peaks(wf, threshold, baseline=bl_ave)
+        valid_double = found['n_peaks'] == 2
+        double_peaks = np.sum(valid_double)
+        single_peaks = np.sum(found['n_peaks'] == 1)
+        peaks_ind_list = found['peak_ind'][valid_double]
 
         info['X'] = info['X'][valid_double]
         info['Y'] = info['Y'][valid_double]
 
-        info['PeaksList'] = peaks_list
+        info['PeaksList'] = found['peak_height'][valid_double]
         info['PeaksIndList'] = peaks_ind_list
-        info['DoublePeaksInd'] = [peak1_ind/double_peaks, peak2_ind/double_peaks]
+        if double_peaks > 0:
+            info['DoublePeaksInd'] = list(np.mean(peaks_ind_list, axis=0))
+        else:
+            info['DoublePeaksInd'] = [np.nan, np.nan]
         #info['Peaks'] = np.array(info['Peaks'])[valid_double]
         #info['PeaksInd'] = info['PeaksInd'][valid_double]
         #info['Widths'] = info['Widths'][valid_double]
         info['Baseline'] = np.array(info['Baseline'])[valid_double]
-        info['ValleyList'] = valley_list
+        info['ValleyList'] = found['valley'][valid_double]
 
     print(f'Single: {single_peaks}')
     print(f'Double: {double_peaks}')
@@ -15,6 +15,7 @@ from scipy.ndimage import gaussian_filter1d
 from degg_measurements.utils import read_data
 from degg_measurements.utils import get_charges, calc_charge
 from degg_measurements.utils import get_spe_avg_waveform
+from degg_measurements.utils import correct_droop, droop_time_constant
 from degg_measurements.utils import load_degg_dict, load_run_json
 from degg_measurements.utils import update_json
 from degg_measurements.utils import DEggLogBook
@@ -23,6 +24,8 @@ from degg_measurements.utils import extract_runnumber_from_path
 
 from degg_measurements.utils.wfana import \
     get_highest_density_region_charge
+from degg_measurements.utils.wfana import \
+    DROOP_TAU_PARAMS, UNDERSHOOT_TAU_PARAMS
 from degg_measurements.analysis import calc_baseline
 
 
@@ -118,35 +121,22 @@ def make_random_correction_plot(files, num, pmt_id):
 
 
 def correction_algorithm(tau, dt, Y):
-    A = (tau/dt) * (1-np.exp(-dt/tau))
-    S = 0
-    X0 = (1/A * Y[0])
-    X = [X0]
-    for j in range(1, len(Y)):
-        sj = X[j-1] + S*np.exp(-dt/tau)
-        xj = (1/A) * Y[j] + (A*dt)/tau * sj
-        S = sj
-        X.append(xj)
-    return X
-
-
-def correct_droop_undershoot(x_value, y_values, baseline):
+    # first order IIR filter along the last axis, Y can be a single
+    # waveform or a (n_waveforms, n_bins) matrix
+    return correct_droop(Y, tau, dt)
+
+
+def correct_droop_undershoot(x_value, y_values, baseline, temp=25):
     #mean values of the constants --update to take the values directly from the database!!!
-    p0 = 4.536475587728131e-06
-    p1 = 2.728386839836242e-05
-    p2 = 29.50883205770401
-    p3 = 4.246080961487583e-06
-    p4 = 2.7143255325039317e-05
-    p5 = 30.620432988018425
-    temp = 25 #room temperature
-    tau_droop = p0 + p1/(1+np.exp(-temp/p2))
-    tau_undershoot = p3 + p4/(1+np.exp(-temp/p5))
-
-    Y = y_values - baseline
+    #temp: 25 = room temperature, or one value per waveform
+    tau_droop = droop_time_constant(temp, DROOP_TAU_PARAMS)
+    tau_undershoot = droop_time_constant(temp, UNDERSHOOT_TAU_PARAMS)
+
+    Y = np.asarray(y_values) - baseline
     dt = TIME_SCALING
     Corrected_droop = correction_algorithm(tau_droop, dt, Y)
     Corrected_undershoot = correction_algorithm(tau_undershoot, dt, Y)
-    return np.asarray(Corrected_droop), np.asarray(Corrected_undershoot), Y, tau_droop, tau_undershoot
+    return Corrected_droop, Corrected_undershoot, Y, tau_droop, tau_undershoot
 
 
 def get_start_end(x_value, Corrected_Original):
@@ -233,9 +223,12 @@ def run_analysis(data_key, degg_dict, run, pmt, logbook, aggregate_fig=None, agg
         e_id, time, waveforms, ts, pc_t, params = read_data(file_name)
         #plot_baseline(pmt_id, waveforms[:,0])
 
+        # all waveforms of the file at once
+        Corrected_droops, Corrected_undershoots, Original_waveforms, tau_droop, tau_undershoot = correct_droop_undershoot(time, waveforms, baseline)
+        Corrected_Originals = Corrected_droops - Original_waveforms
         for wf in range(len(waveforms)):
-            Corrected_droop, Corrected_undershoot, Original_waveform, tau_droop, tau_undershoot = correct_droop_undershoot(time[wf], waveforms[wf], baseline)
-            Corrected_Original = Corrected_droop - (waveforms[wf] - baseline)
+            Corrected_droop = Corrected_droops[wf]
+            Corrected_Original = Corrected_Originals[wf]
             difference.append(np.max(Corrected_Original))
             index_start, index_stop = get_start_end(time[wf], Corrected_Original)
             inflection_point.append(index_stop)
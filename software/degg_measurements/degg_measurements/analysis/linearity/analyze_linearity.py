@@ -6,6 +6,7 @@ import os
 import wave
 import click
 from glob import glob
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from matplotlib import pyplot as plt
 from matplotlib import cm
@@ -19,8 +20,6 @@ from degg_measurements.analysis import Result
 from degg_measurements.analysis import RunHandler
 from degg_measurements.utils import load_run_json
 from degg_measurements.utils import load_degg_dict
-from degg_measurements.utils import read_data
-from degg_measurements.utils import get_charges
 from degg_measurements.utils import CALIBRATION_FACTORS
 from degg_measurements.utils.load_dict import audit_ignore_list
 from degg_measurements.analysis.analysis_utils import get_run_json
@@ -29,6 +28,11 @@ from degg_measurements.analysis.analysis_utils import get_measurement_numbers
 from degg_measurements.analysis.linearity.linearity_fit_functions import linearity_current_curve_func
 from degg_measurements.analysis.linearity.linearity_fit_functions import linearity_current_curve_func2
 from degg_measurements.analysis.linearity.linearity_fit_functions import linearity_current_curve_func3
+from degg_measurements.analysis.linearity.linearity_summary import CHUNK_SIZE
+from degg_measurements.analysis.linearity.linearity_summary import gauss, make_laser_freq_mask
+from degg_measurements.analysis.linearity.linearity_summary import summarize_file, fit_summary
+from degg_measurements.analysis.linearity.linearity_summary import save_summary, load_summary
+from degg_measurements.analysis.linearity.linearity_summary import plot_summary, plot_summaries
 
 from chiba_slackbot import send_message
 from chiba_slackbot import send_warning, push_slow_mon
@@ -37,50 +41,9 @@ from tempfile import NamedTemporaryFile
 E_CONST = 1.60217662e-7
 
 
-def gauss(x, norm, peak, width):
-    val = norm * np.exp(-(x-peak)**2/(2 * width**2))
-    return val
-
-
-def make_laser_freq_mask(timestamps, fw):
-    fw = float(fw)
-    timestamps_per_second = 240e6
-    diffs = np.diff(timestamps)
-    laser_freq_in_hz = 100.
-    dt_in_timestamps = timestamps_per_second / laser_freq_in_hz
-    mask = np.logical_and(diffs > dt_in_timestamps - 10,
-                          diffs < dt_in_timestamps + 10)
-
-    pulses = diffs / timestamps_per_second * laser_freq_in_hz
-    _mask = (pulses > 0.0999) & (pulses < 1.0001)
-    if np.sum(_mask) > np.sum(mask):
-        mask = _mask
-
-    if np.sum(mask) == 0:
-        print('<make_laser_freq_mask>: no valid mask')
-        if fw == 0.1:
-            print('No valid triggers found for the 10% filter. Exiting')
-            exit(1)
-        return np.zeros_like(timestamps, dtype=bool)
-
-    #This part was to verify that the filter above is actually working
-    #But because it was done on bad data it lead to bad results.
-    #It's not needed anymore.
-    #Find one index where a neighboring trigger is the laser freq away
-    # starting_idx = np.where(mask)[0][0]
-
-    # timestamps_shifted = timestamps - timestamps[starting_idx]
-    # timestamps_in_dt = timestamps_shifted / dt_in_timestamps
-    # rounded_timestamps = np.round(timestamps_in_dt)
-    # new_mask = np.isclose(timestamps_in_dt, rounded_timestamps,
-    #                       atol=1e-3, rtol=0)
-
-    # print(f'Mask Info - sum: {np.sum(mask)}, {np.sum(new_mask)}')
-    # return new_mask
-    return np.append(mask, mask[-1])
-
-
-def fit_charge_and_peak_current(PMT, data_folder, plot_dir, data_dir):
+def fit_charge_and_peak_current(PMT, data_folder, plot_dir, data_dir,
+                                droop_correction=False, plot=True,
+                                chunk_size=CHUNK_SIZE):
     print('---' * 20)
     print(PMT)
     npe_ide_list = []
@@ -96,221 +59,54 @@ def fit_charge_and_peak_current(PMT, data_folder, plot_dir, data_dir):
     warn_status = False
     for file_i in files:
         print(f' --- File: {file_i} --- ')
-        # 5001X128 data 5001 waveforms
+        # 5001X128 data 5001 waveforms, read in chunks
         try:
-            e_id, time, waveforms, ts, pc_t, datetime_timestamp, params = read_data(file_i)
+            summary = summarize_file(file_i, droop_correction=droop_correction,
+                                     chunk_size=chunk_size)
         except OSError:
             print(f'Problem reading {file_i}')
             continue
 
-        temperatures.append(float(params['degg_temp']))
-        fw = params['strength']
+        temperatures.append(summary['temperature'])
+        fw = summary['fw']
         fw_settings.append(fw)
 
-        nevent = len(e_id)
+        nevent = summary['n_events']
+        n_valid = summary['n_valid']
         print(f'nEvents: {nevent}')
-        npe_main_mean_list=[]
-        npe_main_std_list=[]
-        ip_main_mean_list=[]
-        ip_main_std_list =[]
-
-        mask = make_laser_freq_mask(ts, fw)
-        if np.sum(mask)/len(mask) <= 0.78 and float(fw) > 0.01:
-            send_warning(f'Linearity Analysis: data has low efficiency! {file_i} - ({np.sum(mask)}/{len(mask)})')
+
+        if n_valid/nevent <= 0.78 and float(fw) > 0.01:
+            send_warning(f'Linearity Analysis: data has low efficiency! {file_i} - ({n_valid}/{nevent})')
             warn_status = True
-        elif np.sum(mask)/len(mask) < 0.3 and float(fw) <= 0.01:
-            send_warning(f'Linearity Analysis: data has low efficiency! {file_i} - ({np.sum(mask)}/{len(mask)})')
+        elif n_valid/nevent < 0.3 and float(fw) <= 0.01:
+            send_warning(f'Linearity Analysis: data has low efficiency! {file_i} - ({n_valid}/{nevent})')
             warn_status = True
-        if np.sum(mask) == 0:
+        if n_valid == 0:
             print(f'No laser triggers found for {PMT} {fw}. Skipping it!')
             continue
-        waveforms = waveforms[mask]
-
-        x_l1_list = time[0, 0:128] * CALIBRATION_FACTORS.fpga_clock_to_s
-        yy = np.zeros(128)
-        # Get the base line
-        pre_trigger_wf = waveforms[:, :10]
-        baselines = np.mean(pre_trigger_wf, axis=1)
-
-        # charge pC
-        charges = get_charges(waveforms*CALIBRATION_FACTORS.adc_to_volts,
-                              gate_start=13,
-                              gate_width=15,
-                              baseline=baselines*CALIBRATION_FACTORS.adc_to_volts)
-
-        npes = charges / 1.602 # PE
-        #print(npes)
-        # if fw in ["0.05", "0.1"]:
-        #     # skip abnormal
-        #     npes = npes[npes <= 80]
-
-        #Peak current
-        waveforms = (waveforms - baselines[:, np.newaxis]) * \
-            CALIBRATION_FACTORS.adc_to_volts
-        ip = np.max(waveforms, axis=1) / 50 * 1000 #mA
-        # if fw in ["0.05", "0.1"]:
-        #     ip = ip[ip <= 8]
-
-        min_wf = 0
-        max_wf = 0
-        for i, wf in enumerate(waveforms):
-            if np.max(wf) > np.max(waveforms[max_wf]):
-                max_wf = i
-            if np.max(wf) < np.max(waveforms[min_wf]):
-                min_wf = i
-
-        # average waveform
-        ym = np.mean(waveforms, axis=0)
-        fig = plt.figure(figsize=(15,3))
-        ax1 = fig.add_subplot(1,3,1)
-        ax2 = fig.add_subplot(1,3,2)
-        ax3 = fig.add_subplot(1,3,3)
-        ax1.set_title(f"averaged waveform [{len(waveforms)} waveforms]")
-        ax1.set_ylim(-0.1, 1.4)
-        ax1.set_xlim(0E-9, 500E-9)
-        ax1.grid(linewidth=1)
-        #ax1.tick_params(labelsize=16)
-        ax1.plot(x_l1_list, ym, label="average waveform", color="tab:blue")
-        ax1.plot(x_l1_list, waveforms[min_wf], label="smallest waveform", color="tab:blue", alpha=0.5)
-        ax1.plot(x_l1_list, waveforms[max_wf], label="largest waveform", color="tab:blue", alpha=0.5)
-        ax1.legend()
 
+        npes = summary['npes']
+        ip = summary['ip']
         # Mean & Error(simple)
         npe0_mean = np.mean(npes)
         npe0_std = np.std(npes)
         ip_mean= np.mean(ip)
         ip_std = np.std(ip)
 
-        #histogram fit for NPE
-        # Use different binning for the two lowest filter settings
-        # For these settings we are in the PE range
-        max_lim_0010 = 25
-        max_lim_0025 = 100
-        if fw == "0.01":
-            bins = np.linspace(0, max_lim_0010, 101)
-
-        elif fw == "0.025":
-            bins = np.linspace(0, max_lim_0025, 101)
-        else:
-            bins = np.linspace(np.min(npes), np.max(npes), 101)
-
-        hist, edges = np.histogram(npes, bins=bins)
-        center = (edges[1:] + edges[:-1]) * 0.5
-        init_norm = np.max(hist)
-        # init_peak = np.abs(center[np.argmax(hist)])
-        init_peak = npe0_mean
-        init_width = 0.25 * init_peak
-        p0 = [init_norm, init_peak, init_width]
-        bounds = [(0.01 * init_norm, init_peak * 0.2, 0.),
-                  (10. * init_norm, init_peak * 2, 3. * init_width)]
-        # try to limit the histogram around the mean to make fitting with lots of
-        # darknoise easier
-        if fw == "0.01":
-            # special limits for fitting for the lowest setting, because it's so close to 0.
-            fit_min = 0.
-            fit_max = init_peak * 2.5
-        else:
-            fit_min = init_peak * 0.4
-            fit_max = init_peak * 2.5
-        fit_mask = np.logical_and(center > fit_min,
-                                  center < fit_max)
-        try:
-            popt, pcov = curve_fit(gauss, center[fit_mask], hist[fit_mask], p0=p0, bounds=bounds)
-        except RuntimeError:
-            popt = np.zeros_like(p0)
-            pcov = np.zeros(9).reshape(len(p0), len(p0))
-        except ValueError:
-            popt = np.zeros_like(p0)
-            pcov = np.zeros(9).reshape(len(p0), len(p0))
         # mean and std by gauss fit
-        fit_mean = popt[1]
-        fit_std = popt[2] / np.sqrt(np.sum(mask))
+        npe_fit, ip_fit = fit_summary(summary)
+        fit_mean = npe_fit['mean']
+        fit_std = npe_fit['std']
         fit_mean_list.append(fit_mean)
         fit_std_list.append(fit_std)
-
-        # histogram of chage distribution for each section
-        ax2.set_title("# NPE distribution ")
-        ax2.set_xlabel("NPE (PE)")
-        ax2.set_ylabel("# of count")
-        # Indicate the fit reagion in the plot
-        # if fit_max is higher that max(center), only plot till there
-        if fit_max > center[-1]:
-            fit_max = center[-1]
-        ax2.axvspan(fit_min, fit_max, color="tab:orange", alpha=0.2,
-                        label="Fit range")
-        ax2.errorbar(center, hist,
-                     xerr=np.diff(edges)*0.5,
-                     yerr=np.sqrt(hist),
-                     fmt='none',
-                     label="Data")
-        ax2.plot(center, gauss(center, *popt),
-                     label=f"Gaussian fit (m={fit_mean:.2f})")
-        ax2.legend()
-
-        #histgrm fit for Ip
-        # Use different binning for the two lowest filter settings
-        # For these settings we are in the PE range
-        if fw == "0.01":
-            bins = np.linspace(0, max_lim_0010/10, 101)
-        elif fw == "0.025":
-            bins = np.linspace(0, max_lim_0025/10, 101)
-        else:
-            bins = np.linspace(np.min(ip), np.max(ip), 101)
-
-        hist2, edges2 = np.histogram(ip, bins=bins)
-        center2 = (edges2[1:] + edges2[:-1]) * 0.5
-        init_norm = np.max(hist2)
-        # init_peak = center2[np.argmax(hist2)]
-        init_peak = ip_mean
-        init_width = 0.35 * init_peak
-        p0 = [init_norm, init_peak, init_width]
-
-        bounds2 = [(0.01 * init_norm, init_peak * 0.2, 0.),
-                  (10. * init_norm, init_peak * 2, 3. * init_width)]
-
-        # try to limit the histogram around the mean to make fitting with lots of
-        # darknoise easier
-        if fw == "0.01":
-            # special limits for fitting for the lowest setting, because it's so close to 0.
-            fit_min2 = 0.
-            fit_max2 = init_peak * 2.5
-        else:
-            fit_min2 = init_peak * 0.4
-            fit_max2 = init_peak * 2.5
-        fit_mask2 = np.logical_and(center2 > fit_min2,
-                                   center2 < fit_max2)
-        try:
-            popt2, pcov = curve_fit(gauss, center2[fit_mask2], hist2[fit_mask2], p0=p0, bounds=bounds2)
-        except RuntimeError:
-            popt2 = np.zeros_like(p0)
-        except ValueError:
-            popt2 = np.zeros_like(p0)
-        fit_ipk = popt2[1]
-        fit_ipk_std = popt2[2]/np.sqrt(np.sum(mask))
-        # fit_ipk_std = np.sqrt(pcov[1, 1])
+        fit_ipk = ip_fit['mean']
+        fit_ipk_std = ip_fit['std']
         fit_ipk_list.append(fit_ipk)
         fit_ipk_std_list.append(fit_ipk_std)
 
-        # histogram of chage distribution for each section
-        ax3.set_title("# Peak current distribution ")
-        ax3.set_xlabel("Peak current (mA)")
-        ax3.set_ylabel("# of count")
-        # Indicate the fit reagion in the plot
-        # if fit_max is higher that max(center), only plot till there
-        if fit_max2 > center2[-1]:
-            fit_max2 = center2[-1]
-        ax3.axvspan(fit_min2, fit_max2, color="tab:orange", alpha=0.2,
-                    label="Fit range")
-        ax3.errorbar(center2, hist2,
-                     xerr=np.diff(edges2)*0.5,
-                     yerr=np.sqrt(hist2),
-                     fmt='none',
-                     label="Data")
-        ax3.plot(center2, gauss(center2, *popt2),
-                 label=f"Gaussian fit (m={fit_ipk:.2f})")
-        ax3.legend()
-        fig.savefig(os.path.join(plot_dir, f'pmt_{PMT}_fw_{fw}.pdf'),
-                    bbox_inches='tight')
+        summary_file = save_summary(data_dir, PMT, summary, npe_fit, ip_fit)
+        if plot:
+            plot_summary(load_summary(summary_file), plot_dir)
 
         print(f"Filter %= {fw}")
         print(f"NPE mean(Observed) = {npe0_mean:.3f}",
@@ -616,7 +412,8 @@ def npe_comparison(data, fw_settings, plot_dir):
                 bbox_inches='tight')
 
 
-def analysis_wrapper(run_json, measurement_number="latest", remote=False, offline=False):
+def analysis_wrapper(run_json, measurement_number="latest", remote=False, offline=False,
+                     droop_correction=False, n_jobs=1, plots=True):
     run_json, run_number = get_run_json(run_json)
     list_of_deggs = load_run_json(run_json)
     measurement_type = "LinearityMeasurement"
@@ -629,6 +426,8 @@ def analysis_wrapper(run_json, measurement_number="latest", remote=False, offlin
     current_popts = []
     observed_npe = {}
 
+    ##collect the measurements first, the PMTs are analysed in parallel
+    jobs = []
     for degg_file in list_of_deggs:
         degg_dict = load_degg_dict(degg_file)
         for pmt in ['LowerPmt', 'UpperPmt']:
@@ -660,27 +459,42 @@ def analysis_wrapper(run_json, measurement_number="latest", remote=False, offlin
                 if data_dir == 'None':
                     print('data_dir is None, skipping measurement.')
                     continue
-                files, data, fw_settings, temps = fit_charge_and_peak_current(
-                    pmt_id,
-                    data_dir,
-                    run_plot_dir,
-                    run_data_dir
-                )
-                chi2_v, popt_current = plot_individual_linearity_curve(
-                    pmt_id,
-                    run_number,
-                    run_plot_dir,
-                    data_key_to_use,
-                    files,
-                    data,
-                    fw_settings,
-                    temps,
-                    logbook
-                )
-                chi2_vals.append(chi2_v)
-                current_popts.append(popt_current)
-                observed_npe[pmt_id] = data[1][0:]
-                send_message(f'Linearity Analysis Finished for {pmt_id}')
+                jobs.append((pmt_id, data_dir, run_plot_dir, run_data_dir,
+                             data_key_to_use))
+
+    ##summaries of all filter settings, plots are made from the saved summaries
+    args = [[job[i] for job in jobs] for i in range(4)]
+    if n_jobs > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(
+                fit_charge_and_peak_current, *args,
+                [droop_correction] * len(jobs), [False] * len(jobs)))
+            if plots:
+                list(executor.map(plot_summaries, args[3], args[2], args[0]))
+    else:
+        results = [fit_charge_and_peak_current(
+                       pmt_id, data_dir, run_plot_dir, run_data_dir,
+                       droop_correction=droop_correction, plot=plots)
+                   for pmt_id, data_dir, run_plot_dir, run_data_dir, _ in jobs]
+
+    for job, result in zip(jobs, results):
+        pmt_id, data_dir, run_plot_dir, run_data_dir, data_key_to_use = job
+        files, data, fw_settings, temps = result
+        chi2_v, popt_current = plot_individual_linearity_curve(
+            pmt_id,
+            run_number,
+            run_plot_dir,
+            data_key_to_use,
+            files,
+            data,
+            fw_settings,
+            temps,
+            logbook
+        )
+        chi2_vals.append(chi2_v)
+        current_popts.append(popt_current)
+        observed_npe[pmt_id] = data[1][0:]
+        send_message(f'Linearity Analysis Finished for {pmt_id}')
 
     npe_comparison(observed_npe, fw_settings, run_plot_dir)
     print(chi2_vals)
@@ -693,8 +507,14 @@ def analysis_wrapper(run_json, measurement_number="latest", remote=False, offlin
 @click.option('--measurement_number', '-n', default='latest')
 @click.option('--remote', is_flag=True)
 @click.option('--offline', is_flag=True)
-def main(run_json, measurement_number, remote, offline):
-    analysis_wrapper(run_json, measurement_number, remote, offline)
+@click.option('--droop_correction', is_flag=True)
+@click.option('--n_jobs', '-j', default=1, help='number of PMTs analysed in parallel')
+@click.option('--no_plots', is_flag=True,
+              help='only save the summaries, plot them later with linearity_summary.py')
+def main(run_json, measurement_number, remote, offline, droop_correction,
+         n_jobs, no_plots):
+    analysis_wrapper(run_json, measurement_number, remote, offline,
+                     droop_correction, n_jobs, not no_plots)
 
 
 if __name__ == '__main__':
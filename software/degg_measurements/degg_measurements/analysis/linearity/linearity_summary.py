@@ -0,0 +1,299 @@
+# Per filter setting summaries of the FAT linearity data
+# The waveforms of a file are read chunk by chunk: charges, peak currents,
+# the average waveform and the smallest/largest waveform are computed in one
+# vectorized pass. The summaries are saved as .npz next to the linearity
+# data, the plots of a filter setting are made from the saved summary.
+import os
+import click
+from glob import glob
+import numpy as np
+from matplotlib import pyplot as plt
+from scipy.optimize import curve_fit
+
+from degg_measurements.utils import read_parameters
+from degg_measurements.utils import iter_data_chunks
+from degg_measurements.utils import get_charges
+from degg_measurements.utils import correct_droop, droop_time_constant
+from degg_measurements.utils import CALIBRATION_FACTORS
+
+##waveforms read at once
+CHUNK_SIZE = 10000
+##charge integration window [bins] and pre-trigger bins of the baseline
+GATE_START = 13
+GATE_WIDTH = 15
+BASELINE_BINS = 10
+N_BINS = 128
+
+##upper histogram limit [PE] of the two lowest filter settings, these are
+##in the PE range; the peak current limits are a tenth of these
+MAX_LIM_0010 = 25
+MAX_LIM_0025 = 100
+
+
+def gauss(x, norm, peak, width):
+    val = norm * np.exp(-(x-peak)**2/(2 * width**2))
+    return val
+
+
+def make_laser_freq_mask(timestamps, fw):
+    fw = float(fw)
+    timestamps_per_second = 240e6
+    diffs = np.diff(timestamps)
+    laser_freq_in_hz = 100.
+    dt_in_timestamps = timestamps_per_second / laser_freq_in_hz
+    mask = np.logical_and(diffs > dt_in_timestamps - 10,
+                          diffs < dt_in_timestamps + 10)
+
+    pulses = diffs / timestamps_per_second * laser_freq_in_hz
+    _mask = (pulses > 0.0999) & (pulses < 1.0001)
+    if np.sum(_mask) > np.sum(mask):
+        mask = _mask
+
+    if np.sum(mask) == 0:
+        print('<make_laser_freq_mask>: no valid mask')
+        if fw == 0.1:
+            print('No valid triggers found for the 10% filter. Exiting')
+            exit(1)
+        return np.zeros_like(timestamps, dtype=bool)
+
+    #This part was to verify that the filter above is actually working
+    #But because it was done on bad data it lead to bad results.
+    #It's not needed anymore.
+    #Find one index where a neighboring trigger is the laser freq away
+    # starting_idx = np.where(mask)[0][0]
+
+    # timestamps_shifted = timestamps - timestamps[starting_idx]
+    # timestamps_in_dt = timestamps_shifted / dt_in_timestamps
+    # rounded_timestamps = np.round(timestamps_in_dt)
+    # new_mask = np.isclose(timestamps_in_dt, rounded_timestamps,
+    #                       atol=1e-3, rtol=0)
+
+    # print(f'Mask Info - sum: {np.sum(mask)}, {np.sum(new_mask)}')
+    # return new_mask
+    return np.append(mask, mask[-1])
+
+
+def summarize_file(filename, droop_correction=False, chunk_size=CHUNK_SIZE):
+    '''
+    Reads one linearity file chunk by chunk. Only the waveforms of laser
+    triggers are used (make_laser_freq_mask on the timestamps of the whole
+    file). Returns a dict with the filter setting, temperature, event
+    counts, the NPE and peak current [mA] of each used waveform, the bin
+    times [s] and the average, smallest and largest waveform [V] (largest
+    and smallest by peak, baseline subtracted).
+    '''
+    params = read_parameters(filename)
+    fw = params['strength']
+    temperature = float(params['degg_temp'])
+    timestamps = np.concatenate(
+        [chunk['timestamp'] for _, chunk in
+         iter_data_chunks(filename, columns=('timestamp',), chunk_size=None)])
+    mask = make_laser_freq_mask(timestamps, fw)
+
+    summary = {'filename': filename,
+               'fw': str(fw),
+               'temperature': temperature,
+               'n_events': len(timestamps),
+               'n_valid': int(np.sum(mask)),
+               'times': np.zeros(N_BINS),
+               'average': np.zeros(N_BINS),
+               'smallest': np.zeros(N_BINS),
+               'largest': np.zeros(N_BINS)}
+    if summary['n_valid'] == 0:
+        summary['npes'] = np.zeros(0)
+        summary['ip'] = np.zeros(0)
+        return summary
+
+    if droop_correction:
+        tau = droop_time_constant(temperature)
+    npes = []
+    ips = []
+    wf_sum = np.zeros(N_BINS)
+    min_peak = np.inf
+    max_peak = -np.inf
+    for start, chunk in iter_data_chunks(filename,
+                                         columns=('time', 'waveform'),
+                                         chunk_size=chunk_size):
+        if start == 0:
+            summary['times'] = (chunk['time'][0, 0:N_BINS] *
+                                CALIBRATION_FACTORS.fpga_clock_to_s)
+        waveforms = chunk['waveform'][mask[start:start + len(chunk['waveform'])]]
+        if len(waveforms) == 0:
+            continue
+        baselines = np.mean(waveforms[:, :BASELINE_BINS], axis=1)
+        waveforms = waveforms - baselines[:, np.newaxis]
+        if droop_correction:
+            # undo the droop of large pulses, baseline is 0 afterwards
+            waveforms = correct_droop(waveforms, tau)
+        waveforms *= CALIBRATION_FACTORS.adc_to_volts
+        # charge pC, peak in V
+        charges, peaks = get_charges(waveforms,
+                                     gate_start=GATE_START,
+                                     gate_width=GATE_WIDTH,
+                                     baseline=0.,
+                                     return_pulse_height=True)
+        npes.append(charges / 1.602) # PE
+        ips.append(peaks / 50 * 1000) # mA
+        wf_sum += np.sum(waveforms[:, :N_BINS], axis=0)
+
+        # first waveform with the extreme peak, like a scan of all of them
+        i_max = np.argmax(peaks)
+        if peaks[i_max] > max_peak:
+            max_peak = peaks[i_max]
+            summary['largest'] = waveforms[i_max, :N_BINS].copy()
+        i_min = np.argmin(peaks)
+        if peaks[i_min] < min_peak:
+            min_peak = peaks[i_min]
+            summary['smallest'] = waveforms[i_min, :N_BINS].copy()
+
+    summary['npes'] = np.concatenate(npes)
+    summary['ip'] = np.concatenate(ips)
+    summary['average'] = wf_sum / summary['n_valid']
+    return summary
+
+
+def fit_distribution(values, fw, max_lim, width_frac, n_valid):
+    '''
+    Gaussian fit of the histogram of values (NPE or peak current) around
+    their mean. Returns the histogram, the fit parameters, the fit range,
+    the fitted mean and its uncertainty (fitted width / sqrt(n_valid)).
+    '''
+    # Use different binning for the two lowest filter settings
+    # For these settings we are in the PE range
+    if fw == "0.01":
+        bins = np.linspace(0, max_lim[0], 101)
+    elif fw == "0.025":
+        bins = np.linspace(0, max_lim[1], 101)
+    else:
+        bins = np.linspace(np.min(values), np.max(values), 101)
+
+    hist, edges = np.histogram(values, bins=bins)
+    center = (edges[1:] + edges[:-1]) * 0.5
+    init_norm = np.max(hist)
+    init_peak = np.mean(values)
+    init_width = width_frac * init_peak
+    p0 = [init_norm, init_peak, init_width]
+    bounds = [(0.01 * init_norm, init_peak * 0.2, 0.),
+              (10. * init_norm, init_peak * 2, 3. * init_width)]
+    # try to limit the histogram around the mean to make fitting with lots of
+    # darknoise easier
+    if fw == "0.01":
+        # special limits for fitting for the lowest setting, because it's so close to 0.
+        fit_min = 0.
+    else:
+        fit_min = init_peak * 0.4
+    fit_max = init_peak * 2.5
+    fit_mask = np.logical_and(center > fit_min,
+                              center < fit_max)
+    try:
+        popt, pcov = curve_fit(gauss, center[fit_mask], hist[fit_mask], p0=p0, bounds=bounds)
+    except (RuntimeError, ValueError):
+        popt = np.zeros_like(p0)
+    return {'hist': hist,
+            'edges': edges,
+            'popt': np.asarray(popt, dtype=float),
+            'fit_range': np.array([fit_min, fit_max]),
+            'mean': popt[1],
+            'std': popt[2] / np.sqrt(n_valid)}
+
+
+def fit_summary(summary):
+    '''fits of the NPE and the peak current distribution of a summary'''
+    npe_fit = fit_distribution(summary['npes'], summary['fw'],
+                               (MAX_LIM_0010, MAX_LIM_0025), 0.25,
+                               summary['n_valid'])
+    ip_fit = fit_distribution(summary['ip'], summary['fw'],
+                              (MAX_LIM_0010/10, MAX_LIM_0025/10), 0.35,
+                              summary['n_valid'])
+    return npe_fit, ip_fit
+
+
+def summary_path(data_dir, PMT, fw):
+    return os.path.join(data_dir, f'{PMT}_fw_{fw}_summary.npz')
+
+
+def save_summary(data_dir, PMT, summary, npe_fit, ip_fit):
+    fpath = summary_path(data_dir, PMT, summary['fw'])
+    arrays = {key: np.asarray(val) for key, val in summary.items()}
+    for prefix, fit in [('npe', npe_fit), ('ip', ip_fit)]:
+        for key in ['hist', 'edges', 'popt', 'fit_range']:
+            arrays[f'{prefix}_{key}'] = fit[key]
+    np.savez(fpath, pmt=PMT, **arrays)
+    return fpath
+
+
+def load_summary(fpath):
+    with np.load(fpath) as f:
+        return {key: (f[key].item() if f[key].ndim == 0 else f[key])
+                for key in f.files}
+
+
+def _plot_fit(ax, summary, prefix, label, unit):
+    edges = summary[f'{prefix}_edges']
+    hist = summary[f'{prefix}_hist']
+    popt = summary[f'{prefix}_popt']
+    fit_min, fit_max = summary[f'{prefix}_fit_range']
+    center = (edges[1:] + edges[:-1]) * 0.5
+    ax.set_title(f"# {label} distribution ")
+    ax.set_xlabel(f"{label} ({unit})")
+    ax.set_ylabel("# of count")
+    # Indicate the fit reagion in the plot
+    # if fit_max is higher that max(center), only plot till there
+    if fit_max > center[-1]:
+        fit_max = center[-1]
+    ax.axvspan(fit_min, fit_max, color="tab:orange", alpha=0.2,
+               label="Fit range")
+    ax.errorbar(center, hist,
+                xerr=np.diff(edges)*0.5,
+                yerr=np.sqrt(hist),
+                fmt='none',
+                label="Data")
+    ax.plot(center, gauss(center, *popt),
+            label=f"Gaussian fit (m={popt[1]:.2f})")
+    ax.legend()
+
+
+def plot_summary(summary, plot_dir):
+    '''average waveform and the NPE and peak current fits of a summary'''
+    PMT = summary['pmt']
+    fw = summary['fw']
+    x_l1_list = summary['times']
+    fig = plt.figure(figsize=(15,3))
+    ax1 = fig.add_subplot(1,3,1)
+    ax2 = fig.add_subplot(1,3,2)
+    ax3 = fig.add_subplot(1,3,3)
+    ax1.set_title(f"averaged waveform [{summary['n_valid']} waveforms]")
+    ax1.set_ylim(-0.1, 1.4)
+    ax1.set_xlim(0E-9, 500E-9)
+    ax1.grid(linewidth=1)
+    ax1.plot(x_l1_list, summary['average'], label="average waveform", color="tab:blue")
+    ax1.plot(x_l1_list, summary['smallest'], label="smallest waveform", color="tab:blue", alpha=0.5)
+    ax1.plot(x_l1_list, summary['largest'], label="largest waveform", color="tab:blue", alpha=0.5)
+    ax1.legend()
+    _plot_fit(ax2, summary, 'npe', 'NPE', 'PE')
+    _plot_fit(ax3, summary, 'ip', 'Peak current', 'mA')
+    fpath = os.path.join(plot_dir, f'pmt_{PMT}_fw_{fw}.pdf')
+    fig.savefig(fpath, bbox_inches='tight')
+    plt.close(fig)
+    return fpath
+
+
+def plot_summaries(data_dir, plot_dir, PMT='*'):
+    '''plots of all saved summaries (of PMT) in data_dir'''
+    if not os.path.isdir(plot_dir):
+        os.makedirs(plot_dir)
+    fpaths = sorted(glob(summary_path(data_dir, PMT, '*')))
+    return [plot_summary(load_summary(fpath), plot_dir) for fpath in fpaths]
+
+
+@click.command()
+@click.argument('data_dir')
+@click.argument('plot_dir')
+@click.option('--pmt', default='*', help='only the summaries of this PMT')
+def main(data_dir, plot_dir, pmt):
+    for fpath in plot_summaries(data_dir, plot_dir, pmt):
+        print(fpath)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,7 @@ from degg_measurements.utils import load_degg_dict
 from degg_measurements.utils import load_run_json
 from degg_measurements.analysis.analysis_utils import get_run_json
 from degg_measurements.utils import DEggLogBook
+from degg_measurements.analysis.analysis_cache import AnalysisCache
 
 from chiba_slackbot import send_message
 
@@ -27,78 +28,98 @@ colormap = "magma"
 def gaus(x,a,x0,sigma):
     return a*np.exp(-(x-x0)**2/(2*sigma**2))
 
-def add_module_to_cache(df, cache, hv_status):
-    degg_name = df['degg_name'].to_numpy()[0]
-    # check if cache is empty
+def summarize_moni_file(moni_file, params=''):
+    '''per-file summary stored in the AnalysisCache'''
+    print(moni_file)
     try:
-        keys = cache[degg_name]['std'].keys()
-    except KeyError:
+        df = pd.read_hdf(moni_file)
+    except ValueError:
+        print(f"File not readable: {moni_file}")
+        return None
+    row = {
+        'degg_name': str(df['degg_name'].to_numpy()[0]),
+        'port': df['port'].to_numpy()[0],
+        'start_time': np.float64(df['start_time'].to_numpy()[0]),
+    }
+    for k in df.keys():
+        if k in ignore:
+            continue
+        _data = df[k].to_numpy()
+        row[f'mean_{k}'] = np.mean(_data)
+        row[f'std_{k}'] = np.std(_data)
+    return row
+
+
+def add_module_to_cache(row, cache, hv_status):
+    degg_name = row['degg_name']
+    keys = [c[len('mean_'):] for c in row.index
+            if c.startswith('mean_') and np.isfinite(row[c])]
+    # check if cache is empty
+    if degg_name not in cache:
         cache[degg_name] = {
             "mean": {},
             "std": {},
             "start_time": [],
             "HVStatus": [],
-            "port": df['port'].to_numpy()[0]
+            "port": row['port']
         }
-        keys = [k for k in df.keys() if k not in ignore]
         for k in keys:
             cache[degg_name]['mean'][k] = []
             cache[degg_name]['std'][k] = []
 
-    cache[degg_name]['start_time'].append(np.float64(df['start_time'].to_numpy()[0]))
+    cache[degg_name]['start_time'].append(row['start_time'])
     cache[degg_name]['HVStatus'].append(hv_status)
-    for k in keys:
-        _data = df[k].to_numpy()
-        cache[degg_name]['mean'][k].append(np.mean(_data))
-        cache[degg_name]['std'][k].append(np.std(_data))
-
-
-def fill_cache(degg_dict, cache, measurement_type, remote, silence=False):
-    if degg_dict[measurement_type]['Folder'] != "None":
-        if remote:
-            if "RemoteFolder" not in degg_dict[measurement_type]:
-                message = "No 'RemoteFolder' for msmt '{}' and DEgg '{}'\n".format(measurement_type, degg_dict["DEggSerialNumber"])
-                message += "Is this the skipped DEgg?"
-                if silence == False:
-                    send_message(message)
-                return
-            elif degg_dict[measurement_type]["RemoteFolder"] is None:
-                return
-            data_dir = degg_dict[measurement_type]['RemoteFolder']
-        else:
-            data_dir = degg_dict[measurement_type]['Folder']
-        # We know there should be 16 files
-        for j in range(16):
-            moni_file = os.path.join(data_dir, f"mon_50{j:02}.hdf5")
-            if not os.path.exists(moni_file):
-                _msg = f"Could not find quick monitoring file for channel 50{j:02} in {moni_file}"
-                print(_msg)
-                if silence == False:
-                    send_message(_msg)
-                continue
-            print(moni_file)
-            try:
-                df = pd.read_hdf(moni_file)
-            except ValueError:
-                print(f"File not readable: {moni_file}")
-                continue
-            hv_status = degg_dict[measurement_type]['HVStatus']
-            add_module_to_cache(df, cache, hv_status)
-
-
-def get_cache(cache_file):
-    if os.path.exists(cache_file):
-        cache = np.load(cache_file, allow_pickle=True).item()
+    for k in cache[degg_name]['mean'].keys():
+        cache[degg_name]['mean'][k].append(row[f'mean_{k}'])
+        cache[degg_name]['std'][k].append(row[f'std_{k}'])
+
+
+def collect_moni_files(degg_dict, measurement_type, remote, silence=False):
+    '''returns [(moni_file, hv_status), ...] of one measurement'''
+    moni_files = []
+    if degg_dict[measurement_type]['Folder'] == "None":
+        return moni_files
+    if remote:
+        if "RemoteFolder" not in degg_dict[measurement_type]:
+            message = "No 'RemoteFolder' for msmt '{}' and DEgg '{}'\n".format(measurement_type, degg_dict["DEggSerialNumber"])
+            message += "Is this the skipped DEgg?"
+            if silence == False:
+                send_message(message)
+            return moni_files
+        elif degg_dict[measurement_type]["RemoteFolder"] is None:
+            return moni_files
+        data_dir = degg_dict[measurement_type]['RemoteFolder']
     else:
-        cache = {}
-    return cache
-
-
-def save_cache(cache_file, cache):
-    cache_dir = os.path.dirname(cache_file)
-    if not os.path.isdir(cache_dir):
-        os.makedirs(cache_dir)
-    np.save(cache_file, cache)
+        data_dir = degg_dict[measurement_type]['Folder']
+    hv_status = degg_dict[measurement_type]['HVStatus']
+    # We know there should be 16 files
+    for j in range(16):
+        moni_file = os.path.join(data_dir, f"mon_50{j:02}.hdf5")
+        if not os.path.exists(moni_file):
+            _msg = f"Could not find quick monitoring file for channel 50{j:02} in {moni_file}"
+            print(_msg)
+            if silence == False:
+                send_message(_msg)
+            continue
+        moni_files.append((moni_file, hv_status))
+    return moni_files
+
+
+def fill_cache(degg_dict, cache, measurement_types, remote, cache_file,
+               silence=False):
+    '''
+    Adds the summaries of all mon files of measurement_types to cache.
+    Files already in the AnalysisCache at cache_file are not read again.
+    '''
+    moni_files = []
+    for measurement_type in measurement_types:
+        moni_files += collect_moni_files(degg_dict, measurement_type,
+                                         remote, silence)
+    analysis_cache = AnalysisCache(cache_file, 'monitor_quick')
+    summary = analysis_cache.update([(f, '') for f, _ in moni_files],
+                                    summarize_moni_file)
+    for _, row in summary.iterrows():
+        add_module_to_cache(row, cache, moni_files[row['entry']][1])
 
 
 def make_plot(x, y_list, err_list, ylabel, titel, label_list,
@@ -482,23 +503,16 @@ def analysis_wrapper(run_json, measurement_number="latest", remote=False,
 
     if cache_file == None:
         cache_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
-                    'cache', f'run_{run_number}.npy')
-    cache = get_cache(cache_file)
+                    'cache', f'run_{run_number}.hdf5')
+    cache = {'run_number': run_number}
     degg_dict = load_degg_dict(list_of_deggs[0])
     max_n = get_measurement_numbers(degg_dict, None, measurement_number, "OnlineMon")
 
-    if len(cache.keys()) == 0 and max_n[0] != 0:
-        # No cache found and not the first measurement made:
-        # Rebuild the cache
-        for i in range(max_n[0]+1):
-            k = f"OnlineMon_{i:02}"
-            fill_cache(degg_dict, cache, k, remote, silence)
-            cache['run_number'] = run_number
-    else:
-        k = f"OnlineMon_{max_n[0]:02}"
-        fill_cache(degg_dict, cache, k, remote, silence)
+    # Only mon files which are not in the cache yet are read
+    measurement_types = [f"OnlineMon_{i:02}" for i in range(max_n[0]+1)]
+    fill_cache(degg_dict, cache, measurement_types, remote, cache_file,
+               silence)
 
-    save_cache(cache_file, cache)
     # Make plots
     degg_comparison_plots(cache)
     make_hv_stability_plot(cache)
@@ -521,9 +535,10 @@ def analysis_wrapper(run_json, measurement_number="latest", remote=False,
 @click.option("--measurement_number", "-n", default="latest")
 @click.option("--remote", is_flag=True)
 @click.option("--offline", is_flag=True)
-@click.opeion("--silence", is_flag=True)
+@click.option("--silence", is_flag=True)
 def main(run_json, measurement_number, remote, offline, silence):
-    analysis_wrapper(run_json, measurement_number, remote, offline, silence)
+    analysis_wrapper(run_json, measurement_number, remote, offline,
+                     silence=silence)
 
 
 if __name__ == "__main__":
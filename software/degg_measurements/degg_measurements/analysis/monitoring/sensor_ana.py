@@ -1,4 +1,5 @@
 from degg_measurements.utils import load_degg_dict, load_run_json
+from degg_measurements.monitoring.sensor_store import load_sensor_data
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
@@ -669,7 +670,7 @@ def readout_reboot_tests(run_json, temperature_file, measurement_type, measureme
         filename = degg_dict[data_key_to_use]['Filename']
         print(f"Using {filename} for Module: {degg_id}")
 
-        df = pd.read_csv(filename, index_col='Local time', infer_datetime_format=True)
+        df = load_sensor_data(filename)
         print(f"Dataframe Size: {df.shape}")
         df_list.append(df)
         degg_id_list.append(degg_id)
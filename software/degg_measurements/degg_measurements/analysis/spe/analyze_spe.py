@@ -17,6 +17,8 @@ from degg_measurements.utils import extract_runnumber_from_path
 from degg_measurements.utils.control_data_charge import read_data_charge
 from degg_measurements.analysis import Result
 from degg_measurements.analysis import RunHandler
+from degg_measurements.analysis.spe.spe_fit import fit_pmts, hv_at_gain
+from degg_measurements.analysis.spe.spe_fit import spe_model
 from termcolor import colored
 
 E_CONST = 1.60217662e-7
@@ -300,12 +302,136 @@ def run_analysis(data_key, degg_dict, pmt, logbook, run_number, icrc, hv_setting
     return degg_dict, center, hist
 
 
+def plot_spe_scan(fit_result, folder):
+    '''charge histograms of all HV points of one PMT with their fits'''
+    pmt_id = fit_result['pmt_id']
+    fig, ax = plt.subplots()
+    for i, point in enumerate(fit_result['points']):
+        center = point['center']
+        color = f'C{i % 10}'
+        ls = '-' if point['ok'] else ':'
+        ax.step(center, point['hist'], where='mid', color=color, alpha=0.5)
+        ax.plot(center, spe_model(center, *point['params'].values()),
+                color=color, ls=ls, label=f"{point['hv']:.0f} V")
+    ax.set_xlabel('Charge Stamp Value [pC]')
+    ax.set_ylabel('Entries / bin')
+    ax.set_yscale('log')
+    ax.set_ylim(1, None)
+    ax.set_title(f'{pmt_id}, gain = {np.exp(fit_result["log_a"]) / E_CONST:.3g}'
+                 f' * (HV / 1500 V)^{fit_result["k"]:.2f}')
+    ax.legend(ncol=2, fontsize=8)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    fig.savefig(os.path.join(folder, f'spe_scan_{pmt_id}.pdf'), bbox_inches='tight')
+    plt.close(fig)
+
+
+def run_joint_analysis(data_key, degg_dict, pmt, logbook, run_number,
+                       fit_result):
+    '''
+    uploads the gain of every HV point of a joint SPE fit
+    (spe_fit.fit_pmts) without quality flags, with the same 'charge'
+    schema as run_analysis; the HV at 1e7 gain is left to analyze_gain
+    '''
+    pmt_id = degg_dict[pmt]['SerialNumber']
+    points = fit_result['points']
+    for point in points:
+        if not point['ok']:
+            print(colored(f"{pmt_id} {point['hv']:.0f} V: fit flagged "
+                          f"{', '.join(point['flags'])}", 'yellow'))
+    good = [point for point in points if point['ok']]
+    if len(good) == 0:
+        print(colored(f'No good SPE fit for {pmt_id}', 'red'))
+        return degg_dict
+    print(f"{pmt_id}: HV at 1e7 gain = "
+          f"{hv_at_gain(fit_result['log_a'], fit_result['k']):.1f} V")
+    if logbook is None:
+        print("Skipping Upload Step, run without --offline to enable")
+        return degg_dict
+
+    remote_path = os.path.join(
+        '/data/exp/IceCubeUpgrade/commissioning',
+        'degg_test_files')
+    import degg_measurements
+    db_path = os.path.join(degg_measurements.__path__[0],
+                           'analysis',
+                           'database_jsons')
+    for point in good:
+        result = Result(pmt_id,
+                        logbook=logbook,
+                        run_number=run_number,
+                        remote_path=remote_path)
+        json_filenames = result.to_json(meas_group='charge',
+                       raw_files=point['file_name'],
+                       folder_name=db_path,
+                       filename_add=data_key.replace('Folder', ''),
+                       high_voltage=float(point['hv']),
+                       gain=float(point['gain']),
+                       gain_err=float(point['gain_err']),
+                       temperature=point['temp'])
+
+        run_handler = RunHandler(filenames=json_filenames)
+        run_handler.submit_based_on_meas_class()
+    return degg_dict
+
+
+def get_data_key(degg_dict, pmt, data_key, measurement_number):
+    if measurement_number == 'latest':
+        eligible_keys = [key for key in degg_dict[pmt].keys()
+                         if key.startswith(data_key)]
+        cts = [int(key.split('_')[1]) for key in eligible_keys]
+        if len(cts) == 0:
+            return None
+        measurement_number = np.max(cts)
+    return data_key + f'_{measurement_number:02d}'
+
+
+def main_joint(list_of_deggs, data_key, measurement_number, logbook,
+               run_number, icrc, n_jobs, plots):
+    ##all PMTs are fitted first, in parallel; uploads are serial
+    jobs = []
+    for degg_file in list_of_deggs:
+        degg_dict = load_degg_dict(degg_file)
+        for pmt in ['LowerPmt', 'UpperPmt']:
+            pmt_id = degg_dict[pmt]['SerialNumber']
+            data_key_to_use = get_data_key(degg_dict, pmt, data_key,
+                                           measurement_number)
+            if data_key_to_use is None or data_key_to_use not in degg_dict[pmt]:
+                print(f'No measurement found for {pmt_id} '
+                      f'in DEgg {degg_dict["DEggSerialNumber"]}. '
+                      f'Skipping it!')
+                continue
+            folder = degg_dict[pmt][data_key_to_use]['Folder']
+            file_names = [os.path.join(folder, pmt_id + f'_{hv_setting}V.hdf5')
+                          for hv_setting in np.arange(1200, 1850, 50)]
+            jobs.append((degg_file, pmt, data_key_to_use, pmt_id, file_names))
+
+    fit_results = fit_pmts([(job[3], job[4]) for job in jobs],
+                           n_jobs=n_jobs, icrc=icrc)
+
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'figs')
+    if run_number is not None:
+        folder = os.path.join(folder, f'run_{run_number}')
+    for (degg_file, pmt, data_key_to_use, pmt_id, _), fit_result in \
+            zip(jobs, fit_results):
+        if plots and len(fit_result['points']) > 0:
+            plot_spe_scan(fit_result, os.path.join(folder, f'key_{data_key_to_use}'))
+        degg_dict = load_degg_dict(degg_file)
+        degg_dict = run_joint_analysis(data_key_to_use, degg_dict, pmt,
+                                       logbook, run_number, fit_result)
+        update_json(degg_file, degg_dict)
+
+
 @click.command()
 @click.argument('run_json', type=click.Path(exists=True))
 @click.option('--measurement_number', '-n', default='latest')
 @click.option('--offline', is_flag=True)
 @click.option('--icrc', is_flag=True)
-def main(run_json, measurement_number, offline, icrc):
+@click.option('--per_hv', is_flag=True,
+              help='fit every HV point on its own instead of the joint fit')
+@click.option('--n_jobs', '-j', default=1, help='number of PMTs fitted in parallel')
+@click.option('--plots', is_flag=True, help='plot the joint fit of each PMT')
+def main(run_json, measurement_number, offline, icrc, per_hv, n_jobs, plots):
     try:
         measurement_number = int(measurement_number)
     except ValueError:
@@ -323,6 +449,11 @@ def main(run_json, measurement_number, offline, icrc):
     list_of_deggs = load_run_json(run_json)
     run_number = extract_runnumber_from_path(run_json)
 
+    if not per_hv:
+        main_joint(list_of_deggs, data_key, measurement_number, logbook,
+                   run_number, icrc, n_jobs, plots)
+        return
+
     plotSetting(plt)
     fig = plt.figure()
     plt.rc('legend', fontsize=9)
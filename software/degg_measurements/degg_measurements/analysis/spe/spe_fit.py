@@ -0,0 +1,382 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import least_squares
+
+from degg_measurements.utils.control_data_charge import read_data_charge
+
+E_CONST = 1.60217662e-7
+
+##the SPE peak follows peak = exp(log_a) * (hv / HV_REF)**k
+HV_REF = 1500.
+##start values of the power law: 1.6 pC at HV_REF, k of a 10 dynode PMT
+DEFAULT_LOG_A = np.log(1.6)
+DEFAULT_K = 7.
+##width of the power law prior in log(peak)
+PRIOR_WIDTH = 0.15
+
+##charge histogram: from CHARGE_MIN to SPE_RANGE times the expected peak
+CHARGE_MIN = -1.
+SPE_RANGE = 2.5
+N_BINS = 100
+##the fit starts below the pedestal
+FIT_MIN = -0.5
+
+PARAM_NAMES = ('ped_norm', 'ped_peak', 'ped_width', 'exp_norm', 'tau',
+               'spe_norm', 'spe_peak', 'spe_width')
+N_PARAMS = len(PARAM_NAMES)
+I_SPE_PEAK = PARAM_NAMES.index('spe_peak')
+
+##quality flags of a fit
+MIN_ENTRIES = 1000
+MAX_CHI2_NDF = 5.
+MAX_PRIOR_PULL = 3.
+MIN_SPE_SIGNIFICANCE = 5.
+
+
+def gauss(x, norm, peak, width):
+    val = norm * np.exp(-(x-peak)**2/(2 * width**2))
+    return val
+
+def normed_gauss(x, peak, width):
+    val = 1 / (np.sqrt(2 * np.pi) * width) * np.exp(-(x-peak)**2/(2 * width**2))
+    return val
+
+def spe_model(x, ped_norm, ped_peak, ped_width, exp_norm, tau,
+              spe_norm, spe_peak, spe_width):
+    '''
+    pedestal + (exponential + SPE gaussian) above 0 pC, the terms of
+    analyze_spe.fit_func_w_exp
+    '''
+    above = x > 0
+    exp_term = np.where(above, exp_norm / tau * np.exp(-x/tau), 0.)
+    gauss_term = np.where(above, spe_norm * normed_gauss(x, spe_peak, spe_width), 0.)
+    return gauss(x, ped_norm, ped_peak, ped_width) + exp_term + gauss_term
+
+def spe_model_jac(x, ped_norm, ped_peak, ped_width, exp_norm, tau,
+                  spe_norm, spe_peak, spe_width):
+    '''analytic derivatives of spe_model, shape (len(x), N_PARAMS)'''
+    above = x > 0
+    jac = np.empty((len(x), N_PARAMS))
+    g = np.exp(-(x-ped_peak)**2/(2 * ped_width**2))
+    jac[:, 0] = g
+    jac[:, 1] = ped_norm * g * (x - ped_peak) / ped_width**2
+    jac[:, 2] = ped_norm * g * (x - ped_peak)**2 / ped_width**3
+    e = np.where(above, np.exp(-x/tau) / tau, 0.)
+    jac[:, 3] = e
+    jac[:, 4] = exp_norm * e * (x / tau - 1) / tau
+    n = np.where(above, normed_gauss(x, spe_peak, spe_width), 0.)
+    jac[:, 5] = n
+    jac[:, 6] = spe_norm * n * (x - spe_peak) / spe_width**2
+    jac[:, 7] = spe_norm * n * ((x - spe_peak)**2 / spe_width**3 - 1 / spe_width)
+    return jac
+
+
+def power_law(hv, log_a, k):
+    return np.exp(log_a) * (np.asarray(hv, dtype=float) / HV_REF)**k
+
+def fit_power_law(hvs, peaks, sigma=None):
+    '''(log_a, k) of a straight line fit in log-log'''
+    x = np.log(np.asarray(hvs, dtype=float) / HV_REF)
+    y = np.log(peaks)
+    w = None if sigma is None else 1 / np.asarray(sigma)
+    k, log_a = np.polyfit(x, y, 1, w=w)
+    return log_a, k
+
+
+def hv_at_gain(log_a, k, gain=1e7):
+    '''HV of the gain from the power law'''
+    return HV_REF * (gain * E_CONST / np.exp(log_a))**(1 / k)
+
+
+def charge_histogram(charges, expected_peak):
+    bins = np.linspace(CHARGE_MIN, max(3., SPE_RANGE * expected_peak), N_BINS + 1)
+    hist, edges = np.histogram(charges, bins=bins)
+    center = (edges[1:] + edges[:-1]) * 0.5
+    return center, hist
+
+def estimate_spe_peak(charges):
+    '''position of the SPE bump, the largest bin clearly above the pedestal'''
+    charges = np.asarray(charges)
+    ped = charges[np.abs(charges) < 0.5]
+    ped_width = np.std(ped) if len(ped) > 1 else 0.1
+    above = charges[charges > 5 * ped_width]
+    if len(above) < 10:
+        return np.exp(DEFAULT_LOG_A)
+    hist, edges = np.histogram(above, bins=50,
+                               range=(5 * ped_width, np.percentile(above, 99)))
+    ##smooth over 3 bins
+    hist = np.convolve(hist, np.ones(3), mode='same')
+    i = np.argmax(hist)
+    return 0.5 * (edges[i] + edges[i + 1])
+
+
+def _pedestal_start(center, hist):
+    ped_mask = np.abs(center) <= 0.5
+    i = np.argmax(np.where(ped_mask, hist, -1))
+    weights = np.where(ped_mask, hist, 0)
+    width = np.sqrt(np.sum(weights * (center - center[i])**2) /
+                    max(np.sum(weights), 1))
+    return [max(hist[i], 1.), center[i], np.clip(width, 0.02, 0.3)]
+
+def _start_values(center, hist, spe_peak):
+    bin_width = center[1] - center[0]
+    n_above = np.sum(hist[center > 0.3 * spe_peak])
+    spe_norm = max(n_above, 1.) * bin_width
+    return np.array(_pedestal_start(center, hist) +
+                    [0.2 * spe_norm, 0.2 * spe_peak,
+                     spe_norm, spe_peak, 0.3 * spe_peak])
+
+def _bounds(center):
+    x_max = center[-1]
+    lower = [0., -0.5, 0.005, 0., 0.01, 0., 0.05, 0.01]
+    upper = [np.inf, 0.5, 1., np.inf, x_max, np.inf, x_max, x_max]
+    return np.array(lower), np.array(upper)
+
+
+def _residuals(params, center, hist, sigma, hv, prior):
+    res = (spe_model(center, *params) - hist) / sigma
+    if prior is None:
+        return res
+    log_a, k = prior
+    pull = (np.log(params[I_SPE_PEAK]) - np.log(power_law(hv, log_a, k))) / PRIOR_WIDTH
+    return np.append(res, pull)
+
+def _jacobian(params, center, hist, sigma, hv, prior):
+    jac = spe_model_jac(center, *params) / sigma[:, np.newaxis]
+    if prior is None:
+        return jac
+    prior_row = np.zeros((1, N_PARAMS))
+    prior_row[0, I_SPE_PEAK] = 1 / (params[I_SPE_PEAK] * PRIOR_WIDTH)
+    return np.vstack([jac, prior_row])
+
+
+def fit_spe_histogram(center, hist, hv, p0, prior=None):
+    '''
+    Fit of spe_model to one charge histogram (bins above FIT_MIN), with
+    Poisson uncertainties and, if prior=(log_a, k) is given, the power
+    law prior on the SPE peak. Returns the least_squares result.
+    '''
+    fit_mask = center >= FIT_MIN
+    center = center[fit_mask]
+    hist = hist[fit_mask]
+    sigma = np.sqrt(np.maximum(hist, 1.))
+    lower, upper = _bounds(center)
+    p0 = np.clip(p0, lower, upper)
+    return least_squares(_residuals, p0, jac=_jacobian, bounds=(lower, upper),
+                         args=(center, hist, sigma, hv, prior),
+                         x_scale='jac', method='trf', max_nfev=2000)
+
+
+def _joint_residuals(x, centers, hists, sigmas, hvs):
+    n = len(hvs)
+    params = x[:n * N_PARAMS].reshape(n, N_PARAMS)
+    log_a, k = x[-2:]
+    res = [(spe_model(c, *p) - h) / s
+           for c, h, s, p in zip(centers, hists, sigmas, params)]
+    pulls = (np.log(params[:, I_SPE_PEAK]) -
+             np.log(power_law(hvs, log_a, k))) / PRIOR_WIDTH
+    return np.concatenate(res + [pulls])
+
+def _joint_jacobian(x, centers, hists, sigmas, hvs):
+    n = len(hvs)
+    params = x[:n * N_PARAMS].reshape(n, N_PARAMS)
+    n_res = sum(len(c) for c in centers)
+    jac = np.zeros((n_res + n, len(x)))
+    row = 0
+    for i, (c, s, p) in enumerate(zip(centers, sigmas, params)):
+        jac[row:row + len(c), i * N_PARAMS:(i + 1) * N_PARAMS] = \
+            spe_model_jac(c, *p) / s[:, np.newaxis]
+        row += len(c)
+    ##prior rows: log(peak_i) - log_a - k * log(hv_i / HV_REF)
+    rows = n_res + np.arange(n)
+    jac[rows, np.arange(n) * N_PARAMS + I_SPE_PEAK] = \
+        1 / (params[:, I_SPE_PEAK] * PRIOR_WIDTH)
+    jac[rows, -2] = -1 / PRIOR_WIDTH
+    jac[rows, -1] = -np.log(np.asarray(hvs, dtype=float) / HV_REF) / PRIOR_WIDTH
+    return jac
+
+
+def _covariance(jac):
+    try:
+        return np.linalg.pinv(jac.T @ jac)
+    except np.linalg.LinAlgError:
+        return np.full((jac.shape[1], jac.shape[1]), np.nan)
+
+
+def _quality_flags(success, params, perr, chi2_ndf, n_entries, lower, upper,
+                   pull):
+    flags = []
+    if not success:
+        flags.append('not_converged')
+    at_bound = (np.isclose(params, lower, rtol=1e-6, atol=1e-9) |
+                np.isclose(params, upper, rtol=1e-6, atol=1e-9))
+    if np.any(at_bound[[1, 2, 6, 7]]):
+        flags.append('at_bound')
+    if not np.isfinite(chi2_ndf) or chi2_ndf > MAX_CHI2_NDF:
+        flags.append('bad_chi2')
+    if n_entries < MIN_ENTRIES:
+        flags.append('low_statistics')
+    if abs(pull) > MAX_PRIOR_PULL:
+        flags.append('prior_tension')
+    ##without SPE signal the peak only follows the prior
+    if not params[5] > MIN_SPE_SIGNIFICANCE * perr[5]:
+        flags.append('no_signal')
+    ##the SPE bump has to be separated from the pedestal
+    if params[6] < params[1] + 3 * params[2]:
+        flags.append('no_valley')
+    if not np.isfinite(perr[6]) or perr[6] > 0.2 * params[6]:
+        flags.append('large_error')
+    return flags
+
+
+def fit_spe_scan(hvs, charges_list, joint=True):
+    '''
+    Fits the charge spectra of all HV points of one PMT.
+
+    The HV points are fitted from the highest HV (best separated SPE
+    peak) down. Each fit is warm-started from the fit of its neighbour,
+    its SPE peak scaled with the gain-HV power law; the power law is
+    refitted after every point and used as a prior on the SPE peak.
+    With joint=True, all HV points and the power law are then refined in
+    one least squares fit. All fits use analytic Jacobians.
+
+    Returns a dict with the power law (log_a, k), and per HV point (in
+    the order of hvs) a dict with hv, params, errors, chi2_ndf, gain,
+    gain_err, the quality flags and ok (no flags), and the histogram.
+    '''
+    hvs = np.asarray(hvs, dtype=float)
+    order = np.argsort(hvs)[::-1]
+    log_a, k = DEFAULT_LOG_A, DEFAULT_K
+    fitted = {}
+    histograms = {}
+    previous = None
+    for i in order:
+        hv = hvs[i]
+        if previous is None:
+            spe_peak = estimate_spe_peak(charges_list[i])
+            log_a = np.log(spe_peak) - k * np.log(hv / HV_REF)
+        else:
+            spe_peak = power_law(hv, log_a, k)
+        center, hist = charge_histogram(charges_list[i], spe_peak)
+        histograms[i] = (center, hist)
+        p0 = _start_values(center, hist, spe_peak)
+        if previous is not None:
+            ##warm start: shapes of the neighbour, scaled to this HV
+            scale = spe_peak / previous[I_SPE_PEAK]
+            p0[3:] = previous[3:] * [1., scale, 1., scale, scale]
+        prior = (log_a, k) if len(fitted) > 0 else None
+        result = fit_spe_histogram(center, hist, hv, p0, prior)
+        fitted[i] = result.x
+        previous = result.x
+        if len(fitted) >= 2:
+            idx = list(fitted)
+            log_a, k = fit_power_law(hvs[idx],
+                                     [fitted[j][I_SPE_PEAK] for j in idx])
+
+    centers, hists, sigmas = [], [], []
+    for i in range(len(hvs)):
+        center, hist = histograms[i]
+        fit_mask = center >= FIT_MIN
+        centers.append(center[fit_mask])
+        hists.append(hist[fit_mask])
+        sigmas.append(np.sqrt(np.maximum(hist[fit_mask], 1.)))
+    params = np.array([fitted[i] for i in range(len(hvs))])
+    bounds = [_bounds(c) for c in centers]
+    lower = np.array([b[0] for b in bounds])
+    upper = np.array([b[1] for b in bounds])
+
+    if joint and len(hvs) >= 2:
+        x0 = np.concatenate([params.ravel(), [log_a, k]])
+        x_lower = np.concatenate([lower.ravel(), [-np.inf, -np.inf]])
+        x_upper = np.concatenate([upper.ravel(), [np.inf, np.inf]])
+        x0 = np.clip(x0, x_lower, x_upper)
+        result = least_squares(_joint_residuals, x0, jac=_joint_jacobian,
+                               bounds=(x_lower, x_upper),
+                               args=(centers, hists, sigmas, hvs),
+                               x_scale='jac', method='trf', max_nfev=1000)
+        params = result.x[:-2].reshape(len(hvs), N_PARAMS)
+        log_a, k = result.x[-2:]
+        cov = _covariance(result.jac)
+        success = result.success
+        residuals = result.fun
+        n_res = [len(c) for c in centers]
+        res_per_hv = np.split(residuals[:sum(n_res)], np.cumsum(n_res)[:-1])
+        perr_all = np.sqrt(np.abs(np.diag(cov)))[:-2].reshape(len(hvs), N_PARAMS)
+        results = [(success, res_per_hv[i], perr_all[i]) for i in range(len(hvs))]
+    else:
+        results = []
+        for i in range(len(hvs)):
+            prior = (log_a, k) if len(hvs) >= 2 else None
+            result = fit_spe_histogram(*histograms[i], hvs[i], params[i], prior)
+            params[i] = result.x
+            cov = _covariance(result.jac)
+            results.append((result.success, result.fun[:len(centers[i])],
+                            np.sqrt(np.abs(np.diag(cov)))))
+
+    points = []
+    for i, (success, res, perr) in enumerate(results):
+        chi2_ndf = np.sum(res**2) / max(len(res) - N_PARAMS, 1)
+        pull = ((np.log(params[i, I_SPE_PEAK]) -
+                 np.log(power_law(hvs[i], log_a, k))) / PRIOR_WIDTH
+                if len(hvs) >= 2 else 0.)
+        flags = _quality_flags(success, params[i], perr, chi2_ndf,
+                               len(charges_list[i]), lower[i], upper[i], pull)
+        gain = params[i, I_SPE_PEAK] / E_CONST
+        ##2% systematic, like analyze_spe.calculate_gain
+        gain_err = np.sqrt((perr[I_SPE_PEAK] / E_CONST)**2 + (gain * 0.02)**2)
+        points.append({'hv': hvs[i],
+                       'params': dict(zip(PARAM_NAMES, params[i])),
+                       'errors': dict(zip(PARAM_NAMES, perr)),
+                       'chi2_ndf': chi2_ndf,
+                       'gain': gain,
+                       'gain_err': gain_err,
+                       'prior_pull': pull,
+                       'flags': flags,
+                       'ok': len(flags) == 0,
+                       'center': histograms[i][0],
+                       'hist': histograms[i][1]})
+    return {'log_a': log_a, 'k': k, 'points': points}
+
+
+def fit_pmt_files(pmt_id, file_names, icrc=False, joint=True):
+    '''
+    reads the charge stamp files of one PMT (one per HV point) and fits
+    them with fit_spe_scan; files that do not exist are skipped
+    '''
+    hvs, charges_list, infos = [], [], []
+    for file_name in file_names:
+        if not os.path.isfile(file_name):
+            print(f"No valid file {file_name} - skipping...")
+            continue
+        charges, timestamps, _, params = read_data_charge(file_name)
+        if icrc:
+            # STM32Workspace/xdom-processing/include/xdom-processing/degg/degg_constants.h
+            charges = charges * 36.96 / 50.
+        hvs.append(params['hv'])
+        charges_list.append(np.atleast_1d(charges))
+        infos.append({'file_name': file_name,
+                      'temp': params['degg_temp'],
+                      'hv_mon': params.get('hv_mon'),
+                      'hv_mon_pre': params.get('hv_mon_pre')})
+    if len(hvs) == 0:
+        return {'pmt_id': pmt_id, 'log_a': np.nan, 'k': np.nan, 'points': []}
+    ret = fit_spe_scan(hvs, charges_list, joint=joint)
+    for point, info in zip(ret['points'], infos):
+        point.update(info)
+    ret['pmt_id'] = pmt_id
+    return ret
+
+
+def fit_pmts(jobs, n_jobs=1, icrc=False, joint=True):
+    '''
+    fit_pmt_files for every (pmt_id, file_names) in jobs, in a process
+    pool with n_jobs > 1
+    '''
+    pmt_ids = [job[0] for job in jobs]
+    file_names = [job[1] for job in jobs]
+    flags = ([icrc] * len(jobs), [joint] * len(jobs))
+    if n_jobs > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            return list(executor.map(fit_pmt_files, pmt_ids, file_names, *flags))
+    return [fit_pmt_files(*args) for args in zip(pmt_ids, file_names, *flags)]
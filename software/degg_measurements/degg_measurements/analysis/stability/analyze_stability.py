@@ -21,6 +21,7 @@ from degg_measurements.analysis import RunHandler
 from degg_measurements.analysis.analysis_utils import get_run_json
 from degg_measurements.analysis.gain.analyze_gain import run_fit
 from degg_measurements.analysis.analysis_utils import get_measurement_numbers
+from degg_measurements.analysis.analysis_cache import AnalysisCache
 from degg_measurements.analysis.darkrate.analyze_dt import read_timestamps
 from degg_measurements.analysis.darkrate.analyze_dt import plot_dt_distribution
 from degg_measurements.analysis.darkrate.analyze_dt import plot_charge_distribution
@@ -33,10 +34,13 @@ from chiba_slackbot import send_warning
 @click.option('--offline', is_flag=True)
 @click.option('--remote', is_flag=True)
 @click.option('--skip_redo', is_flag=True)
-def main(run_json, offline, remote, skip_redo):
-    analysis_wrapper(run_json, offline, remote, skip_redo)
+@click.option('--rebuild', is_flag=True,
+              help='Ignore the analysis cache and process all files again')
+def main(run_json, offline, remote, skip_redo, rebuild):
+    analysis_wrapper(run_json, offline, remote, skip_redo, rebuild)
 
-def analysis_wrapper(run_json, offline=False, remote=False, skip_redo=False):
+def analysis_wrapper(run_json, offline=False, remote=False, skip_redo=False,
+                     rebuild=False):
     run_json, run_number = get_run_json(run_json)
     list_of_deggs = load_run_json(run_json)
     measurement_type = "AdvancedMonitoring"
@@ -50,8 +54,15 @@ def analysis_wrapper(run_json, offline=False, remote=False, skip_redo=False):
     if not os.path.exists(cache_dir):
         os.mkdir(cache_dir)
 
+    ##per measurement results, only files which changed or are not
+    ##in there yet are processed again
+    analysis_cache = AnalysisCache(
+        os.path.join(cache_dir, f'run_{run_number}.hdf5'), 'stability')
+    if rebuild == True and os.path.exists(analysis_cache.cache_file):
+        os.remove(analysis_cache.cache_file)
+
     if skip_redo == False:
-        print('Rerunning over all files, this will take some time!')
+        print('Updating the analysis cache with new files!')
         redoData = True
     if skip_redo == True:
         print('Using processed cache!')
@@ -60,7 +71,7 @@ def analysis_wrapper(run_json, offline=False, remote=False, skip_redo=False):
     dfList = []
     for degg_file in tqdm(list_of_deggs, desc='DEggs'):
         unpackData(dfList, degg_file, measurement_type, run_number, redoData, cache_dir,
-                   remote, logbook, offline)
+                   remote, logbook, offline, analysis_cache)
 
     dfTotal = pd.concat(dfList)
     pErr = (dfTotal.GainPeakError.values/dfTotal.GainPeakPosition.values) * 100
@@ -93,8 +104,49 @@ def analysis_wrapper(run_json, offline=False, remote=False, skip_redo=False):
                  os.path.join(os.path.dirname(os.path.abspath(__file__)), 'figs'),
                  f'each_peakErrorPercent_hist.pdf'))
 
+def unpackMeasurement(run_number, data_key, data_dir, run_plot_dir,
+                      pmt, pmt_id, m_num):
+    '''results of one measurement, as stored in the AnalysisCache'''
+    peakPosition, peakWidth, peakError = np.zeros(1), np.zeros(1), np.zeros(1)
+    tempList, hvStd, mNumber = np.zeros(1), np.zeros(1), np.zeros(1)
+    deltaTs = []
+    dtTemp, dtHighF = np.zeros(1), np.zeros(1)
+    dtAfterPulse, dtLowF = np.zeros(1), np.zeros(1)
+    drList, drErr, drTemp = np.zeros(1), np.zeros(1), np.zeros(1)
+    drThresh, drFIR = np.zeros(1), np.zeros(1)
+
+    unpackGainInfo(0, run_number, data_key, data_dir,
+                   run_plot_dir, pmt, pmt_id, m_num,
+                   peakPosition, peakWidth, peakError,
+                   tempList, hvStd, mNumber)
+    unpackDeltaT(0, run_number, data_key, data_dir,
+                 run_plot_dir, pmt, pmt_id, m_num,
+                 deltaTs, dtTemp, dtHighF, dtAfterPulse, dtLowF)
+    unpackScaler(0, run_number, data_key, data_dir,
+                 run_plot_dir, pmt, pmt_id, m_num,
+                 drList, drErr, drTemp, drThresh, drFIR)
+
+    row = {
+        'MeasurementNumber': mNumber[0],
+        'GainPeakPosition' : peakPosition[0],
+        'GainPeakWidth': peakWidth[0],
+        'GainPeakError': peakError[0],
+        'GainTemperature': tempList[0],
+        'GainHVStd': hvStd[0],
+        'DeltaTTemp': dtTemp[0],
+        'DeltaTHighFreq': dtHighF[0],
+        'DeltaTAfterPulse': dtAfterPulse[0],
+        'DeltaTLowFreq': dtLowF[0],
+        'DarkRate': drList[0],
+        'DarkRateErr': drErr[0],
+        'DarkRateTemp': drTemp[0],
+        'DarkRateThreshold': drThresh[0],
+        'DarkRateFIR': drFIR[0]
+    }
+    return row, {'DeltaT': deltaTs[0]}
+
 def unpackData(dfList, degg_file, measurement_type, run_number, redoData, cache_dir,
-               remote, logbook, offline):
+               remote, logbook, offline, analysis_cache=None):
     degg_dict = load_degg_dict(degg_file)
     degg_name = degg_dict['DEggSerialNumber']
     for pmt in ['LowerPmt', 'UpperPmt']:
@@ -113,7 +165,7 @@ def unpackData(dfList, degg_file, measurement_type, run_number, redoData, cache_
             tempList     = np.zeros(len(measurement_numbers))
             hvStd        = np.zeros(len(measurement_numbers))
 
-            deltaTs      = []
+            deltaTs      = [[] for m_num in measurement_numbers]
             dtTemp       = np.zeros(len(measurement_numbers))
             dtHighF      = np.zeros(len(measurement_numbers))
             dtAfterPulse = np.zeros(len(measurement_numbers))
@@ -127,30 +179,58 @@ def unpackData(dfList, degg_file, measurement_type, run_number, redoData, cache_
 
             mNumber      = np.zeros(len(measurement_numbers))
 
+            ##one cache entry per measurement, keyed by its files
+            entries = []
+            entry_index = []
+            meta = {}
             for i, m_num in enumerate(measurement_numbers):
                 run_plot_dir, run_data_dir, \
                   data_key, data_dir = collectMetaInfo(run_number, m_num,
                                                        degg_dict, pmt,
                                                        measurement_type, remote)
                 if data_key == 'SKIP':
-                    deltaTs.append([])
                     continue
                 if data_dir == 'None' or data_dir == None:
                     print('data_dir is None, skipping measurement.')
-                    deltaTs.append([])
                     continue
-
-                ##do specific measurement operations
-                unpackGainInfo(i, run_number, data_key, data_dir,
-                               run_plot_dir, pmt, pmt_id, m_num,
-                               peakPosition, peakWidth, peakError,
-                               tempList, hvStd, mNumber)
-                unpackDeltaT(i, run_number, data_key, data_dir,
-                             run_plot_dir, pmt, pmt_id, m_num,
-                             deltaTs, dtTemp, dtHighF, dtAfterPulse, dtLowF)
-                unpackScaler(i, run_number, data_key, data_dir,
-                             run_plot_dir, pmt, pmt_id, m_num,
-                             drList, drErr, drTemp, drThresh, drFIR)
+                sources = []
+                for name in ['gain', 'delta_t', 'scaler']:
+                    sources += sorted(glob(os.path.join(
+                        data_dir, f'{pmt_id}_{name}_*.hdf5')))
+                params = f'{data_key}|{pmt}|{pmt_id}|{m_num}'
+                meta[params] = (data_key, data_dir, run_plot_dir, m_num)
+                entries.append((sources, params))
+                entry_index.append(i)
+
+            def compute(sources, params):
+                data_key, data_dir, run_plot_dir, m_num = meta[params]
+                return unpackMeasurement(run_number, data_key, data_dir,
+                                         run_plot_dir, pmt, pmt_id, m_num)
+
+            if analysis_cache is None:
+                analysis_cache = AnalysisCache(
+                    os.path.join(cache_dir, f'run_{run_number}.hdf5'),
+                    'stability')
+            summary = analysis_cache.update(entries, compute)
+            for _, row in summary.iterrows():
+                i = entry_index[row['entry']]
+                peakPosition[i] = row['GainPeakPosition']
+                peakWidth[i]    = row['GainPeakWidth']
+                peakError[i]    = row['GainPeakError']
+                tempList[i]     = row['GainTemperature']
+                hvStd[i]        = row['GainHVStd']
+                mNumber[i]      = row['MeasurementNumber']
+                deltaTs[i]      = analysis_cache.get_array(
+                    row['cache_key'], 'DeltaT')
+                dtTemp[i]       = row['DeltaTTemp']
+                dtHighF[i]      = row['DeltaTHighFreq']
+                dtAfterPulse[i] = row['DeltaTAfterPulse']
+                dtLowF[i]       = row['DeltaTLowFreq']
+                drList[i]       = row['DarkRate']
+                drErr[i]        = row['DarkRateErr']
+                drTemp[i]       = row['DarkRateTemp']
+                drThresh[i]     = row['DarkRateThreshold']
+                drFIR[i]        = row['DarkRateFIR']
 
             ##save data to avoid looping again in the future
             data = {
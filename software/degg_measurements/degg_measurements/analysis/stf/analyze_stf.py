@@ -9,38 +9,16 @@ import glob
 import os,sys
 
 from degg_measurements.utils import extract_runnumber_from_path
+from degg_measurements.analysis.stf.stf_store import STFStore, STF_ITEMS
+from degg_measurements.analysis.stf.stf_store import DEFAULT_STORE
 
-StfItems = ["AccelerometerSensor",
-            "ADCComms-channel-0",
-            "ADCComms-channel-1",
-            "BaselineStability-channel-0",
-            "BaselineStability-channel-1",
-            "CameraCombinations-fast",
-            "CameraComms-camera-1",
-            "CameraComms-camera-2",
-            "CameraComms-camera-3",
-            "DACScan-channel-0",
-            "DACScan-channel-1",
-            "DPRAM",
-            "FieldHub",
-            "Flash",
-            "FPGAMemTest",
-            "HVMonitors-base-channel-0",
-            "HVMonitors-base-channel-1",
-            "Icm-base",
-            "IcmFpgaSync",
-            "IcmFwAudit",
-            "IcmWriteProtect",
-            "Interlock",
-            "LightSensor-inside-freezer",
-            "Magnetometer",
-            "PowerLVS",
-            "PowerRails",
-            "PressureSensor",
-            "RAPCal",
-            "ScalerScan-base-channel-0",
-            "ScalerScan-base-channel-1",
-            "TempCompare"]
+StfItems = STF_ITEMS
+
+HVS_VALIDATORS = ['HVS_VMon_Fit_R2', 'HVS_VMon_Fit_Slope', 'HVS_IMon_Fit_R2', 'HVS_IMon_Fit_Slope']
+##phase of the HVMonitors test which holds the measurements
+HVS_PHASE = 2
+##trees of the HVMonitors comparison of ivcurves, the two Prod trees are one
+IV_TREES = ['data/NME-Sealing', 'data/DEgg-FAT', 'data/DEgg-MB-Prod', 'data/DEgg-MB-Prod_batch1']
 
 #@click.group()
 #def cli():
@@ -237,90 +215,35 @@ def hvsmon(runconfig,stfnumber):
 
 #@cli.command()
 #@click.option('--runnumbers',type=str,required=True)
-def hvsmon_combine(runnumbers):
-    validators = ['HVS_VMon_Fit_R2', 'HVS_VMon_Fit_Slope', 'HVS_IMon_Fit_R2', 'HVS_IMon_Fit_Slope']
+def hvsmon_combine(runnumbers, store_file=DEFAULT_STORE):
+    validators = HVS_VALIDATORS
     hist_min = [0.995,0.9,0.9,0.001]
     hist_max = [1,1.05,1,0.02]
     offset = 0.1
 
-    defaultpath = os.path.expanduser('~/data/json/run/')
-    runconfigs = []
     runnums = runnumbers.split(',')
-    for runnum in runnums:
-        runconfig = defaultpath + f'run_{int(runnum.split("-")[0]):05}.json'
-        try:
-            os.path.exists(runconfig)
-        except:
-            print('Run json file not found')
-            sys.exit(1)
-        runconfigs.append(runconfig)
-
-    alldata = []
-    deggdata = {}
-    expectedValues = {}
-    for runconfig, runnum in zip(runconfigs, runnums):
-        for validator in validators:
-            deggdata[validator] = []
-        runnum_ = runnum.split('-')
-        if len(runnum_) == 1:
-            stfnumber = None
-        else:
-            stfnumber = runnum_[-1]
-        with open(runconfig,'r') as f:
-            jsonfile = json.load(f)
-
-        for key in jsonfile:
-            if 'DEgg' not in key:
-                continue
-            with open(jsonfile[key],'r') as f:
-                deggjson = json.load(f)
-            deggserialnumber = deggjson['DEggSerialNumber']
-            opendir = ""
-            for testitem in deggjson:
-                if 'STF' not in testitem:
-                    continue
-                if stfnumber is not None:
-                    if stfnumber in testitem:
-                        opendir = deggjson[testitem]['Folder']
-                        break
-                else:
-                    opendir = deggjson[testitem]['Folder']
-            if opendir == "":
-                print(f"{key}: File not found")
-            else:
-                for channel in range(2):
-                    item = f'HVMonitors-base-channel-{channel}'
-                    dirlist = glob.glob(f'{opendir}/{item}*.json')
-                    if len(dirlist) < 1:
-                        for validator in validators:
-                            deggdata[validator].append(-1)
-                        continue
-                    with open(dirlist[0],'r') as f:
-                        data = json.load(f)
-                    for validator in validators:
-                        deggdata[validator].append(data['phases'][2]['measurements'][validator]['measured_value'])
-                        expectedValues[f'{validator}_min'] = data['metadata']['test_config']['expectedValues'][f'{validator}_min']
-                        expectedValues[f'{validator}_max'] = data['metadata']['test_config']['expectedValues'][f'{validator}_max']
-        alldata.append(deggdata.copy())
+    alldata, expectedValues = getHVdata(runnums, store_file)
 
     fig = plt.figure()
     with PdfPages(f'plots/hvsmon-runs{runnumbers}.pdf') as pdf:
         for validator, hmin, hmax in zip(validators, hist_min, hist_max):
             plt.title(f'Runs#{runnumbers}: {validator}')
             for deggdata in alldata:
-                plt.hist(deggdata[validator],bins=30, range=(hmin,hmax),histtype='step')
+                plt.hist(deggdata[validator].dropna(),bins=30, range=(hmin,hmax),histtype='step')
             plt.axvline(expectedValues[f'{validator}_min'],linestyle=':',color='magenta',lw=.5)
             plt.axvline(expectedValues[f'{validator}_max'],linestyle=':',color='magenta',lw=.5)
             pdf.savefig()
             fig.clear()
 
     if len(alldata)==2:
+        # same D-Egg and channel in both runs, -1 if it is missing in one
+        paired = alldata[0].join(alldata[1], how='outer', lsuffix='_0', rsuffix='_1').fillna(-1)
         figure = plt.figure(figsize=(6,6))
         with PdfPages(f'plots/hvsmon-runs{runnumbers}_scatter.pdf') as pdf:
             for validator, hmin, hmax in zip(validators, hist_min, hist_max):
                 plt.title(f'Runs#{runnumbers}: {validator}')
                 plt.plot(np.linspace(hmin,hmax,20),np.linspace(hmin,hmax,20),color='gray',lw=1)
-                plt.plot(alldata[0][validator],alldata[1][validator],marker='o',lw=0)
+                plt.plot(paired[f'{validator}_0'],paired[f'{validator}_1'],marker='o',lw=0)
                 plt.xlabel(runnums[0])
                 plt.ylabel(runnums[1])
                 plt.xlim(hmin,hmax)
@@ -328,53 +251,28 @@ def hvsmon_combine(runnumbers):
                 pdf.savefig()
                 figure.clear()
 
-def getHVdata():
+def getHVdata(runnums, store_file=DEFAULT_STORE, validators=HVS_VALIDATORS):
+    '''
+    HVMonitors validators of the runs ("<run>" or "<run>-<stfnumber>"),
+    the STF results of the runs are ingested into the store first.
+    Returns a DataFrame per run indexed by D-Egg and channel with one
+    column per validator, and the limits {f'{validator}_min/_max': value}.
+    '''
+    store = STFStore(store_file)
+    store.ingest_runs(runnums)
     alldata = []
-    deggdata = {}
+    for runnum in runnums:
+        alldata.append(store.table(validators, index=('degg', 'channel'),
+                                   tree='run', run=str(runnum),
+                                   test_item='HVMonitors-base',
+                                   phase=HVS_PHASE))
     expectedValues = {}
-    for runconfig, runnum in zip(runconfigs, runnums):
-        for validator in validators:
-            deggdata[validator] = []
-        runnum_ = runnum.split('-')
-        if len(runnum_) == 1:
-            stfnumber = None
-        else:
-            stfnumber = runnum_[-1]
-        with open(runconfig,'r') as f:
-            jsonfile = json.load(f)
-
-        for key in jsonfile:
-            if 'DEgg' not in key:
-                continue
-            with open(jsonfile[key],'r') as f:
-                deggjson = json.load(f)
-            deggserialnumber = deggjson['DEggSerialNumber']
-            opendir = ""
-            for testitem in deggjson:
-                if 'STF' not in testitem:
-                    continue
-                if stfnumber is not None:
-                    if stfnumber in testitem:
-                        opendir = deggjson[testitem]['Folder']
-                        break
-                else:
-                    opendir = deggjson[testitem]['Folder']
-            if opendir == "":
-                print(f"{key}: File not found")
-            else:
-                for channel in range(2):
-                    item = f'HVMonitors-base-channel-{channel}'
-                    dirlist = glob.glob(f'{opendir}/{item}*.json')
-                    if len(dirlist) < 1:
-                        continue
-                    with open(dirlist[0],'r') as f:
-                        data = json.load(f)
-                    for validator in validators:
-                        deggdata[validator].append(data['phases'][2]['measurements'][validator]['measured_value'])
-                        expectedValues[f'{validator}_min'] = data['metadata']['test_config']['expectedValues'][f'{validator}_min']
-                        expectedValues[f'{validator}_max'] = data['metadata']['test_config']['expectedValues'][f'{validator}_max']
-        alldata.append(deggdata.copy())
-    return alldata
+    for validator in validators:
+        vmin, vmax = store.limits(validator, tree='run', run=[str(r) for r in runnums],
+                                  phase=HVS_PHASE)
+        expectedValues[f'{validator}_min'] = vmin
+        expectedValues[f'{validator}_max'] = vmax
+    return alldata, expectedValues
 
 #@cli.command()
 def imonslope():
@@ -425,19 +323,16 @@ def cameraspi():
 
 #@cli.command()
 #@click.option('--jsonlist',required=True)
-def imonmeas(jsonlist):
-    idata = []
-    setvdata = []
+def imonmeas(jsonlist, store_file=DEFAULT_STORE):
     with open(jsonlist,'r') as f:
-        fnames = f.readlines()
-    for fname_ in fnames:
-        for channel in range(2):
-            fname = fname_.split('\n')[0]
-            with open(glob.glob(f'{fname}/HVMonitors-base-channel-{channel}*.json')[0],'r') as f:
-                data = json.load(f)
-                setv  = data['phases'][2]['measurements']['HVS_Monitors']['measured_value']['set_voltage']
-                measi = data['phases'][2]['measurements']['HVS_Monitors']['measured_value']['meas_current']
-                plt.plot(setv,measi)
+        fnames = [os.path.abspath(fname.split('\n')[0]) for fname in f.readlines()]
+    fnames = [fname for fname in fnames if fname != os.path.abspath('')]
+    store = STFStore(store_file)
+    store.ingest(fnames, os.path.basename(jsonlist))
+    for row, curve in store.curves('HVS_Monitors', tree=os.path.basename(jsonlist),
+                                   folder=fnames, test_item='HVMonitors-base',
+                                   phase=HVS_PHASE):
+        plt.plot(curve['set_voltage'],curve['meas_current'])
     plt.xlabel('Set Voltage [V]')
     plt.ylabel('Measured Current [$\mu$A]')
     plt.xlim(500,1600)
@@ -627,7 +522,20 @@ def imonparam(jsonlist):
 
 #@cli.command()
 #@click.option('--rsquared',type=str,default=None,help='"fat", "nme", or "measurements" (fat-nme).')
-def ivcurves(rsquared):
+def _hvmon_files(store, tree):
+    '''file_id of the first HVMonitors file of each (D-Egg, channel) of a tree'''
+    df = store.results(tree=tree, test_item='HVMonitors-base', phase=HVS_PHASE)
+    df = df[df['degg'] != ''].sort_values('file_id')
+    df = df.drop_duplicates(['degg', 'channel'])
+    return dict(zip(zip(df['degg'], df['channel']), df['file_id']))
+
+def ivcurves(rsquared, store_file=DEFAULT_STORE, n_jobs=1):
+    store = STFStore(store_file)
+    store.ingest_trees(IV_TREES, n_jobs=n_jobs)
+    nmefiles, fatfiles, prodfiles, batch1files = [
+        _hvmon_files(store, os.path.basename(tree)) for tree in IV_TREES]
+    prodfiles = {**batch1files, **prodfiles}
+
     pdf = PdfPages(f'plots/compareR2_{rsquared}.pdf' if rsquared is not None else 'plots/compareIV.pdf')
     if rsquared is not None:
         fig = plt.figure(figsize=(6.4,6.4))
@@ -637,107 +545,70 @@ def ivcurves(rsquared):
         plt.subplots_adjust(left=0.12, right=0.9, top=0.92, bottom=0.1)
 
     ax1 = fig.add_subplot(111)
-    for nmedir in tqdm(glob.iglob('data/NME-Sealing/*/degg-*')):
-        for channel in range(2):
-            snum, nmedata = getHVMonData(nmedir, channel)
-            if snum is None:
-                continue
-            fatsnum = None
-            prodsnum = None
-            for fatdir in glob.iglob('data/DEgg-FAT/*/degg-*'):
-                fatsnum, fatdata = getHVMonData(fatdir, channel)
-                if fatsnum is None:
-                    continue
-                if snum == fatsnum:
-                    break
-            for proddir in glob.iglob('data/DEgg-MB-Prod/*/degg-*'):
-                prodsnum, proddata = getHVMonData(proddir, channel)
-                if prodsnum is None:
-                    continue
-                if snum == prodsnum:
-                    break
-            if prodsnum is None:
-                for proddir in glob.iglob('data/DEgg-MB-Prod_batch1/*/degg-*'):
-                    prodsnum, proddata = getHVMonData(proddir, channel)
-                    if prodsnum is None:
-                        continue
-                    if snum == prodsum:
-                        break
-            #if snum!=fatsnum:
-            #    continue
-            if snum!=prodsnum:
-                continue
+    for (snum, channel), nmeid in tqdm(sorted(nmefiles.items(), key=lambda x: x[1])):
+        fatid = fatfiles.get((snum, channel))
+        prodid = prodfiles.get((snum, channel))
+        if prodid is None:
+            continue
 
-            if rsquared is not None:
+        if rsquared is not None:
+            try:
                 if rsquared == 'nme':
-                    prodVRsq = 1-proddata['phases'][2]['measurements']['HVS_VMon_Fit_R2']['measured_value']
-                    prodIRsq = 1-proddata['phases'][2]['measurements']['HVS_IMon_Fit_R2']['measured_value']
-                    try:
-                        VRsq = 1-nmedata['phases'][2]['measurements']['HVS_VMon_Fit_R2']['measured_value']
-                        IRsq = 1-nmedata['phases'][2]['measurements']['HVS_IMon_Fit_R2']['measured_value']
-                    except KeyError:
-                        continue
+                    prodVRsq = 1-store.value(prodid, 'HVS_VMon_Fit_R2', HVS_PHASE)
+                    prodIRsq = 1-store.value(prodid, 'HVS_IMon_Fit_R2', HVS_PHASE)
+                    VRsq = 1-store.value(nmeid, 'HVS_VMon_Fit_R2', HVS_PHASE)
+                    IRsq = 1-store.value(nmeid, 'HVS_IMon_Fit_R2', HVS_PHASE)
                 elif rsquared == 'fat':
-                    prodVRsq = 1-proddata['phases'][2]['measurements']['HVS_VMon_Fit_R2']['measured_value']
-                    prodIRsq = 1-proddata['phases'][2]['measurements']['HVS_IMon_Fit_R2']['measured_value']
-                    VRsq = 1-fatdata['phases'][2]['measurements']['HVS_VMon_Fit_R2']['measured_value']
-                    IRsq = 1-fatdata['phases'][2]['measurements']['HVS_IMon_Fit_R2']['measured_value']
+                    prodVRsq = 1-store.value(prodid, 'HVS_VMon_Fit_R2', HVS_PHASE)
+                    prodIRsq = 1-store.value(prodid, 'HVS_IMon_Fit_R2', HVS_PHASE)
+                    VRsq = 1-store.value(fatid, 'HVS_VMon_Fit_R2', HVS_PHASE)
+                    IRsq = 1-store.value(fatid, 'HVS_IMon_Fit_R2', HVS_PHASE)
                 elif rsquared == 'measurements':
-                    try:
-                        prodVRsq = 1-nmedata['phases'][2]['measurements']['HVS_VMon_Fit_R2']['measured_value']
-                        prodIRsq = 1-nmedata['phases'][2]['measurements']['HVS_IMon_Fit_R2']['measured_value']
-                    except KeyError:
-                        continue
-                    VRsq = 1-fatdata['phases'][2]['measurements']['HVS_VMon_Fit_R2']['measured_value']
-                    IRsq = 1-fatdata['phases'][2]['measurements']['HVS_IMon_Fit_R2']['measured_value']
+                    prodVRsq = 1-store.value(nmeid, 'HVS_VMon_Fit_R2', HVS_PHASE)
+                    prodIRsq = 1-store.value(nmeid, 'HVS_IMon_Fit_R2', HVS_PHASE)
+                    VRsq = 1-store.value(fatid, 'HVS_VMon_Fit_R2', HVS_PHASE)
+                    IRsq = 1-store.value(fatid, 'HVS_IMon_Fit_R2', HVS_PHASE)
                 else:
                     continue
-
-                ax1.plot([prodVRsq],[VRsq],marker='o',color='tab:blue')
-                ax1.plot([prodIRsq],[IRsq],marker='o',color='tab:orange')
+            except KeyError:
                 continue
 
-            ax2 = ax1.twinx()
+            ax1.plot([prodVRsq],[VRsq],marker='o',color='tab:blue')
+            ax1.plot([prodIRsq],[IRsq],marker='o',color='tab:orange')
+            continue
 
-            ax1.set_xlabel('Set Voltage [V]')
-            ax1.set_ylabel('Measured Voltage [V]')
-            ax2.set_ylabel('Measured Current [$\mu$A]')
-            try:
-                nmesetv  = nmedata['phases'][2]['measurements']['HVS_Monitors']['measured_value']['set_voltage']
-            except KeyError:
-                fig.clear()
-                ax1 = fig.add_subplot(111)
+        nmecurve = store.curve(nmeid, 'HVS_Monitors', HVS_PHASE)
+        if len(nmecurve) == 0:
+            continue
+        ax2 = ax1.twinx()
+        ax1.plot(nmecurve['set_voltage'],nmecurve['meas_voltage'],color='tab:blue',ls='solid')
+        ax2.plot(nmecurve['set_voltage'],nmecurve['meas_current'],color='tab:orange',ls='solid')
+        ax2.plot([],[],color='gray',ls='solid',label='NME')
+        for fileid, ls, label in [(fatid, '--', 'FAT'), (prodid, ':', 'Prod')]:
+            if fileid is None:
                 continue
-            ax1.plot(nmesetv,nmedata['phases'][2]['measurements']['HVS_Monitors']['measured_value']['meas_voltage'],color='tab:blue',ls='solid')
-            ax2.plot(nmesetv,nmedata['phases'][2]['measurements']['HVS_Monitors']['measured_value']['meas_current'],color='tab:orange',ls='solid')
-
-            ax2.plot([],[],color='gray',ls='solid',label='NME')
-            if snum==fatsnum:
-                fatsetv  = fatdata['phases'][2]['measurements']['HVS_Monitors']['measured_value']['set_voltage']
-                ax1.plot(fatsetv,fatdata['phases'][2]['measurements']['HVS_Monitors']['measured_value']['meas_voltage'],color='tab:blue',ls='--')
-                ax2.plot(fatsetv,fatdata['phases'][2]['measurements']['HVS_Monitors']['measured_value']['meas_current'],color='tab:orange',ls='--')
-                ax2.plot([],[],color='gray',ls='--',label='FAT')
-            if snum==prodsnum:
-                prodsetv  = proddata['phases'][2]['measurements']['HVS_Monitors']['measured_value']['set_voltage']
-                ax1.plot(prodsetv,proddata['phases'][2]['measurements']['HVS_Monitors']['measured_value']['meas_voltage'],color='tab:blue',ls=':')
-                ax2.plot(prodsetv,proddata['phases'][2]['measurements']['HVS_Monitors']['measured_value']['meas_current'],color='tab:orange',ls=':')
-                ax2.plot([],[],color='gray',ls=':',label='Prod')
-
-            legend = ax2.legend(loc='lower right')
-            ax1.set_xlabel('Set Voltage [V]')
-            ax1.set_ylabel('Measured Voltage [V]',color='tab:blue')
-            ax2.set_ylabel('Measured Current [$\mu$A]',color='tab:orange')
-            plt.title(f'{snum}: HVMonitors for channel-{channel}')
-            ax1.set_xlim(0,1600)
-            ax1.set_ylim(0,1600)
-            ax2.set_ylim(0,16)
-            ax2.spines['left'].set_color('tab:blue')
-            ax2.spines['right'].set_color('tab:orange')
-            ax1.tick_params(axis='y',colors='tab:blue')
-            ax2.tick_params(axis='y',colors='tab:orange')
-            pdf.savefig()
-            fig.clear()
-            ax1 = fig.add_subplot(111)
+            curve = store.curve(fileid, 'HVS_Monitors', HVS_PHASE)
+            if len(curve) == 0:
+                continue
+            ax1.plot(curve['set_voltage'],curve['meas_voltage'],color='tab:blue',ls=ls)
+            ax2.plot(curve['set_voltage'],curve['meas_current'],color='tab:orange',ls=ls)
+            ax2.plot([],[],color='gray',ls=ls,label=label)
+
+        legend = ax2.legend(loc='lower right')
+        ax1.set_xlabel('Set Voltage [V]')
+        ax1.set_ylabel('Measured Voltage [V]',color='tab:blue')
+        ax2.set_ylabel('Measured Current [$\mu$A]',color='tab:orange')
+        plt.title(f'{snum}: HVMonitors for channel-{channel}')
+        ax1.set_xlim(0,1600)
+        ax1.set_ylim(0,1600)
+        ax2.set_ylim(0,16)
+        ax2.spines['left'].set_color('tab:blue')
+        ax2.spines['right'].set_color('tab:orange')
+        ax1.tick_params(axis='y',colors='tab:blue')
+        ax2.tick_params(axis='y',colors='tab:orange')
+        pdf.savefig()
+        fig.clear()
+        ax1 = fig.add_subplot(111)
 
     if rsquared is not None:
         ax1.set_xlim(1.e-7,1)
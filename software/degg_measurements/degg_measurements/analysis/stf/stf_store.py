@@ -0,0 +1,495 @@
+import os
+import re
+import click
+import json
+from glob import glob
+from fnmatch import fnmatchcase
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_STORE = os.path.expanduser('~/data/stf_store.hdf5')
+DEFAULT_RUN_DIR = os.path.expanduser('~/data/json/run/')
+
+##key of a result row, the stored table is sorted by it
+KEY = ['degg', 'port', 'run', 'channel', 'test_item', 'validator']
+
+STF_ITEMS = ["AccelerometerSensor",
+             "ADCComms-channel-0",
+             "ADCComms-channel-1",
+             "BaselineStability-channel-0",
+             "BaselineStability-channel-1",
+             "CameraCombinations-fast",
+             "CameraComms-camera-1",
+             "CameraComms-camera-2",
+             "CameraComms-camera-3",
+             "DACScan-channel-0",
+             "DACScan-channel-1",
+             "DPRAM",
+             "FieldHub",
+             "Flash",
+             "FPGAMemTest",
+             "HVMonitors-base-channel-0",
+             "HVMonitors-base-channel-1",
+             "Icm-base",
+             "IcmFpgaSync",
+             "IcmFwAudit",
+             "IcmWriteProtect",
+             "Interlock",
+             "LightSensor-inside-freezer",
+             "Magnetometer",
+             "PowerLVS",
+             "PowerRails",
+             "PressureSensor",
+             "RAPCal",
+             "ScalerScan-base-channel-0",
+             "ScalerScan-base-channel-1",
+             "TempCompare"]
+
+_CHANNEL_RE = re.compile(r'-channel-(\d+)$')
+_STRING_SIZE = 256
+
+##columns and types of the stored tables
+_COLUMNS = {
+    'files': {'file_id': np.int64, 'tree': object, 'run': object,
+              'path': object, 'size': np.int64, 'mtime_ns': np.int64,
+              'degg': object, 'port': np.int64, 'station': object,
+              'outcome': object},
+    'results': {'degg': object, 'port': np.int64, 'run': object,
+                'channel': np.int64, 'test_item': object,
+                'validator': object, 'file_id': np.int64, 'tree': object,
+                'folder': object, 'phase': np.int64, 'value': np.float64,
+                'min': np.float64, 'max': np.float64, 'm_outcome': object,
+                'outcome': object, 'station': object},
+    'arrays': {'file_id': np.int64, 'phase': np.int64, 'validator': object,
+               'field': object, 'i': np.int64, 'value': np.float64}}
+
+
+def split_test_item(filename):
+    '''
+    (test item, channel) of a STF result file, e.g.
+    HVMonitors-base-channel-1_<suffix>.json -> ('HVMonitors-base', 1).
+    The channel is -1 for items without one.
+    '''
+    name = os.path.basename(filename)
+    if name.endswith('.json'):
+        name = name[:-len('.json')]
+    matches = [item for item in STF_ITEMS if name.startswith(item)]
+    if len(matches) > 0:
+        item = max(matches, key=len)
+    else:
+        item = re.split(r'[_.]', name)[0]
+    match = _CHANNEL_RE.search(item)
+    if match is None:
+        return item, -1
+    return item[:match.start()], int(match.group(1))
+
+
+def _get(data, *keys, default=None):
+    for key in keys:
+        try:
+            data = data[key]
+        except (KeyError, IndexError, TypeError):
+            return default
+    return data
+
+
+def _as_float(value):
+    if isinstance(value, (bool, int, float, np.number)):
+        return float(value)
+    return np.nan
+
+
+def parse_stf_file(path):
+    '''
+    Parses one STF result JSON. Returns (info, results, arrays): info is
+    a dict with the D-Egg serial, port, station and outcome of the test,
+    results a list of dicts with one entry per measurement (phase,
+    validator, scalar value, limits) and arrays a list of dicts with one
+    entry per element of list valued measurements (e.g. HVS_Monitors).
+    Files which are no valid JSON give (None, [], []).
+    '''
+    try:
+        with open(path, 'r') as open_file:
+            data = json.load(open_file)
+    except (OSError, ValueError):
+        return None, [], []
+    if not isinstance(data, dict):
+        return None, [], []
+    port = _get(data, 'metadata', 'stf_config', 'iceboot', 'port')
+    info = {'degg': str(_get(data, 'metadata', 'device', 'dut_serial',
+                             default='')),
+            'port': int(port) if isinstance(port, (int, float)) else -1,
+            'station': str(_get(data, 'metadata', 'config', 'station_id',
+                                default='')),
+            'outcome': str(_get(data, 'outcome', default=''))}
+    expected = _get(data, 'metadata', 'test_config', 'expectedValues',
+                    default={})
+    if not isinstance(expected, dict):
+        expected = {}
+
+    results = []
+    arrays = []
+    for phase, phase_data in enumerate(_get(data, 'phases', default=[])):
+        measurements = _get(phase_data, 'measurements', default={})
+        if not isinstance(measurements, dict):
+            continue
+        for validator, measurement in measurements.items():
+            value = _get(measurement, 'measured_value')
+            results.append({
+                'phase': phase,
+                'validator': validator,
+                'value': _as_float(value),
+                'min': _as_float(expected.get(f'{validator}_min')),
+                'max': _as_float(expected.get(f'{validator}_max')),
+                'm_outcome': str(_get(measurement, 'outcome', default=''))})
+            if isinstance(value, list):
+                value = {'': value}
+            if not isinstance(value, dict):
+                continue
+            for field, values in value.items():
+                values = np.atleast_1d(np.asarray(values, dtype=object))
+                for i, val in enumerate(values):
+                    arrays.append({'phase': phase,
+                                   'validator': validator,
+                                   'field': str(field),
+                                   'i': i,
+                                   'value': _as_float(val)})
+    return info, results, arrays
+
+
+def _default_run(path):
+    '''run of a STF file without run label: directory above its folder'''
+    return os.path.basename(os.path.dirname(os.path.dirname(path)))
+
+
+def run_folders(runnum, run_dir=DEFAULT_RUN_DIR):
+    '''
+    STF folders of the D-Eggs of a run, runnum is "<run>" (latest STF)
+    or "<run>-<stfnumber>", as in hvsmon_combine
+    '''
+    runnum_ = str(runnum).split('-')
+    stfnumber = runnum_[1] if len(runnum_) > 1 else None
+    runconfig = os.path.join(run_dir, f'run_{int(runnum_[0]):05}.json')
+    with open(runconfig, 'r') as f:
+        jsonfile = json.load(f)
+    folders = []
+    for key in jsonfile:
+        if 'DEgg' not in key:
+            continue
+        with open(jsonfile[key], 'r') as f:
+            deggjson = json.load(f)
+        opendir = ''
+        for testitem in deggjson:
+            if 'STF' not in testitem:
+                continue
+            if stfnumber is not None:
+                if stfnumber in testitem:
+                    opendir = deggjson[testitem]['Folder']
+                    break
+            else:
+                opendir = deggjson[testitem]['Folder']
+        if opendir in ('', 'None', None):
+            print(f'{key}: File not found')
+            continue
+        folders.append(opendir)
+    return folders
+
+
+class STFStore(object):
+    '''
+    Indexed table of the STF results.
+
+    Every STF result JSON is parsed once: scalar measurements go into the
+    'results' table, one row per D-Egg, port, run, channel, test item and
+    validator (see KEY); list valued measurements (e.g. the set/measured
+    voltages of HVS_Monitors) go element-wise into the 'arrays' table.
+    Files are grouped into trees (e.g. 'NME-Sealing' or 'run') and runs
+    (the directory above the STF folder, or the run number). The 'files'
+    table keeps path, size and mtime of every ingested file, so another
+    ingestion only parses new and changed files and drops the rows of
+    files which are gone.
+
+    Queries work on the tables in memory, the HDF5 file is only read
+    once per STFStore (and rewritten by ingest).
+    '''
+    def __init__(self, store_file=DEFAULT_STORE):
+        self.store_file = store_file
+        self._tables = None
+        self._curves = {}
+
+    def _load(self):
+        if self._tables is not None:
+            return self._tables
+        tables = {}
+        if os.path.isfile(self.store_file):
+            with pd.HDFStore(self.store_file, mode='r') as store:
+                for name in ['files', 'results', 'arrays']:
+                    if f'/{name}' in store:
+                        tables[name] = store[name]
+        for name, columns in _COLUMNS.items():
+            if name not in tables:
+                tables[name] = pd.DataFrame(
+                    {c: pd.Series(dtype=d) for c, d in columns.items()})
+        self._tables = tables
+        self._curves = {}
+        return tables
+
+    def _save(self, tables):
+        store_dir = os.path.dirname(os.path.abspath(self.store_file))
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+        tmp_file = f'{self.store_file}.tmp'
+        with pd.HDFStore(tmp_file, mode='w') as store:
+            for name, df in tables.items():
+                min_itemsize = {c: _STRING_SIZE for c in df.columns
+                                if df[c].dtype == object}
+                # the columns of the results are indexed by PyTables
+                data_columns = KEY if name == 'results' else None
+                store.put(name, df, format='table', index=False,
+                          data_columns=data_columns,
+                          min_itemsize=min_itemsize)
+            if len(tables['results']) > 0:
+                store.create_table_index('results', columns=KEY,
+                                         optlevel=6, kind='medium')
+        os.replace(tmp_file, self.store_file)
+
+    def ingest(self, folders, tree, run=None, n_jobs=1, verbose=True):
+        '''
+        folders: STF folder, glob pattern of STF folders or list of them
+        tree:    name of the group of folders, e.g. 'DEgg-FAT'
+        run:     run of all folders, default: name of the parent
+                 directory of each folder
+
+        Parses the JSON files of the folders which are new or changed
+        since the last ingestion of this tree and run, files of the tree
+        and run in the same folders which are gone are removed from the
+        store. The same folder ingested under another run label (e.g.
+        run '100' and '100-1') gets its own rows.
+        Returns the number of parsed files.
+        '''
+        pattern = None
+        if isinstance(folders, str):
+            pattern = os.path.abspath(folders)
+            folders = sorted(glob(folders))
+        tables = self._load()
+        files = tables['files']
+        known = files[files['tree'] == tree]
+        if run is not None:
+            known = known[known['run'] == str(run)]
+        else:
+            known = known[known['run'] == known['path'].map(_default_run)]
+        known = known.set_index('path')
+
+        paths = []
+        for folder in folders:
+            folder = os.path.abspath(folder)
+            paths.extend(sorted(glob(os.path.join(folder, '*.json'))))
+        scanned_dirs = set(os.path.abspath(f) for f in folders)
+
+        new_files = []
+        for path in paths:
+            info = os.stat(path)
+            if path in known.index:
+                entry = known.loc[path]
+                if entry['size'] == info.st_size and \
+                        entry['mtime_ns'] == info.st_mtime_ns:
+                    continue
+            new_files.append({
+                'tree': tree,
+                'run': str(run) if run is not None else _default_run(path),
+                'path': path,
+                'size': info.st_size,
+                'mtime_ns': info.st_mtime_ns})
+        path_set = set(paths)
+        # a pattern also covers the folders which were deleted since
+        gone = [p for p in known.index if p not in path_set and
+                (os.path.dirname(p) in scanned_dirs or (
+                    pattern is not None and
+                    fnmatchcase(os.path.dirname(p), pattern)))]
+        if len(new_files) == 0 and len(gone) == 0:
+            if verbose:
+                print(f'{tree}: {len(paths)} files, nothing to update')
+            return 0
+
+        todo = [f['path'] for f in new_files]
+        if n_jobs > 1 and len(todo) > 1:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                parsed = list(executor.map(parse_stf_file, todo,
+                                           chunksize=16))
+        else:
+            parsed = [parse_stf_file(path) for path in todo]
+
+        # rows of changed and removed files are replaced
+        replaced = set(gone) | set(todo)
+        old_ids = set(known.loc[[p for p in known.index if p in replaced],
+                                'file_id'])
+        next_id = int(files['file_id'].max()) + 1 if len(files) > 0 else 0
+        results = []
+        arrays = []
+        for i, (entry, (info, res, arr)) in enumerate(zip(new_files, parsed)):
+            entry['file_id'] = next_id + i
+            if info is None:
+                info = {'degg': '', 'port': -1, 'station': '',
+                        'outcome': 'INVALID'}
+            entry.update(info)
+            item, channel = split_test_item(entry['path'])
+            for row in res:
+                row.update(file_id=entry['file_id'], tree=tree,
+                           run=entry['run'], test_item=item,
+                           channel=channel,
+                           folder=os.path.dirname(entry['path']), **info)
+            for row in arr:
+                row['file_id'] = entry['file_id']
+            results.extend(res)
+            arrays.extend(arr)
+
+        def _replace(df, new_rows):
+            df = df[~df['file_id'].isin(old_ids)]
+            if len(new_rows) > 0:
+                df = pd.concat([df, pd.DataFrame(new_rows)],
+                               ignore_index=True, sort=False)
+            return df
+        tables['files'] = _replace(files, new_files)
+        tables['results'] = _replace(tables['results'], results)
+        tables['results'] = tables['results'].sort_values(
+            KEY).reset_index(drop=True)
+        tables['arrays'] = _replace(tables['arrays'], arrays)
+        for name, columns in _COLUMNS.items():
+            tables[name] = tables[name].astype(columns)
+        self._save(tables)
+        self._tables = tables
+        self._curves = {}
+        if verbose:
+            print(f'{tree}: {len(paths)} files, {len(todo)} parsed, '
+                  f'{len(gone)} removed')
+        return len(todo)
+
+    def ingest_runs(self, runnums, run_dir=DEFAULT_RUN_DIR, **kwargs):
+        '''ingest the STF folders of runs (see run_folders) as tree "run"'''
+        n_parsed = 0
+        for runnum in runnums:
+            n_parsed += self.ingest(run_folders(runnum, run_dir), 'run',
+                                    run=str(runnum), **kwargs)
+        return n_parsed
+
+    def ingest_trees(self, trees, **kwargs):
+        '''
+        ingest directory trees <tree>/<run>/degg-*, the tree is named by
+        its last path component
+        '''
+        n_parsed = 0
+        for tree in trees:
+            n_parsed += self.ingest(
+                os.path.join(tree, '*', 'degg-*'),
+                os.path.basename(os.path.normpath(tree)), **kwargs)
+        return n_parsed
+
+    def results(self, tree=None, phase=None, **selection):
+        '''
+        Rows of the results table. selection is column=value for the
+        columns of KEY, folder, file_id, station or outcome; a value can
+        be a list of values or, for strings, a glob pattern (e.g.
+        validator='HVS_*').
+        '''
+        df = self._load()['results']
+        selection['tree'] = tree
+        selection['phase'] = phase
+        mask = np.ones(len(df), dtype=bool)
+        for column, value in selection.items():
+            if value is None:
+                continue
+            col = df[column]
+            if isinstance(value, (list, tuple, set, np.ndarray)):
+                mask &= col.isin(list(value)).to_numpy()
+            elif isinstance(value, str) and any(c in value for c in '*?['):
+                matches = [v for v in col.unique() if fnmatchcase(v, value)]
+                mask &= col.isin(matches).to_numpy()
+            else:
+                mask &= (col == value).to_numpy()
+        return df[mask]
+
+    def table(self, validators, index=('tree', 'run', 'degg', 'port',
+                                       'channel'), **selection):
+        '''
+        Values of validators as columns, one row per index (by default
+        one row per tree, run, D-Egg, port and channel). Duplicates are
+        resolved by the last ingested file.
+        '''
+        if isinstance(validators, str):
+            validators = [validators]
+        df = self.results(validator=list(validators), **selection)
+        df = df.sort_values('file_id').drop_duplicates(
+            list(index) + ['validator'], keep='last')
+        table = df.pivot(index=list(index), columns='validator',
+                         values='value')
+        return table.reindex(columns=list(validators))
+
+    def value(self, file_id, validator, phase=None):
+        '''scalar value of validator in a file, KeyError if it has none'''
+        if file_id is None:
+            raise KeyError(validator)
+        df = self.results(file_id=file_id, validator=validator, phase=phase)
+        if len(df) == 0:
+            raise KeyError(f'{validator} not in file {file_id}')
+        return df['value'].iloc[-1]
+
+    def limits(self, validator, **selection):
+        '''(min, max) of validator as in the last ingested file'''
+        df = self.results(validator=validator, **selection)
+        if len(df) == 0:
+            return np.nan, np.nan
+        row = df.loc[df['file_id'].idxmax()]
+        return row['min'], row['max']
+
+    def curve(self, file_id, validator, phase=None):
+        '''
+        List valued measurement of one file as a DataFrame, one column per
+        field (e.g. set_voltage, meas_voltage and meas_current). Taken
+        from phase, by default from the last phase which has it.
+        '''
+        if len(self._curves) == 0:
+            arrays = self._load()['arrays']
+            self._curves = dict(list(arrays.groupby(['file_id',
+                                                     'validator'])))
+        arr = self._curves.get((file_id, validator))
+        if arr is None:
+            return pd.DataFrame()
+        if phase is None:
+            phase = arr['phase'].max()
+        arr = arr[arr['phase'] == phase]
+        if len(arr) == 0:
+            return pd.DataFrame()
+        return arr.pivot(index='i', columns='field', values='value')
+
+    def curves(self, validator, **selection):
+        '''
+        (result row, curve) of every file matching selection which has
+        the list valued measurement validator
+        '''
+        df = self.results(validator=validator, **selection)
+        curves = []
+        for _, row in df.iterrows():
+            curve = self.curve(row['file_id'], validator, row['phase'])
+            if len(curve) > 0:
+                curves.append((row, curve))
+        return curves
+
+
+@click.command()
+@click.option('--tree', '-t', multiple=True,
+              help='directory tree <tree>/<run>/degg-* to ingest')
+@click.option('--runs', default=None,
+              help='runs to ingest, separated by ",", e.g. 123,124-2')
+@click.option('--store_file', default=DEFAULT_STORE)
+@click.option('--n_jobs', '-j', default=1)
+def main(tree, runs, store_file, n_jobs):
+    store = STFStore(store_file)
+    store.ingest_trees(tree, n_jobs=n_jobs)
+    if runs is not None:
+        store.ingest_runs(runs.split(','), n_jobs=n_jobs)
+
+
+if __name__ == '__main__':
+    main()
@@ -1221,22 +1221,16 @@ class RunHandler(object):
         if len(u_dirnames) > 1:
             raise ValueError('There should only be one remote dirname. Instead '
                              f'unique remote_dirnames are {u_dirnames}!')
-        # Create the remote dir
-        self.ssh_client.run_cmd(f'mkdir -p "{u_dirnames[0]}"')
-
-        for remote_file, local_file in tqdm(
-                zip(files_to_transfer, local_files),
-                desc='Copying files'):
-            try:
-                self.ssh_client.send_file(local_file, remote_file)
-            except ValueError as err:
-                if (err.__str__() ==
-                        'Remote file already exists (use "force" to override)'):
-
-                    print('Remote file already exists! Skipping it.')
-                    pass
-                else:
-                    raise
+        # Ship everything over one connection, files that are already
+        # on the remote side are skipped
+        manifest_file = os.path.join(
+            os.path.dirname(os.path.abspath(self.file_names[0])),
+            '.transfer_manifest.json')
+        transferred = self.ssh_client.send_files(
+            local_files, files_to_transfer,
+            manifest_file=manifest_file)
+        print(f'Copied {len(transferred["sent"])} files, '
+              f'{len(transferred["skipped"])} were already on the remote.')
 
         u_vals, indices = self.organize_files_by_key(key='meas_class')
         print(u_vals)
@@ -0,0 +1,241 @@
+import os
+import time
+import threading
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from degg_measurements.daq_scripts.master_scope import initialize
+from degg_measurements.analysis.baseline.baseline_stats import baseline_stats
+from degg_measurements.analysis.baseline.baseline_stats import ChannelBaseline
+from degg_measurements.monitoring import readout_sensor
+from degg_measurements.utils.hv_check import checkHV
+
+from degg_measurements import DATA_DIR
+
+DEFAULT_CACHE = os.path.join(DATA_DIR, 'baseline_cache.hdf5')
+PMTS = ['LowerPmt', 'UpperPmt']
+##readout overhead of a waveform in a block (uint32 length, header and
+##footer words), a sample takes up to 4 bytes (with the trigger flags)
+WAVEFORM_OVERHEAD_BYTES = 4 + 2 * (17 + 2)
+_STRING_SIZE = 64
+
+
+def read_forced_trigger_block(session, channel, n_waveforms, n_samples,
+                              dac_value, discard=1, timeout=30.):
+    '''
+    n_waveforms software triggered waveforms of channel, read in blocks
+    with readWFBlockArrays instead of one round trip per waveform. The
+    first discard waveforms are tossed out.
+    Returns (waveforms (n_waveforms, n_samples) [ADC], timestamps)
+    '''
+    session = initialize(session, channel=channel, n_samples=n_samples,
+                         dac_value=dac_value, high_voltage0=None,
+                         modHV=False, verbose=False)
+    waveforms = []
+    timestamps = []
+    n_read = 0
+    to_discard = discard
+    start = time.monotonic()
+    try:
+        while n_read < n_waveforms:
+            n_missing = n_waveforms - n_read + to_discard
+            n_bytes = n_missing * (4 * n_samples + WAVEFORM_OVERHEAD_BYTES)
+            for block in session.readWFBlockArrays(n_bytes):
+                selected = np.asarray(block['channel']) == channel
+                wfs = np.asarray(block['waveform'])[selected]
+                ts = np.asarray(block['timestamp'])[selected]
+                n_skip = min(to_discard, len(wfs))
+                to_discard -= n_skip
+                if len(wfs) > n_skip:
+                    waveforms.append(wfs[n_skip:])
+                    timestamps.append(ts[n_skip:])
+                    n_read += len(wfs) - n_skip
+            if n_read < n_waveforms and time.monotonic() - start > timeout:
+                raise IOError(f'Timeout reading the baseline waveforms of '
+                              f'channel {channel}: {n_read}/{n_waveforms}')
+    finally:
+        session.endStream()
+    waveforms = np.vstack(waveforms)[:n_waveforms]
+    timestamps = np.concatenate(timestamps)[:n_waveforms]
+    return waveforms, timestamps
+
+
+def prepare_hv(sessions, degg_dicts, default_hv=1500, ramp_time=40):
+    '''
+    Enables the HV of all channels which are off (at HV1e7Gain or
+    default_hv) and waits ramp_time seconds once if any was off
+    '''
+    n_ramping = 0
+    for session, degg_dict in zip(sessions, degg_dicts):
+        if session is None:
+            continue
+        for channel, pmt in enumerate(PMTS):
+            if checkHV(session, channel):
+                continue
+            set_hv = int(degg_dict[pmt]['HV1e7Gain'])
+            if set_hv == -1:
+                set_hv = default_hv
+            session.enableHV(channel)
+            session.setDEggHV(channel, set_hv)
+            n_ramping += 1
+    if n_ramping > 0:
+        print(f'Sleeping for HV to ramp before baseline measurement '
+              f'({n_ramping} channels)')
+        for i in tqdm(range(ramp_time)):
+            time.sleep(1)
+    return n_ramping
+
+
+class BaselineService(object):
+    '''
+    PMT baselines for trigger thresholds, measured or taken from a cache.
+
+    A baseline is measured from one block of n_waveforms forced trigger
+    waveforms per channel (see read_forced_trigger_block), the statistics
+    come from one vectorized pass over the block (baseline_stats). All
+    D-Eggs of a run are measured at the same time, one thread per
+    session.
+
+    Every measurement is stored in the HDF5 cache_file together with the
+    D-Egg temperature and the measured HV. A cached baseline of the same
+    PMT, channel, DAC value and number of samples is used again as long
+    as temperature and HV are within temp_tolerance [C] and hv_tolerance
+    [V] of the current ones and it is younger than max_age [s].
+    '''
+    def __init__(self, cache_file=DEFAULT_CACHE, n_waveforms=200,
+                 n_samples=256, dac_value=30000, temp_tolerance=2.,
+                 hv_tolerance=10., max_age=12*3600, verbose=True):
+        self.cache_file = cache_file
+        self.n_waveforms = n_waveforms
+        self.n_samples = n_samples
+        self.dac_value = dac_value
+        self.temp_tolerance = temp_tolerance
+        self.hv_tolerance = hv_tolerance
+        self.max_age = max_age
+        self.verbose = verbose
+        self._lock = threading.Lock()
+        self._table = None
+
+    def _load(self):
+        if self._table is None:
+            self._table = pd.DataFrame()
+            if os.path.isfile(self.cache_file):
+                with pd.HDFStore(self.cache_file, mode='r') as store:
+                    if '/baselines' in store:
+                        self._table = store['baselines']
+        return self._table
+
+    def _per_sample_node(self, entry_id):
+        return f'/per_sample/e{entry_id}'
+
+    def lookup(self, pmt, channel, temperature, hv, now=None):
+        '''latest cached ChannelBaseline valid at the conditions or None'''
+        if now is None:
+            now = time.time()
+        with self._lock:
+            table = self._load()
+        if len(table) == 0:
+            return None
+        valid = ((table['pmt'] == pmt) &
+                 (table['channel'] == channel) &
+                 (table['dac_value'] == self.dac_value) &
+                 (table['n_samples'] == self.n_samples) &
+                 (np.abs(table['temperature'] - temperature)
+                  <= self.temp_tolerance) &
+                 (np.abs(table['hv'] - hv) <= self.hv_tolerance) &
+                 (now - table['timestamp'] <= self.max_age))
+        if not np.any(valid):
+            return None
+        row = table[valid].sort_values('timestamp').iloc[-1]
+        with self._lock:
+            with pd.HDFStore(self.cache_file, mode='r') as store:
+                per_sample = store[self._per_sample_node(
+                    row['entry_id'])].to_numpy()
+        return ChannelBaseline(per_sample_median=per_sample,
+                               **{key: row[key] for key in
+                                  ChannelBaseline._fields
+                                  if key != 'per_sample_median'})
+
+    def _store(self, baseline):
+        row = baseline._asdict()
+        per_sample = row.pop('per_sample_median')
+        entry_id = time.time_ns()
+        row['entry_id'] = entry_id
+        df = pd.DataFrame([row])
+        with self._lock:
+            cache_dir = os.path.dirname(os.path.abspath(self.cache_file))
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with pd.HDFStore(self.cache_file, mode='a') as store:
+                store.append('baselines', df, format='table', index=False,
+                             min_itemsize={'pmt': _STRING_SIZE})
+                store.put(self._per_sample_node(entry_id),
+                          pd.Series(per_sample))
+            self._table = pd.concat([self._load(), df], ignore_index=True)
+
+    def measure(self, session, pmt, port, channel, temperature, hv):
+        '''measures and caches the ChannelBaseline of one channel'''
+        waveforms, timestamps = read_forced_trigger_block(
+            session, channel, self.n_waveforms, self.n_samples,
+            self.dac_value)
+        stats = baseline_stats(waveforms, timestamps)
+        baseline = ChannelBaseline.from_stats(
+            stats, pmt=pmt, port=int(port), channel=channel,
+            temperature=float(temperature), hv=float(hv),
+            dac_value=int(self.dac_value), timestamp=time.time())
+        self._store(baseline)
+        return baseline
+
+    def get(self, session, degg_dict, force=False):
+        '''
+        {channel: ChannelBaseline} of both PMTs of a D-Egg, measured if
+        there is no valid cached one or force
+        '''
+        port = int(degg_dict['Port'])
+        temperature = readout_sensor(session, 'temperature_sensor')
+        baselines = {}
+        for channel, pmt in enumerate(PMTS):
+            name = degg_dict[pmt]['SerialNumber']
+            hv = readout_sensor(session, f'voltage_channel{channel}')
+            baseline = None
+            if not force:
+                baseline = self.lookup(name, channel, temperature, hv)
+            if baseline is None:
+                baseline = self.measure(session, name, port, channel,
+                                        temperature, hv)
+                status = 'measured'
+            else:
+                status = 'cached'
+            if self.verbose:
+                print(f'{port} {name} ({status}): {baseline.baseline:.2f} '
+                      f'+/- {baseline.robust_rms:.2f} ADC, '
+                      f'{temperature:.1f} C, {hv:.0f} V')
+            baselines[channel] = baseline
+        return baselines
+
+    def get_run(self, sessions, degg_dicts, force=False):
+        '''
+        get for all D-Eggs at once, one thread per session. Returns a
+        list in the order of sessions, None for sessions which are None
+        or failed.
+        '''
+        results = [None] * len(sessions)
+
+        def _get(i, session, degg_dict):
+            try:
+                results[i] = self.get(session, degg_dict, force=force)
+            except IOError as err:
+                print(f'Baseline of port {degg_dict["Port"]} failed: {err}')
+
+        threads = []
+        for i, (session, degg_dict) in enumerate(zip(sessions, degg_dicts)):
+            if session is None:
+                continue
+            threads.append(threading.Thread(target=_get,
+                                            args=[i, session, degg_dict]))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
@@ -486,6 +486,20 @@ def validate_gain(run_json_file, verbose=False):
 
     return True
 
+def update_pipeline_status(schedule, current_dict, background_keys):
+    ##results of analyses/backups that finished in the background
+    results = schedule.collect_pipeline_results()
+    if len(results) == 0:
+        return
+    current_key = schedule.get_run_key()
+    for title, success, trace in results:
+        if not success:
+            send_warning(f"@channel - Background task {title} failed")
+            send_warning(trace)
+        if title in background_keys:
+            current_dict[current_key][background_keys[title]] = int(success)
+    update_json(schedule.get_run(), current_dict)
+
 def run_schedule(schedule):
     verbose = schedule.verbosity()
     current_dict = open_json(schedule.get_run())
@@ -494,6 +508,8 @@ def run_schedule(schedule):
     print(task_title_list)
     print("=" * 20)
     task_num = 0
+    ##title -> run json entry of tasks handed to the pipeline
+    background_keys = dict()
     send_message("--- Now Running: ---")
     for task, task_title in zip(task_list, task_title_list):
         print_task_str = schedule.get_task_print_string(task,
@@ -504,11 +520,16 @@ def run_schedule(schedule):
         if verbose:
             send_message(print_task_str)
         try:
-            schedule.execute_task(task_title)
-            ##true
+            finished = schedule.execute_task(task_title)
             current_key = schedule.get_run_key()
-            current_dict[current_key][dict_task_str] = 1
-            update_json(schedule.get_run(), current_dict)
+            if finished:
+                ##true
+                current_dict[current_key][dict_task_str] = 1
+                update_json(schedule.get_run(), current_dict)
+            else:
+                ##stays -1 until the pipeline reports back
+                background_keys[task_title] = dict_task_str
+            update_pipeline_status(schedule, current_dict, background_keys)
         except KeyboardInterrupt:
             current_dict[dict_task_str] = 0
             print("DAQ Stopped by Manual Interrupt")
@@ -532,6 +553,11 @@ def run_schedule(schedule):
             exit(1)
         task_num += 1
         ##unfinished task stays set to -1
+
+    if schedule.get_pipeline() is not None:
+        print("Waiting for background analyses and backups...")
+        schedule.shutdown_pipeline()
+        update_pipeline_status(schedule, current_dict, background_keys)
     return True
 
 def get_recovery_run_key(run_dict, key=KEY_NAME):
@@ -647,7 +673,13 @@ def monitoring_session(schedule, title, comment, reboot=False, n_sets=6):
 @click.option('--recover', is_flag=True, default=False)
 @click.option('--test', is_flag=True, default=False)
 @click.option('--force', is_flag=True)
-def main(config_file, recover, test, force):
+@click.option('--pipeline', default=0,
+              help='Run analyses and backups in this many background '
+                   'processes while the DAQ continues (0: in order)')
+@click.option('--auto-analysis', is_flag=True, default=False,
+              help='With --pipeline, trigger the remote analysis as soon '
+                   'as a measurement wrote new data')
+def main(config_file, recover, test, force, pipeline, auto_analysis):
     if uncommitted_changes and not force:
         raise Exception(
             'Commit changes to the repository before running a measurement! '
@@ -676,7 +708,12 @@ def main(config_file, recover, test, force):
         kwargs={'local_path':RUN_DIR,
         'remote_folder':'/misc/disk19/users/icecube/fat_backup',
         'run_number':run_number,
-        'remote_filename':'run_json.tar.gz'})
+        'remote_filename':'run_json.tar.gz',
+        'incremental':True})
+
+    if pipeline > 0:
+        schedule.enable_pipeline(max_workers=pipeline,
+                                 auto_analysis=auto_analysis)
 
     ##Very noisy - only use temporarily for debugging
     send_all = False
@@ -3,8 +3,10 @@ from .monitoring import reboot, SENSOR_TO_VALUE
 from .readout_thermometer import readout_temperature
 from .readout_and_reboot import readout_and_reboot
 from .readout_and_readout import readout_and_readout
+from .sensor_store import SensorStore, load_sensor_data
 
 __all__ = ('readout', 'readout_sensor',
            'reboot', 'SENSOR_TO_VALUE',
            'readout_temperature', 'readout_and_reboot',
-           'readout_and_readout')
+           'readout_and_readout',
+           'SensorStore', 'load_sensor_data')
@@ -85,6 +85,8 @@ def readout_sensor(session, sensor):
             return -1
 
     channel_no = SENSOR_TO_VALUE[sensor]
+    ##sensors without an ADC channel (pressure_sensor)
+    value = np.nan
     if np.isfinite(channel_no):
         try:
             value = session.sloAdcReadChannel(channel_no)
@@ -106,42 +108,55 @@ def readout_sensor(session, sensor):
     return value
 
 
-def readout(session, reflash_count, filename):
+def readout(session, reflash_count, filename, device=None):
     '''
     Parameters
     ----------
     session : IceBoot Session
     filename : str
-        Filename to save the sensor data to.
+        Filename to save the sensor data to. Files ending in .hdf5/.h5
+        are SensorStores, anything else is written as CSV.
+    device : str
+        Device name stored with the values in a SensorStore, defaults
+        to the basename of the file.
 
     Returns
     -------
     session : IceBoot Session
         Returns the given IceBoot Session.
     '''
-    measured_values = dict()
+    from degg_measurements.monitoring.sensor_store import SensorStore
+    from degg_measurements.monitoring.sensor_store import STORE_EXTENSIONS
 
-    df = pd.DataFrame()
-    index = pd.to_datetime([pd.Timestamp.now()])
-    index.name = 'Local time'
+    measured_values = dict()
+    timestamp = pd.Timestamp.now()
 
     for key in SENSOR_TO_VALUE.keys():
         if key == 'reflash_count':
-            val = reflash_count
-            df[key] = pd.Series(val, index=index)
+            measured_values[key] = reflash_count
             continue
         try:
             val = readout_sensor(session, key)
         except ValueError:
             val = np.nan
-        df[key] = pd.Series(val, index=index)
+        measured_values[key] = val
 
+    if filename.endswith(STORE_EXTENSIONS):
+        if device is None:
+            device = os.path.splitext(os.path.basename(filename))[0]
+        SensorStore(filename).append(measured_values, device=device,
+                                     timestamp=timestamp)
+        return session
+
+    ##append the row instead of reading and rewriting the whole file
+    index = pd.to_datetime([timestamp])
+    index.name = 'Local time'
+    df = pd.DataFrame({key: [val] for key, val in measured_values.items()},
+                      index=index)
     if not os.path.isfile(filename):
         df.to_csv(filename, mode='w', header=True)
     else:
-        existing_df = pd.read_csv(filename, index_col='Local time')
-        df = existing_df.append(df)
-        df.to_csv(filename, mode='w', header=True)
+        df.to_csv(filename, mode='a', header=False)
     return session
 
 
@@ -200,7 +200,7 @@ def readout_and_readout(json_file, set_time, comment):
         key_list.append(key)
         degg_dict[key] = dict()
         degg_id = degg_dict['DEggSerialNumber']
-        filename = os.path.join(dirpath, degg_id + '.csv')
+        filename = os.path.join(dirpath, degg_id + '.hdf5')
         degg_dict[key]['Filename'] = filename
         degg_dict[key]['Comment'] = comment
         degg_dict[key]['Time'] = set_time
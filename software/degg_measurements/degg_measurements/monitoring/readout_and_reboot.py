@@ -45,7 +45,7 @@ def readout_and_reboot(json_file, comment, set_time):
         key = create_key(degg_dict, measurement_type)
         degg_dict[key] = dict()
         degg_id = degg_dict['DEggSerialNumber']
-        filename = os.path.join(dirpath, degg_id + '.csv')
+        filename = os.path.join(dirpath, degg_id + '.hdf5')
         degg_dict[key]['Filename'] = filename
         degg_dict[key]['Comment'] = comment
         degg_dict[key]['Time'] = set_time
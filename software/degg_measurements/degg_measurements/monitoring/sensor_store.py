@@ -0,0 +1,171 @@
+import os
+import numpy as np
+import pandas as pd
+import tables
+
+from degg_measurements.monitoring.monitoring import SENSOR_TO_VALUE
+
+STORE_EXTENSIONS = ('.h5', '.hdf5')
+TABLE_NAME = 'sensors'
+TIME_COLUMN = 'Local time'
+
+# reflash_count is a counter, all other quantities are read as floats
+SENSOR_DTYPE = np.dtype(
+    [('local_time', np.int64), ('device', 'S32')] +
+    [(key, np.int32 if key == 'reflash_count' else np.float64)
+     for key in SENSOR_TO_VALUE.keys()])
+
+
+class SensorStore(object):
+    '''
+    Append-only HDF5 time series of the SENSOR_TO_VALUE quantities.
+
+    Each poll is appended as one row of a chunked table (local time in
+    ns, device name and one typed column per sensor), so appending does
+    not depend on the length of the history. Range queries by time and
+    device are evaluated in-kernel by PyTables.
+
+    The DataFrames returned by `read` have the same layout as the CSV
+    files written by earlier versions of `readout`.
+    '''
+    def __init__(self, filename, expectedrows=100000):
+        self.filename = filename
+        self.expectedrows = expectedrows
+
+    def _open(self, mode):
+        open_file = tables.open_file(self.filename, mode)
+        if TABLE_NAME not in open_file.root:
+            if mode == 'r':
+                open_file.close()
+                raise IOError(f'{self.filename} is not a sensor store!')
+            filters = tables.Filters(complevel=5, complib='zlib')
+            open_file.create_table(
+                '/', TABLE_NAME, description=SENSOR_DTYPE,
+                title='Sensor readout', filters=filters,
+                expectedrows=self.expectedrows)
+        return open_file
+
+    def append(self, values, device='', timestamp=None):
+        '''
+        Append one or more rows. `values` is a dict of sensor name to
+        value (or to equal-length arrays of values); sensors missing
+        from it are stored as NaN (-1 for reflash_count).
+        '''
+        if timestamp is None:
+            timestamp = pd.Timestamp.now()
+        timestamps = pd.to_datetime(np.atleast_1d(timestamp))
+        rows = np.zeros(len(timestamps), dtype=SENSOR_DTYPE)
+        rows['local_time'] = np.asarray(
+            timestamps, dtype='datetime64[ns]').view(np.int64)
+        rows['device'] = device
+        for key in SENSOR_TO_VALUE.keys():
+            default = -1 if key == 'reflash_count' else np.nan
+            val = values.get(key, default)
+            rows[key] = np.nan_to_num(val, nan=-1) \
+                if key == 'reflash_count' else val
+        with self._open('a') as open_file:
+            table = open_file.get_node('/', TABLE_NAME)
+            table.append(rows)
+            table.flush()
+
+    def read_array(self, start=None, stop=None, device=None):
+        '''
+        Structured array of the rows with start <= time < stop
+        (anything pd.Timestamp accepts) and matching device.
+        '''
+        conditions = []
+        condvars = {}
+        if start is not None:
+            conditions.append('(local_time >= t_start)')
+            condvars['t_start'] = pd.Timestamp(start).value
+        if stop is not None:
+            conditions.append('(local_time < t_stop)')
+            condvars['t_stop'] = pd.Timestamp(stop).value
+        if device is not None:
+            conditions.append('(device == dev)')
+            condvars['dev'] = device.encode()
+        with self._open('r') as open_file:
+            table = open_file.get_node('/', TABLE_NAME)
+            if len(conditions) == 0:
+                return table.read()
+            return table.read_where(' & '.join(conditions), condvars)
+
+    def read(self, start=None, stop=None, device=None):
+        rows = self.read_array(start=start, stop=stop, device=device)
+        index = pd.DatetimeIndex(rows['local_time'].view('datetime64[ns]'))
+        index.name = TIME_COLUMN
+        df = pd.DataFrame(
+            {key: rows[key] for key in SENSOR_TO_VALUE.keys()}, index=index)
+        if len(np.unique(rows['device'])) > 1:
+            df['device'] = rows['device'].astype(str)
+        return df
+
+    def devices(self):
+        with self._open('r') as open_file:
+            table = open_file.get_node('/', TABLE_NAME)
+            return sorted(set(d.decode() for d in table.col('device')))
+
+    def __len__(self):
+        with self._open('r') as open_file:
+            return open_file.get_node('/', TABLE_NAME).nrows
+
+
+def sensor_file_format(filename):
+    '''
+    'store' for a SensorStore, 'pandas' for an HDF5 file written by
+    DataFrame.to_hdf (e.g. the mon_<port>.hdf5 files of bolt) and 'csv'
+    for anything that is not HDF5.
+    '''
+    if not tables.is_hdf5_file(filename):
+        return 'csv'
+    with tables.open_file(filename, 'r') as open_file:
+        if TABLE_NAME in open_file.root:
+            node = open_file.get_node('/', TABLE_NAME)
+            if isinstance(node, tables.Table) and \
+                    'local_time' in node.colnames:
+                return 'store'
+        for node in open_file.walk_nodes('/'):
+            if 'pandas_type' in node._v_attrs:
+                return 'pandas'
+    raise ValueError(f'{filename} is neither a SensorStore nor a pandas '
+                     'HDF5 file!')
+
+
+def is_sensor_store(filename):
+    return sensor_file_format(filename) == 'store'
+
+
+def load_sensor_data(filename, start=None, stop=None, device=None):
+    '''
+    Load sensor readout data as a DataFrame indexed by local time,
+    either from a SensorStore, a pandas HDF5 file or a legacy CSV file.
+    The format is taken from the content of the file, not its name.
+    '''
+    file_format = sensor_file_format(filename)
+    if file_format == 'store':
+        return SensorStore(filename).read(start=start, stop=stop,
+                                          device=device)
+    if file_format == 'pandas':
+        df = pd.read_hdf(filename)
+    else:
+        df = pd.read_csv(filename, index_col=TIME_COLUMN)
+        df.index = pd.to_datetime(df.index)
+    if start is not None:
+        df = df[df.index >= pd.Timestamp(start)]
+    if stop is not None:
+        df = df[df.index < pd.Timestamp(stop)]
+    return df
+
+
+def convert_csv_to_store(csv_file, store_file=None, device=None):
+    '''Copy a CSV file written by the old readout into a SensorStore'''
+    if store_file is None:
+        store_file = os.path.splitext(csv_file)[0] + '.hdf5'
+    if device is None:
+        device = os.path.splitext(os.path.basename(csv_file))[0]
+    df = pd.read_csv(csv_file, index_col=TIME_COLUMN)
+    values = {key: df[key].to_numpy() for key in SENSOR_TO_VALUE.keys()
+              if key in df.columns}
+    SensorStore(store_file).append(values, device=device,
+                                   timestamp=pd.to_datetime(df.index))
+    return store_file
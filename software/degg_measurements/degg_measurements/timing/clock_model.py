@@ -0,0 +1,251 @@
+##Continuously updated DOM -> surface clock model per D-Egg
+##
+##calculateTimingInfoAfterDataTaking only uses the two RapCals taken
+##around each block of charge stamps (A/B), so every block of every
+##scan point needs its own RapCal sequence. The clock relation drifts
+##slowly, so the RapCals of earlier blocks and points are kept here
+##as anchors: a timestamp is translated with the RapCalPair of the two
+##anchors around it (or the last two, if it is after the last one) and
+##a new RapCal is only needed once the extrapolation gets uncertain.
+##Only charge stamp data is supported, scan.run takes the full RapCal
+##sequence for other methods.
+import time
+import weakref
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+
+from RapCal import rapcal as rp
+
+##universal offset, same as in calculateTimingInfoAfterDataTaking
+OFFSET_DATETIME = datetime(2022, 1, 1)
+
+
+class ClockModel(object):
+    '''
+    RapCal anchors of one D-Egg, sorted in DOM time.
+
+    A new anchor that does not continue the current model (DOM clock
+    going backwards or off by more than reset_tolerance [s] from the
+    prediction, e.g. after a power cycle) starts a new model.
+    '''
+    def __init__(self, max_anchors=50, reset_tolerance=1e-6,
+                 n_stability=10):
+        self.max_anchors = max_anchors
+        self.reset_tolerance = reset_tolerance
+        self.n_stability = n_stability
+        self.t_offset = OFFSET_DATETIME.timestamp()
+        self.events = []
+        self.seeds = []
+        self.wall_times = []
+        self._pairs = {}
+
+    def __len__(self):
+        return len(self.events)
+
+    def _dom_seconds(self, event):
+        return event.Tc_dom / rp.ICM_CLOCK_FREQ
+
+    def _pair(self, k):
+        ##built once per pair of anchors
+        key = id(self.events[k]), id(self.events[k + 1])
+        if key not in self._pairs:
+            utc, icm = self.seeds[k]
+            self._pairs[key] = rp.RapCalPair(
+                self.events[k], self.events[k + 1],
+                utc=[(utc - self.t_offset)], icm=icm,
+                utc_is_seconds=True, icm_is_base16=True)
+        return self._pairs[key]
+
+    def predict_dor(self, event):
+        '''surface time [ICM ticks] of the centre of event from the model'''
+        pair = self._pair(len(self.events) - 2)
+        last = self.events[-1]
+        return last.Tc_dor + (1 + pair.epsilon) * (event.Tc_dom - last.Tc_dom)
+
+    def add(self, event, utc, icm, wall_time=None):
+        if wall_time is None:
+            wall_time = time.time()
+        if len(self.events) > 0:
+            reset = event.Tc_dom <= self.events[-1].Tc_dom
+            if not reset and len(self.events) >= 2:
+                deviation = abs(self.predict_dor(event) - event.Tc_dor)
+                reset = deviation / rp.ICM_CLOCK_FREQ > self.reset_tolerance
+            if reset:
+                print('ClockModel: RapCal does not continue the model, restarting it')
+                self.events, self.seeds, self.wall_times = [], [], []
+                self._pairs = {}
+        self.events.append(event)
+        self.seeds.append((utc, icm))
+        self.wall_times.append(wall_time)
+        if len(self.events) > self.max_anchors:
+            drop = len(self.events) - self.max_anchors
+            for k in range(drop):
+                self._pairs.pop((id(self.events[k]), id(self.events[k + 1])), None)
+            self.events = self.events[drop:]
+            self.seeds = self.seeds[drop:]
+            self.wall_times = self.wall_times[drop:]
+
+    def epsilons(self):
+        return np.array([self._pair(k).epsilon for k in range(len(self.events) - 1)],
+                        dtype=float)
+
+    def uncertainty(self, wall_time=None):
+        '''
+        Expected error [s] of a timestamp taken at wall_time that is
+        translated with the last pair: the spread of the clock drift of
+        the last n_stability pairs times the time since the last RapCal.
+        inf with less than three anchors.
+        '''
+        if len(self.events) < 3:
+            return np.inf
+        if wall_time is None:
+            wall_time = time.time()
+        eps = self.epsilons()[-self.n_stability:]
+        dt = max(wall_time - self.wall_times[-1], 0)
+        return np.std(eps, ddof=1) * dt
+
+    def pair_index(self, timestamps, device_clock=None):
+        '''index k of the pair (k, k+1) used for every DOM timestamp'''
+        if device_clock is None:
+            device_clock = rp.DEGG_CLOCK_FREQ
+        anchors = np.array([self._dom_seconds(e) for e in self.events], dtype=float)
+        t_dom = np.asarray(timestamps, dtype=float) / device_clock
+        k = np.searchsorted(anchors, t_dom, side='right') - 1
+        return np.clip(k, 0, len(self.events) - 2)
+
+    def dom2surface(self, timestamps):
+        '''
+        Returns (mfh_t [s since OFFSET_DATETIME], delta [s], pair index)
+        for an array of DOM timestamps. The pairs are built once, but
+        RapCalPair.dom2surface is called per timestamp, as everywhere
+        else in the repo.
+        '''
+        if len(self.events) < 2:
+            raise RuntimeError('Clock model needs at least two RapCals!')
+        timestamps = np.asarray(timestamps)
+        k = self.pair_index(timestamps)
+        mfh_t = np.zeros(len(timestamps), dtype=np.longdouble)
+        delta = np.zeros(len(timestamps))
+        for i, (timestamp, i_pair) in enumerate(zip(timestamps.tolist(), k)):
+            mfh_t[i], delta[i] = self._pair(i_pair).dom2surface(
+                timestamp, device_type='DEGG', deggMode=True)
+        return mfh_t, delta, k
+
+
+class ClockModelService(object):
+    '''
+    ClockModels of all D-Eggs (by port), shared by the points of a scan.
+
+    * `update(deggsList)` adds the RapCals recorded in the deggContainers
+      since the last call.
+    * `needs_rapcal(deggsList, horizon)` is True if the model of any of
+      them would be more uncertain than tolerance [s] horizon seconds
+      from now.
+    * `calculate_timing_info(deggsList)` fills the infoContainers like
+      calculateTimingInfoAfterDataTaking, but from the models.
+    * `start(rapcal, period)` calls rapcal() (which takes RapCals and
+      calls update) every period seconds in a thread, e.g. while the
+      motors move. Data taking wraps itself in `hold()`, so no RapCal
+      runs at the same time.
+
+    `seeds` can hold the ICM/UTC seed times of the first point, they
+    do not have to be read again for the following ones.
+    '''
+    def __init__(self, tolerance=5e-9, period=10, **model_kwargs):
+        self.tolerance = tolerance
+        self.period = period
+        self.seeds = None
+        self.model_kwargs = model_kwargs
+        self.models = {}
+        self._consumed = weakref.WeakKeyDictionary()
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._rapcal = None
+
+    def model(self, port):
+        if port not in self.models:
+            self.models[port] = ClockModel(**self.model_kwargs)
+        return self.models[port]
+
+    def update(self, deggsList, wall_time=None):
+        with self._lock:
+            for degg in deggsList:
+                events = degg.rapcals.rapcals
+                n_done = self._consumed.get(degg, 0)
+                model = self.model(degg.port)
+                for i in range(n_done, len(events)):
+                    model.add(events[i], degg.rapcal_utcs[i],
+                              degg.rapcal_icms[i], wall_time)
+                self._consumed[degg] = len(events)
+
+    def uncertainty(self, deggsList, horizon=0):
+        wall_time = time.time() + horizon
+        with self._lock:
+            return max([self.model(degg.port).uncertainty(wall_time)
+                        for degg in deggsList] + [0])
+
+    def needs_rapcal(self, deggsList, horizon=0):
+        return self.uncertainty(deggsList, horizon) > self.tolerance
+
+    def calculate_timing_info(self, deggsList, method='charge_stamp'):
+        '''
+        Sets mfh_t [fs], delta, datetime_offset, clockDrift and the
+        cable delays of all infoContainers (charge stamp data only)
+        '''
+        if method != 'charge_stamp':
+            raise ValueError(f'Method {method} not supported by the clock model, '
+                             'use calculateTimingInfoAfterDataTaking')
+        with self._lock:
+            for degg in deggsList:
+                model = self.model(degg.port)
+                for infoList in [degg.info0, degg.info1]:
+                    if len(infoList) == 0:
+                        continue
+                    timestamps = [info.timestamp for info in infoList]
+                    mfh_t, delta, k = model.dom2surface(timestamps)
+                    ##int cast to preserve precision
+                    mfh_fs = [int(t) for t in mfh_t * 1e15]
+                    for info, t_fs, t_delta, i_pair in zip(infoList, mfh_fs, delta, k):
+                        pair = model._pair(i_pair)
+                        info.mfh_t = t_fs #[fs]
+                        info.mfh_t2 = t_fs
+                        info.datetime_offset = model.t_offset
+                        info.delta = t_delta #[s]
+                        info.clockDrift = pair.epsilon
+                        info.cable_delay0 = pair.cable_delays[0]
+                        info.cable_delay1 = pair.cable_delays[1]
+
+    @contextmanager
+    def hold(self):
+        '''no scheduled RapCal runs inside this block'''
+        with self._lock:
+            yield
+
+    def start(self, rapcal, period):
+        '''rapcal is called without arguments, replaces the previous one'''
+        self._rapcal = rapcal
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=[period],
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self, period):
+        while not self._stop.wait(period):
+            with self._lock:
+                try:
+                    self._rapcal()
+                except Exception as err:
+                    print(f'ClockModelService: scheduled RapCal failed: {err}')
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
@@ -19,6 +19,7 @@ from degg_measurements.timing.setupHelper import recreateStreams
 from degg_measurements.timing.setupHelper import makeBatches, getEventDataParallel
 from degg_measurements.timing.setupHelper import infoContainer, deggContainer
 from degg_measurements.timing.setupHelper import configureBaselines
+from degg_measurements.daq_scripts.baseline_service import BaselineService
 from degg_measurements.timing.setupHelper import deggListInitialize, doInitialize
 from degg_measurements.timing.setupHelper import recreateDEggStreams
 from degg_measurements.timing.setupHelper import getTimeMFH
@@ -258,7 +259,7 @@ def verify_hv(deggBatches, verbose=False):
 
 def run_timing(run_file, comment, n_jobs, fStrength = 1,
                method='charge_stamp', overwrite=False,
-               verbose=False, ALT_FITTING=False):
+               verbose=False, ALT_FITTING=False, cached_baselines=False):
     n_jobs = int(n_jobs)
 
 
@@ -294,9 +295,10 @@ def run_timing(run_file, comment, n_jobs, fStrength = 1,
                                                 nevents, n_rapcals)
 
     ##this stage measures the PMT baselines
+    service = BaselineService() if cached_baselines else None
     deggNameList, deggList, sessionList, portList, hvSetList, thresholdList, baselineFileList, baselineList = configureBaselines(
         run_file=run_file, n_jobs=n_jobs, fStrength=fStrength, tSleep=tSleep,
-        overwrite=overwrite, key=key, ignoreList=ignoreList)
+        overwrite=overwrite, key=key, ignoreList=ignoreList, service=service)
 
     ##this just populates the deggsList, no calculations
     print('\n')
@@ -412,10 +414,13 @@ def run_timing(run_file, comment, n_jobs, fStrength = 1,
 @click.option('--overwrite', '-o', is_flag=True)
 @click.option('--verbose', '-v', is_flag=True)
 @click.option('--alt_fit', is_flag=True)
-def main(run_file, comment, n_jobs, method, overwrite, verbose, alt_fit):
+@click.option('--cached_baselines', is_flag=True,
+              help='measure all baselines at once, reuse cached ones')
+def main(run_file, comment, n_jobs, method, overwrite, verbose, alt_fit,
+         cached_baselines):
     run_timing(run_file=run_file, comment=comment, n_jobs=n_jobs,
                method=method, overwrite=overwrite, verbose=verbose,
-               ALT_FITTING=alt_fit)
+               ALT_FITTING=alt_fit, cached_baselines=cached_baselines)
 
 if __name__ == "__main__":
     main()
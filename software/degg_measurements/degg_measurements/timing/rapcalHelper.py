@@ -1,4 +1,5 @@
 import time
+import threading
 from datetime import datetime, timedelta
 import os, sys
 from degg_measurements import FH_SERVER_SCRIPTS
@@ -127,6 +128,21 @@ def getRapCalData(icms, icm_port, deggBatch=None, nRepeat=2, verbose=False,
 
     #return True
 
+##one RapCal for all D-Egg batches, the ICMs are handled in parallel
+def getRapCalDataParallel(icmConnectList, rapcal_ports, deggBatches, verbose=False,
+                          ALT_FITTING=False):
+    threads = []
+    for deggBatch, icmConnect, rapcal_port in zip(deggBatches, icmConnectList, rapcal_ports):
+        if len(deggBatch) != 0:
+            seedTime = [deggBatch[0].seedTimeICM, deggBatch[0].seedTimeUTC]
+            threads.append(threading.Thread(target=getRapCalData,
+                                            args=[icmConnect, rapcal_port, deggBatch, 1,
+                                                  verbose, seedTime, ALT_FITTING]))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
 def offset(deggsList, method):
     print("WARN - rapCalHelper::offset functionality may be outdated!")
     mfhTimeList = []
@@ -11,6 +11,7 @@ from RapCal import rapcal as rp
 
 from degg_measurements.daq_scripts.master_scope import initialize_dual
 from degg_measurements.daq_scripts.measure_pmt_baseline import measure_baseline
+from degg_measurements.daq_scripts.baseline_service import prepare_hv
 from degg_measurements.analysis import calc_baseline
 from degg_measurements import DATA_DIR
 from degg_measurements.utils import CALIBRATION_FACTORS
@@ -449,14 +450,17 @@ def getNewHV(degg_dict, pmt, gain_factor, gainMeasurement):
     new_hv = (1e7 * gain_factor / gainFitNorm)**(1/gainFitExp)
     return new_hv
 
+##with a BaselineService the baselines of all modules are measured at once
+##(or taken from its cache) instead of with measure_baseline
 def configureBaselines(run_file, n_jobs, fStrength, tSleep, key=None, overwrite=False,
-                       ignoreList=[]):
+                       ignoreList=[], service=None):
 
     tmp_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tmp')
     if not os.path.exists(tmp_file):
         os.mkdir(tmp_file)
 
-    measure_baseline(run_file, n_jobs=n_jobs, modHV=False, return_sessions=False, ignoreList=ignoreList)
+    if service is None:
+        measure_baseline(run_file, n_jobs=n_jobs, modHV=False, return_sessions=False, ignoreList=ignoreList)
 
     degg_list = []
     hvSetList = []
@@ -493,18 +497,33 @@ def configureBaselines(run_file, n_jobs, fStrength, tSleep, key=None, overwrite=
         portList.append(port)
         deggNameList.append(degg_dict['DEggSerialNumber'])
 
-    i = 0
-    for degg_file, session in zip(usingDEggFileList, sessionList):
+    if service is not None:
+        activeSessions = [None if port in ignoreList else session
+                          for port, session in zip(portList, sessionList)]
+        activeDicts = [load_degg_dict(degg_file) for degg_file in usingDEggFileList]
+        prepare_hv(activeSessions, activeDicts, ramp_time=tSleep)
+        channelBaselines = service.get_run(activeSessions, activeDicts)
+
+    for i, (degg_file, session) in enumerate(zip(usingDEggFileList,
+                                                 sessionList)):
         degg_dict = load_degg_dict(degg_file)
         port = int(degg_dict['Port'])
         if port in ignoreList:
             thresholdList.append([0, 0])
             baselineList.append([0, 0])
             continue
-        baselineFileList[i][0] = degg_dict['LowerPmt']['BaselineFilename']
-        baselineFileList[i][1] = degg_dict['UpperPmt']['BaselineFilename']
-        baseline0 = calc_baseline(baselineFileList[i][0])['baseline'].values[0]
-        baseline1 = calc_baseline(baselineFileList[i][1])['baseline'].values[0]
+        if service is not None:
+            if channelBaselines[i] is None:
+                raise IOError(f'No baseline for port {port}!')
+            baselineFileList[i][0] = service.cache_file
+            baselineFileList[i][1] = service.cache_file
+            baseline0 = channelBaselines[i][0].baseline
+            baseline1 = channelBaselines[i][1].baseline
+        else:
+            baselineFileList[i][0] = degg_dict['LowerPmt']['BaselineFilename']
+            baselineFileList[i][1] = degg_dict['UpperPmt']['BaselineFilename']
+            baseline0 = calc_baseline(baselineFileList[i][0])['baseline'].values[0]
+            baseline1 = calc_baseline(baselineFileList[i][1])['baseline'].values[0]
         baselineList.append([baseline0, baseline1])
 
         ##these are in Volts
@@ -574,7 +593,6 @@ def configureBaselines(run_file, n_jobs, fStrength, tSleep, key=None, overwrite=
                 print("use this to recover the file")
                 print(degg_dict)
                 exit(1)
-        i += 1
     print(f"baselinelist = {baselineList}")
     return deggNameList, degg_list, sessionList, portList, hvSetList, thresholdList, baselineFileList, baselineList
 
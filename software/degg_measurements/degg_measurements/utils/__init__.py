@@ -11,10 +11,11 @@ from .icm_manipulation import mfh_power_on
 from .paths import create_save_dir
 from .paths import extract_runnumber_from_path
 from .parser import startIcebootSession
-from .read_data import read_data
+from .read_data import read_data, read_parameters, iter_data_chunks
 from .wfana import get_charges, get_charges_old
 from .wfana import calc_charge
 from .wfana import get_spe_avg_waveform
+from .wfana import correct_droop, droop_time_constant
 from .create_configs import update_json
 from .load_dict import load_run_json, load_degg_dict
 from .load_dict import flatten_dict, create_key
@@ -31,8 +32,8 @@ from .crash_logger import log_crash
 
 #WARN - order matters!
 
-__all__ = ('create_save_dir', 'startIcebootSession', 'read_data', 'get_charges',
-        'calc_charge', 'get_spe_avg_waveform', 'load_run_json', 'load_degg_dict', 'check_channel', 'short_sha', 'sha', 'origin', 'active_branch',
+__all__ = ('create_save_dir', 'startIcebootSession', 'read_data', 'read_parameters', 'iter_data_chunks', 'get_charges',
+        'calc_charge', 'get_spe_avg_waveform', 'correct_droop', 'droop_time_constant', 'load_run_json', 'load_degg_dict', 'check_channel', 'short_sha', 'sha', 'origin', 'active_branch',
            'uncommitted_changes', 'DEggLogBook', 'DatabaseHelper', 'flatten_dict',
            'create_key', 'sort_degg_dicts_and_files_by_key', 'add_default_meas_dict',
            'update_json', 'OptparseWrapper', 'extract_runnumber_from_path', 'run_backup',
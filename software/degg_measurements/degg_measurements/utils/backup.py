@@ -3,9 +3,21 @@ import os
 import time
 
 
-def run_backup(local_path, remote_folder, run_number, remote_filename):
+def run_backup(local_path, remote_folder, run_number, remote_filename,
+               incremental=False, n_channels=4):
     if not remote_filename.endswith('.tar.gz'):
         raise ValueError(f'remote_filename is expected to end with .tar.gz')
+    if incremental:
+        # Mirror the directory instead of shipping a full snapshot,
+        # only new or changed files are sent
+        remote_path = os.path.join(remote_folder, f'run_{run_number:05d}',
+                                   remote_filename.replace('.tar.gz', ''))
+        manifest_file = os.path.join(
+            local_path, f'.backup_manifest_{run_number:05d}.json')
+        ssh_client = SSHClient('grappa')
+        return ssh_client.sync_directory(local_path, remote_path,
+                                         n_channels=n_channels,
+                                         manifest_file=manifest_file)
     timestamp = int(time.time())
     remote_filename = remote_filename.replace('.tar.gz', f'_{timestamp}.tar.gz')
     remote_path = os.path.join(remote_folder, f'run_{run_number:05d}',
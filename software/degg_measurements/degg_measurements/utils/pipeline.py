@@ -0,0 +1,200 @@
+import re
+import time
+import threading
+import traceback
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from degg_measurements.utils.load_dict import load_run_json, load_degg_dict
+
+# measurement key prefix in the D-Egg json -> analysis name used by
+# trigger_remote_analysis / remote_analysis_wrapper
+MEASUREMENT_TYPE_TO_ANALYSIS = {
+    'DarkrateScalerMeasurement': 'darkrate',
+    'DoublePulse': 'double_pulse',
+    'FlasherCheck': 'flasher_chargestamp',
+    'GainMeasurement': 'gain',
+    'LinearityMeasurement': 'linearity',
+    'OnlineMon': 'quick_monitoring',
+    'SpeMeasurement': 'spe',
+    'TransitTimeSpread': 'tts',
+    'DeltaTMeasurement': 'dt',
+    'AdvancedMonitoring': 'detailed_monitoring',
+}
+
+_KEY_PATTERN = re.compile(r'^([A-Za-z]+)_(\d{2,4})$')
+
+DataReadyEvent = namedtuple(
+    'DataReadyEvent',
+    ['task_title', 'run_file', 'degg_name', 'degg_file',
+     'measurement_key', 'measurement_type', 'measurement_number'])
+
+
+def get_measurement_keys(run_file):
+    '''
+    Returns {degg_file: set of measurement keys} for all D-Eggs of the
+    run. Keys are collected from the top level and from the PMT dicts.
+    '''
+    keys = {}
+    for degg_file in load_run_json(run_file):
+        degg_dict = load_degg_dict(degg_file)
+        degg_keys = set()
+        for dct in [degg_dict, degg_dict.get('LowerPmt', {}),
+                    degg_dict.get('UpperPmt', {})]:
+            degg_keys.update(k for k in dct.keys() if _KEY_PATTERN.match(k))
+        keys[degg_file] = (degg_dict.get('DEggSerialNumber', degg_file),
+                           degg_keys)
+    return keys
+
+
+def diff_measurement_keys(task_title, run_file, before, after):
+    '''DataReadyEvents for all keys in after that are not in before'''
+    events = []
+    for degg_file, (degg_name, keys) in after.items():
+        old_keys = before.get(degg_file, (None, set()))[1]
+        for key in sorted(keys - old_keys):
+            meas_type, meas_number = _KEY_PATTERN.match(key).groups()
+            events.append(DataReadyEvent(task_title, run_file, degg_name,
+                                         degg_file, key, meas_type,
+                                         int(meas_number)))
+    return events
+
+
+class AnalysisPipeline(object):
+    '''
+    Runs analyses and backups in a bounded pool of worker processes
+    while the scheduler continues with the next DAQ task.
+
+    * `submit` runs a (picklable, module level) function in the pool.
+    * DAQ tasks emit DataReadyEvents (one per D-Egg and new measurement
+      key), handlers registered with `add_handler` turn them into
+      submissions. With `auto_analysis` the matching remote analysis
+      is triggered once per measurement type and number.
+    * Backups are coalesced: while one is queued or running, further
+      requests only mark that another backup is needed afterwards.
+
+    Worker processes are used so the analyses (numpy, matplotlib) do
+    not compete with the DAQ threads for the GIL; `max_workers` bounds
+    how much of the machine they can take.
+    '''
+    def __init__(self, max_workers=2, auto_analysis=False):
+        if max_workers < 1:
+            raise ValueError(f'max_workers must be >= 1, not {max_workers}!')
+        self.max_workers = max_workers
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context('spawn'))
+        self._lock = threading.Lock()
+        self._pending = []
+        self._handlers = []
+        self._submitted_analyses = set()
+        self._backup = None
+        self._backup_again = None
+        if auto_analysis:
+            self.add_handler(self.remote_analysis_handler)
+
+    def add_handler(self, handler):
+        '''handler(pipeline, event) is called for every DataReadyEvent'''
+        self._handlers.append(handler)
+
+    def submit(self, title, func, *args, **kwargs):
+        future = self._executor.submit(func, *args, **kwargs)
+        with self._lock:
+            self._pending.append((title, future))
+        return future
+
+    def data_ready(self, events):
+        for event in events:
+            for handler in self._handlers:
+                handler(self, event)
+
+    def remote_analysis_handler(self, pipeline, event):
+        from degg_measurements.analysis.trigger_remote_analysis import trigger_remote_wrapper
+        analysis = MEASUREMENT_TYPE_TO_ANALYSIS.get(event.measurement_type, None)
+        if analysis is None:
+            return
+        # the analyses run over all D-Eggs of the run
+        key = (analysis, event.measurement_number)
+        if key in self._submitted_analyses:
+            return
+        self._submitted_analyses.add(key)
+        self.submit(f'{analysis}_{event.measurement_number:02d}',
+                    trigger_remote_wrapper, event.run_file, analysis,
+                    event.measurement_number)
+
+    def submit_backup(self, task, kwargs):
+        with self._lock:
+            if self._backup is not None and not self._backup.done():
+                self._backup_again = (task, kwargs)
+                return self._backup
+        backup = self.submit('backup', task, **kwargs)
+        with self._lock:
+            self._backup = backup
+        backup.add_done_callback(self._rerun_backup)
+        return backup
+
+    def _rerun_backup(self, future):
+        with self._lock:
+            again = self._backup_again
+        if again is None:
+            return
+        # _backup_again is only cleared once the new backup is pending,
+        # so wait() can not miss it
+        task, kwargs = again
+        new_backup = self.submit('backup', task, **kwargs)
+        with self._lock:
+            self._backup = new_backup
+            if self._backup_again is again:
+                self._backup_again = None
+        new_backup.add_done_callback(self._rerun_backup)
+
+    def collect(self):
+        '''
+        Returns [(title, success, traceback or None), ...] of all
+        submissions finished since the last call
+        '''
+        with self._lock:
+            done = [(t, f) for t, f in self._pending if f.done()]
+            self._pending = [(t, f) for t, f in self._pending
+                             if not f.done()]
+        results = []
+        for title, future in done:
+            err = future.exception()
+            if err is None:
+                results.append((title, True, None))
+            else:
+                results.append((title, False, ''.join(
+                    traceback.format_exception(type(err), err,
+                                               err.__traceback__))))
+        return results
+
+    def n_pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def wait(self):
+        '''block until everything submitted so far (and any coalesced
+        backup) has finished, returns the collected results'''
+        results = []
+        while True:
+            with self._lock:
+                futures = [f for _, f in self._pending]
+                again = self._backup_again
+            if len(futures) == 0 and again is None:
+                break
+            if len(futures) == 0:
+                # a coalesced backup is about to be submitted
+                time.sleep(0.1)
+            for future in futures:
+                try:
+                    future.result()
+                except Exception:
+                    pass
+            results += self.collect()
+        return results + self.collect()
+
+    def shutdown(self):
+        results = self.wait()
+        self._executor.shutdown(wait=True)
+        return results
@@ -7,6 +7,19 @@ from matplotlib import pyplot as plt
 from warnings import warn
 from datetime import datetime
 
+def _parameter_dict(parameters):
+    parameter_dict = {}
+    parameter_keys = parameters.keys[:]
+    parameter_vals = parameters.values[:]
+    for key, val in zip(parameter_keys, parameter_vals):
+        key = key.decode('utf-8')
+        val = val.decode('utf-8')
+        try:
+            parameter_dict[key] = int(val)
+        except ValueError:
+            parameter_dict[key] = val
+    return parameter_dict
+
 def read_data(filename, ignoreParams=False):
     with tables.open_file(filename) as open_file:
         try:
@@ -20,15 +33,7 @@ def read_data(filename, ignoreParams=False):
 
         parameter_dict = {}
         if not ignoreParams:
-            parameter_keys = parameters.keys[:]
-            parameter_vals = parameters.values[:]
-            for key, val in zip(parameter_keys, parameter_vals):
-                key = key.decode('utf-8')
-                val = val.decode('utf-8')
-                try:
-                    parameter_dict[key] = int(val)
-                except ValueError:
-                    parameter_dict[key] = val
+            parameter_dict = _parameter_dict(parameters)
 
         event_id = data.col('event_id')
         time = data.col('time')
@@ -51,3 +56,29 @@ def read_data(filename, ignoreParams=False):
 
     return event_id, time, waveforms, timestamp, pc_time, datetime_timestamp, parameter_dict
 
+def read_parameters(filename):
+    with tables.open_file(filename) as open_file:
+        try:
+            parameters = open_file.get_node('/parameters')
+        except:
+            raise IOError(f"{filename} missing /parameters")
+        return _parameter_dict(parameters)
+
+def iter_data_chunks(filename, columns=('waveform',), chunk_size=10000):
+    '''
+    Reads the columns of /data in blocks of chunk_size rows (all rows
+    at once for chunk_size=None) and yields (start_row, {column: array}),
+    so that the waveforms of a file never have to be in memory at once.
+    '''
+    with tables.open_file(filename) as open_file:
+        try:
+            data = open_file.get_node('/data')
+        except:
+            raise IOError(f"{filename} missing /data")
+        n_rows = data.nrows
+        if chunk_size is None:
+            chunk_size = max(n_rows, 1)
+        for start in range(0, n_rows, chunk_size):
+            stop = min(start + chunk_size, n_rows)
+            yield start, {column: data.read(start, stop, field=column)
+                          for column in columns}
@@ -3,6 +3,14 @@ from importlib import import_module
 import os
 
 from degg_measurements.utils.master_tools import open_json
+from degg_measurements.utils.pipeline import AnalysisPipeline
+from degg_measurements.utils.pipeline import get_measurement_keys
+from degg_measurements.utils.pipeline import diff_measurement_keys
+
+##tasks run in the background by default if the pipeline is enabled
+BACKGROUND_TASKS = ['trigger_remote_wrapper', 'analysis_wrapper']
+##tasks waiting for all background work, e.g. because they need the results
+WAIT_FOR_PIPELINE_TASKS = ['validate_gain', 'manual_input']
 
 class Scheduler(object):
     def __init__(self, recover=False):
@@ -12,6 +20,9 @@ class Scheduler(object):
         self._backup_task = None
         self._backup_kwargs = None
         self._backup_list = []
+        self._background_list = []
+        self._pipeline = None
+        self._pipeline_results = []
         self._run_file = None
         self._verbose = False
         self._recover = recover
@@ -127,6 +138,8 @@ class Scheduler(object):
         self._task_list = new_tasks
         self._task_arg_list = new_args
         self._task_title_list = new_tasks_title
+        self._backup_list = self._backup_list[new_start_ind:]
+        self._background_list = self._background_list[new_start_ind:]
 
         '''
         for r in r_list:
@@ -151,28 +164,83 @@ class Scheduler(object):
         task_arg_list = self._task_arg_list
         return task_arg_list
 
-    def add_task(self, task, title, args=None, run_backup=False):
+    def add_task(self, task, title, args=None, run_backup=False,
+                 background=None):
         self._task_list.append(task)
         self._task_title_list.append(title)
         if args is None:
             print(f"Warning {task} has arguments None")
         self._task_arg_list.append(args)
         self._backup_list.append(run_backup)
+        if background is None:
+            background = getattr(task, '__name__', '') in BACKGROUND_TASKS
+        self._background_list.append(background)
+
+    ##----------------------------------------------------------------------
+    ##pipeline mode: analyses and backups run in worker processes while
+    ##the next DAQ task takes data
+    ##----------------------------------------------------------------------
+    def enable_pipeline(self, max_workers=2, auto_analysis=False):
+        self._pipeline = AnalysisPipeline(max_workers=max_workers,
+                                          auto_analysis=auto_analysis)
+        return self._pipeline
+
+    def get_pipeline(self):
+        return self._pipeline
+
+    def wait_pipeline(self):
+        if self._pipeline is not None:
+            self._pipeline_results += self._pipeline.wait()
+
+    def collect_pipeline_results(self):
+        if self._pipeline is None:
+            return []
+        results = self._pipeline_results + self._pipeline.collect()
+        self._pipeline_results = []
+        return results
+
+    def shutdown_pipeline(self):
+        ##results stay available from collect_pipeline_results
+        if self._pipeline is not None:
+            self._pipeline_results += self._pipeline.shutdown()
 
     def execute_task(self, task_title):
+        '''
+        Returns True if the task ran, False if it was handed to the
+        pipeline (its result comes from collect_pipeline_results)
+        '''
         task_list = self._task_list
         task_title_list = self._task_title_list
         task_arg_list = self._task_arg_list
         index = task_title_list.index(task_title)
-        if len(task_arg_list[index]) == 0:
-            task_list[index](self._run_file)
-        else:
-            task_list[index](self._run_file, *task_arg_list[index])
+        pipeline = self._pipeline
+        task = task_list[index]
+        args = task_arg_list[index]
+        if args is None:
+            args = []
+
+        if pipeline is not None:
+            if self._background_list[index]:
+                pipeline.submit(task_title, task, self._run_file, *args)
+                return False
+            if getattr(task, '__name__', '') in WAIT_FOR_PIPELINE_TASKS:
+                self.wait_pipeline()
+            keys_before = get_measurement_keys(self._run_file)
+
+        task(self._run_file, *args)
+
+        if pipeline is not None:
+            keys_after = get_measurement_keys(self._run_file)
+            pipeline.data_ready(diff_measurement_keys(
+                task_title, self._run_file, keys_before, keys_after))
         if self._backup_task is None:
             raise ValueError('Scheduler backup_task not configured!')
-        elif self._backup_task is not None:
-            if self._backup_list[index]:
+        if self._backup_list[index]:
+            if pipeline is not None:
+                pipeline.submit_backup(self._backup_task, self._backup_kwargs)
+            else:
                 self._backup_task(**self._backup_kwargs)
+        return True
 
     def execute_analysis(self, task_title):
         task_list = self._task_list
@@ -240,6 +308,7 @@ class Scheduler(object):
             args = []
             _task = False
             _frag = False
+            background = None
             for key in keys:
                 if key == 'task':
                     action = config[sec]['task']
@@ -252,6 +321,9 @@ class Scheduler(object):
                 if key == 'run_backup':
                     run_backup = bool(config[sec]['run_backup'])
                     continue
+                if key == 'background':
+                    background = config[sec]['background'].lower() == 'true'
+                    continue
                 if key == 'package':
                     continue
                 ##get the argument values
@@ -270,7 +342,8 @@ class Scheduler(object):
             module = import_module(str(config[sec]['package']))
             func = getattr(module, action)
             if _task == True:
-                self.add_task(func, sec, args, run_backup=run_backup)
+                self.add_task(func, sec, args, run_backup=run_backup,
+                              background=background)
             if _frag == True:
                 func(self, sec, *args)
 
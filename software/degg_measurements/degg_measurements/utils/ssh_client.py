@@ -6,6 +6,7 @@ import uuid
 from getpass import getuser, getpass
 
 from degg_measurements.utils import rerun_after_exception
+from degg_measurements.utils.transfer import TransferEngine
 from paramiko.ssh_exception import SSHException
 
 
@@ -208,6 +209,48 @@ class SSHClient(object):
             sftp.put(local_path, remote_path)
             return remote_path
 
+    @rerun_after_exception(SSHException, 2)
+    def send_files(self,
+                   local_paths,
+                   remote_paths,
+                   hostname=None,
+                   username=None,
+                   force=False,
+                   n_channels=4,
+                   checksum=False,
+                   manifest_file=None):
+        '''
+        Send many files over one connection, see TransferEngine.
+        remote_paths have to be full file paths.
+        '''
+        with self(hostname=hostname, username=username):
+            engine = TransferEngine(self,
+                                    n_channels=n_channels,
+                                    checksum=checksum,
+                                    manifest_file=manifest_file)
+            return engine.send_files(local_paths, remote_paths, force=force)
+
+    @rerun_after_exception(SSHException, 2)
+    def sync_directory(self,
+                       local_path,
+                       remote_path,
+                       hostname=None,
+                       username=None,
+                       force=False,
+                       n_channels=4,
+                       checksum=False,
+                       manifest_file=None):
+        '''
+        Mirror local_path into remote_path, only sending files that are
+        missing or differ on the remote side, see TransferEngine.
+        '''
+        with self(hostname=hostname, username=username):
+            engine = TransferEngine(self,
+                                    n_channels=n_channels,
+                                    checksum=checksum,
+                                    manifest_file=manifest_file)
+            return engine.sync_directory(local_path, remote_path, force=force)
+
     def get_file(self,
                  remote_path,
                  local_path,
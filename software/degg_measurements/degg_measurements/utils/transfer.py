@@ -0,0 +1,361 @@
+import os
+import io
+import json
+import stat
+import shlex
+import tarfile
+import hashlib
+import threading
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import paramiko
+
+
+class TransferManifest(object):
+    '''
+    Local record of files that were already shipped to the remote side.
+    Entries are keyed by remote path and store size, mtime and
+    (optionally) the md5 of the local file at the time of the upload.
+    add only updates the entries in memory, save rewrites the file
+    atomically. The engine saves after every completed batch or large
+    file, so an interrupted transfer can be resumed from it.
+    '''
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._entries = {}
+        if filename is not None and os.path.isfile(filename):
+            with open(filename, 'r') as open_file:
+                try:
+                    self._entries = json.load(open_file)
+                except json.decoder.JSONDecodeError:
+                    print(f'Corrupt transfer manifest {filename}, '
+                          'starting from scratch.')
+                    self._entries = {}
+
+    def is_done(self, local_path, remote_path):
+        entry = self._entries.get(remote_path, None)
+        if entry is None:
+            return False
+        info = os.stat(local_path)
+        return (entry['size'] == info.st_size and
+                entry['mtime'] == info.st_mtime)
+
+    def add(self, local_path, remote_path, md5=None):
+        info = os.stat(local_path)
+        with self._lock:
+            self._entries[remote_path] = {
+                'local_path': os.path.abspath(local_path),
+                'size': info.st_size,
+                'mtime': info.st_mtime,
+                'md5': md5}
+
+    def save(self):
+        if self.filename is None:
+            return
+        with self._lock:
+            tmp_file = f'{self.filename}.tmp'
+            with open(tmp_file, 'w') as open_file:
+                json.dump(self._entries, open_file, indent=4)
+            os.replace(tmp_file, self.filename)
+
+    def __contains__(self, remote_path):
+        return remote_path in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def md5_local(path, chunk_size=1 << 20):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as open_file:
+        for chunk in iter(lambda: open_file.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class TransferEngine(object):
+    '''
+    Ship many files to one remote host over a single SSH transport.
+
+    * Files that were sent before (according to the manifest) are sent
+      again if their local size or mtime changed since, overwriting the
+      remote copy.
+    * Other files that are already on the remote side with the same
+      size (and md5 if `checksum` is set) are skipped. The remote state is
+      queried with one listdir per remote directory and one md5sum
+      call per batch instead of a stat per file.
+    * Files smaller than `small_file_size` are packed into tarballs
+      of at most `batch_size` bytes in memory, uploaded in one go and
+      unpacked on the remote side.
+    * Large files are uploaded in parallel using `n_channels` SFTP
+      channels, to a `.part` file that is appended to if a previous
+      upload was interrupted, and renamed once complete.
+    * Completed items are recorded in a TransferManifest so that a
+      crashed transfer can be resumed without talking to the remote.
+
+    The engine expects an already connected degg_measurements SSHClient.
+    '''
+    def __init__(self, ssh_client, n_channels=4, small_file_size=1 << 20,
+                 batch_size=64 << 20, checksum=False, manifest_file=None,
+                 verbose=False):
+        if n_channels < 1:
+            raise ValueError(f'n_channels must be >= 1, not {n_channels}!')
+        self.ssh_client = ssh_client
+        self.n_channels = n_channels
+        self.small_file_size = small_file_size
+        self.batch_size = batch_size
+        self.checksum = checksum
+        self.manifest = TransferManifest(manifest_file)
+        self.verbose = verbose
+        self._local = threading.local()
+        self._sftp_lock = threading.Lock()
+        self._sftp_clients = []
+
+    @property
+    def transport(self):
+        transport = self.ssh_client.transport
+        if transport is None or not transport.is_active():
+            raise paramiko.SSHException('SSH transport is not connected!')
+        return transport
+
+    def _sftp(self):
+        # One SFTP channel per worker thread, all on the same transport
+        sftp = getattr(self._local, 'sftp', None)
+        if sftp is None:
+            sftp = paramiko.SFTPClient.from_transport(self.transport)
+            self._local.sftp = sftp
+            with self._sftp_lock:
+                self._sftp_clients.append(sftp)
+        return sftp
+
+    def close(self):
+        with self._sftp_lock:
+            for sftp in self._sftp_clients:
+                sftp.close()
+            self._sftp_clients = []
+        self._local = threading.local()
+
+    def _exec(self, cmd):
+        channel = self.transport.open_session()
+        try:
+            channel.exec_command(cmd)
+            stdout = channel.makefile('r').read()
+            exit_status = channel.recv_exit_status()
+            if exit_status != 0:
+                raise RuntimeError(
+                    f'{cmd} finished with {exit_status}!\n'
+                    f'stderr: {channel.recv_stderr(10000)}')
+        finally:
+            channel.close()
+        if isinstance(stdout, bytes):
+            stdout = stdout.decode()
+        return stdout
+
+    def _remote_sizes(self, remote_dirs):
+        sizes = {}
+        sftp = self._sftp()
+        for remote_dir in remote_dirs:
+            try:
+                attrs = sftp.listdir_attr(remote_dir)
+            except IOError:
+                continue
+            for attr in attrs:
+                if stat.S_ISDIR(attr.st_mode):
+                    continue
+                sizes[os.path.join(remote_dir, attr.filename)] = attr.st_size
+        return sizes
+
+    def _remote_md5(self, remote_paths):
+        md5s = {}
+        remote_paths = list(remote_paths)
+        # Keep the command line at a reasonable length
+        for i in range(0, len(remote_paths), 200):
+            chunk = remote_paths[i:i + 200]
+            cmd = 'md5sum ' + ' '.join(shlex.quote(p) for p in chunk)
+            for line in self._exec(cmd).splitlines():
+                checksum, path = line.split(None, 1)
+                md5s[path.lstrip('*')] = checksum
+        return md5s
+
+    def _plan(self, pairs, force):
+        todo = []
+        skipped = []
+        plan = []
+        for local_path, remote_path in pairs:
+            if self.manifest.is_done(local_path, remote_path):
+                skipped.append(remote_path)
+            elif remote_path in self.manifest:
+                # Sent before and changed locally since, mirror it
+                plan.append((local_path, remote_path, 0))
+            else:
+                todo.append((local_path, remote_path))
+
+        remote_dirs = set(os.path.dirname(r) for _, r in todo)
+        remote_sizes = self._remote_sizes(remote_dirs)
+
+        same_size = []
+        for local_path, remote_path in todo:
+            remote_size = remote_sizes.get(remote_path, None)
+            if remote_size is None:
+                plan.append((local_path, remote_path,
+                             remote_sizes.get(f'{remote_path}.part', 0)))
+            elif remote_size == os.path.getsize(local_path):
+                same_size.append((local_path, remote_path))
+            elif force:
+                plan.append((local_path, remote_path, 0))
+            else:
+                print(f'Remote file {remote_path} already exists with a '
+                      'different size (use "force" to override). Skipping it.')
+                skipped.append(remote_path)
+
+        if self.checksum and len(same_size) > 0:
+            remote_md5 = self._remote_md5(r for _, r in same_size)
+            for local_path, remote_path in same_size:
+                local_md5 = md5_local(local_path)
+                if remote_md5.get(remote_path, None) == local_md5:
+                    self.manifest.add(local_path, remote_path, md5=local_md5)
+                    skipped.append(remote_path)
+                elif force:
+                    plan.append((local_path, remote_path, 0))
+                else:
+                    print(f'Remote file {remote_path} already exists with a '
+                          'different checksum (use "force" to override). '
+                          'Skipping it.')
+                    skipped.append(remote_path)
+        else:
+            for local_path, remote_path in same_size:
+                self.manifest.add(local_path, remote_path)
+                skipped.append(remote_path)
+        self.manifest.save()
+        return plan, skipped
+
+    def _make_batches(self, small_files):
+        by_dir = defaultdict(list)
+        for local_path, remote_path in small_files:
+            by_dir[os.path.dirname(remote_path)].append(
+                (local_path, remote_path))
+        batches = []
+        for remote_dir, files in by_dir.items():
+            batch = []
+            batch_bytes = 0
+            for local_path, remote_path in files:
+                size = os.path.getsize(local_path)
+                if len(batch) > 0 and batch_bytes + size > self.batch_size:
+                    batches.append((remote_dir, batch))
+                    batch = []
+                    batch_bytes = 0
+                batch.append((local_path, remote_path))
+                batch_bytes += size
+            if len(batch) > 0:
+                batches.append((remote_dir, batch))
+        return batches
+
+    def _send_batch(self, remote_dir, batch):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tar:
+            for local_path, remote_path in batch:
+                tar.add(local_path, arcname=os.path.basename(remote_path))
+        buf.seek(0)
+        remote_tarball = os.path.join(remote_dir,
+                                      f'.{uuid.uuid4()}.transfer.tar')
+        self._sftp().putfo(buf, remote_tarball)
+        self._exec(f'tar -xf {shlex.quote(remote_tarball)} '
+                   f'-C {shlex.quote(remote_dir)} && '
+                   f'rm -f {shlex.quote(remote_tarball)}')
+        for local_path, remote_path in batch:
+            self.manifest.add(local_path, remote_path)
+        self.manifest.save()
+        return [remote_path for _, remote_path in batch]
+
+    def _send_large(self, local_path, remote_path, offset):
+        sftp = self._sftp()
+        part_path = f'{remote_path}.part'
+        size = os.path.getsize(local_path)
+        if offset > size:
+            offset = 0
+        mode = 'ab' if offset > 0 else 'wb'
+        if self.verbose and offset > 0:
+            print(f'Resuming {remote_path} at {offset}/{size} bytes')
+        with open(local_path, 'rb') as local_file, \
+                sftp.open(part_path, mode) as remote_file:
+            remote_file.set_pipelined(True)
+            local_file.seek(offset)
+            for chunk in iter(lambda: local_file.read(1 << 20), b''):
+                remote_file.write(chunk)
+        if sftp.stat(part_path).st_size != size:
+            raise IOError(f'Size mismatch after uploading {remote_path}!')
+        sftp.posix_rename(part_path, remote_path)
+        self.manifest.add(local_path, remote_path)
+        self.manifest.save()
+        return [remote_path]
+
+    def send_files(self, local_paths, remote_paths, force=False):
+        '''
+        Copy local_paths[i] to remote_paths[i] (full remote filenames).
+        Returns a dict with the lists of sent and skipped remote paths.
+        '''
+        if len(local_paths) != len(remote_paths):
+            raise ValueError('local_paths and remote_paths must have '
+                             'the same length!')
+        pairs = list(zip(local_paths, remote_paths))
+        for local_path, _ in pairs:
+            if not os.path.isfile(local_path):
+                raise IOError(f'{local_path} is not a file!')
+
+        remote_dirs = sorted(set(os.path.dirname(r) for _, r in pairs))
+        if len(remote_dirs) > 0:
+            self._exec('mkdir -p ' +
+                       ' '.join(shlex.quote(d) for d in remote_dirs))
+
+        plan, skipped = self._plan(pairs, force)
+        small_files = [(l, r) for l, r, offset in plan
+                       if os.path.getsize(l) < self.small_file_size
+                       and offset == 0]
+        small_set = set(r for _, r in small_files)
+        large_files = [(l, r, offset) for l, r, offset in plan
+                       if r not in small_set]
+
+        sent = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.n_channels) as executor:
+                futures = [
+                    executor.submit(self._send_batch, remote_dir, batch)
+                    for remote_dir, batch in self._make_batches(small_files)]
+                futures += [executor.submit(self._send_large, l, r, offset)
+                            for l, r, offset in large_files]
+                for future in futures:
+                    sent.extend(future.result())
+        finally:
+            self.close()
+
+        if self.verbose:
+            print(f'Transferred {len(sent)} files, skipped {len(skipped)}.')
+        return {'sent': sent, 'skipped': skipped}
+
+    def sync_directory(self, local_path, remote_path, force=False,
+                       exclude=()):
+        '''
+        Mirror the directory tree below local_path into remote_path.
+        '''
+        local_path = os.path.abspath(local_path)
+        if not os.path.isdir(local_path):
+            raise ValueError(f'{local_path} is not a directory!')
+        exclude = set(os.path.abspath(e) for e in exclude)
+        if self.manifest.filename is not None:
+            exclude.add(os.path.abspath(self.manifest.filename))
+            exclude.add(os.path.abspath(f'{self.manifest.filename}.tmp'))
+        local_paths = []
+        remote_paths = []
+        for dirpath, _, filenames in os.walk(local_path):
+            rel_dir = os.path.relpath(dirpath, local_path)
+            for filename in sorted(filenames):
+                local_file = os.path.join(dirpath, filename)
+                if local_file in exclude:
+                    continue
+                local_paths.append(local_file)
+                remote_paths.append(os.path.normpath(
+                    os.path.join(remote_path, rel_dir, filename)))
+        return self.send_files(local_paths, remote_paths, force=force)
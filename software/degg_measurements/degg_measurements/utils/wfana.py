@@ -2,6 +2,7 @@ import sys
 import os.path
 import numpy as np
 from scipy import integrate, interpolate
+from scipy.signal import lfilter
 import tqdm
 from degg_measurements.utils import CALIBRATION_FACTORS
 
@@ -194,3 +195,202 @@ def get_highest_density_region_charge(waveforms,
     return np.max(charges, axis=1)
 
 
+# p0 + p1 / (1 + exp(-T / p2)), fitted in the droop calibration,
+# mean values over all PMTs
+DROOP_TAU_PARAMS = (4.536475587728131e-06, 2.728386839836242e-05,
+                    29.50883205770401)
+UNDERSHOOT_TAU_PARAMS = (4.246080961487583e-06, 2.7143255325039317e-05,
+                         30.620432988018425)
+
+
+def droop_time_constant(temperature, params=DROOP_TAU_PARAMS):
+    '''
+    Time constant in s of the droop (or with UNDERSHOOT_TAU_PARAMS of
+    the undershoot) at a temperature in deg C. params can be replaced
+    by the fit values of a single PMT.
+    '''
+    p0, p1, p2 = params
+    return p0 + p1 / (1 + np.exp(-np.asarray(temperature) / p2))
+
+
+def droop_filter_coefficients(tau, dt):
+    '''
+    (b, a) of the first order IIR filter equivalent to the recursive
+    droop correction
+
+        s_j = x_{j-1} + exp(-dt/tau) * s_{j-1}
+        x_j = y_j / A + A * dt / tau * s_j
+
+    with A = tau / dt * (1 - exp(-dt/tau)) and x_0 = y_0 / A.
+    '''
+    decay = np.exp(-dt / tau)
+    A = (tau / dt) * (1 - decay)
+    b = np.array([1 / A, -decay / A])
+    a = np.array([1., -(decay + A * dt / tau)])
+    return b, a
+
+
+def correct_droop(waveforms, tau, dt=CALIBRATION_FACTORS.fpga_clock_to_s):
+    '''
+    Parameters
+    ----------
+    waveforms : np.array shape: (n_bins,) or (n_waveforms, n_bins)
+        Baseline subtracted waveforms, filtered along the last axis.
+    tau : float or np.array shape: (n_waveforms,)
+        Droop (or undershoot) time constant in s. Waveforms sharing the
+        same value are filtered together, e.g. pass one tau per PMT
+        repeated for all of its waveforms.
+    dt : float
+        Sampling interval in s.
+
+    Returns
+    -------
+    corrected : np.array, same shape as waveforms
+    '''
+    waveforms = np.asarray(waveforms, dtype=float)
+    tau = np.asarray(tau, dtype=float)
+    if tau.ndim == 0:
+        b, a = droop_filter_coefficients(tau, dt)
+        return lfilter(b, a, waveforms, axis=-1)
+    if tau.shape != waveforms.shape[:-1]:
+        raise ValueError(f'tau has shape {tau.shape}, expected a scalar or '
+                         f'{waveforms.shape[:-1]}!')
+    corrected = np.empty_like(waveforms)
+    unique_taus, inverse = np.unique(tau, return_inverse=True)
+    inverse = inverse.reshape(tau.shape)
+    for i, tau_i in enumerate(unique_taus):
+        mask = inverse == i
+        b, a = droop_filter_coefficients(tau_i, dt)
+        corrected[mask] = lfilter(b, a, waveforms[mask], axis=-1)
+    return corrected
+
+
+def _local_maxima_runs(waveforms):
+    '''
+    Local maxima along the last axis of a (n_waveforms, n_bins) array
+    with the plateau handling of scipy.signal.find_peaks.
+
+    Returns (rows, left, right, mid): the waveform of each maximum, the
+    first and last bin of its plateau and its (middle) position, in
+    row-major order.
+    '''
+    n_wfs, n_bins = waveforms.shape
+    # column j holds sign(wf[j] - wf[j-1]), columns 0 and n_bins are
+    # row boundaries, which stop the fills below
+    slopes = np.zeros((n_wfs, n_bins + 1), dtype=np.int8)
+    slopes[:, 1:-1] = np.sign(np.diff(waveforms, axis=1))
+    marker = slopes != 0
+    marker[:, 0] = True
+    marker[:, -1] = True
+    slopes = slopes.ravel()
+    marker = marker.ravel()
+    index = np.arange(len(slopes), dtype=np.int64)
+    # last non-zero slope left of / first one right of each bin
+    last = np.where(marker, index, 0)
+    np.maximum.accumulate(last, out=last)
+    following = np.where(marker, index, len(slopes) - 1)[::-1]
+    following = np.minimum.accumulate(following)[::-1]
+    rising = (slopes[last] > 0).reshape(n_wfs, n_bins + 1)
+    falling = (slopes[following] < 0).reshape(n_wfs, n_bins + 1)
+    member = rising[:, :-1] & falling[:, 1:]
+
+    edge = np.zeros((n_wfs, n_bins + 1), dtype=bool)
+    edge[:, 1:-1] = member[:, 1:] != member[:, :-1]
+    edge[:, 0] = member[:, 0]
+    edge[:, -1] = member[:, -1]
+    rows, edges = np.nonzero(edge)
+    rows = rows[::2]
+    left = edges[::2]
+    right = edges[1::2] - 1
+    return rows, left, right, (left + right) // 2
+
+
+def find_peaks_batch(waveforms, height=None):
+    '''
+    Vectorised scipy.signal.find_peaks(wf, height=height) for every
+    waveform of a (n_waveforms, n_bins) array.
+
+    Returns
+    -------
+    rows, peak_ind : np.array
+        Waveform index and bin of every peak, sorted by waveform and bin.
+    '''
+    waveforms = np.atleast_2d(waveforms)
+    rows, left, right, mid = _local_maxima_runs(waveforms)
+    if height is not None:
+        keep = waveforms[rows, mid] >= height
+        rows, mid = rows[keep], mid[keep]
+    return rows, mid
+
+
+def find_double_peaks(waveforms, threshold, baseline=0., chunk_size=10000):
+    '''
+    Peaks above threshold and the valley between the first two of them
+    for every waveform, as done per waveform with find_peaks in the
+    double pulse analysis.
+
+    Parameters
+    ----------
+    waveforms : np.array shape: (n_waveforms, n_bins)
+    threshold : float
+        Minimum height of a peak after subtracting baseline.
+    baseline : float or np.array shape: (n_waveforms,)
+    chunk_size : int
+        Number of waveforms processed at once, limits the memory used.
+
+    Returns
+    -------
+    dict of np.arrays
+        'n_peaks' (n_waveforms,), 'peak_ind' (n_waveforms, 2) with -1
+        and 'peak_height' (n_waveforms, 2) with NaN where there are
+        fewer peaks, 'valley' (n_waveforms,) value at the first local
+        minimum between the first two peaks (0 if there is none).
+    '''
+    n_wfs = len(waveforms)
+    result = {
+        'n_peaks': np.zeros(n_wfs, dtype=int),
+        'peak_ind': np.full((n_wfs, 2), -1, dtype=int),
+        'peak_height': np.full((n_wfs, 2), np.nan),
+        'valley': np.zeros(n_wfs),
+    }
+    for start in range(0, n_wfs, chunk_size):
+        stop = min(start + chunk_size, n_wfs)
+        wz = np.asarray(waveforms[start:stop], dtype=float)
+        if isinstance(baseline, Iterable):
+            wz = wz - np.asarray(baseline)[start:stop, np.newaxis]
+        else:
+            wz = wz - baseline
+        n_chunk, n_bins = wz.shape
+
+        rows, peak_ind = find_peaks_batch(wz, height=threshold)
+        n_peaks = np.bincount(rows, minlength=n_chunk)
+        first = np.cumsum(n_peaks) - n_peaks
+        has_one = n_peaks >= 1
+        has_two = n_peaks >= 2
+        p0 = np.where(has_one, peak_ind[np.minimum(first, len(rows) - 1)], -1)
+        p1 = np.where(has_two, peak_ind[np.minimum(first + 1, len(rows) - 1)], -1)
+
+        ##valley: first minimum lying completely inside wz[p0:p1],
+        ##like find_peaks(-wz[p0:p1])
+        v_rows, v_left, v_right, v_mid = _local_maxima_runs(-wz[has_two])
+        v_rows = np.nonzero(has_two)[0][v_rows]
+        key = v_rows * n_bins + v_left
+        idx = np.searchsorted(key, np.arange(n_chunk) * n_bins + p0 + 1)
+        idx_c = np.minimum(idx, max(len(key) - 1, 0))
+        valid = has_two & (idx < len(key))
+        if len(key) > 0:
+            valid &= (v_rows[idx_c] == np.arange(n_chunk)) & \
+                     (v_right[idx_c] <= p1 - 2)
+            valley = np.where(valid, wz[np.arange(n_chunk), v_mid[idx_c]], 0.)
+        else:
+            valley = np.zeros(n_chunk)
+
+        ind = np.stack([p0, p1], axis=1)
+        height = np.where(ind >= 0,
+                          np.take_along_axis(wz, np.maximum(ind, 0), axis=1),
+                          np.nan)
+        result['n_peaks'][start:stop] = n_peaks
+        result['peak_ind'][start:stop] = ind
+        result['peak_height'][start:stop] = height
+        result['valley'][start:stop] = valley
+    return result
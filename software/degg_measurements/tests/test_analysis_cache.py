@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# Tests of the incremental per-file summary cache on text files written
+# into a temporary directory
+#
+
+import os
+import numpy as np
+import pytest
+
+from degg_measurements.analysis.analysis_cache import AnalysisCache
+
+CALLS = []
+
+
+def summarize(sources, params):
+    # module level, so that it can run in a process pool
+    CALLS.append(sources)
+    with open(sources, 'r') as open_file:
+        content = open_file.read()
+    if content.startswith('bad'):
+        return None
+    values = np.array([float(v) for v in content.split()])
+    return {'mean': values.mean(), 'params': params}, {'values': values}
+
+
+def write(path, content):
+    with open(path, 'w') as open_file:
+        open_file.write(content)
+    return str(path)
+
+
+@pytest.fixture
+def files(tmp_path):
+    CALLS.clear()
+    return [write(tmp_path / f'{i}.txt', ' '.join(str(i + j)
+                                                  for j in range(3)))
+            for i in range(4)]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return AnalysisCache(str(tmp_path / 'cache' / 'cache.hdf5'), 'test')
+
+
+def test_miss_then_hit(cache, files):
+    entries = [(f, 'a') for f in files]
+    first = cache.update(entries, summarize, verbose=False)
+    assert len(CALLS) == 4
+    assert list(first['entry']) == [0, 1, 2, 3]
+    assert list(first['mean']) == [1., 2., 3., 4.]
+    np.testing.assert_array_equal(
+        cache.get_array(first['cache_key'][2], 'values'), [2., 3., 4.])
+    assert len(cache.get_array('unknown', 'values')) == 0
+
+    second = cache.update(entries[::-1], summarize, verbose=False)
+    assert len(CALLS) == 4
+    assert list(second['mean']) == [4., 3., 2., 1.]
+    # other parameters are other entries
+    cache.update([(files[0], 'b')], summarize, verbose=False)
+    assert len(CALLS) == 5
+
+
+def test_copied_and_changed_file(tmp_path, cache, files):
+    first = cache.update([(f, '') for f in files], summarize,
+                         verbose=False)
+    copy = write(tmp_path / 'copy.txt', open(files[1]).read())
+    result = cache.update([(copy, '')], summarize, verbose=False)
+    assert len(CALLS) == 4
+    assert result['cache_key'][0] == first['cache_key'][1]
+
+    mtime = os.stat(files[1]).st_mtime
+    write(files[1], '10 20 30')
+    os.utime(files[1], (mtime + 10, mtime + 10))
+    result = cache.update([(f, '') for f in files], summarize,
+                          verbose=False)
+    assert CALLS[4:] == [files[1]]
+    assert list(result['mean']) == [1., 20., 3., 4.]
+
+
+def test_all_none(tmp_path, cache):
+    bad = [write(tmp_path / f'bad{i}.txt', 'bad') for i in range(2)]
+    result = cache.update([(f, '') for f in bad], summarize, verbose=False)
+    assert len(result) == 0
+    assert list(result.columns) == ['cache_key', 'entry']
+
+    good = write(tmp_path / 'good.txt', '1 2')
+    result = cache.update([(f, '') for f in bad + [good]], summarize,
+                          verbose=False)
+    assert list(result['entry']) == [2]
+    assert list(result['mean']) == [1.5]
+
+
+def test_process_pool(cache, files):
+    serial = AnalysisCache(cache.cache_file + '.serial', 'test')
+    expected = serial.update([(f, '') for f in files], summarize,
+                             verbose=False)
+    result = cache.update([(f, '') for f in files], summarize,
+                          verbose=False, n_jobs=2)
+    assert list(result['cache_key']) == list(expected['cache_key'])
+    assert list(result['mean']) == list(expected['mean'])
+    np.testing.assert_array_equal(
+        cache.get_array(result['cache_key'][3], 'values'), [3., 4., 5.])
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+#
+# Tests of the baseline statistics and of the BaselineService block
+# readout and cache against a fake D-Egg session
+#
+
+import time
+import numpy as np
+import pytest
+
+from degg_measurements.utils import CALIBRATION_FACTORS
+from degg_measurements.analysis.baseline.baseline_stats import baseline_stats
+from degg_measurements.analysis.baseline.baseline_stats import ChannelBaseline
+from degg_measurements.daq_scripts import baseline_service
+from degg_measurements.daq_scripts.baseline_service import BaselineService
+from degg_measurements.daq_scripts.baseline_service import \
+    read_forced_trigger_block
+
+BASELINES = (8000., 7900.)
+
+
+class FakeSession:
+    # forced trigger waveforms of both channels, at most 5 per block
+    def __init__(self, noise=3., drift=0., seed=0):
+        self.rnd = np.random.RandomState(seed)
+        self.noise = noise
+        self.drift = drift
+        self.channel = None
+        self.n_samples = None
+        self.n_blocks = 0
+        self.n_streams = 0
+        self.n_ended = 0
+        self.clock = 0
+        self.sensors = {'temperature_sensor': -20.,
+                        'voltage_channel0': 1500.,
+                        'voltage_channel1': 1600.}
+
+    def start(self, channel, n_samples):
+        self.channel = channel
+        self.n_samples = n_samples
+        self.n_streams += 1
+
+    def endStream(self):
+        self.n_ended += 1
+
+    def readWFBlockArrays(self, n_bytes):
+        self.n_blocks += 1
+        channels = np.array([self.channel, 1 - self.channel] * 3)[:5]
+        t = self.clock + 240000 * np.arange(5)
+        self.clock = t[-1] + 240000
+        wfs = (np.array(BASELINES)[channels, np.newaxis] +
+               self.drift * t[:, np.newaxis] *
+               CALIBRATION_FACTORS.fpga_clock_to_s +
+               self.rnd.normal(0, self.noise, (5, self.n_samples)))
+        yield {'channel': channels,
+               'timestamp': t,
+               'waveform': np.round(wfs).astype(np.int64)}
+
+
+@pytest.fixture
+def fake_daq(monkeypatch):
+    def initialize(session, channel, n_samples, **kwargs):
+        session.start(channel, n_samples)
+        return session
+    monkeypatch.setattr(baseline_service, 'initialize', initialize)
+    monkeypatch.setattr(baseline_service, 'readout_sensor',
+                        lambda session, name: session.sensors[name])
+
+
+def test_baseline_stats():
+    rnd = np.random.RandomState(1)
+    wfs = 8000 + rnd.normal(0, 4, (200, 128))
+    # dark pulses in a few waveforms
+    wfs[::20, 50:55] += 300
+    t = 240e6 * np.arange(200) * 0.01
+    wfs += 5. * (t * CALIBRATION_FACTORS.fpga_clock_to_s)[:, np.newaxis]
+    stats = baseline_stats(wfs, t)
+
+    samples = np.sort(wfs, axis=None)
+    k = int(0.1 * len(samples))
+    assert stats['mean'] == pytest.approx(np.mean(wfs))
+    assert stats['median'] == pytest.approx(np.median(wfs))
+    assert stats['trimmed_mean'] == pytest.approx(
+        np.mean(samples[k:len(samples) - k]))
+    mad = np.median(np.abs(wfs - np.median(wfs)))
+    assert stats['robust_rms'] == pytest.approx(1.4826 * mad)
+    assert stats['robust_rms'] < stats['rms']
+    assert stats['drift_slope'] == pytest.approx(5., rel=0.05)
+    assert stats['per_sample_median'].shape == (128,)
+    assert stats['per_waveform_rms'].shape == (200,)
+
+    baseline = ChannelBaseline.from_stats(
+        stats, pmt='SQ0001', port=5000, channel=0, temperature=-20.,
+        hv=1500., dac_value=30000, timestamp=0.)
+    assert baseline.baseline == pytest.approx(stats['mean'])
+    assert baseline.trimmed_mean == pytest.approx(stats['trimmed_mean'])
+    assert baseline.noise_threshold(5) == int(round(
+        stats['mean'] + 5 * stats['robust_rms']))
+
+
+def test_baseline_stats_invalid():
+    with pytest.raises(ValueError):
+        baseline_stats(np.zeros(10))
+
+
+def test_read_forced_trigger_block(fake_daq):
+    session = FakeSession()
+    wfs, ts = read_forced_trigger_block(session, 1, n_waveforms=12,
+                                        n_samples=64, dac_value=30000,
+                                        discard=1)
+    assert wfs.shape == (12, 64)
+    assert len(ts) == 12
+    # only channel 1, the first waveform discarded
+    assert np.allclose(wfs.mean(axis=1), BASELINES[1], atol=2)
+    assert ts[0] > 0
+    assert np.all(np.diff(ts) > 0)
+    assert session.n_blocks > 1
+    assert session.n_ended == 1
+
+
+def test_cache_lookup(tmp_path, fake_daq):
+    session = FakeSession()
+    service = BaselineService(cache_file=str(tmp_path / 'cache.hdf5'),
+                              n_waveforms=20, n_samples=64, verbose=False)
+    measured = service.measure(session, 'SQ0001', 5000, 0, -20., 1500.)
+    assert measured.baseline == pytest.approx(BASELINES[0], abs=1)
+
+    # a new service reads the cache file
+    service = BaselineService(cache_file=str(tmp_path / 'cache.hdf5'),
+                              n_waveforms=20, n_samples=64, verbose=False)
+    cached = service.lookup('SQ0001', 0, -19., 1505.)
+    assert cached is not None
+    assert cached.baseline == pytest.approx(measured.baseline)
+    assert np.allclose(cached.per_sample_median,
+                       measured.per_sample_median)
+    assert service.lookup('SQ0001', 0, -15., 1500.) is None
+    assert service.lookup('SQ0001', 0, -20., 1530.) is None
+    assert service.lookup('SQ0001', 1, -20., 1500.) is None
+    assert service.lookup('SQ0002', 0, -20., 1500.) is None
+    # expired
+    assert service.lookup('SQ0001', 0, -20., 1500.,
+                          now=time.time() + service.max_age + 1) is None
+
+    other_dac = BaselineService(cache_file=str(tmp_path / 'cache.hdf5'),
+                                n_waveforms=20, n_samples=64,
+                                dac_value=25000, verbose=False)
+    assert other_dac.lookup('SQ0001', 0, -20., 1500.) is None
+
+
+def test_get_remeasures_changed_conditions(tmp_path, fake_daq):
+    session = FakeSession()
+    degg_dict = {'Port': 5000,
+                 'LowerPmt': {'SerialNumber': 'SQ0001'},
+                 'UpperPmt': {'SerialNumber': 'SQ0002'}}
+    service = BaselineService(cache_file=str(tmp_path / 'cache.hdf5'),
+                              n_waveforms=20, n_samples=64, verbose=False)
+    first = service.get(session, degg_dict)
+    assert session.n_streams == 2
+    assert first[1].baseline == pytest.approx(BASELINES[1], abs=1)
+
+    second = service.get(session, degg_dict)
+    assert session.n_streams == 2
+    assert second[0].timestamp == first[0].timestamp
+
+    session.sensors['voltage_channel1'] = 1700.
+    third = service.get(session, degg_dict)
+    assert session.n_streams == 3
+    assert third[0].timestamp == first[0].timestamp
+    assert third[1].hv == 1700.
+
+    service.get(session, degg_dict, force=True)
+    assert session.n_streams == 5
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#
+# Tests of the RapCal clock model on simulated RapCals of a D-Egg whose
+# clock runs fast by a known drift; RapCalPair is replaced by the
+# linear translation of RapCal, called with scalars only
+#
+
+import types
+import numpy as np
+import pytest
+
+from degg_measurements.timing import clock_model
+from degg_measurements.timing.clock_model import ClockModel
+from degg_measurements.timing.clock_model import ClockModelService
+
+ICM_CLOCK_FREQ = 60e6
+DEGG_CLOCK_FREQ = 240e6
+SURFACE_START = 1000.
+UTC_SEED = clock_model.OFFSET_DATETIME.timestamp() + 5.
+ICM_SEED = 3 * ICM_CLOCK_FREQ
+
+
+class FakeRapCalPair(object):
+    def __init__(self, rc0, rc1, utc, icm, utc_is_seconds, icm_is_base16):
+        self.rc0 = rc0
+        self.rc1 = rc1
+        self.delta = utc[0] - icm / ICM_CLOCK_FREQ
+        self.epsilon = ((rc1.Tc_dor - rc0.Tc_dor) /
+                        (rc1.Tc_dom - rc0.Tc_dom)) - 1
+        self.cable_delays = (rc0.cable_delay(self.epsilon),
+                             rc1.cable_delay(self.epsilon))
+
+    def dom2surface(self, t_dom, device_type, deggMode):
+        assert np.isscalar(t_dom)
+        assert device_type == 'DEGG' and deggMode
+        t = ((1 + self.epsilon) * (t_dom / DEGG_CLOCK_FREQ -
+                                   self.rc1.Tc_dom / ICM_CLOCK_FREQ) +
+             self.rc1.Tc_dor / ICM_CLOCK_FREQ)
+        return np.longdouble(t), self.delta
+
+
+class FakeRapCal(object):
+    def __init__(self, dom_s, surface_s):
+        self.Tc_dom = dom_s * ICM_CLOCK_FREQ
+        self.Tc_dor = surface_s * ICM_CLOCK_FREQ
+
+    def cable_delay(self, epsilon):
+        return 1e-6 * (1 + epsilon)
+
+
+class Clock(object):
+    '''surface time of a DOM time, piecewise linear with the drifts'''
+    def __init__(self, epsilons, step=10.):
+        self.step = step
+        self.epsilons = epsilons
+
+    def surface(self, dom_s):
+        t = SURFACE_START
+        for i, eps in enumerate(self.epsilons):
+            start = i * self.step
+            stop = np.inf if i == len(self.epsilons) - 1 else start + self.step
+            t += (1 + eps) * max(min(dom_s, stop) - start, 0)
+        return t
+
+    def rapcal(self, i):
+        dom_s = i * self.step
+        return FakeRapCal(dom_s, self.surface(dom_s))
+
+
+class FakeDEgg(object):
+    def __init__(self, port, rapcals=(), timestamps=()):
+        self.port = port
+        self.rapcals = types.SimpleNamespace(rapcals=list(rapcals))
+        self.rapcal_utcs = [UTC_SEED] * len(rapcals)
+        self.rapcal_icms = [ICM_SEED] * len(rapcals)
+        self.info0 = [types.SimpleNamespace(timestamp=t) for t in timestamps]
+        self.info1 = []
+
+
+@pytest.fixture(autouse=True)
+def fake_rapcal(monkeypatch):
+    monkeypatch.setattr(clock_model, 'rp', types.SimpleNamespace(
+        ICM_CLOCK_FREQ=ICM_CLOCK_FREQ, DEGG_CLOCK_FREQ=DEGG_CLOCK_FREQ,
+        RapCalPair=FakeRapCalPair))
+
+
+def test_translation():
+    clock = Clock([2e-6, 3e-6, 1e-6])
+    model = ClockModel(reset_tolerance=1.)
+    for i in range(4):
+        model.add(clock.rapcal(i), UTC_SEED, ICM_SEED, wall_time=float(i))
+    np.testing.assert_allclose(model.epsilons(), clock.epsilons)
+
+    dom_s = np.array([1., 15., 25., 29.9, 45.])
+    mfh_t, delta, k = model.dom2surface(
+        [int(t * DEGG_CLOCK_FREQ) for t in dom_s])
+    # between the anchors around it, after the last one with the last pair
+    assert list(k) == [0, 1, 2, 2, 2]
+    expected = [clock.surface(t) for t in dom_s]
+    np.testing.assert_allclose(mfh_t.astype(float), expected, atol=1e-11)
+    np.testing.assert_allclose(delta, 2.)
+
+
+def test_reset_and_trim():
+    clock = Clock([2e-6])
+    model = ClockModel(max_anchors=4, reset_tolerance=1e-6)
+    for i in range(6):
+        model.add(clock.rapcal(i), UTC_SEED, ICM_SEED)
+    assert len(model) == 4
+    assert len(model.epsilons()) == 3
+    assert len(model._pairs) <= 3
+
+    # predicted within the tolerance
+    model.add(FakeRapCal(60., clock.surface(60.) + 1e-7), UTC_SEED, ICM_SEED)
+    assert len(model) == 4
+    # e.g. a power cycle: the DOM clock starts again
+    model.add(clock.rapcal(1), UTC_SEED, ICM_SEED)
+    assert len(model) == 1
+    model.add(clock.rapcal(2), UTC_SEED, ICM_SEED)
+    # off by more than the tolerance
+    model.add(FakeRapCal(30., clock.surface(30.) + 1e-5), UTC_SEED, ICM_SEED)
+    assert len(model) == 1
+    with pytest.raises(RuntimeError):
+        model.dom2surface([0])
+
+
+def test_uncertainty():
+    epsilons = [2e-6, 2.1e-6, 1.9e-6, 2.05e-6, 1.95e-6]
+    clock = Clock(epsilons)
+    model = ClockModel(reset_tolerance=1., n_stability=3)
+    for i in range(2):
+        model.add(clock.rapcal(i), UTC_SEED, ICM_SEED, wall_time=10. * i)
+        assert model.uncertainty(wall_time=100.) == np.inf
+    for i in range(2, len(epsilons) + 1):
+        model.add(clock.rapcal(i), UTC_SEED, ICM_SEED, wall_time=10. * i)
+    expected = np.std(epsilons[-3:], ddof=1) * 20.
+    assert model.uncertainty(wall_time=70.) == pytest.approx(expected)
+    # no negative extrapolation time
+    assert model.uncertainty(wall_time=0.) == 0.
+
+    service = ClockModelService(tolerance=expected / 2, reset_tolerance=1.,
+                                n_stability=3)
+    service.models[5000] = model
+    degg = FakeDEgg(5000)
+    # time.time() is long after the last wall_time of the model
+    assert service.needs_rapcal([degg])
+    model.wall_times[-1] = np.inf
+    assert not service.needs_rapcal([degg])
+
+
+def test_service_reuse_between_points():
+    clock = Clock([2e-6])
+    service = ClockModelService(tolerance=1e-9, reset_tolerance=1e-6)
+
+    def timestamps(dom_s):
+        return [int(t * DEGG_CLOCK_FREQ) for t in dom_s]
+
+    first = FakeDEgg(5000, [clock.rapcal(i) for i in range(3)],
+                     timestamps([5., 15.]))
+    service.update([first])
+    service.update([first])
+    assert len(service.model(5000)) == 3
+    assert not service.needs_rapcal([first])
+    service.calculate_timing_info([first])
+
+    # the next point: new containers without RapCals of their own
+    second = FakeDEgg(5000, timestamps=timestamps([35., 50.]))
+    service.update([second])
+    assert len(service.model(5000)) == 3
+    service.calculate_timing_info([second])
+    for degg, dom_s in [(first, [5., 15.]), (second, [35., 50.])]:
+        for info, t in zip(degg.info0, dom_s):
+            assert info.mfh_t == pytest.approx(
+                clock.surface(t) * 1e15, abs=1e4)
+            assert info.mfh_t2 == info.mfh_t
+            assert info.delta == pytest.approx(2.)
+            assert info.clockDrift == pytest.approx(2e-6)
+            assert info.cable_delay0 == pytest.approx(1e-6 * (1 + 2e-6))
+            assert info.datetime_offset == clock_model.OFFSET_DATETIME.timestamp()
+
+    # a RapCal of a later point extends the same model
+    third = FakeDEgg(5000, [clock.rapcal(6)])
+    service.update([third])
+    assert len(service.model(5000)) == 4
+    assert len(service.model(5001)) == 0
+
+    with pytest.raises(ValueError):
+        service.calculate_timing_info([second], method='waveform')
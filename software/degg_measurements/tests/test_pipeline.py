@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+#
+# Tests of the analysis pipeline and of the scheduler in pipeline mode
+# on run and D-Egg jsons written into a temporary directory; the worker
+# processes only run stdlib functions
+#
+
+import os
+import sys
+import json
+import math
+import time
+import types
+import functools
+import pytest
+
+from degg_measurements.utils.pipeline import AnalysisPipeline
+from degg_measurements.utils.pipeline import DataReadyEvent
+from degg_measurements.utils.pipeline import get_measurement_keys
+from degg_measurements.utils.pipeline import diff_measurement_keys
+from degg_measurements.utils.scheduler import Scheduler
+
+
+def write_json(path, dct):
+    with open(path, 'w') as open_file:
+        json.dump(dct, open_file)
+    return str(path)
+
+
+def read_json(path):
+    with open(path, 'r') as open_file:
+        return json.load(open_file)
+
+
+@pytest.fixture
+def run_file(tmp_path):
+    run = {'comment': '', 'date': '2026-10-19'}
+    for i, name in enumerate(['DEgg2021-1-001', 'DEgg2021-1-002']):
+        run[name] = write_json(tmp_path / f'{name}.json', {
+            'DEggSerialNumber': name,
+            'GainMeasurement_00': {},
+            'LowerPmt': {'SpeMeasurement_00': {}, 'HV1e7Gain': 1500},
+            'UpperPmt': {'SpeMeasurement_00': {}}})
+    return write_json(tmp_path / 'run_00001.json', run)
+
+
+def add_key(degg_file, key, pmt=None):
+    degg_dict = read_json(degg_file)
+    if pmt is None:
+        degg_dict[key] = {}
+    else:
+        degg_dict[pmt][key] = {}
+    write_json(degg_file, degg_dict)
+
+
+@pytest.fixture
+def pipeline():
+    pipeline = AnalysisPipeline(max_workers=2)
+    yield pipeline
+    pipeline.shutdown()
+
+
+def test_measurement_keys(run_file):
+    before = get_measurement_keys(run_file)
+    assert len(before) == 2
+    first, second = sorted(before)
+    assert before[first] == ('DEgg2021-1-001',
+                             {'GainMeasurement_00', 'SpeMeasurement_00'})
+    assert diff_measurement_keys('spe', run_file, before, before) == []
+
+    add_key(first, 'SpeMeasurement_01', pmt='UpperPmt')
+    add_key(first, 'DarkrateScalerMeasurement_00')
+    add_key(second, 'SpeMeasurement_01', pmt='LowerPmt')
+    # no measurement keys
+    add_key(second, 'HV1e7Gain')
+    add_key(second, 'SpeMeasurement', pmt='LowerPmt')
+    events = diff_measurement_keys('spe', run_file, before,
+                                   get_measurement_keys(run_file))
+    assert events == [
+        DataReadyEvent('spe', run_file, 'DEgg2021-1-001', first,
+                       'DarkrateScalerMeasurement_00',
+                       'DarkrateScalerMeasurement', 0),
+        DataReadyEvent('spe', run_file, 'DEgg2021-1-001', first,
+                       'SpeMeasurement_01', 'SpeMeasurement', 1),
+        DataReadyEvent('spe', run_file, 'DEgg2021-1-002', second,
+                       'SpeMeasurement_01', 'SpeMeasurement', 1)]
+    # a D-Egg missing before
+    assert len(diff_measurement_keys('spe', run_file, {},
+                                     get_measurement_keys(run_file))) == 7
+
+
+def test_event_dispatch(pipeline):
+    received = []
+
+    def handler(pipeline, event):
+        received.append(event)
+        if event.measurement_type == 'GainMeasurement':
+            pipeline.submit(event.measurement_key, math.sqrt,
+                            event.measurement_number)
+
+    pipeline.add_handler(handler)
+    events = [DataReadyEvent('gain', 'run.json', f'DEgg{i}', f'{i}.json',
+                             f'{meas}_04', meas, 4)
+              for i in range(2) for meas in ['GainMeasurement', 'SpeMeasurement']]
+    pipeline.data_ready(events)
+    assert received == events
+    assert pipeline.wait() == [('GainMeasurement_04', True, None)] * 2
+    assert pipeline.n_pending() == 0
+
+
+def test_failing_analysis(pipeline):
+    pipeline.submit('ok', math.sqrt, 4.)
+    pipeline.submit('fail', math.sqrt, -1.)
+    results = dict((title, (success, tb))
+                   for title, success, tb in pipeline.wait())
+    assert results['ok'] == (True, None)
+    assert results['fail'][0] is False
+    assert 'ValueError: math domain error' in results['fail'][1]
+    # collected results are not returned again
+    assert pipeline.collect() == []
+
+
+def test_coalesced_backup(pipeline):
+    backup = functools.partial(time.sleep, 1.)
+    first = pipeline.submit_backup(backup, {})
+    for _ in range(5):
+        assert pipeline.submit_backup(backup, {}) is first
+    results = pipeline.wait()
+    # the running backup and a single one for all later requests
+    assert [r[:2] for r in results] == [('backup', True)] * 2
+
+
+def test_auto_analysis(monkeypatch):
+    pipeline = AnalysisPipeline(max_workers=1, auto_analysis=True)
+    submitted = []
+    monkeypatch.setattr(pipeline, 'submit',
+                        lambda title, *args: submitted.append((title, args[1:])))
+    events = [DataReadyEvent('spe', 'run.json', f'DEgg{i}', f'{i}.json',
+                             f'{meas}_01', meas, 1)
+              for i in range(2) for meas in ['SpeMeasurement', 'LiveCheck']]
+    # submit is patched, only the name is used
+    monkeypatch.setitem(sys.modules,
+                        'degg_measurements.analysis.trigger_remote_analysis',
+                        types.SimpleNamespace(trigger_remote_wrapper=None))
+    pipeline.data_ready(events)
+    pipeline.shutdown()
+    # once per measurement type and number, not per D-Egg
+    assert submitted == [('spe_01', ('run.json', 'spe', 1))]
+
+
+class Recorder(object):
+    def __init__(self):
+        self.calls = []
+
+    def task(self, title):
+        def run(run_file, *args):
+            self.calls.append((title, args))
+        run.__name__ = title
+        return run
+
+    def backup(self, **kwargs):
+        self.calls.append(('backup', kwargs))
+
+
+def scheduler(run_file, recorder, titles=('a', 'b', 'c', 'd')):
+    schedule = Scheduler()
+    schedule.set_run(run_file)
+    schedule.set_backup_task(recorder.backup, {'run_file': run_file})
+    for i, title in enumerate(titles):
+        schedule.add_task(recorder.task(title), title, [i],
+                          run_backup=(i % 2 == 1))
+    return schedule
+
+
+def test_execute_task(run_file):
+    recorder = Recorder()
+    schedule = scheduler(run_file, recorder)
+    assert schedule.execute_task('b')
+    assert schedule.execute_task('c')
+    assert recorder.calls == [('b', (1,)), ('backup', {'run_file': run_file}),
+                              ('c', (2,))]
+    assert schedule.collect_pipeline_results() == []
+
+
+def test_recovery_slices_backup_list(run_file):
+    recorder = Recorder()
+    schedule = scheduler(run_file, recorder)
+    schedule.set_recovery_task_title_list(['[2] c', '[3] d'])
+    schedule.resolve_recovery()
+    assert schedule.get_task_title_list() == ['c', 'd']
+    assert schedule._backup_list == [False, True]
+    assert schedule._background_list == [False, False]
+    schedule.execute_task('c')
+    schedule.execute_task('d')
+    assert recorder.calls == [('c', (2,)), ('d', (3,)),
+                              ('backup', {'run_file': run_file})]
+
+
+def test_execute_task_pipeline(run_file):
+    schedule = Scheduler()
+    schedule.set_run(run_file)
+    schedule.set_backup_task(functools.partial(time.sleep, 0.), {})
+    degg_file = sorted(get_measurement_keys(run_file))[0]
+
+    def measure(run_file):
+        add_key(degg_file, 'GainMeasurement_01')
+    schedule.add_task(measure, 'gain', [], run_backup=True)
+    # module level, so that it can run in a worker process
+    schedule.add_task(os.path.isfile, 'analysis', [], background=True)
+
+    pipeline = schedule.enable_pipeline(max_workers=1)
+    events = []
+    pipeline.add_handler(lambda pipeline, event: events.append(event))
+    assert schedule.execute_task('gain')
+    assert [e.measurement_key for e in events] == ['GainMeasurement_01']
+    assert not schedule.execute_task('analysis')
+    schedule.shutdown_pipeline()
+    assert sorted(schedule.collect_pipeline_results()) == [
+        ('analysis', True, None), ('backup', True, None)]
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+#
+# Tests of the append-only sensor store, the conversion of the CSV files
+# of the old readout and the format detection of load_sensor_data
+#
+
+import numpy as np
+import pandas as pd
+import tables
+import pytest
+
+from degg_measurements.monitoring.monitoring import SENSOR_TO_VALUE
+from degg_measurements.monitoring.sensor_store import SensorStore
+from degg_measurements.monitoring.sensor_store import TIME_COLUMN
+from degg_measurements.monitoring.sensor_store import sensor_file_format
+from degg_measurements.monitoring.sensor_store import load_sensor_data
+from degg_measurements.monitoring.sensor_store import convert_csv_to_store
+
+START = pd.Timestamp('2026-10-19 12:00:00')
+
+
+def sensor_values(n, offset=0.):
+    values = {key: np.arange(n) + offset + i
+              for i, key in enumerate(SENSOR_TO_VALUE.keys())}
+    values['reflash_count'] = np.arange(n)
+    return values
+
+
+def times(n, first=0):
+    return START + pd.to_timedelta(np.arange(first, first + n), unit='s')
+
+
+def test_round_trip(tmp_path):
+    filename = str(tmp_path / 'DEgg2021-1-001.hdf5')
+    store = SensorStore(filename)
+    values = sensor_values(5)
+    store.append(values, device='DEgg2021-1-001', timestamp=times(5))
+    assert len(store) == 5
+
+    df = store.read()
+    assert df.index.name == TIME_COLUMN
+    assert list(df.columns) == list(SENSOR_TO_VALUE.keys())
+    assert (df.index == times(5)).all()
+    for key, val in values.items():
+        np.testing.assert_array_equal(df[key], val)
+    assert df['reflash_count'].dtype == np.int32
+    assert store.devices() == ['DEgg2021-1-001']
+
+    # the same from a new instance, found by the content of the file
+    assert sensor_file_format(filename) == 'store'
+    pd.testing.assert_frame_equal(load_sensor_data(filename), df)
+
+
+def test_append(tmp_path):
+    filename = str(tmp_path / 'sensors.hdf5')
+    for i in range(3):
+        SensorStore(filename).append(sensor_values(4, offset=10. * i),
+                                     device='a', timestamp=times(4, 4 * i))
+    # a single row, missing sensors are NaN (-1 for the counter)
+    SensorStore(filename).append({'temperature_sensor': -20.}, device='b',
+                                 timestamp=times(1, 12)[0])
+    store = SensorStore(filename)
+    assert len(store) == 13
+    assert store.devices() == ['a', 'b']
+
+    df = store.read()
+    assert (df.index == times(13)).all()
+    assert list(df['device']) == ['a'] * 12 + ['b']
+    np.testing.assert_array_equal(
+        df['light_sensor'][:12],
+        np.concatenate([np.arange(4) + 10. * i for i in range(3)]))
+    last = df.iloc[-1]
+    assert last['temperature_sensor'] == -20.
+    assert np.isnan(last['light_sensor'])
+    assert last['reflash_count'] == -1
+
+    # time ranges and devices are selected in the query
+    df = load_sensor_data(filename, start=times(1, 2)[0],
+                          stop=times(1, 6)[0], device='a')
+    assert (df.index == times(4, 2)).all()
+    assert 'device' not in df.columns
+    assert len(store.read(device='b')) == 1
+
+
+def test_convert_csv(tmp_path):
+    # layout of the CSV files of the old readout
+    csv_file = str(tmp_path / 'DEgg2021-1-002.csv')
+    index = times(6)
+    index.name = TIME_COLUMN
+    old = pd.DataFrame(sensor_values(6), index=index)
+    old.to_csv(csv_file)
+    csv = load_sensor_data(csv_file)
+    assert sensor_file_format(csv_file) == 'csv'
+
+    store_file = convert_csv_to_store(csv_file)
+    assert store_file == str(tmp_path / 'DEgg2021-1-002.hdf5')
+    assert SensorStore(store_file).devices() == ['DEgg2021-1-002']
+    df = load_sensor_data(store_file)
+    # the CSV index may be parsed with another time resolution
+    pd.testing.assert_frame_equal(df, csv, check_dtype=False,
+                                  check_index_type=False, check_freq=False)
+    # a second conversion appends to the store
+    convert_csv_to_store(csv_file, store_file)
+    assert len(SensorStore(store_file)) == 12
+
+
+@pytest.mark.parametrize('key', ['df5003', 'sensors'])
+@pytest.mark.parametrize('fmt', ['fixed', 'table'])
+def test_pandas_hdf(tmp_path, key, fmt):
+    # mon_<port>.hdf5 files are written by DataFrame.to_hdf
+    filename = str(tmp_path / 'mon_5003.hdf5')
+    df = pd.DataFrame({'degg_name': ['DEgg2021-1-003'] * 3,
+                       'port': [5003] * 3,
+                       'temperature_sensor': [-20., -21., -22.]})
+    df.to_hdf(filename, key=key, mode='w', format=fmt)
+    assert sensor_file_format(filename) == 'pandas'
+    pd.testing.assert_frame_equal(load_sensor_data(filename), df)
+
+
+def test_unknown_hdf5(tmp_path):
+    filename = str(tmp_path / 'other.hdf5')
+    with tables.open_file(filename, 'w') as open_file:
+        open_file.create_array('/', 'sensors', np.arange(3))
+    with pytest.raises(ValueError):
+        load_sensor_data(filename)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#
+# Tests of the joint multi-HV SPE fit on simulated gain scans: pedestal,
+# exponential and SPE gaussian, the SPE peak following the power law
+#
+
+import numpy as np
+import pytest
+
+from degg_measurements.analysis.spe.spe_fit import fit_spe_scan
+from degg_measurements.analysis.spe.spe_fit import spe_model
+from degg_measurements.analysis.spe.spe_fit import spe_model_jac
+from degg_measurements.analysis.spe.spe_fit import hv_at_gain
+from degg_measurements.analysis.spe.spe_fit import E_CONST, HV_REF
+
+PEAK_AT_REF = 1.6
+K = 7.
+HVS = np.arange(1300., 1850., 100.)
+
+
+def true_peak(hv):
+    return PEAK_AT_REF * (hv / HV_REF)**K
+
+
+def simulate(hv, n, rnd, spe_fraction=0.3):
+    peak = true_peak(hv)
+    n_spe = int(spe_fraction * n)
+    n_exp = int(0.05 * n)
+    return np.concatenate([rnd.normal(0, 0.05, n - n_spe - n_exp),
+                           rnd.normal(peak, 0.3 * peak, n_spe),
+                           rnd.exponential(0.2 * peak, n_exp)])
+
+
+def test_spe_model_jac():
+    x = np.linspace(-0.5, 4., 50)
+    params = np.array([1000., 0.01, 0.05, 30., 0.3, 500., 1.6, 0.5])
+    jac = spe_model_jac(x, *params)
+    for i in range(len(params)):
+        step = np.zeros(len(params))
+        step[i] = 1e-6 * max(abs(params[i]), 1.)
+        numeric = (spe_model(x, *(params + step)) -
+                   spe_model(x, *(params - step))) / (2 * step[i])
+        np.testing.assert_allclose(jac[:, i], numeric, rtol=1e-4, atol=1e-6)
+
+
+@pytest.mark.parametrize('joint', [True, False])
+def test_fit_spe_scan(joint):
+    rnd = np.random.RandomState(0)
+    charges = [simulate(hv, 20000, rnd) for hv in HVS]
+    result = fit_spe_scan(HVS, charges, joint=joint)
+    assert result['k'] == pytest.approx(K, rel=0.03)
+    assert np.exp(result['log_a']) == pytest.approx(PEAK_AT_REF, rel=0.03)
+    expected_hv = HV_REF * (1e7 * E_CONST / PEAK_AT_REF)**(1 / K)
+    assert hv_at_gain(result['log_a'], result['k']) == \
+        pytest.approx(expected_hv, rel=0.01)
+
+    # the points are in the order of the HV values
+    assert [point['hv'] for point in result['points']] == list(HVS)
+    for point in result['points']:
+        assert point['ok'], point['flags']
+        assert point['params']['spe_peak'] == \
+            pytest.approx(true_peak(point['hv']), rel=0.03)
+        assert point['gain'] == \
+            pytest.approx(point['params']['spe_peak'] / E_CONST)
+        # at least the 2% systematic uncertainty
+        assert point['gain_err'] >= 0.02 * point['gain']
+
+
+def test_fit_spe_scan_flags():
+    rnd = np.random.RandomState(1)
+    charges = [simulate(hv, 20000, rnd) for hv in HVS]
+    charges[1] = simulate(HVS[1], 300, rnd)
+    # only the pedestal, no light
+    charges[2] = rnd.normal(0, 0.05, 20000)
+    points = fit_spe_scan(HVS, charges)['points']
+    assert 'low_statistics' in points[1]['flags']
+    assert 'no_signal' in points[2]['flags']
+    assert not points[1]['ok'] and not points[2]['ok']
+    # the broken points do not pull the others off
+    for i in [0, 3, 4, 5]:
+        assert points[i]['ok'], points[i]['flags']
+        assert points[i]['params']['spe_peak'] == \
+            pytest.approx(true_peak(HVS[i]), rel=0.03)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#
+# Tests of the incremental ingestion and the queries of the STF store on
+# STF result folders written into a temporary directory
+#
+
+import os
+import json
+import shutil
+import numpy as np
+import pytest
+
+from degg_measurements.analysis.stf.stf_store import STFStore
+from degg_measurements.analysis.stf.stf_store import split_test_item
+
+
+def stf_result(serial, port, r2, slope=0.001, outcome='PASS'):
+    # the measurements are in phase 2, phase 0 has a validator of the same
+    # name as decoy
+    voltages = [100., 500., 1000.]
+    return {
+        'outcome': outcome,
+        'metadata': {
+            'device': {'dut_serial': serial},
+            'stf_config': {'iceboot': {'port': port}},
+            'config': {'station_id': 'fat'},
+            'test_config': {'expectedValues': {
+                'HVS_VMon_Fit_R2_min': 0.999, 'HVS_VMon_Fit_R2_max': 1.}}},
+        'phases': [
+            {'measurements': {'HVS_VMon_Fit_R2': {'measured_value': -1.}}},
+            {'measurements': {}},
+            {'measurements': {
+                'HVS_VMon_Fit_R2': {'measured_value': r2,
+                                    'outcome': outcome},
+                'HVS_IMon_Fit_Slope': {'measured_value': slope},
+                'HVS_Monitors': {'measured_value': {
+                    'set_voltage': voltages,
+                    'meas_voltage': [0.99 * v for v in voltages],
+                    'meas_current': [v / 100. for v in voltages]}}}}]}
+
+
+def write_folder(folder, serial, port, r2s):
+    os.makedirs(folder, exist_ok=True)
+    for channel, r2 in enumerate(r2s):
+        path = os.path.join(folder,
+                            f'HVMonitors-base-channel-{channel}_0.json')
+        with open(path, 'w') as open_file:
+            json.dump(stf_result(serial, port, r2), open_file)
+    return folder
+
+
+@pytest.fixture
+def trees(tmp_path):
+    root = tmp_path / 'DEgg-FAT'
+    write_folder(str(root / 'run_a' / 'degg-1'), 'DEgg001', 5000,
+                 [0.9995, 0.9991])
+    write_folder(str(root / 'run_a' / 'degg-2'), 'DEgg002', 5001,
+                 [0.9999, 0.9993])
+    write_folder(str(root / 'run_b' / 'degg-1'), 'DEgg001', 5000,
+                 [0.9997, 0.9992])
+    return root
+
+
+def test_split_test_item():
+    assert split_test_item('HVMonitors-base-channel-1_20220501.json') == \
+        ('HVMonitors-base', 1)
+    assert split_test_item('/a/b/Magnetometer_1.json') == ('Magnetometer', -1)
+
+
+def test_ingest_and_query(tmp_path, trees):
+    store = STFStore(str(tmp_path / 'store.hdf5'))
+    assert store.ingest_trees([str(trees)], verbose=False) == 6
+    table = store.table('HVS_VMon_Fit_R2', phase=2)
+    assert len(table) == 6
+    assert table.loc[('DEgg-FAT', 'run_b', 'DEgg001', 5000, 1),
+                     'HVS_VMon_Fit_R2'] == pytest.approx(0.9992)
+    # phase 0 holds another value of the same validator
+    assert np.all(store.results(validator='HVS_VMon_Fit_R2',
+                                phase=0)['value'] == -1)
+    assert store.limits('HVS_VMon_Fit_R2', phase=2) == (0.999, 1.)
+    df = store.results(validator='HVS_*', degg=['DEgg002'], phase=2)
+    assert sorted(df['validator'].unique()) == ['HVS_IMon_Fit_Slope',
+                                                'HVS_Monitors',
+                                                'HVS_VMon_Fit_R2']
+
+    row = store.results(run='run_a', degg='DEgg002', channel=1,
+                        validator='HVS_VMon_Fit_R2', phase=2).iloc[0]
+    assert store.value(row['file_id'], 'HVS_VMon_Fit_R2', 2) == \
+        pytest.approx(0.9993)
+    with pytest.raises(KeyError):
+        store.value(row['file_id'], 'HVS_Unknown')
+    curve = store.curve(row['file_id'], 'HVS_Monitors', 2)
+    assert list(curve['set_voltage']) == [100., 500., 1000.]
+    assert len(store.curves('HVS_Monitors', run='run_a')) == 4
+
+    # a new store reads the same tables from the file
+    reloaded = STFStore(str(tmp_path / 'store.hdf5'))
+    assert reloaded.table('HVS_VMon_Fit_R2', phase=2).equals(table)
+
+
+def test_incremental(tmp_path, trees):
+    store = STFStore(str(tmp_path / 'store.hdf5'))
+    store.ingest_trees([str(trees)], verbose=False)
+    assert store.ingest_trees([str(trees)], verbose=False) == 0
+
+    # a changed file is parsed again and replaces its rows
+    path = str(trees / 'run_a' / 'degg-1' /
+               'HVMonitors-base-channel-0_0.json')
+    with open(path, 'w') as open_file:
+        json.dump(stf_result('DEgg001', 5000, 0.9), open_file)
+    mtime = os.stat(path).st_mtime
+    os.utime(path, (mtime + 10, mtime + 10))
+    assert store.ingest_trees([str(trees)], verbose=False) == 1
+    df = store.results(run='run_a', degg='DEgg001', channel=0,
+                       validator='HVS_VMon_Fit_R2', phase=2)
+    assert list(df['value']) == [0.9]
+
+    # removed files and folders are dropped
+    os.remove(str(trees / 'run_a' / 'degg-2' /
+                  'HVMonitors-base-channel-1_0.json'))
+    shutil.rmtree(str(trees / 'run_b'))
+    assert store.ingest_trees([str(trees)], verbose=False) == 0
+    table = store.table('HVS_VMon_Fit_R2', phase=2)
+    assert len(table) == 3
+    assert 'run_b' not in table.index.get_level_values('run')
+    assert len(store.curves('HVS_Monitors')) == 3
+
+
+def test_same_folder_two_runs(tmp_path, trees):
+    store = STFStore(str(tmp_path / 'store.hdf5'))
+    folder = str(trees / 'run_a' / 'degg-1')
+    assert store.ingest([folder], 'run', run='100', verbose=False) == 2
+    # the latest STF of run 100 is also STF 1 of it
+    assert store.ingest([folder], 'run', run='100-1', verbose=False) == 2
+    assert store.ingest([folder], 'run', run='100-1', verbose=False) == 0
+    for run in ['100', '100-1']:
+        table = store.table('HVS_VMon_Fit_R2', index=('degg', 'channel'),
+                            tree='run', run=run, phase=2)
+        assert list(table['HVS_VMon_Fit_R2']) == pytest.approx(
+            [0.9995, 0.9991])
+
+    # removing a file only touches the run that is ingested
+    os.remove(os.path.join(folder, 'HVMonitors-base-channel-1_0.json'))
+    store.ingest([folder], 'run', run='100-1', verbose=False)
+    assert len(store.results(tree='run', run='100-1', phase=2,
+                             validator='HVS_VMon_Fit_R2')) == 1
+    assert len(store.results(tree='run', run='100', phase=2,
+                             validator='HVS_VMon_Fit_R2')) == 2
+
+
+def test_invalid_file(tmp_path, trees):
+    with open(str(trees / 'run_a' / 'degg-1' / 'bad.json'), 'w') as f:
+        f.write('{not json')
+    store = STFStore(str(tmp_path / 'store.hdf5'))
+    assert store.ingest_trees([str(trees)], verbose=False) == 7
+    assert store.ingest_trees([str(trees)], verbose=False) == 0
+    assert len(store.table('HVS_VMon_Fit_R2', phase=2)) == 6
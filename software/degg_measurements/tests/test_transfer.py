@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+#
+# Tests of the TransferEngine upload plan, with the remote directory
+# listing replaced by a dict of remote file sizes
+#
+
+import os
+import json
+import subprocess
+import paramiko
+import pytest
+
+from degg_measurements.utils.transfer import TransferEngine
+from degg_measurements.utils.transfer import TransferManifest
+
+REMOTE_DIR = '/remote/run_00001'
+
+
+class FakeRemoteEngine(TransferEngine):
+    def __init__(self, remote_sizes, **kwargs):
+        super().__init__(ssh_client=None, **kwargs)
+        self.remote_sizes = remote_sizes
+
+    def _remote_sizes(self, remote_dirs):
+        return {path: size for path, size in self.remote_sizes.items()
+                if os.path.dirname(path) in remote_dirs}
+
+
+def write(path, content):
+    with open(path, 'w') as open_file:
+        open_file.write(content)
+    return str(path)
+
+
+def remote(local_path):
+    return os.path.join(REMOTE_DIR, os.path.basename(local_path))
+
+
+@pytest.fixture
+def manifest_file(tmp_path):
+    return str(tmp_path / 'manifest.json')
+
+
+def test_plan_new_file(tmp_path, manifest_file):
+    local_path = write(tmp_path / 'new.json', '{"a": 1}')
+    engine = FakeRemoteEngine({}, manifest_file=manifest_file)
+    plan, skipped = engine._plan([(local_path, remote(local_path))], False)
+    assert plan == [(local_path, remote(local_path), 0)]
+    assert skipped == []
+
+
+def test_plan_unchanged_file(tmp_path, manifest_file):
+    local_path = write(tmp_path / 'run.json', '{"a": 1}')
+    manifest = TransferManifest(manifest_file)
+    manifest.add(local_path, remote(local_path))
+    manifest.save()
+    engine = FakeRemoteEngine({remote(local_path): 8},
+                              manifest_file=manifest_file)
+    plan, skipped = engine._plan([(local_path, remote(local_path))], False)
+    assert plan == []
+    assert skipped == [remote(local_path)]
+
+
+def test_plan_changed_size(tmp_path, manifest_file):
+    local_path = write(tmp_path / 'run.json', '{"a": 1}')
+    manifest = TransferManifest(manifest_file)
+    manifest.add(local_path, remote(local_path))
+    manifest.save()
+    write(local_path, '{"a": 1, "b": 2}')
+    # the remote copy still has the size of the first upload
+    engine = FakeRemoteEngine({remote(local_path): 8},
+                              manifest_file=manifest_file)
+    plan, skipped = engine._plan([(local_path, remote(local_path))], False)
+    assert plan == [(local_path, remote(local_path), 0)]
+    assert skipped == []
+
+
+def test_plan_changed_content_same_size(tmp_path, manifest_file):
+    local_path = write(tmp_path / 'run.json', '{"a": 1}')
+    manifest = TransferManifest(manifest_file)
+    manifest.add(local_path, remote(local_path))
+    manifest.save()
+    mtime = os.stat(local_path).st_mtime
+    write(local_path, '{"a": 2}')
+    os.utime(local_path, (mtime + 10, mtime + 10))
+    engine = FakeRemoteEngine({remote(local_path): 8},
+                              manifest_file=manifest_file)
+    plan, skipped = engine._plan([(local_path, remote(local_path))], False)
+    assert plan == [(local_path, remote(local_path), 0)]
+    assert skipped == []
+
+
+def test_plan_same_size_unknown_file(tmp_path, manifest_file):
+    # on the remote side, but not in the manifest: recorded, not sent
+    local_path = write(tmp_path / 'run.json', '{"a": 1}')
+    engine = FakeRemoteEngine({remote(local_path): 8},
+                              manifest_file=manifest_file)
+    plan, skipped = engine._plan([(local_path, remote(local_path))], False)
+    assert plan == []
+    assert skipped == [remote(local_path)]
+    with open(manifest_file, 'r') as open_file:
+        assert remote(local_path) in json.load(open_file)
+
+
+def test_plan_interrupted_upload(tmp_path, manifest_file):
+    local_path = write(tmp_path / 'big.hdf5', 'x' * 1000)
+    engine = FakeRemoteEngine({f'{remote(local_path)}.part': 400},
+                              manifest_file=manifest_file)
+    plan, skipped = engine._plan([(local_path, remote(local_path))], False)
+    assert plan == [(local_path, remote(local_path), 400)]
+    assert skipped == []
+
+
+def test_manifest_saved_once(tmp_path, manifest_file):
+    manifest = TransferManifest(manifest_file)
+    for i in range(10):
+        local_path = write(tmp_path / f'{i}.json', str(i))
+        manifest.add(local_path, remote(local_path))
+    assert not os.path.isfile(manifest_file)
+    manifest.save()
+    reloaded = TransferManifest(manifest_file)
+    assert len(reloaded) == 10
+    assert all(reloaded.is_done(str(tmp_path / f'{i}.json'),
+                                remote(str(tmp_path / f'{i}.json')))
+               for i in range(10))
+
+
+class LocalFile(object):
+    # SFTP file on the local file system, fails after fail_after writes
+    def __init__(self, path, mode, fail_after=None):
+        self._file = open(path, mode)
+        self._fail_after = fail_after
+
+    def set_pipelined(self, pipelined):
+        pass
+
+    def write(self, data):
+        if self._fail_after is not None:
+            if self._fail_after == 0:
+                raise IOError('Connection lost')
+            self._fail_after -= 1
+        self._file.write(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._file.close()
+
+
+class LocalSFTP(object):
+    def __init__(self, remote):
+        self.remote = remote
+
+    def putfo(self, open_file, path):
+        self.remote.n_put += 1
+        if self.remote.n_put == self.remote.fail_put:
+            raise IOError('Connection lost')
+        with open(path, 'wb') as remote_file:
+            remote_file.write(open_file.read())
+
+    def open(self, path, mode):
+        self.remote.n_open += 1
+        fail_after = None
+        if self.remote.n_open == self.remote.fail_open:
+            fail_after = 1
+        return LocalFile(path, mode, fail_after)
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def posix_rename(self, old_path, new_path):
+        os.replace(old_path, new_path)
+
+    def listdir_attr(self, path):
+        return [paramiko.SFTPAttributes.from_stat(
+                    os.stat(os.path.join(path, name)), filename=name)
+                for name in os.listdir(path)]
+
+    def close(self):
+        pass
+
+
+class LocalRemoteEngine(TransferEngine):
+    '''
+    The remote side is a directory of the local file system, the remote
+    commands (mkdir, tar, md5sum) run in a local shell. fail_put and
+    fail_open make the n-th tarball upload or large file upload fail.
+    '''
+    def __init__(self, fail_put=None, fail_open=None, **kwargs):
+        super().__init__(ssh_client=None, n_channels=1, **kwargs)
+        self.fail_put = fail_put
+        self.fail_open = fail_open
+        self.n_put = 0
+        self.n_open = 0
+
+    def _sftp(self):
+        return LocalSFTP(self)
+
+    def _exec(self, cmd):
+        return subprocess.run(cmd, shell=True, check=True, text=True,
+                              stdout=subprocess.PIPE).stdout
+
+
+@pytest.fixture
+def local_tree(tmp_path):
+    local_dir = tmp_path / 'local'
+    os.makedirs(str(local_dir / 'sub'))
+    for i in range(6):
+        write(local_dir / f'{i}.json', f'{{"run": {i}}}')
+    write(local_dir / 'sub' / 'a.txt', 'a' * 100)
+    with open(str(local_dir / 'big.hdf5'), 'wb') as open_file:
+        open_file.write(os.urandom((5 << 20) // 2))
+    return str(local_dir)
+
+
+def read_tree(path):
+    tree = {}
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            full_path = os.path.join(dirpath, filename)
+            with open(full_path, 'rb') as open_file:
+                tree[os.path.relpath(full_path, path)] = open_file.read()
+    return tree
+
+
+def test_resume_interrupted_transfer(tmp_path, local_tree, manifest_file):
+    remote_dir = str(tmp_path / 'remote')
+    # small batches of two files, the second tarball and the large file
+    # fail after the first MB
+    engine = LocalRemoteEngine(fail_put=2, fail_open=1, batch_size=20,
+                               manifest_file=manifest_file)
+    with pytest.raises(IOError):
+        engine.sync_directory(local_tree, remote_dir)
+    assert 0 < len(TransferManifest(manifest_file)) < 8
+    assert os.path.getsize(os.path.join(remote_dir, 'big.hdf5.part')) == \
+        1 << 20
+
+    engine = LocalRemoteEngine(batch_size=20, manifest_file=manifest_file)
+    result = engine.sync_directory(local_tree, remote_dir)
+    done = TransferManifest(manifest_file)
+    assert len(done) == 8
+    # files of the first upload are skipped based on the manifest
+    assert len(result['sent']) + len(result['skipped']) == 8
+    assert len(result['skipped']) > 0
+    assert os.path.join(remote_dir, 'big.hdf5') in result['sent']
+    # the large file was appended to, not sent again
+    assert engine.n_open == 1
+    assert read_tree(remote_dir) == read_tree(local_tree)
+
+
+def test_mirror_changed_files(tmp_path, local_tree, manifest_file):
+    remote_dir = str(tmp_path / 'remote')
+    engine = LocalRemoteEngine(manifest_file=manifest_file)
+    result = engine.sync_directory(local_tree, remote_dir)
+    assert len(result['sent']) == 8
+
+    changed = os.path.join(local_tree, '1.json')
+    mtime = os.stat(changed).st_mtime
+    write(changed, '{"run": 7}')
+    os.utime(changed, (mtime + 10, mtime + 10))
+    write(os.path.join(local_tree, 'sub', 'a.txt'), 'b' * 120)
+
+    engine = LocalRemoteEngine(manifest_file=manifest_file)
+    result = engine.sync_directory(local_tree, remote_dir)
+    assert sorted(result['sent']) == [
+        os.path.join(remote_dir, '1.json'),
+        os.path.join(remote_dir, 'sub', 'a.txt')]
+    assert len(result['skipped']) == 6
+    assert read_tree(remote_dir) == read_tree(local_tree)
+
+    # nothing changed, nothing sent
+    result = LocalRemoteEngine(manifest_file=manifest_file).sync_directory(
+        local_tree, remote_dir)
+    assert result['sent'] == []
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+# Tests of the batched waveform functions of utils.wfana against the
+# per-waveform scipy.signal.find_peaks and droop correction loop they
+# replace
+#
+
+import numpy as np
+import pytest
+from scipy import signal
+
+from degg_measurements.utils.wfana import _local_maxima_runs
+from degg_measurements.utils.wfana import find_peaks_batch
+from degg_measurements.utils.wfana import find_double_peaks
+from degg_measurements.utils.wfana import correct_droop
+from degg_measurements.utils.wfana import droop_time_constant
+from degg_measurements.utils.wfana import UNDERSHOOT_TAU_PARAMS
+
+
+def random_waveforms(seed, n_wfs=2000, n_bins=64):
+    rng = np.random.default_rng(seed)
+    # few ADC values give many plateaus, also at the waveform edges
+    waveforms = [rng.integers(0, 4, size=(n_wfs // 2, n_bins)).astype(float)]
+    # double pulses on a noisy baseline, rounded like ADC counts
+    t = np.arange(n_bins)
+    t0 = rng.uniform(5, 30, size=(n_wfs // 2, 1))
+    dt = rng.uniform(2, 25, size=(n_wfs // 2, 1))
+    pulses = (rng.uniform(5, 40, size=(n_wfs // 2, 1)) *
+              np.exp(-0.5 * ((t - t0) / 2.) ** 2) +
+              rng.uniform(0, 40, size=(n_wfs // 2, 1)) *
+              np.exp(-0.5 * ((t - t0 - dt) / 2.) ** 2) +
+              rng.normal(100, 1., size=(n_wfs // 2, n_bins)))
+    waveforms.append(np.round(pulses))
+    return np.concatenate(waveforms)
+
+
+SPECIAL = np.array([
+    np.zeros(16),
+    [0, 1, 1, 1] * 4,
+    [1, 1, 1, 0] * 4,
+    [2, 2, 1, 3, 3, 3, 0, 5, 5, 0, 4, 4, 4, 4, 1, 1],
+    np.arange(16),
+    np.arange(16)[::-1],
+], dtype=float)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_local_maxima_runs(seed):
+    waveforms = np.concatenate([SPECIAL, random_waveforms(seed)[:, :16]])
+    rows, left, right, mid = _local_maxima_runs(waveforms)
+    for i, wf in enumerate(waveforms):
+        peaks, props = signal.find_peaks(wf, plateau_size=(None, None))
+        sel = rows == i
+        np.testing.assert_array_equal(mid[sel], peaks)
+        np.testing.assert_array_equal(left[sel], props['left_edges'])
+        np.testing.assert_array_equal(right[sel], props['right_edges'])
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('height', [None, 2., 110.])
+def test_find_peaks_batch(seed, height):
+    waveforms = random_waveforms(seed)
+    rows, peak_ind = find_peaks_batch(waveforms, height=height)
+    for i, wf in enumerate(waveforms):
+        peaks, _ = signal.find_peaks(wf, height=height)
+        np.testing.assert_array_equal(peak_ind[rows == i], peaks)
+
+
+def double_peaks_loop(waveforms, threshold, baseline):
+    '''the per-waveform loop of the double pulse analysis'''
+    n_peaks, peak_ind, valley = [], [], []
+    for wf in waveforms:
+        wz = wf - baseline
+        p_i, _ = signal.find_peaks(wz, height=threshold)
+        n_peaks.append(len(p_i))
+        peak_ind.append((list(p_i[:2]) + [-1, -1])[:2])
+        if len(p_i) < 2:
+            valley.append(0.)
+            continue
+        between = wz[p_i[0]:p_i[1]]
+        m_i, _ = signal.find_peaks(-between)
+        valley.append(between[m_i[0]] if len(m_i) > 0 else 0.)
+    return np.array(n_peaks), np.array(peak_ind), np.array(valley)
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('chunk_size', [10000, 333])
+def test_find_double_peaks(seed, chunk_size):
+    waveforms = random_waveforms(seed)
+    baseline, threshold = 100., 3.
+    # the integer waveforms on the baseline of the pulses
+    waveforms[:1000] += baseline
+    result = find_double_peaks(waveforms, threshold, baseline=baseline,
+                               chunk_size=chunk_size)
+    n_peaks, peak_ind, valley = double_peaks_loop(waveforms, threshold,
+                                                  baseline)
+    assert (n_peaks >= 2).sum() > 100 and (valley != 0).sum() > 100
+    np.testing.assert_array_equal(result['n_peaks'], n_peaks)
+    np.testing.assert_array_equal(result['peak_ind'], peak_ind)
+    np.testing.assert_array_equal(result['valley'], valley)
+    height = np.where(peak_ind >= 0, np.take_along_axis(
+        waveforms - baseline, np.maximum(peak_ind, 0), axis=1), np.nan)
+    np.testing.assert_array_equal(result['peak_height'], height)
+
+    # one baseline per waveform
+    baselines = np.full(len(waveforms), baseline)
+    per_wf = find_double_peaks(waveforms, threshold, baseline=baselines,
+                               chunk_size=chunk_size)
+    for key in result:
+        np.testing.assert_array_equal(per_wf[key], result[key])
+
+
+def correction_algorithm(tau, dt, Y):
+    '''the recursive droop correction of analyze_droop'''
+    A = (tau/dt) * (1-np.exp(-dt/tau))
+    S = 0
+    X0 = (1/A * Y[0])
+    X = [X0]
+    for j in range(1, len(Y)):
+        sj = X[j-1] + S*np.exp(-dt/tau)
+        xj = (1/A) * Y[j] + (A*dt)/tau * sj
+        S = sj
+        X.append(xj)
+    return X
+
+
+def test_correct_droop():
+    rng = np.random.default_rng(0)
+    dt = 1. / 240e6
+    waveforms = random_waveforms(0, n_wfs=200, n_bins=128) - 100.
+    taus = droop_time_constant(rng.choice([-40., -20., 25.], 200))
+    assert len(np.unique(taus)) == 3
+    tau_undershoot = droop_time_constant(25., UNDERSHOOT_TAU_PARAMS)
+
+    corrected = correct_droop(waveforms, taus, dt)
+    single = correct_droop(waveforms, tau_undershoot, dt)
+    assert corrected.shape == single.shape == waveforms.shape
+    for i, wf in enumerate(waveforms):
+        np.testing.assert_allclose(
+            corrected[i], correction_algorithm(taus[i], dt, wf),
+            rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(
+            single[i], correction_algorithm(tau_undershoot, dt, wf),
+            rtol=1e-12, atol=1e-12)
+    np.testing.assert_array_equal(correct_droop(waveforms[3], taus[3], dt),
+                                  corrected[3])
+
+    with pytest.raises(ValueError):
+        correct_droop(waveforms, taus[:10], dt)
@@ -11,6 +11,9 @@ import glob
 import tables
 from natsort import natsorted
 
+from src.charge_extraction import read_charges
+from src.scan_store import load_scan
+
 def gaussian(x, A, mu, sigma):
     return A * np.exp(-(x-mu)**2/(2*sigma**2))
 
@@ -94,23 +97,9 @@ def plot_polar_heatmap(radii, theta, val, graph_dir, top_bottom, mean_std):
 
 def get_reference_data(filename):
 
-    charges = []
-    with tables.open_file(filename) as f:
-        data = f.get_node('/data')
-        waveforms = data.col("waveform")
-        times = data.col("time")
-
-        start_point = int(len(times[0])/2)
-        end_point = int(start_point + start_point//3)
-        base = np.mean(waveforms[0][0:200])
-
-        for time, waveform in tqdm(zip(times, waveforms)):
+    ##all waveforms at once, baseline per waveform
+    charges = read_charges(filename)
 
-            waveform = -waveform[start_point:end_point] + base
-            time = time[start_point:end_point]
-            charge = integrate.simps(waveform, time)/50*1e12
-            charges.append(charge)
-        
     popt = fit_gaussian(30, charges)
     return popt[1], popt[2]
 
@@ -155,7 +144,7 @@ def plot_theta_efficiency(r_range, theta_range, relative_mean_charge, graph_dir,
 def analysis_xscan(file_name, graph_dir, top_bottom, ref_data_dir):
 
     ##scan data
-    df = pd.read_hdf(file_name, 'df')
+    df = load_scan(file_name)
     theta_range = np.array(df.tVal.unique())
     theta_range = np.sort(theta_range)
     r_range = np.array(df.rVal.unique())
@@ -197,6 +186,14 @@ def analysis_xscan(file_name, graph_dir, top_bottom, ref_data_dir):
     
 
 
+def scan_file(data_dir):
+    ##scan store written by DEggScan/scan.py, else the merged total files
+    store_file = f'{data_dir}sig/scan_charge_stamp.hdf5'
+    if os.path.isfile(store_file):
+        return store_file
+    return f'{data_dir}sig/degg_scan_data_stamp.hdf5'
+
+
 ##################################################
 @click.command()
 @click.argument('data_dir')
@@ -205,7 +202,7 @@ def analysis_xscan(file_name, graph_dir, top_bottom, ref_data_dir):
 def main(data_dir, top_bottom, graph_dir_name):
 
     graph_dir = '/home/icecube/Workspace/degg_scan/graph/'+graph_dir_name+'/'
-    file_name = f'{data_dir}sig/degg_scan_data_stamp.hdf5'
+    file_name = scan_file(data_dir)
     ref_data_dir = f'{data_dir}ref/'
     try:
         os.mkdir(graph_dir)
@@ -30,7 +30,7 @@ def plot_2d_heatmap(x, y, val, graph_dir, top_bottom, mean_std='mean'):
 def analysis_yscan(file_name, graph_dir, top_bottom, ref_data_dir):
 
     ##scan data
-    df = pd.read_hdf(file_name, 'df')
+    df = load_scan(file_name)
     theta_range = np.array(df.tVal.unique())
     theta_range = np.sort(theta_range)
     z_range = np.array(df.rVal.unique())
@@ -78,7 +78,7 @@ def analysis_yscan(file_name, graph_dir, top_bottom, ref_data_dir):
 def main(data_dir, top_bottom, graph_dir_name):
 
     graph_dir = '/home/icecube/Workspace/degg_scan/graph/'+graph_dir_name+'/'
-    file_name = f'{data_dir}sig/degg_scan_data_stamp.hdf5'
+    file_name = scan_file(data_dir)
     ref_data_dir = f'{data_dir}ref/'
     try:
         os.mkdir(graph_dir)
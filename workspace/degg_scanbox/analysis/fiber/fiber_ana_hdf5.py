@@ -11,13 +11,15 @@ import matplotlib.pyplot as plt
 import numpy as np
 import tables
 
+from src.charge_extraction import read_charges, simpson
+
 def gaussian(x, A, mu, sigma):
     return A * np.exp(-(x-mu)**2/(2*sigma**2))
 
 
 def find_charge(t, waveform):
 
-    integrate_value = integrate.simps(waveform, t)
+    integrate_value = simpson(waveform, x=t)
     
     charge = integrate_value/50*1e12
     return charge
@@ -25,26 +27,8 @@ def find_charge(t, waveform):
 
 def get_charge(i):
 
-    charge_list = []
-
-    with tables.open_file(i) as open_file:
-        data = open_file.get_node('/data')
-        waveforms = data.col("waveform")
-        times = data.col("time")
-
-        start_point = int(len(times[0])/2)
-        end_point = int(start_point + len(times[0])//6)
-
-        base = np.mean(waveforms[0][0:200])
-
-        for time, waveform in tqdm(zip(times, waveforms)):
-            # np.sum(waveform[start_point:end_point])
-            waveform = -waveform[start_point:end_point] + base
-            time = time[start_point:end_point]
-            charge = find_charge(time, waveform)
-            charge_list.append(charge)
-
-    return charge_list
+    ##all waveforms at once, baseline per waveform
+    return read_charges(i)
 
 
 def fit_gaussian(bin, charge_list):
@@ -0,0 +1,140 @@
+##Local fake of the reference PMT scope, speaking raw socket SCPI
+##
+##Implements the subset of commands used by read_waveform.py and
+##scope_readout.py (single and sequence acquisition), returning gaussian
+##pulses on top of noise.  Like the real scope, data is sent as ASCII
+##until FORM REAL and FORM:BORD LSBF select REAL/LSBF blocks.
+##See test_scope_readout.py.
+
+import socketserver
+import threading
+import time
+import numpy as np
+
+
+class FakeScopeState(object):
+    def __init__(self, n_samples=1000, t_start=-5e-7, t_end=5e-7,
+                 trigger_period=0.):
+        self.n_samples = n_samples
+        self.t_start = t_start
+        self.t_end = t_end
+        self.trigger_period = trigger_period
+        self.segmented = False
+        self.n_segments = 1
+        self.multichannel = False
+        self.export_channels = set()
+        self.real_format = False
+        self.lsbf = False
+        self.n_arms = 0
+        self.rng = np.random.default_rng(0)
+        self.lock = threading.Lock()
+        self._acquired = None
+
+    def acquire(self):
+        n_segments = self.n_segments if self.segmented else 1
+        time.sleep(self.trigger_period * n_segments)
+        t = np.linspace(self.t_start, self.t_end, self.n_samples)
+        amplitude = self.rng.exponential(0.01, size=(n_segments, 4, 1))
+        pulse = -amplitude * np.exp(-0.5 * (t / 5e-9)**2)
+        noise = self.rng.normal(0, 5e-4, size=pulse.shape[:2] + t.shape)
+        self._acquired = (pulse + noise).astype('<f4')
+        self.n_arms += 1
+
+    def header(self):
+        return f'{self.t_start:e},{self.t_end:e},{self.n_samples},1'
+
+    def encode(self, data):
+        if not self.real_format:
+            return ','.join(f'{v:.6e}' for v in data.ravel())
+        dtype = '<f4' if self.lsbf else '>f4'
+        return ieee_block(np.ascontiguousarray(data, dtype=dtype).tobytes())
+
+    def channel_data(self, ch):
+        return self.encode(self._acquired[-1, ch - 1])
+
+    def export_data(self):
+        chs = sorted(self.export_channels)
+        ##(segment, sample, channel)
+        data = self._acquired[:, [ch - 1 for ch in chs], :]
+        return self.encode(data.transpose(0, 2, 1))
+
+
+def ieee_block(payload):
+    length = str(len(payload)).encode()
+    return b'#' + str(len(length)).encode() + length + payload + b'\n'
+
+
+class FakeScopeHandler(socketserver.StreamRequestHandler):
+    def reply(self, data):
+        if isinstance(data, str):
+            data = data.encode() + b'\n'
+        self.wfile.write(data)
+
+    def handle(self):
+        state = self.server.state
+        for line in self.rfile:
+            for cmd in line.decode().strip().split(';'):
+                cmd = cmd.strip().lstrip(':').upper()
+                if cmd == '':
+                    continue
+                with state.lock:
+                    self.dispatch(state, cmd)
+
+    def dispatch(self, state, cmd):
+        if cmd == '*IDN?':
+            self.reply('Rohde&Schwarz,FAKE-RTM3004,0,0.1')
+        elif cmd == '*OPC?':
+            self.reply('1')
+        elif cmd == '*RST':
+            state.segmented = False
+            state.n_segments = 1
+        elif cmd == 'SING':
+            state.acquire()
+        elif cmd.startswith('FORM:BORD'):
+            state.lsbf = cmd.split()[-1] == 'LSBF'
+        elif cmd.startswith('FORM'):
+            state.real_format = cmd.split()[-1].startswith('REAL')
+        elif cmd.startswith('ACQ:SEGM:STAT'):
+            state.segmented = cmd.split()[-1] in ['ON', '1']
+        elif cmd.startswith('ACQ:NSIN:COUN'):
+            state.n_segments = int(cmd.split()[-1])
+        elif cmd.startswith('EXP:WAV:MULT'):
+            state.multichannel = cmd.split()[-1] in ['ON', '1']
+        elif cmd.startswith('EXP:WAV:DATA?'):
+            self.reply(state.export_data())
+        elif cmd.startswith('CHAN') and ':EXP:STAT' in cmd:
+            ch = int(cmd[4:cmd.index(':')])
+            if cmd.split()[-1] in ['ON', '1']:
+                state.export_channels.add(ch)
+            else:
+                state.export_channels.discard(ch)
+        elif cmd.startswith('CHAN') and cmd.endswith(':DATA:HEAD?'):
+            self.reply(state.header())
+        elif cmd.startswith('CHAN') and cmd.endswith(':DATA?'):
+            ch = int(cmd[4:cmd.index(':')])
+            self.reply(state.channel_data(ch))
+        ##all other settings (TIM:SCAL, CHAN:TYPE, ...) are accepted
+
+
+class FakeScopeServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port=0, **kwargs):
+        super().__init__(('localhost', port), FakeScopeHandler)
+        self.state = FakeScopeState(**kwargs)
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
@@ -1,11 +1,13 @@
 from src.oriental_motor import *
 from src.thorlabs_hdr50 import *
 from src.kikusui import *
+from src.scan_store import container_rows
 
 from termcolor import colored
 from tqdm import tqdm
 import time
 import os
+import numpy as np
 import pandas as pd
 import threading
 
@@ -43,7 +45,7 @@ from degg_measurements.timing.setupHelper import getTimeMFH
 
 def run(filepath, run_file, r_point, t_point, icm_ports, deggNameList, deggList, sessionList, portList, hvSetList, thresholdList,
          baselineFileList, baselineList, ignoreList, method='charge_stamp', 
-        overwrite=True, verbose=False, ALT_FITTING=False):
+        overwrite=True, verbose=False, ALT_FITTING=False, scan_store=None):
     
     nevents = 1
     dac_value = 30000
@@ -152,7 +154,8 @@ def run(filepath, run_file, r_point, t_point, icm_ports, deggNameList, deggList,
     run_number = os.path.basename(run_file)
     run_number = run_number.split('.')[0]
     run_number = run_number.split('_')[-1]
-    saveContainer(deggsList, filepath, r_point, t_point, method, run_number, ALT_FITTING)
+    saveContainer(deggsList, filepath, r_point, t_point, method, run_number, ALT_FITTING,
+                  scan_store=scan_store)
 
 
 
@@ -160,7 +163,14 @@ def run(filepath, run_file, r_point, t_point, icm_ports, deggNameList, deggList,
 
 
 def saveContainer(deggContainerList, filepath, r_point, t_point, method='charge_stamp', run_number='00000',
-                  ALT_FITTING=False):
+                  ALT_FITTING=False, scan_store=None, total_file=True):
+
+    ##all points of the scan in one table
+    if scan_store is not None and method == 'charge_stamp':
+        rows = [container_rows(degg, channel) for degg in deggContainerList for channel in [0, 1]]
+        scan_store.append_point(t_point, r_point, np.concatenate(rows))
+    if not total_file:
+        return
 
     dfList = []
     for degg in deggContainerList:
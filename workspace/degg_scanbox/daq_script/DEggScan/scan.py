@@ -9,12 +9,16 @@ from tqdm import tqdm
 import numpy as np
 import threading
 import pandas as pd
+from contextlib import nullcontext
 #########
 
 from src.oriental_motor import *
 from src.thorlabs_hdr50 import *
 from src.kikusui import *
+from src.scan_store import ScanStore, container_rows
 import skippylab as sl
+from scope_readout import SequenceReader, measure_reference_sequence
+from scan_scheduler import ScanScheduler, ScanCheckpoint, OrientalAxis, ThorlabsAxis
 
 #########
 from degg_measurements import FH_SERVER_SCRIPTS
@@ -29,8 +33,9 @@ from degg_measurements.timing.setupHelper import recreateDEggStreams
 from degg_measurements.timing.setupHelper import getTimeMFH
 from degg_measurements.utils import create_save_dir
 from degg_measurements.utils import load_run_json, load_degg_dict, add_default_meas_dict, update_json
-from degg_measurements.timing.rapcalHelper import getRapCalData
+from degg_measurements.timing.rapcalHelper import getRapCalData, getRapCalDataParallel
 from degg_measurements.timing.setupHelper import getEventDataParallel
+from degg_measurements.timing.clock_model import ClockModelService
 from degg_measurements.timing.rapcalHelper import calculateTimingInfoAfterDataTaking
 from degg_measurements.timing.rapcalHelper import getRapCalData
 from degg_measurements.timing.rapcalHelper import calculateTimingInfoAfterDataTaking
@@ -86,11 +91,19 @@ def prepare_metadata(run_json, comment, filepath, fStrength, laser_freq, nevents
     return icm_ports, key, ignoreList
 
 
-def setup_paths(degg_id, meas_type):
-    data_dir = '/home/scanbox/data/scanbox/'
-    if(not os.path.exists(data_dir)):
-        os.mkdir(data_dir)
-    dirname = create_save_dir(data_dir, degg_id, meas_type)
+def setup_paths(degg_id, meas_type, resume=None):
+    ##resume: directory of an earlier scan, its checkpoint and scan store
+    ##are used again instead of creating a new directory
+    if resume is not None:
+        if not os.path.isdir(resume):
+            raise IOError(f'{resume} does not exist, cannot resume the scan!')
+        dirname = resume
+        print(f"Resuming the scan in {dirname}")
+    else:
+        data_dir = '/home/scanbox/data/scanbox/'
+        if(not os.path.exists(data_dir)):
+            os.mkdir(data_dir)
+        dirname = create_save_dir(data_dir, degg_id, meas_type)
     dirname_ref = os.path.join(dirname, 'ref')
     dirname_sig = os.path.join(dirname, 'sig')
     if not os.path.exists(dirname_ref):
@@ -129,8 +142,15 @@ def create_save_dir(data_dir, degg_id, meas_type):
 
 def run(filepath, run_json, r_point, t_point, icm_ports, deggNameList, deggList, sessionList, portList, hvSetList, thresholdList,
          baselineFileList, baselineList, ignoreList, method='charge_stamp', 
-        overwrite=True, verbose=False, ALT_FITTING=False):
-    
+        overwrite=True, verbose=False, ALT_FITTING=False, scan_store=None, clock_service=None):
+
+    ##the clock model only translates charge stamps, other methods take
+    ##the full RapCal sequence of every block
+    if clock_service is not None and method != 'charge_stamp':
+        print(colored(f'Clock model not supported for {method}, '
+                      'taking RapCals for every block', 'yellow'))
+        clock_service = None
+
     nevents = 1
     # dac_value = 30000
     dac_value = 22891
@@ -184,29 +204,37 @@ def run(filepath, run_json, r_point, t_point, icm_ports, deggNameList, deggList,
     deggBatches.append([tabletop])
     print("deggbatches1", deggBatches)
     ##get the ICM seed times in parallel to reduce offset between them
-    t_threads = []
-    for icms, deggBatch in zip(icmConnectList, deggBatches):
-        t_threads.append(threading.Thread(target=getTimeMFH, args=[icms, deggBatch]))
-    for t in t_threads:
-        t.start()
-    for t in t_threads:
-        t.join()
+    ##(the clock model keeps them from the first point)
+    if clock_service is not None and clock_service.seeds is not None:
+        for deggBatch, seed in zip(deggBatches, clock_service.seeds):
+            for degg in deggBatch:
+                degg.seedTimeICM, degg.seedTimeUTC = seed
+    else:
+        t_threads = []
+        for icms, deggBatch in zip(icmConnectList, deggBatches):
+            t_threads.append(threading.Thread(target=getTimeMFH, args=[icms, deggBatch]))
+        for t in t_threads:
+            t.start()
+        for t in t_threads:
+            t.join()
+        if clock_service is not None:
+            clock_service.seeds = [(deggBatch[0].seedTimeICM, deggBatch[0].seedTimeUTC)
+                                   for deggBatch in deggBatches]
 
     n_rapcals = 5
     rapcal_ports = [6000, 6008]
     nevents = 500
+    allDeggs = deggsList + [tabletop]
+    block_time = 0
     for i in range(n_rapcals):
         print(f'Event: {i}')
-        threads = []
-        print("RapCal A")
-        for deggBatch, icmConnect, rapcal_port in zip(deggBatches, icmConnectList, rapcal_ports):
-            if len(deggBatch) != 0:
-                seedTime = [deggBatch[0].seedTimeICM, deggBatch[0].seedTimeUTC]
-                threads.append(threading.Thread(target=getRapCalData, args=[icmConnect, rapcal_port, deggBatch, 1, verbose, seedTime, ALT_FITTING]))
-        for t in threads:
-            t.start()
-        for t in threads:
-            t.join()
+        ##with the clock model, RapCals are only taken if the data of
+        ##this block could not be translated precisely enough
+        if clock_service is None or clock_service.needs_rapcal(allDeggs, horizon=block_time):
+            print("RapCal A")
+            getRapCalDataParallel(icmConnectList, rapcal_ports, deggBatches, verbose, ALT_FITTING)
+            if clock_service is not None:
+                clock_service.update(allDeggs)
 
         threads = []
         print("Waveforms")
@@ -214,36 +242,54 @@ def run(filepath, run_json, r_point, t_point, icm_ports, deggNameList, deggList,
             for degg in deggBatch:
                 threads.append(threading.Thread(target=getEventDataParallel,
                                                 args=[degg, nevents, method, i, ALT_FITTING]))
+        t_start = time.time()
         for t in threads:
             t.start()
         for t in threads:
             t.join()
+        block_time = time.time() - t_start
 
-        threads = []
-        print("RapCal B")
-        for deggBatch, icmConnect, rapcal_port in zip(deggBatches, icmConnectList, rapcal_ports):
-            if len(deggBatch) != 0:
-                seedTime = [deggBatch[0].seedTimeICM, deggBatch[0].seedTimeUTC]
-                threads.append(threading.Thread(target=getRapCalData, args=[icmConnect, rapcal_port, deggBatch, 1, verbose, seedTime, ALT_FITTING]))
-        for t in threads:
-            t.start()
-        for t in threads:
-            t.join()
+        if clock_service is None or clock_service.needs_rapcal(allDeggs):
+            print("RapCal B")
+            getRapCalDataParallel(icmConnectList, rapcal_ports, deggBatches, verbose, ALT_FITTING)
+            if clock_service is not None:
+                clock_service.update(allDeggs)
         time.sleep(1.1)
 
     print("- Finished data taking -")
     ##calculate timing and save info
     deggsList.append(tabletop)
-    calculateTimingInfoAfterDataTaking(deggsList, method, ALT_FITTING)
+    if clock_service is None:
+        calculateTimingInfoAfterDataTaking(deggsList, method, ALT_FITTING)
+    else:
+        ##make sure the last block is covered precisely enough
+        if clock_service.needs_rapcal(deggsList):
+            getRapCalDataParallel(icmConnectList, rapcal_ports, deggBatches, verbose, ALT_FITTING)
+            clock_service.update(deggsList)
+        clock_service.calculate_timing_info(deggsList, method)
+
+        ##keep the models up to date in between points (while the motors move)
+        def scheduled_rapcal():
+            getRapCalDataParallel(icmConnectList, rapcal_ports, deggBatches, False, ALT_FITTING)
+            clock_service.update(deggsList)
+        clock_service.start(scheduled_rapcal, period=clock_service.period)
 
     run_number = os.path.basename(run_json)
     run_number = run_number.split('.')[0]
     run_number = run_number.split('_')[-1]
-    saveContainer(deggsList, filepath, r_point, t_point, method, run_number, ALT_FITTING)
+    saveContainer(deggsList, filepath, r_point, t_point, method, run_number, ALT_FITTING,
+                  scan_store=scan_store)
 
 
 def saveContainer(deggContainerList, filepath, r_point, t_point, method='charge_stamp', run_number='00000',
-                  ALT_FITTING=False):
+                  ALT_FITTING=False, scan_store=None, total_file=True):
+
+    ##all points of the scan in one table
+    if scan_store is not None and method == 'charge_stamp':
+        rows = [container_rows(degg, channel) for degg in deggContainerList for channel in [0, 1]]
+        scan_store.append_point(t_point, r_point, np.concatenate(rows))
+    if not total_file:
+        return
 
     dfList = []
     for degg in deggContainerList:
@@ -377,6 +423,19 @@ def setup_reference():
     scope.ping()
     return scope
 
+def setup_reference_sequence(reference_pmt_channel=1, n_segments=100):
+    print(colored(f"Setting up reference pmt sequence readout "
+                  f"({n_segments} segments per arm)...", 'green'))
+    ##imported here, the single waveform readout does not need vxi11
+    from read_waveform import init, set_DAQ
+    scope_ip = "10.25.101.2"
+    readch = 2**(reference_pmt_channel - 1)
+    instr = init(scope_ip)
+    set_DAQ(instr, readch)
+    reader = SequenceReader(instr, readch, n_segments=n_segments)
+    reader.configure()
+    return reader
+
 def convert_wf(raw_wf):
     times, volts = raw_wf
     return times, volts
@@ -384,6 +443,9 @@ def convert_wf(raw_wf):
 
 def measure_reference(filename, scope, reference_pmt_channel=1, num_reference_wfs=1000):
     print(colored(f"Reference Measurement - {num_reference_wfs} WFs", 'green'))
+    if isinstance(scope, SequenceReader):
+        measure_reference_sequence(filename, scope, num_reference_wfs)
+        return
     for i in range(num_reference_wfs):
         raw_wf = scope.acquire_waveform(reference_pmt_channel)
         times, wf = convert_wf(raw_wf)
@@ -436,8 +498,8 @@ def setup_oriental_motor():
 
 
 def measure(run_json, dir_sig, dir_ref, comment, meas_type, theta_step, theta_scan_points, r_step, r_scan_points, 
-            fStrength, rotate_slave_address, r_slave_address, stage, scope, rotate_stage = "", overwrite = True
-            ):
+            fStrength, rotate_slave_address, r_slave_address, stage, scope, rotate_stage = "", overwrite = True,
+            serpentine=True, clock_tolerance=0):
 
     reference_pmt_channel = 1
     #initialize DEgg and MB
@@ -464,69 +526,72 @@ def measure(run_json, dir_sig, dir_ref, comment, meas_type, theta_step, theta_sc
 
     print(f"thresholdList = {thresholdList}")
     # measuring
-    for theta_point in theta_scan_points:
-        #home r_stage
-        stage.moveToHome(r_slave_address)
-        print('r_stage homing...')
-        time.sleep(15)
-
-        print(f'Measuring: {r_scan_points}')
-        for event_num, r_point in enumerate(r_scan_points):
-            
-            ##take DEgg data
-            print("r_point =", r_point, "theta_point =", theta_point)
+    ##finished points are skipped when the scan is resumed
+    checkpoint = ScanCheckpoint(os.path.join(dir_sig, 'scan_checkpoint.json'))
+    ##all charge stamps of the scan, points already in it are not measured again
+    scan_store = ScanStore(os.path.join(dir_sig, 'scan_charge_stamp.hdf5'))
+    checkpoint.mark_points(scan_store.points()[['tVal', 'rVal']].to_numpy())
+
+    if meas_type == "bottom-r" or meas_type == "bottom-z":
+        theta_axis = ThorlabsAxis(rotate_stage)
+        ##undo the -90 deg of setup_thorlab_motor at the end
+        theta_end = theta_scan_points[0] + 90
+        ##homed by setup_thorlab_motor, also when resuming
+        theta_position = None
+    elif meas_type == "top-r" or meas_type == "top-z":
+        theta_axis = OrientalAxis(stage, rotate_slave_address, sign=-1)
+        theta_end = theta_scan_points[0]
+        ##not homed, a resumed scan continues from the last position
+        if checkpoint.theta_moving:
+            raise RuntimeError('The scan stopped during a theta move, the theta '
+                               'stage position is unknown. Move it to '
+                               f'{theta_scan_points[0]} deg and set theta_position '
+                               f'in {checkpoint.filename} before resuming.')
+        theta_position = checkpoint.theta_position
+    r_axis = OrientalAxis(stage, r_slave_address)
+
+    ##RapCals are shared between the points, the clock model decides when
+    ##new ones are needed (0: full RapCal sequence at every point)
+    clock_service = None
+    if clock_tolerance > 0:
+        clock_service = ClockModelService(tolerance=clock_tolerance)
+
+    def take_data(r_point, theta_point):
+        ##no scheduled RapCal while the point is measured
+        with clock_service.hold() if clock_service is not None else nullcontext():
             run(dir_sig, run_json, r_point, theta_point, icm_ports, deggNameList, deggList, sessionList, 
                 portList, hvSetList, thresholdList, baselineFileList, baselineList, ignoreList,
-                method='charge_stamp', verbose=False, ALT_FITTING=False)
-            # num_retry = 0
-            # retry = True
-            # while retry == True:
-            #     try:
-            #         print("r_point =", r_point, "theta_point =", theta_point)
-            #         run(dir_sig, run_json, r_point, theta_point, icm_ports, deggNameList, deggList, sessionList, 
-            #             portList, hvSetList, thresholdList, baselineFileList, baselineList, ignoreList,
-            #             method='charge_stamp', verbose=False, ALT_FITTING=False)
-            #         retry = False
-            #     except:
-            #         print(f'retry {num_retry}')
-            #         retry = True
-            #         num_retry += 1
-            #         if num_retry > 5:
-            #             print("failed to take the data")
-            #             retry = True
-
-            
-            print("r_motor moving...")
-            stage.moveRelative(r_slave_address, r_step)
-            time.sleep(5)
-        if meas_type == "bottom-r" or meas_type == "bottom-z":
-            rotate_stage.move_relative(theta_step)
-            rotate_stage.wait_up()
-        elif meas_type == "top-r" or meas_type == "top-z":
-            stage.moveRelative(rotate_slave_address, -theta_step)
-        print("theta_motor moving...")
-        time.sleep(5)
-        
-        #take reference data
+                method='charge_stamp', verbose=False, ALT_FITTING=False, scan_store=scan_store,
+                clock_service=clock_service)
+
+    def take_reference(theta_point):
         print("measuring reference PMT")
         reference_pmt_file = os.path.join(dir_ref, f'ref_{theta_point}.hdf5')
         measure_reference(reference_pmt_file, scope, reference_pmt_channel)
-    
-    if meas_type == "bottom-r" or meas_type == "bottom-z":
-        rotate_stage.move_relative(-270)
-        rotate_stage.wait_up()
-    elif meas_type == "top-r" or meas_type == "top-z":
-        stage.moveRelative(rotate_slave_address, 360)
+
+    scheduler = ScanScheduler(theta_axis, r_axis, take_data, take_reference,
+                              checkpoint=checkpoint, serpentine=serpentine,
+                              rehome_every=0 if serpentine else 1)
+    print(f'Measuring: {r_scan_points}')
+    timing = scheduler.run(theta_scan_points, r_scan_points,
+                           theta_position=theta_position)
+    print(f"motion: {timing['motion']:.0f} s, data: {timing['data']:.0f} s, "
+          f"waiting for reference: {timing['reference_wait']:.0f} s")
+
+    if clock_service is not None:
+        clock_service.stop()
+
     print('stage homing...')
-    for i in tqdm(range(120)):
-        time.sleep(1)
+    scheduler.move_theta_to(theta_end)
+    scheduler.home_r()
     
 
-def daq_wrapper(run_json, comment, meas_type):
+def daq_wrapper(run_json, comment, meas_type, ref_segments=0, serpentine=True, clock_tolerance=0,
+                resume=None):
 
     ##setup path
     degg_id = get_deggID(run_json)
-    dir_ref, dir_sig = setup_paths(degg_id, meas_type)
+    dir_ref, dir_sig = setup_paths(degg_id, meas_type, resume=resume)
     #set theta_range
     theta_step = 6 ##deg
     theta_max = 360 ##deg                                                                          
@@ -557,6 +622,7 @@ def daq_wrapper(run_json, comment, meas_type):
         r_max = 135 ##mm (radius)
         r_scan_points = np.arange(0, r_max, r_step)
         r_slave_address = 1
+        rotate_slave_address = None
         rotate_stage = setup_thorlab_motor()    
         fStrength = 0
     if(meas_type == "bottom-z"):
@@ -567,17 +633,21 @@ def daq_wrapper(run_json, comment, meas_type):
         r_max = 135 ##mm (radius)
         r_scan_points = np.arange(0, r_max, r_step)
         r_slave_address = 2
+        rotate_slave_address = None
         rotate_stage = setup_thorlab_motor()
         fStrength = 0
 
     #set up oriental motor 
     stage = setup_oriental_motor()
     #set up scope 
-    scope = setup_reference()
+    if ref_segments > 0:
+        scope = setup_reference_sequence(n_segments=ref_segments)
+    else:
+        scope = setup_reference()
 
     measure(run_json, dir_sig, dir_ref, comment, meas_type, theta_step, theta_scan_points, r_step, r_scan_points, 
-            fStrength, rotate_slave_address, r_slave_address, stage, scope, rotate_stage
-            )
+            fStrength, rotate_slave_address, r_slave_address, stage, scope, rotate_stage,
+            serpentine=serpentine, clock_tolerance=clock_tolerance)
 
 
 ###################################################
@@ -585,7 +655,19 @@ def daq_wrapper(run_json, comment, meas_type):
 @click.command()
 @click.argument('run_json')
 @click.argument('comment')
-def main(run_json, comment):
+@click.option('--ref-segments', default=0,
+              help='Record the reference PMT in sequence mode with this '
+                   'many segments per arm (0: one waveform per arm)')
+@click.option('--serpentine/--no-serpentine', default=True,
+              help='Scan r back and forth instead of homing the r stage '
+                   'for every theta row')
+@click.option('--clock-tolerance', default=0.,
+              help='Reuse the RapCals of earlier points while the clock model '
+                   'is more precise than this [s] (0: RapCals at every point)')
+@click.option('--resume', default=None, type=click.Path(exists=True, file_okay=False),
+              help='Directory of an interrupted scan (.../<meas_type>/YYYYMMDD_NN), '
+                   'its finished points are not measured again')
+def main(run_json, comment, ref_segments, serpentine, clock_tolerance, resume):
 
     questions = [
         inquirer.List(
@@ -601,7 +683,8 @@ def main(run_json, comment):
         print('bye bye')
         sys.exit()
 
-    daq_wrapper(run_json, comment, meas_type)
+    daq_wrapper(run_json, comment, meas_type, ref_segments, serpentine, clock_tolerance,
+                resume=resume)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,257 @@
+##Overlapped motion / acquisition scheduler for the theta/r scan
+##
+##Replaces the fixed sleeps of scan.measure:
+## - motors are polled (AZD_AD.waitForStop, HDR50.wait_settled) and the
+##   next point is measured as soon as they report to be stopped
+## - the r stage runs in serpentine order (out on even theta rows, back
+##   on odd ones) instead of being homed for every theta row, and it
+##   moves to the first point of a row together with the theta stage
+## - the reference PMT is read out in a thread while the motors move to
+##   the next theta row
+## - every finished point is written to a json checkpoint, a crashed
+##   scan started again with the same checkpoint (scan.py --resume)
+##   skips them
+
+import os
+import json
+import time
+import threading
+import numpy as np
+
+
+def serpentine_order(theta_scan_points, r_scan_points, serpentine=True):
+    '''returns [(theta_point, [r_point, ...]), ...] in measuring order'''
+    rows = []
+    for i, theta_point in enumerate(theta_scan_points):
+        r_points = list(r_scan_points)
+        if serpentine and i % 2 == 1:
+            r_points.reverse()
+        rows.append((theta_point, r_points))
+    return rows
+
+
+def point_key(theta_point, r_point):
+    return f'{float(theta_point):g}_{float(r_point):g}'
+
+
+class ScanCheckpoint(object):
+    '''
+    json record of the measured (theta, r) points and reference files,
+    rewritten atomically after every update
+
+    It also keeps the theta position of the stage after the last move
+    (None before the first one) and whether a theta move was started
+    but not finished, so a resumed scan knows where a stage is that is
+    not homed at start.
+    '''
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self.points = set()
+        self.references = set()
+        self.theta_position = None
+        self.theta_moving = False
+        if filename is not None and os.path.isfile(filename):
+            with open(filename, 'r') as open_file:
+                try:
+                    state = json.load(open_file)
+                    self.points = set(state['points'])
+                    self.references = set(state['references'])
+                    self.theta_position = state.get('theta_position')
+                    self.theta_moving = state.get('theta_moving', False)
+                except (json.decoder.JSONDecodeError, KeyError):
+                    print(f'Corrupt checkpoint {filename}, starting from scratch.')
+
+    def point_done(self, theta_point, r_point):
+        return point_key(theta_point, r_point) in self.points
+
+    def reference_done(self, theta_point):
+        return f'{float(theta_point):g}' in self.references
+
+    def mark_point(self, theta_point, r_point):
+        with self._lock:
+            self.points.add(point_key(theta_point, r_point))
+            self._save()
+
+    def mark_points(self, points):
+        '''marks [(theta_point, r_point), ...], e.g. the points of a ScanStore'''
+        with self._lock:
+            self.points.update(point_key(t, r) for t, r in points)
+            self._save()
+
+    def mark_reference(self, theta_point):
+        with self._lock:
+            self.references.add(f'{float(theta_point):g}')
+            self._save()
+
+    def start_theta_move(self):
+        with self._lock:
+            self.theta_moving = True
+            self._save()
+
+    def end_theta_move(self, theta_position):
+        with self._lock:
+            self.theta_position = float(theta_position)
+            self.theta_moving = False
+            self._save()
+
+    def _save(self):
+        if self.filename is None:
+            return
+        tmp_file = f'{self.filename}.tmp'
+        with open(tmp_file, 'w') as open_file:
+            json.dump({'points': sorted(self.points),
+                       'references': sorted(self.references),
+                       'theta_position': self.theta_position,
+                       'theta_moving': self.theta_moving},
+                      open_file, indent=4)
+        os.replace(tmp_file, self.filename)
+
+
+class OrientalAxis(object):
+    '''one slave of src/oriental_motor.AZD_AD (mm or degree)'''
+    def __init__(self, stage, slave_address, sign=1, timeout=120):
+        self.stage = stage
+        self.slave_address = slave_address
+        self.sign = sign
+        self.timeout = timeout
+
+    def start_move(self, distance):
+        self.stage.moveRelative(self.slave_address, self.sign * distance)
+
+    def start_home(self):
+        self.stage.startHome(self.slave_address)
+
+    def wait(self):
+        return self.stage.waitForStop(self.slave_address, timeout=self.timeout)
+
+
+class ThorlabsAxis(object):
+    '''src/thorlabs_hdr50.HDR50 rotation stage (degree)'''
+    def __init__(self, rotate_stage, sign=1, timeout=120):
+        self.rotate_stage = rotate_stage
+        self.sign = sign
+        self.timeout = timeout
+
+    def start_move(self, distance):
+        self.rotate_stage.move_relative(self.sign * distance)
+
+    def start_home(self):
+        ##the -90 deg offset of setup_thorlab_motor is not applied
+        self.rotate_stage.home()
+
+    def wait(self):
+        return self.rotate_stage.wait_settled(timeout=self.timeout)
+
+
+class ScanScheduler(object):
+    '''
+    theta_axis, r_axis: OrientalAxis / ThorlabsAxis
+    take_data(r_point, theta_point): D-Egg measurement at one point
+    take_reference(theta_point): reference PMT measurement after a row
+    checkpoint: ScanCheckpoint, points in it are skipped
+    rehome_every: home the r stage every n theta rows (0: only at start)
+
+    The theta stage is expected at theta_position (default
+    theta_scan_points[0]) when run() is called, the r stage is homed by
+    run() and r_points are measured from the home position.
+    '''
+    def __init__(self, theta_axis, r_axis, take_data, take_reference,
+                 checkpoint=None, serpentine=True, rehome_every=0):
+        self.theta_axis = theta_axis
+        self.r_axis = r_axis
+        self.take_data = take_data
+        self.take_reference = take_reference
+        self.checkpoint = checkpoint if checkpoint is not None else ScanCheckpoint()
+        self.serpentine = serpentine
+        self.rehome_every = rehome_every
+        self.theta_position = None
+        self.r_position = None
+        self._reference_thread = None
+        self._reference_errors = []
+        self.timing = {'motion': 0., 'data': 0., 'reference_wait': 0.}
+
+    def _move(self, theta_target=None, r_target=None):
+        ##start both stages, then wait for both
+        start = time.time()
+        moving = []
+        if theta_target is not None and not np.isclose(theta_target, self.theta_position):
+            self.checkpoint.start_theta_move()
+            self.theta_axis.start_move(theta_target - self.theta_position)
+            moving.append(self.theta_axis)
+            self.theta_position = theta_target
+        if r_target is not None and not np.isclose(r_target, self.r_position):
+            self.r_axis.start_move(r_target - self.r_position)
+            moving.append(self.r_axis)
+            self.r_position = r_target
+        for axis in moving:
+            axis.wait()
+        if self.theta_axis in moving:
+            self.checkpoint.end_theta_move(self.theta_position)
+        self.timing['motion'] += time.time() - start
+
+    def home_r(self):
+        start = time.time()
+        self.r_axis.start_home()
+        self.r_axis.wait()
+        self.r_position = 0.
+        self.timing['motion'] += time.time() - start
+
+    def move_theta_to(self, theta_target):
+        self._move(theta_target=theta_target)
+
+    def _start_reference(self, theta_point):
+        def worker():
+            try:
+                self.take_reference(theta_point)
+                self.checkpoint.mark_reference(theta_point)
+            except Exception as err:
+                self._reference_errors.append(err)
+        self._reference_thread = threading.Thread(target=worker)
+        self._reference_thread.start()
+
+    def _join_reference(self):
+        start = time.time()
+        if self._reference_thread is not None:
+            self._reference_thread.join()
+            self._reference_thread = None
+        self.timing['reference_wait'] += time.time() - start
+        if len(self._reference_errors) > 0:
+            raise self._reference_errors.pop(0)
+
+    def run(self, theta_scan_points, r_scan_points, theta_position=None):
+        if theta_position is None:
+            theta_position = theta_scan_points[0]
+        self.theta_position = float(theta_position)
+        self.home_r()
+        rows = serpentine_order(theta_scan_points, r_scan_points, self.serpentine)
+        try:
+            for row, (theta_point, r_points) in enumerate(rows):
+                todo = [r for r in r_points
+                        if not self.checkpoint.point_done(theta_point, r)]
+                if len(todo) == 0:
+                    if not self.checkpoint.reference_done(theta_point):
+                        self._join_reference()
+                        self._start_reference(theta_point)
+                    continue
+                if self.rehome_every > 0 and row > 0 and row % self.rehome_every == 0:
+                    self.home_r()
+
+                ##first point of the row, while the reference of the
+                ##previous row is still being read out
+                self._move(theta_target=float(theta_point), r_target=float(todo[0]))
+                self._join_reference()
+
+                for r_point in todo:
+                    self._move(r_target=float(r_point))
+                    print("r_point =", r_point, "theta_point =", theta_point)
+                    start = time.time()
+                    self.take_data(r_point, theta_point)
+                    self.timing['data'] += time.time() - start
+                    self.checkpoint.mark_point(theta_point, r_point)
+
+                if not self.checkpoint.reference_done(theta_point):
+                    self._start_reference(theta_point)
+        finally:
+            self._join_reference()
+        return self.timing
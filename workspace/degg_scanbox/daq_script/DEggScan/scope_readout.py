@@ -0,0 +1,267 @@
+##Sequence (segmented memory) readout of the reference PMT scope
+##
+##Instead of one SING;*OPC? + header + CHAN:DATA? round trip per waveform,
+##the scope records n_segments triggers per arm and all enabled channels
+##are downloaded in one binary block (REAL, LSBF), which is decoded with
+##np.frombuffer straight into a preallocated array.  Decoding and writing
+##run in a worker thread, so they overlap with the next arm/acquisition.
+##The binary download itself does not: the scope exports the segments of
+##the last arm, which the next SING overwrites, so every arm waits until
+##the data of the previous one has been transferred.
+##
+##Works with a vxi11.Instrument or with SCPISocket (raw SCPI on port 5025),
+##see fake_scope.py for a local test server.
+
+import socket
+import threading
+import queue
+import time
+import os
+import numpy as np
+import tables
+from datetime import datetime
+
+
+def parse_ieee_block(data):
+    '''
+    Returns the payload of an IEEE 488.2 definite length block
+    (#<n digits><length><payload>) as a memoryview, without copying
+    '''
+    data = memoryview(data)
+    if len(data) < 2 or data[0] != ord('#'):
+        raise ValueError('Response is not an IEEE 488.2 block')
+    n_digits = data[1] - ord('0')
+    if n_digits <= 0:
+        raise ValueError('Indefinite length blocks are not supported')
+    length = int(bytes(data[2:2 + n_digits]))
+    start = 2 + n_digits
+    if len(data) < start + length:
+        raise ValueError(f'Block is truncated: {len(data) - start}'
+                         f' of {length} bytes')
+    return data[start:start + length]
+
+
+class SCPISocket(object):
+    '''
+    Minimal raw socket SCPI instrument with the write/ask/read_raw
+    interface of vxi11.Instrument
+    '''
+    def __init__(self, host, port=5025, timeout=10):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._buf = bytearray()
+
+    def write(self, cmd):
+        self.sock.sendall(cmd.encode() + b'\n')
+
+    def _fill(self, n):
+        while len(self._buf) < n:
+            chunk = self.sock.recv(max(65536, n - len(self._buf)))
+            if not chunk:
+                raise ConnectionError('Scope closed the connection')
+            self._buf.extend(chunk)
+
+    def read_raw(self):
+        self._fill(1)
+        if self._buf[0] == ord('#'):
+            self._fill(2)
+            n_digits = self._buf[1] - ord('0')
+            self._fill(2 + n_digits)
+            total = 2 + n_digits + int(bytes(self._buf[2:2 + n_digits]))
+            ##payload + terminating newline
+            self._fill(total + 1)
+            data = bytes(self._buf[:total])
+            del self._buf[:total + 1]
+            return data
+        while b'\n' not in self._buf:
+            self._fill(len(self._buf) + 1)
+        end = self._buf.index(b'\n')
+        data = bytes(self._buf[:end])
+        del self._buf[:end + 1]
+        return data
+
+    def read(self):
+        return self.read_raw().decode()
+
+    def ask(self, cmd):
+        self.write(cmd)
+        return self.read().strip()
+
+    def close(self):
+        self.sock.close()
+
+
+def channel_list(readch):
+    ##readch is the bit mask used in read_waveform.py (ch1 -> 1, ch3 -> 4)
+    return [i + 1 for i in range(4) if (readch & (2**i)) > 0]
+
+
+class SequenceReader(object):
+    '''
+    Pipelined segmented-memory readout of one or more scope channels
+
+    instr:      vxi11.Instrument or SCPISocket
+    readch:     channel bit mask as in read_waveform.py
+    n_segments: triggers recorded per arm
+
+    The SCPI commands are class attributes so they can be adapted to the
+    scope firmware.  configure() also sets the binary data format, the
+    scope answers in ASCII otherwise.  The data query is expected to return all segments of
+    all exported channels as float32, interleaved per sample:
+    (segment, sample, channel).
+
+    Only decoding and writing overlap with the next acquisition.  The
+    download of a sequence still blocks the next arm, the scope keeps
+    the segments of a single arm only.
+    '''
+    FORMAT_CMDS = ['FORM REAL', 'FORM:BORD LSBF']
+    SEGMENT_CMDS = ['ACQ:SEGM:STAT ON', 'ACQ:NSIN:COUN {n_segments}']
+    MULTICHANNEL_CMDS = ['EXP:WAV:MULT ON']
+    CHANNEL_EXPORT_CMD = 'CHAN{ch}:EXP:STAT ON'
+    ARM_QUERY = 'SING;*OPC?'
+    HEADER_QUERY = 'CHAN{ch}:DATA:HEAD?'
+    DATA_QUERY = 'EXP:WAV:DATA?'
+
+    def __init__(self, instr, readch, n_segments=100):
+        self.instr = instr
+        self.channels = channel_list(readch)
+        if len(self.channels) == 0:
+            raise ValueError(f'No channel selected in readch={readch}')
+        self.n_segments = int(n_segments)
+        self.times = None
+        self._buffer = None
+
+    def configure(self):
+        for cmd in self.FORMAT_CMDS:
+            self.instr.write(cmd)
+        for cmd in self.SEGMENT_CMDS:
+            self.instr.write(cmd.format(n_segments=self.n_segments))
+        for cmd in self.MULTICHANNEL_CMDS:
+            self.instr.write(cmd)
+        for ch in self.channels:
+            self.instr.write(self.CHANNEL_EXPORT_CMD.format(ch=ch))
+
+    def _read_header(self):
+        header = self.instr.ask(
+            self.HEADER_QUERY.format(ch=self.channels[0])).split(',')
+        t_start = float(header[0])
+        t_end = float(header[1])
+        n_samples = int(header[2])
+        self.times = np.linspace(t_start, t_end, n_samples,
+                                 dtype=np.float32)
+        self._buffer = np.empty(
+            (self.n_segments, len(self.channels), n_samples),
+            dtype=np.float32)
+
+    def acquire_raw(self):
+        '''arm, wait for n_segments triggers and download the raw block'''
+        self.instr.ask(self.ARM_QUERY)
+        if self.times is None:
+            self._read_header()
+        self.instr.write(self.DATA_QUERY)
+        return self.instr.read_raw()
+
+    def decode(self, raw):
+        '''
+        decode a raw block into the preallocated
+        (n_segments, n_channels, n_samples) buffer, which is returned
+        and reused by the next call
+        '''
+        payload = parse_ieee_block(raw)
+        n_seg, n_ch, n_samples = self._buffer.shape
+        if len(payload) != 4 * n_seg * n_ch * n_samples:
+            raise ValueError(f'Expected {4 * n_seg * n_ch * n_samples} '
+                             f'bytes, got {len(payload)}')
+        data = np.frombuffer(payload, dtype='<f4').reshape(
+            n_seg, n_samples, n_ch)
+        np.copyto(self._buffer, data.transpose(0, 2, 1))
+        return self._buffer
+
+    def run(self, n_waveforms, callback, max_pending=2):
+        '''
+        Acquire at least n_waveforms per channel.  callback(first_index,
+        times, block) is called from a worker thread for every decoded
+        block, while the main thread already arms the next acquisition
+        (after the download of the block).  block is reused, callbacks
+        have to copy what they keep.
+        '''
+        n_arms = int(np.ceil(n_waveforms / self.n_segments))
+        pending = queue.Queue(maxsize=max_pending)
+        errors = []
+
+        def worker():
+            while True:
+                item = pending.get()
+                if item is None:
+                    break
+                first_index, raw = item
+                if len(errors) > 0:
+                    continue
+                try:
+                    block = self.decode(raw)
+                    n_keep = min(self.n_segments, n_waveforms - first_index)
+                    callback(first_index, self.times, block[:n_keep])
+                except Exception as err:
+                    errors.append(err)
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        try:
+            for i in range(n_arms):
+                if len(errors) > 0:
+                    break
+                pending.put((i * self.n_segments, self.acquire_raw()))
+        finally:
+            pending.put(None)
+            thread.join()
+        if len(errors) > 0:
+            raise errors[0]
+        return n_arms * self.n_segments
+
+
+class HDF5BlockWriter(object):
+    '''
+    Appends blocks of waveforms to the /data table layout of
+    master_scope.write_to_hdf5, one flush per block instead of
+    opening the file for every waveform
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __call__(self, first_index, times, waveforms):
+        if not os.path.isfile(self.filename):
+            class Event(tables.IsDescription):
+                event_id = tables.Int32Col()
+                time = tables.Float32Col(shape=np.asarray(times).shape)
+                waveform = tables.Float32Col(shape=waveforms.shape[1:])
+                timestamp = tables.Int64Col()
+                pc_time = tables.Float32Col()
+                datetime_timestamp = tables.Float64Col()
+
+            with tables.open_file(self.filename, 'w') as open_file:
+                open_file.create_table('/', 'data', Event)
+
+        with tables.open_file(self.filename, 'a') as open_file:
+            table = open_file.get_node('/data')
+            rows = np.zeros(len(waveforms), dtype=table.dtype)
+            rows['event_id'] = first_index + np.arange(len(waveforms))
+            rows['time'] = times
+            rows['waveform'] = waveforms
+            rows['datetime_timestamp'] = datetime.now().timestamp()
+            table.append(rows)
+            table.flush()
+
+
+def measure_reference_sequence(filename, reader, num_reference_wfs=1000):
+    '''
+    Sequence mode replacement for scan.measure_reference, the waveforms
+    of a single channel are written with the same layout
+    '''
+    writer = HDF5BlockWriter(filename)
+    if len(reader.channels) == 1:
+        callback = lambda i, t, block: writer(i, t, block[:, 0, :])
+    else:
+        callback = writer
+    start = time.time()
+    reader.run(num_reference_wfs, callback)
+    return time.time() - start
@@ -0,0 +1,131 @@
+##Tests of the scan scheduler against fake stages: a scan killed in the
+##middle of the grid and resumed with its checkpoint
+
+import numpy as np
+import pytest
+
+from scan_scheduler import ScanScheduler, ScanCheckpoint, OrientalAxis
+from scan_scheduler import serpentine_order
+
+THETA_POINTS = np.arange(0, 30, 6)
+R_POINTS = np.arange(0, 12, 3)
+
+
+class FakeStage(object):
+    '''AZD_AD with the physical position of every slave'''
+    def __init__(self):
+        self.position = {5: 0., 3: 0.}
+
+    def moveRelative(self, slave_address, distance):
+        self.position[slave_address] += distance
+
+    def startHome(self, slave_address):
+        self.position[slave_address] = 0.
+
+    def waitForStop(self, slave_address, timeout=120):
+        return 0.
+
+
+class Killed(Exception):
+    pass
+
+
+class FakeScan(object):
+    '''take_data / take_reference recording the physical stage position'''
+    def __init__(self, stage, kill_after=None):
+        self.stage = stage
+        self.kill_after = kill_after
+        self.points = []
+        self.references = []
+
+    def take_data(self, r_point, theta_point):
+        if self.kill_after is not None and len(self.points) == self.kill_after:
+            raise Killed()
+        ##theta axis has sign -1
+        self.points.append((theta_point, r_point,
+                            -self.stage.position[5], self.stage.position[3]))
+
+    def take_reference(self, theta_point):
+        self.references.append(theta_point)
+
+
+def scheduler(stage, scan, checkpoint):
+    return ScanScheduler(OrientalAxis(stage, 5, sign=-1), OrientalAxis(stage, 3),
+                         scan.take_data, scan.take_reference,
+                         checkpoint=checkpoint)
+
+
+def all_points():
+    return [(t, r) for t, rs in serpentine_order(THETA_POINTS, R_POINTS)
+            for r in rs]
+
+
+def check_positions(scan):
+    for theta_point, r_point, theta, r in scan.points:
+        assert theta == pytest.approx(theta_point)
+        assert r == pytest.approx(r_point)
+
+
+def test_full_scan(tmp_path):
+    stage = FakeStage()
+    scan = FakeScan(stage)
+    checkpoint = ScanCheckpoint(str(tmp_path / 'scan_checkpoint.json'))
+    scheduler(stage, scan, checkpoint).run(THETA_POINTS, R_POINTS)
+    assert [p[:2] for p in scan.points] == all_points()
+    assert scan.references == list(THETA_POINTS)
+    check_positions(scan)
+    assert checkpoint.theta_position == THETA_POINTS[-1]
+    assert not checkpoint.theta_moving
+
+
+@pytest.mark.parametrize('kill_after', [1, 9, 13])
+def test_kill_and_resume(tmp_path, kill_after):
+    filename = str(tmp_path / 'scan_checkpoint.json')
+    stage = FakeStage()
+    first = FakeScan(stage, kill_after=kill_after)
+    with pytest.raises(Killed):
+        scheduler(stage, first, ScanCheckpoint(filename)).run(
+            THETA_POINTS, R_POINTS)
+    assert len(first.points) == kill_after
+    check_positions(first)
+
+    ##a new process: the stages stay where they are, the theta position
+    ##comes from the checkpoint
+    checkpoint = ScanCheckpoint(filename)
+    assert len(checkpoint.points) == kill_after
+    assert not checkpoint.theta_moving
+    second = FakeScan(stage)
+    scheduler(stage, second, checkpoint).run(
+        THETA_POINTS, R_POINTS, theta_position=checkpoint.theta_position)
+    check_positions(second)
+    measured = [p[:2] for p in first.points + second.points]
+    assert measured == all_points()
+    assert sorted(first.references + second.references) == list(THETA_POINTS)
+
+    ##resuming a finished scan measures nothing
+    third = FakeScan(stage)
+    checkpoint = ScanCheckpoint(filename)
+    scheduler(stage, third, checkpoint).run(
+        THETA_POINTS, R_POINTS, theta_position=checkpoint.theta_position)
+    assert third.points == [] and third.references == []
+
+
+def test_resume_from_stored_points(tmp_path):
+    ##killed after the data of a point was stored, before its checkpoint
+    ##entry: the points of the scan store are marked when resuming
+    filename = str(tmp_path / 'scan_checkpoint.json')
+    stage = FakeStage()
+    first = FakeScan(stage, kill_after=6)
+    with pytest.raises(Killed):
+        scheduler(stage, first, ScanCheckpoint(filename)).run(
+            THETA_POINTS, R_POINTS)
+    stored = [p[:2] for p in first.points] + [all_points()[6]]
+
+    checkpoint = ScanCheckpoint(filename)
+    checkpoint.mark_points(stored)
+    second = FakeScan(stage)
+    scheduler(stage, second, checkpoint).run(
+        THETA_POINTS, R_POINTS, theta_position=checkpoint.theta_position)
+    check_positions(second)
+    assert stored + [p[:2] for p in second.points] == all_points()
+    assert len(ScanCheckpoint(filename).points) == len(all_points())
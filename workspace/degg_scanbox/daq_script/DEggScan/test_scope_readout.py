@@ -0,0 +1,83 @@
+##Tests of the sequence readout of the reference scope against the local
+##fake scope (fake_scope.py)
+
+import numpy as np
+import pytest
+import tables
+
+from fake_scope import FakeScopeServer
+from scope_readout import SCPISocket, SequenceReader, parse_ieee_block
+from scope_readout import measure_reference_sequence
+
+
+@pytest.fixture
+def scope():
+    server = FakeScopeServer(n_samples=200).start()
+    instr = SCPISocket('localhost', server.port)
+    yield server, instr
+    instr.close()
+    server.stop()
+
+
+def test_parse_ieee_block():
+    payload = np.arange(5, dtype='<f4').tobytes()
+    block = b'#220' + payload
+    assert bytes(parse_ieee_block(block)) == payload
+    with pytest.raises(ValueError):
+        parse_ieee_block(b'1.0,2.0')
+    with pytest.raises(ValueError):
+        parse_ieee_block(b'#240' + payload)
+
+
+def test_configure_sets_binary_format(scope):
+    server, instr = scope
+    reader = SequenceReader(instr, 1, n_segments=10)
+    reader.configure()
+    instr.ask('*OPC?')
+    assert server.state.real_format
+    assert server.state.lsbf
+    assert server.state.segmented
+    assert server.state.n_segments == 10
+    assert server.state.export_channels == {1}
+
+
+def test_ascii_reply_is_rejected(scope):
+    server, instr = scope
+    reader = SequenceReader(instr, 1, n_segments=10)
+    reader.FORMAT_CMDS = []
+    reader.configure()
+    with pytest.raises(ValueError):
+        reader.decode(reader.acquire_raw())
+
+
+@pytest.mark.parametrize('readch', [1, 1 + 4])
+def test_sequence_blocks(scope, readch):
+    server, instr = scope
+    reader = SequenceReader(instr, readch, n_segments=10)
+    reader.configure()
+    blocks = []
+    n = reader.run(25, lambda i, t, block: blocks.append((i, block.copy())))
+    assert n == 30
+    assert server.state.n_arms == 3
+    assert [i for i, _ in blocks] == [0, 10, 20]
+    assert [len(block) for _, block in blocks] == [10, 10, 5]
+    assert reader.times.shape == (200,)
+    # the last arm is still in the scope, compare with its raw data
+    n_channels = len(reader.channels)
+    expected = server.state._acquired[:5, [ch - 1 for ch in
+                                           reader.channels], :]
+    assert blocks[-1][1].shape == (5, n_channels, 200)
+    np.testing.assert_array_equal(blocks[-1][1], expected)
+
+
+def test_measure_reference_sequence(scope, tmp_path):
+    server, instr = scope
+    reader = SequenceReader(instr, 1, n_segments=8)
+    reader.configure()
+    filename = str(tmp_path / 'ref.hdf5')
+    measure_reference_sequence(filename, reader, num_reference_wfs=20)
+    with tables.open_file(filename) as open_file:
+        data = open_file.get_node('/data').read()
+    assert len(data) == 20
+    np.testing.assert_array_equal(data['event_id'], np.arange(20))
+    assert data['waveform'].shape == (20, 200)
@@ -7,5 +7,7 @@ setup(
     description='Collection of scripts for DEgg Scan system',
     author='Icehap',
     packages=['src'],
+    install_requires=['numpy', 'pandas', 'scipy', 'tables', 'pyserial',
+                      'thorlabs_apt_device', 'python-vxi11'],
 
 )
\ No newline at end of file
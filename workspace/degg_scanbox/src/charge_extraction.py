@@ -0,0 +1,96 @@
+##Charge extraction for scope waveform files (/data table with 'time'
+##and 'waveform' columns, one row per trigger)
+##
+##All waveforms of a chunk are integrated with one Simpson call along
+##the sample axis, with a baseline per waveform from a pre-pulse window.
+##The table is read in chunks, so files with 10^5 waveforms do not have
+##to fit into memory at once.
+
+import numpy as np
+import tables
+from scipy import integrate
+
+##scipy < 1.6 only has simps
+simpson = getattr(integrate, 'simpson', None) or integrate.simps
+
+IMPEDANCE = 50 ##Ohm
+BASELINE_WINDOW = (0, 200)
+
+
+def default_window(n_samples):
+    ##integration window starting at the trigger (centre of the record),
+    ##one sixth of the record long
+    start_point = int(n_samples/2)
+    return start_point, start_point + n_samples//6
+
+
+def pre_pulse_baselines(waveforms, window=BASELINE_WINDOW):
+    ##mean of the pre-pulse window of every waveform
+    return np.mean(waveforms[:, window[0]:window[1]], axis=1, dtype=float)
+
+
+def integrate_waveforms(times, waveforms, start_point, end_point,
+                        baselines=None, invert=True, impedance=IMPEDANCE):
+    '''
+    Charges [pC] of a (n_waveforms, n_samples) matrix, integrating
+    samples start_point:end_point with Simpson's rule.
+    times: (n_samples,) common time axis or (n_waveforms, n_samples)
+    baselines: float, one value per waveform or None (pre-pulse window)
+    invert: negative pulses, integrate baseline - waveform
+    '''
+    waveforms = np.asarray(waveforms)
+    times = np.asarray(times, dtype=float)
+    if baselines is None:
+        baselines = pre_pulse_baselines(waveforms)
+    baselines = np.asarray(baselines, dtype=float)
+    if baselines.ndim == 1:
+        baselines = baselines[:, np.newaxis]
+
+    pulse = waveforms[:, start_point:end_point] - baselines
+    if invert:
+        pulse = -pulse
+    if times.ndim == 1:
+        t = times[start_point:end_point]
+    else:
+        t = times[:, start_point:end_point]
+        ##a shared time axis is much faster to integrate
+        if np.all(t == t[0]):
+            t = t[0]
+    return simpson(pulse, x=t, axis=-1)/impedance*1e12
+
+
+def read_charges(filename, start_point=None, end_point=None,
+                 baseline_window=BASELINE_WINDOW, per_waveform_baseline=True,
+                 invert=True, chunk_size=10000, node='/data'):
+    '''
+    Charges [pC] of all waveforms in filename.
+    start_point/end_point default to default_window(n_samples).
+    per_waveform_baseline=False uses the pre-pulse baseline of the
+    first waveform for all of them (the old behaviour).
+    '''
+    with tables.open_file(filename) as open_file:
+        data = open_file.get_node(node)
+        n_rows = data.nrows
+        charges = np.zeros(n_rows)
+        if n_rows == 0:
+            return charges
+        first = data.read(0, 1)
+        n_samples = first['waveform'].shape[-1]
+        if start_point is None or end_point is None:
+            start_point, end_point = default_window(n_samples)
+        base = None
+        if not per_waveform_baseline:
+            base = pre_pulse_baselines(first['waveform'], baseline_window)[0]
+
+        for start in range(0, n_rows, chunk_size):
+            stop = min(start + chunk_size, n_rows)
+            rows = data.read(start, stop)
+            waveforms = rows['waveform']
+            if per_waveform_baseline:
+                baselines = pre_pulse_baselines(waveforms, baseline_window)
+            else:
+                baselines = base
+            charges[start:stop] = integrate_waveforms(
+                rows['time'], waveforms, start_point, end_point,
+                baselines=baselines, invert=invert)
+    return charges
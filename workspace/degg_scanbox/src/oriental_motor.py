@@ -134,14 +134,19 @@ class AZD_AD():
         time.sleep(5)
         self.ZHOMEOff(slaveAddress)
 
-    def moveRelative(self, slaveAddress, distance):
-
+    def stepsPerUnit(self, slaveAddress):
+        # steps per mm (slave 1-4) or per degree (slave 5)
         if(slaveAddress==1 or slaveAddress==3):
-            displacement = int(distance * 500/3)
+            return 500/3
         elif(slaveAddress==2 or slaveAddress==4):
-            displacement = int(distance * 500)
+            return 500
         elif(slaveAddress==5):
-            displacement = int(distance * 100)
+            return 100
+        raise ValueError("unknown slave address " + str(slaveAddress))
+
+    def moveRelative(self, slaveAddress, distance):
+
+        displacement = int(distance * self.stepsPerUnit(slaveAddress))
             
         functionCode = 0x10
         dataStart = 0x0058
@@ -160,4 +165,96 @@ class AZD_AD():
         command = self.genCommand(slaveAddress, functionCode, dataStart, dataNum, data)
         self._driver.write(command)
         self._driver.read(self.size)
-        return command
\ No newline at end of file
+        return command
+
+    # ----- status polling (function code 0x03) -----
+
+    # driver output status (lower), detection position (upper, lower)
+    OUTPUT_STATUS = 0x007F
+    DETECTION_POSITION = 0x00CC
+    READY = 0x0020
+    ALM_A = 0x0080
+    MOVE = 0x2000
+
+    def genReadCommand(self, slaveAddress, dataStart, dataNum):
+        res = [slaveAddress, 0x03]
+        res += self.to2Int(dataStart)
+        res += self.to2Int(dataNum)
+        return self.calcCRC(bytes(res))
+
+    def readRegisters(self, slaveAddress, dataStart, dataNum, timeout=0.5):
+        # returns the dataNum registers starting at dataStart as 2 byte ints
+        command = self.genReadCommand(slaveAddress, dataStart, dataNum)
+        self._driver.reset_input_buffer()
+        self._driver.write(command)
+
+        # slave, function, byte count, data, CRC
+        expected = 5 + 2*dataNum
+        response = b''
+        deadline = time.time() + timeout
+        while len(response) < expected and time.time() < deadline:
+            response += self._driver.read(expected - len(response))
+            if len(response) >= 3 and response[1] & 0x80:
+                # exception response: slave, 0x83, code, CRC
+                raise IOError("slave " + str(slaveAddress) +
+                              " returned exception code " +
+                              hex(response[2]))
+        if len(response) < expected:
+            raise TimeoutError("no response from slave " + str(slaveAddress))
+        if self.calcCRC(response[:-2]) != response:
+            raise IOError("CRC error in response from slave " +
+                          str(slaveAddress))
+
+        data = response[3:-2]
+        return [data[2*i]*16**2 + data[2*i+1] for i in range(dataNum)]
+
+    def getStatus(self, slaveAddress):
+        return self.readRegisters(slaveAddress, self.OUTPUT_STATUS, 1)[0]
+
+    def isMoving(self, slaveAddress):
+        return bool(self.getStatus(slaveAddress) & self.MOVE)
+
+    def getPosition(self, slaveAddress):
+        # detection position in mm (slave 1-4) or degree (slave 5)
+        upper, lower = self.readRegisters(slaveAddress,
+                                          self.DETECTION_POSITION, 2)
+        steps = upper*16**4 + lower
+        if(steps >= 16**8/2):
+            steps -= 16**8
+        return steps / self.stepsPerUnit(slaveAddress)
+
+    def waitForStop(self, slaveAddress, timeout=120, interval=0.05,
+                    startTimeout=0.5):
+        # poll until MOVE is off and READY is on instead of sleeping
+        # a fixed time; the MOVE bit may take a few ms to come up after
+        # the command, so READY alone is not trusted for startTimeout
+        start = time.time()
+        started = False
+        while True:
+            status = self.getStatus(slaveAddress)
+            if status & self.ALM_A:
+                raise RuntimeError("alarm on slave " + str(slaveAddress))
+            elapsed = time.time() - start
+            if status & self.MOVE:
+                started = True
+            elif status & self.READY:
+                if started or elapsed >= startTimeout:
+                    return elapsed
+            if elapsed > timeout:
+                raise TimeoutError("slave " + str(slaveAddress) +
+                                   " still moving after " + str(timeout) + " s")
+            time.sleep(interval)
+
+    def startHome(self, slaveAddress):
+        # ZHOME starts on the rising edge, no need to hold it
+        self.ZHOMEOn(slaveAddress)
+        time.sleep(0.05)
+        self.ZHOMEOff(slaveAddress)
+
+    def homeAndWait(self, slaveAddress, timeout=120):
+        self.startHome(slaveAddress)
+        return self.waitForStop(slaveAddress, timeout=timeout)
+
+    def moveRelativeAndWait(self, slaveAddress, distance, timeout=120):
+        self.moveRelative(slaveAddress, distance)
+        return self.waitForStop(slaveAddress, timeout=timeout)
@@ -0,0 +1,173 @@
+##Scan-level store for the charge stamps of a theta/r (or theta/z) scan
+##
+##All points of a scan go into one chunked, compressed table with the
+##scan position, D-Egg port and PMT as columns, instead of one
+##total_*.hdf5 file per point. A second table maps every point to its
+##row range, so single points are read without scanning the data.
+##
+##The index row of a point is written after its data rows, a point
+##whose writing was interrupted is therefore not in the index and is
+##measured again when the scan is resumed. Measuring a point again
+##appends new rows and a new index row, the last one wins.
+
+import os
+import numpy as np
+import pandas as pd
+import tables
+
+DATA_TABLE = 'data'
+INDEX_TABLE = 'point_index'
+
+##mfhTime is in fs since datetime_offset (~1e23), float64 would only
+##resolve ~10 ns there
+SCAN_DTYPE = np.dtype([
+    ('tVal', np.float64), ('rVal', np.float64),
+    ('port', np.int32), ('pmt', 'S32'), ('channel', np.int32),
+    ('timestamp', np.float64), ('charge', np.float64),
+    ('mfhTime', np.longdouble), ('delta', np.float64), ('offset', np.float64),
+    ('blockNum', np.int32), ('triggerNum', np.int64),
+    ('cableDelay0', np.float64), ('cableDelay1', np.float64),
+    ('clockDrift', np.float64), ('temperature', np.float64)])
+
+INDEX_DTYPE = np.dtype([
+    ('tVal', np.float64), ('rVal', np.float64),
+    ('start', np.int64), ('stop', np.int64), ('written', np.float64)])
+
+##column -> attribute of the infoContainer filled during data taking
+INFO_COLUMNS = {
+    'channel': 'channel', 'timestamp': 'timestamp', 'charge': 'charge',
+    'mfhTime': 'mfh_t', 'delta': 'delta', 'offset': 'datetime_offset',
+    'blockNum': 'i_pair', 'triggerNum': 'triggerNum',
+    'cableDelay0': 'cable_delay0', 'cableDelay1': 'cable_delay1',
+    'clockDrift': 'clockDrift'}
+
+
+def container_rows(degg, channel):
+    '''rows of the charge stamps of one PMT of a deggContainer'''
+    info = degg.info0 if channel == 0 else degg.info1
+    rows = np.zeros(len(info), dtype=SCAN_DTYPE)
+    for column, attribute in INFO_COLUMNS.items():
+        rows[column] = [getattr(_info, attribute) for _info in info]
+    rows['port'] = degg.port
+    pmt = getattr(degg, 'lowerPMT' if channel == 0 else 'upperPMT', '')
+    rows['pmt'] = str(pmt).encode()
+    rows['temperature'] = getattr(degg, 'temperature', np.nan)
+    return rows
+
+
+class ScanStore(object):
+    '''
+    One HDF5 file per scan, see the module header.
+
+    DataFrames returned by `read` have the columns of the total_*.hdf5
+    files (rVal/tVal for the position) plus port and pmt.
+    '''
+    def __init__(self, filename, expectedrows=1000000):
+        self.filename = filename
+        self.expectedrows = expectedrows
+
+    def _open(self, mode):
+        if mode == 'r' and not os.path.isfile(self.filename):
+            raise IOError(f'{self.filename} does not exist!')
+        open_file = tables.open_file(self.filename, mode)
+        if DATA_TABLE not in open_file.root:
+            if mode == 'r':
+                open_file.close()
+                raise IOError(f'{self.filename} is not a scan store!')
+            filters = tables.Filters(complevel=5, complib='zlib')
+            open_file.create_table(
+                '/', DATA_TABLE, description=SCAN_DTYPE,
+                title='Charge stamps', filters=filters,
+                expectedrows=self.expectedrows)
+            open_file.create_table(
+                '/', INDEX_TABLE, description=INDEX_DTYPE,
+                title='Row range of every scan point')
+        return open_file
+
+    def append_point(self, theta_point, r_point, rows):
+        '''
+        Append the rows (SCAN_DTYPE or anything numpy can convert) of
+        one point, replacing earlier data of the same point.
+        '''
+        rows = np.array(rows, dtype=SCAN_DTYPE)
+        rows['tVal'] = theta_point
+        rows['rVal'] = r_point
+        with self._open('a') as open_file:
+            data = open_file.get_node('/', DATA_TABLE)
+            start = data.nrows
+            data.append(rows)
+            data.flush()
+            index = open_file.get_node('/', INDEX_TABLE)
+            index.append(np.array(
+                [(theta_point, r_point, start, start + len(rows),
+                  pd.Timestamp.now().timestamp())], dtype=INDEX_DTYPE))
+            index.flush()
+
+    def _read_index(self, open_file):
+        index = open_file.get_node('/', INDEX_TABLE).read()
+        ##keep the last entry of every point
+        _, last = np.unique(index[['tVal', 'rVal']][::-1], return_index=True)
+        return np.sort(index[len(index) - 1 - last], order='start')
+
+    def points(self):
+        '''DataFrame of the measured points (tVal, rVal, start, stop)'''
+        if not os.path.isfile(self.filename):
+            return pd.DataFrame(np.zeros(0, dtype=INDEX_DTYPE))
+        with self._open('r') as open_file:
+            return pd.DataFrame(self._read_index(open_file))
+
+    def has_point(self, theta_point, r_point):
+        points = self.points()
+        return bool(np.any((points.tVal == theta_point) &
+                           (points.rVal == r_point)))
+
+    def read_array(self, theta_point=None, r_point=None):
+        '''structured array of the rows of the (selected) points'''
+        with self._open('r') as open_file:
+            data = open_file.get_node('/', DATA_TABLE)
+            index = self._read_index(open_file)
+            if theta_point is not None:
+                index = index[index['tVal'] == theta_point]
+            if r_point is not None:
+                index = index[index['rVal'] == r_point]
+            if len(index) == 1:
+                return data.read(index['start'][0], index['stop'][0])
+            if len(index) == 0:
+                return np.zeros(0, dtype=SCAN_DTYPE)
+            ##one read, then drop rows of replaced or unselected points
+            rows = data.read(index['start'].min(), index['stop'].max())
+            offset = index['start'].min()
+            mask = np.zeros(len(rows), dtype=bool)
+            for start, stop in zip(index['start'], index['stop']):
+                mask[start - offset:stop - offset] = True
+            return rows[mask]
+
+    def read(self, theta_point=None, r_point=None, port=None, channel=None):
+        rows = self.read_array(theta_point=theta_point, r_point=r_point)
+        if port is not None:
+            rows = rows[rows['port'] == port]
+        if channel is not None:
+            rows = rows[rows['channel'] == channel]
+        df = pd.DataFrame(rows)
+        df['pmt'] = df['pmt'].str.decode('utf-8')
+        return df
+
+    def __len__(self):
+        return int(np.sum(self.points().eval('stop - start')))
+
+
+def is_scan_store(filename):
+    if not tables.is_hdf5_file(filename):
+        return False
+    with tables.open_file(filename, 'r') as open_file:
+        return DATA_TABLE in open_file.root and INDEX_TABLE in open_file.root
+
+
+def load_scan(filename):
+    '''
+    DataFrame of a whole scan, from a ScanStore or from a pandas file
+    with the merged total_*.hdf5 files (key 'df')
+    '''
+    if is_scan_store(filename):
+        return ScanStore(filename).read()
+    return pd.read_hdf(filename, 'df')
@@ -61,4 +61,31 @@ class HDR50(BSC201):
 
         self.set_enabled(False)
 
-        return 0
\ No newline at end of file
+        return 0
+
+    def is_moving(self):
+        status = self.status
+        return (status["moving_forward"] or status["moving_reverse"] or
+                status["jogging_forward"] or status["jogging_reverse"] or
+                status["homing"])
+
+    def wait_settled(self, timeout=120, interval=0.05, start_timeout=0.5):
+        # poll the status flags sent by the controller instead of
+        # comparing positions every 2 s like wait_up
+        start = time.time()
+        started = False
+        while True:
+            elapsed = time.time() - start
+            if self.status["motion_error"]:
+                raise RuntimeError("HDR50 reports a motion error")
+            if self.is_moving():
+                started = True
+            elif started or elapsed >= start_timeout:
+                return elapsed
+            if elapsed > timeout:
+                raise TimeoutError("HDR50 still moving after " + str(timeout) + " s")
+            time.sleep(interval)
+
+    def move_relative_and_wait(self, degree, timeout=120):
+        self.move_relative(degree)
+        return self.wait_settled(timeout=timeout)